@@ -0,0 +1,846 @@
+"""
+DisMagicNAS オフラインベンチマーク
+
+Discord / Gemini / Google Drive に接続せず、bot.py のハンドラ
+(on_message, files_list, filename_autocomplete, upload_to_gdrive,
+get_tags_from_gemini, parse_bot_filename) をプロセス内のフェイクに対して実行し、
+スループット・レイテンシのパーセンタイル・ピークメモリを計測する。
+
+使い方:
+    python benchmark.py                       # 全シナリオを実行
+    python benchmark.py --scenario ingest --albums 50 --images-per-album 10
+    python benchmark.py --scenario list --files 100000 --months 60
+    python benchmark.py --gemini-latency 1.5 --drive-latency 0.2 --error-rate 0.05
+    python benchmark.py --json > bench_output.txt
+    python benchmark.py --scenario replay --trace traffic_trace.jsonl --speed 10   # 記録した実トラフィックを10倍速で再生
+"""
+import argparse
+import asyncio
+import io
+import json
+import mimetypes
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from PIL import Image
+
+from gdrive_emulator import DriveEmulator, generate_archive
+
+nasbot = None # bot.py (起動ログを --quiet/--json で抑制できるよう main() で読み込む)
+
+
+def load_bot_module():
+    global nasbot
+    if nasbot is None:
+        import bot
+        nasbot = bot
+    return nasbot
+
+
+# --- レイテンシ・エラー注入 ---
+class FaultProfile:
+    """ 呼び出しごとの遅延 (平均±ジッタ秒、tail_rate の割合で tail_latency 秒を追加) とエラー率を表す。乱数はシード固定で再現可能 """
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, seed: int = 0,
+                 tail_rate: float = 0.0, tail_latency: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _draw(self) -> tuple[float, bool]:
+        with self._lock:
+            delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+            if self.tail_rate and self._rng.random() < self.tail_rate: delay += self.tail_latency
+            fail = self._rng.random() < self.error_rate
+        return delay, fail
+
+    def block(self, label: str):
+        """ 同期呼び出し用 (スレッドまたはイベントループをブロックする実APIの挙動を再現) """
+        delay, fail = self._draw()
+        if delay: time.sleep(delay)
+        if fail: raise RuntimeError(f"injected failure: {label}")
+
+    async def wait(self, label: str):
+        delay, fail = self._draw()
+        if delay: await asyncio.sleep(delay)
+        if fail: raise RuntimeError(f"injected failure: {label}")
+
+
+class CallCounter:
+    def __init__(self):
+        self.counts: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def hit(self, name: str):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self.counts.clear()
+
+
+# --- Gemini フェイク ---
+class FakeUploadedFile:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class FakeGenaiModule:
+    """ bot.genai の代わりに差し込む。upload_file / delete_file は実SDK同様に同期呼び出し。
+        GenerativeModel (予備のモデルの作成) は fallback_profile の遅延で応答するモデルを返す """
+    def __init__(self, profile: FaultProfile, counter: CallCounter, fallback_profile: FaultProfile | None = None):
+        self.profile = profile
+        self.counter = counter
+        self.fallback_profile = fallback_profile or profile
+        self._seq = 0
+
+    def GenerativeModel(self, model_name, **kwargs):
+        return FakeGeminiModel(self.fallback_profile, self.counter, name="gemini_fallback")
+
+    def upload_file(self, path, display_name=None):
+        self.counter.hit("gemini.upload_file")
+        self.profile.block("gemini.upload_file")
+        self._seq += 1
+        return FakeUploadedFile(f"files/bench-{self._seq}")
+
+    def delete_file(self, name):
+        self.counter.hit("gemini.delete_file")
+
+    def list_models(self):
+        return []
+
+
+class FakeGeminiResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeGeminiModel:
+    TAG_POOL = ["風景", "猫", "犬", "空", "海", "山", "夜景", "料理", "花", "人物", "建物", "車", "ゲーム", "イラスト"]
+
+    def __init__(self, profile: FaultProfile, counter: CallCounter, seed: int = 0, name: str = "gemini"):
+        self.profile = profile
+        self.counter = counter
+        self.name = name
+        self._rng = random.Random(seed)
+
+    async def generate_content_async(self, contents, generation_config=None, **kwargs):
+        self.counter.hit(f"{self.name}.generate_content")
+        await self.profile.wait(f"{self.name}.generate_content")
+        if (generation_config or {}).get("response_mime_type") == "application/json":
+            files = [c for c in contents if isinstance(c, FakeUploadedFile)]
+            return FakeGeminiResponse(json.dumps(
+                [{"index": i, "tags": self._rng.sample(self.TAG_POOL, 5)} for i in range(len(files))], ensure_ascii=False))
+        return FakeGeminiResponse(",".join(self._rng.sample(self.TAG_POOL, 5)))
+
+
+# --- Discord フェイク ---
+class FakeRole:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class FakeUser:
+    def __init__(self, user_id: int, name: str, bot: bool = False):
+        self.id = user_id
+        self.name = name
+        self.bot = bot
+        self.mention = f"<@{user_id}>"
+        self.roles = [FakeRole(r) for r in nasbot.ADMIN_ROLE_NAMES]
+
+    def __str__(self):
+        return self.name
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int = 1, filesize_limit: int = 25 * 1024 * 1024):
+        self.id = guild_id
+        self.filesize_limit = filesize_limit
+
+
+class FakeSentMessage:
+    def __init__(self, channel: "FakeChannel", content=None, **kwargs):
+        self.channel = channel
+        self.content = content
+        self.kwargs = kwargs
+        self.edits = 0
+
+    async def edit(self, content=None, **kwargs):
+        self.channel.counter.hit("discord.edit")
+        await self.channel.profile.wait("discord.edit")
+        self.content = content if content is not None else self.content
+        self.edits += 1
+        return self
+
+
+class FakeChannel:
+    def __init__(self, profile: FaultProfile, counter: CallCounter, channel_id: int = 10):
+        self.id = channel_id
+        self.profile = profile
+        self.counter = counter
+        self.sent: list[FakeSentMessage] = []
+
+    async def send(self, content=None, **kwargs):
+        self.counter.hit("discord.send")
+        await self.profile.wait("discord.send")
+        msg = FakeSentMessage(self, content, **kwargs)
+        self.sent.append(msg)
+        return msg
+
+
+class FakeAttachment:
+    def __init__(self, attachment_id: int, filename: str, data: bytes, content_type: str):
+        self.id = attachment_id
+        self.filename = filename
+        self.size = len(data)
+        self.content_type = content_type
+        self._data = data
+
+    async def read(self, *args, **kwargs) -> bytes:
+        return self._data
+
+    async def save(self, fp, *args, **kwargs):
+        with open(fp, "wb") as f:
+            f.write(self._data)
+        return self.size
+
+
+class FakeMessage:
+    def __init__(self, message_id: int, author: FakeUser, channel: FakeChannel, guild: FakeGuild, attachments: list[FakeAttachment]):
+        self.id = message_id
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.attachments = attachments
+        self.content = ""
+        self._state = nasbot.bot._connection # commands.Context が参照する
+
+
+class FakeInteractionResponse:
+    def __init__(self, interaction: "FakeInteraction"):
+        self._interaction = interaction
+        self._done = False
+
+    def is_done(self):
+        return self._done
+
+    async def defer(self, *args, **kwargs):
+        self._done = True
+
+    async def send_message(self, content=None, **kwargs):
+        self._done = True
+        self._interaction.responses.append((content, kwargs))
+
+
+class FakeFollowup:
+    def __init__(self, interaction: "FakeInteraction"):
+        self._interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        self._interaction.responses.append((content, kwargs))
+        return FakeSentMessage(self._interaction.channel, content, **kwargs)
+
+
+class FakeInteraction:
+    _next_id = 1
+
+    def __init__(self, user: FakeUser, channel: FakeChannel, guild: FakeGuild):
+        self.id = FakeInteraction._next_id
+        FakeInteraction._next_id += 1
+        self.user = user
+        self.channel = channel
+        self.guild = guild
+        self.responses: list[tuple] = []
+        self.response = FakeInteractionResponse(self)
+        self.followup = FakeFollowup(self)
+
+
+# --- 計測 ---
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values: return 0.0
+    k = (len(sorted_values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def percentiles_ms(sorted_values: list[float]) -> dict[str, float]:
+    return ({f"p{p}": round(percentile(sorted_values, p) * 1000, 2) for p in (50, 90, 99)}
+            | {"max": round((sorted_values[-1] if sorted_values else 0.0) * 1000, 2)})
+
+
+class BenchResult:
+    def __init__(self, name: str, latencies: list[float], elapsed: float, units: int, unit_name: str, peak_bytes: int, calls: dict[str, int],
+                 queue_delays: list[float] | None = None):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.elapsed = elapsed
+        self.units = units
+        self.unit_name = unit_name
+        self.peak_bytes = peak_bytes
+        self.calls = dict(calls)
+        self.queue_delays = sorted(queue_delays) if queue_delays is not None else None # replay: 処理が始まるまでの待ち時間
+
+    def to_dict(self) -> dict:
+        d = {
+            "scenario": self.name,
+            "operations": len(self.latencies),
+            "elapsed_s": round(self.elapsed, 4),
+            f"{self.unit_name}_per_s": round(self.units / self.elapsed, 2) if self.elapsed else 0.0,
+            "latency_ms": percentiles_ms(self.latencies),
+            "peak_memory_mb": round(self.peak_bytes / (1024 * 1024), 2),
+            "calls": self.calls,
+        }
+        if self.queue_delays is not None:
+            d["queue_delay_ms"] = percentiles_ms(self.queue_delays)
+        return d
+
+    def format(self) -> str:
+        d = self.to_dict()
+        lat = d["latency_ms"]
+        lines = [f"== {self.name} ==",
+                 f"  ops={d['operations']} elapsed={d['elapsed_s']}s {self.unit_name}/s={d[f'{self.unit_name}_per_s']}",
+                 f"  latency ms: p50={lat['p50']} p90={lat['p90']} p99={lat['p99']} max={lat['max']}"]
+        if self.queue_delays is not None:
+            qd = d["queue_delay_ms"]
+            lines.append(f"  queue delay ms: p50={qd['p50']} p90={qd['p90']} p99={qd['p99']} max={qd['max']}")
+        lines.append(f"  peak memory: {d['peak_memory_mb']} MB")
+        if self.calls:
+            lines.append("  calls: " + ", ".join(f"{k}={v}" for k, v in sorted(self.calls.items())))
+        return "\n".join(lines)
+
+
+# --- ハーネス ---
+class BenchHarness:
+    """ bot.py のグローバル状態をフェイクに差し替え、終了時に元へ戻す """
+    def __init__(self, args):
+        self.args = args
+        self.counter = CallCounter()
+        self.gemini_profile = FaultProfile(args.gemini_latency, args.gemini_latency * 0.3, args.error_rate, seed=args.seed)
+        # 応答の遅れ (tail) は生成リクエストにだけ加える (ファイルのアップロードはヘッジできないので対象外)
+        self.gemini_model_profile = self.gemini_profile if not args.gemini_tail_rate else FaultProfile(
+            args.gemini_latency, args.gemini_latency * 0.3, args.error_rate, seed=args.seed + 4,
+            tail_rate=args.gemini_tail_rate, tail_latency=args.gemini_tail_latency)
+        fallback_latency = args.gemini_fallback_latency or 0.0
+        self.gemini_fallback_profile = FaultProfile(fallback_latency, fallback_latency * 0.3, args.error_rate, seed=args.seed + 3)
+        self.drive_profile = FaultProfile(args.drive_latency, args.drive_latency * 0.3, args.error_rate, seed=args.seed + 1)
+        self.discord_profile = FaultProfile(args.discord_latency, args.discord_latency * 0.3, 0.0, seed=args.seed + 2)
+        self.workdir = tempfile.mkdtemp(prefix="nasbench_")
+        self.guild = FakeGuild()
+        self.channel = FakeChannel(self.discord_profile, self.counter)
+        self.user = FakeUser(1000, "bench-user")
+        self.drive = DriveEmulator(on_call=self._on_drive_call, seed=args.seed)
+        self._saved: dict[str, object] = {}
+        self._saved_config: dict = {}
+
+    def _on_drive_call(self, method_id: str):
+        self.counter.hit(method_id)
+        self.drive_profile.block(method_id)
+
+    def __enter__(self):
+        for name in ("genai", "gemini_model_instance", "gdrive_service", "GDRIVE_TARGET_FOLDER_ID",
+                     "GDRIVE_CREATE_YM_FOLDERS", "BASE_UPLOAD_FOLDER", "GEMINI_BATCH_TAGGING", "WRITE_BACK_INGEST",
+                     "google_drive_libs_available", "load_tagging_prompt"):
+            self._saved[name] = getattr(nasbot, name)
+        self._saved_config = dict(nasbot.bot_config)
+        self._saved_user = nasbot.bot._connection.user
+
+        nasbot.genai = FakeGenaiModule(self.gemini_profile, self.counter, self.gemini_fallback_profile)
+        nasbot.gemini_model_instance = FakeGeminiModel(self.gemini_model_profile, self.counter, seed=self.args.seed)
+        nasbot.gdrive_service = self.drive
+        nasbot.google_drive_libs_available = True
+        nasbot.GDRIVE_TARGET_FOLDER_ID = self.drive.root_id
+        nasbot.GDRIVE_CREATE_YM_FOLDERS = True
+        nasbot.BASE_UPLOAD_FOLDER = self.workdir
+        nasbot.GEMINI_BATCH_TAGGING = not self.args.no_batch
+        nasbot.WRITE_BACK_INGEST = self.args.write_back
+        nasbot.bot_config["gemini_fallback_model"] = "bench-fallback" if self.args.gemini_fallback_latency is not None else None
+        nasbot.gemini_hedger.fallback_model() # 予備のモデルを先に作っておく (SDK の型の読み込みを計測に含めない)
+        # 1ユーザー・1チャンネルからの大量投入を計測するので流量の上限は外す (同時受け付け数の上限は本番どおり)
+        for key in ("ingest_user_files_per_minute", "ingest_user_mb_per_minute",
+                    "ingest_channel_files_per_minute", "ingest_channel_mb_per_minute"):
+            nasbot.bot_config[key] = 0
+        prompt = nasbot.DEFAULT_TAGGING_PROMPT_TEXT
+        nasbot.load_tagging_prompt = lambda: prompt # 計測ノイズになるファイル読込とログ出力を避ける
+        nasbot.bot._connection.user = FakeUser(1, "nasbot", bot=True)
+        self._warm_up_image_workers()
+        return self
+
+    def _warm_up_image_workers(self, timeout: float = 60.0):
+        """ 画像処理ワーカーが全プロセス起動し終わるまで待つ (起動時間と起動中の CPU 負荷を計測に含めない) """
+        pids: set[int] = set()
+        deadline = time.monotonic() + timeout
+        while len(pids) < nasbot.IMAGE_WORKER_PROCESSES and time.monotonic() < deadline:
+            pids.update(future.result() for future in nasbot.image_workers.start())
+            time.sleep(0.05)
+
+    def __exit__(self, *exc):
+        for name, value in self._saved.items():
+            setattr(nasbot, name, value)
+        nasbot.bot_config.clear()
+        nasbot.bot_config.update(self._saved_config)
+        nasbot.bot._connection.user = self._saved_user
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def set_destination(self, destination: str):
+        nasbot.bot_config["upload_destination"] = destination
+
+    async def measure(self, name: str, coros_factory, units: int, unit_name: str, concurrency: int) -> BenchResult:
+        """ coros_factory() が返すコルーチン関数のリストを同時実行数 concurrency で実行し計測する """
+        self.counter.reset()
+        jobs = coros_factory()
+        latencies: list[float] = []
+        sem = asyncio.Semaphore(concurrency)
+
+        async def timed(job):
+            async with sem:
+                t0 = time.perf_counter()
+                try:
+                    await job()
+                except nasbot.DependencyUnavailableError: # ブレーカーが開いている・障害とみなした失敗は縮退した結果として数える
+                    self.counter.hit("degraded")
+                latencies.append(time.perf_counter() - t0)
+
+        tracemalloc.start()
+        t_start = time.perf_counter()
+        await asyncio.gather(*(timed(job) for job in jobs))
+        elapsed = time.perf_counter() - t_start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return BenchResult(name, latencies, elapsed, units, unit_name, peak, self.counter.counts)
+
+
+def make_image_bytes(rng: random.Random, size: int = 256) -> bytes:
+    img = Image.new("RGB", (size, size), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    for _ in range(8):
+        x0, y0 = rng.randrange(size), rng.randrange(size)
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        img.paste(color, (x0, y0, min(size, x0 + rng.randrange(16, 96)), min(size, y0 + rng.randrange(16, 96))))
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+# --- シナリオ ---
+async def scenario_ingest(h: BenchHarness, destination: str) -> list[BenchResult]:
+    """ albums 件のメッセージ (各 images_per_album 枚の画像) を同時に on_message へ流す
+        --write-back の場合は on_message が返るまで (受け付け) と、バックグラウンド処理が終わるまでを別々に計測する """
+    args = h.args
+    h.set_destination(destination)
+    rng = random.Random(args.seed)
+
+    def factory():
+        jobs = []
+        attachment_id = 1
+        generated: list[bytes] = []
+        for album in range(args.albums):
+            attachments = []
+            for i in range(args.images_per_album):
+                if generated and rng.random() < args.duplicate_ratio:
+                    data = rng.choice(generated) # 既出画像の再投稿 (知覚ハッシュによるタグ再利用の対象)
+                else:
+                    data = make_image_bytes(rng)
+                    generated.append(data)
+                attachments.append(FakeAttachment(attachment_id, f"album{album:03d}_img{i:02d}.png", data, "image/png"))
+                attachment_id += 1
+            message = FakeMessage(50000 + album, h.user, h.channel, h.guild, attachments)
+            jobs.append(lambda m=message: nasbot.on_message(m))
+        return jobs
+
+    total_images = args.albums * args.images_per_album
+    label = f"{args.albums}x{args.images_per_album} images"
+    if not args.write_back:
+        return [await h.measure(f"ingest[{destination}] {label}", factory, total_images, "images", concurrency=args.albums)]
+    results = [await h.measure(f"ingest-ack[{destination}] {label}", factory, total_images, "images", concurrency=args.albums)]
+    results.append(await h.measure(f"ingest-background[{destination}] {label}",
+                                   lambda: [nasbot.write_back_ingest.drain], total_images, "images", concurrency=1))
+    return results
+
+
+def populate_archive(h: BenchHarness, destination: str, total_files: int, months: int) -> list[str]:
+    """ ベンチ用のアーカイブを生成し、YYYYMM フォルダ名の一覧 (降順) を返す """
+    if destination == "gdrive":
+        info = generate_archive(h.drive, total_files, months, seed=h.args.seed, parent_id=h.drive.root_id)
+        return sorted(info["months"], reverse=True)
+    # ローカルは Drive エミュレータで生成した名前をそのままディスクに写す
+    scratch = DriveEmulator(seed=h.args.seed)
+    info = generate_archive(scratch, total_files, months, seed=h.args.seed)
+    for ym, folder_id in info["months"].items():
+        folder = os.path.join(h.workdir, ym)
+        os.makedirs(folder, exist_ok=True)
+        page_token = None
+        while True:
+            resp = scratch.files().list(q=f"'{folder_id}' in parents", pageSize=1000, pageToken=page_token,
+                                        fields="nextPageToken, files(name)").execute()
+            for item in resp["files"]:
+                with open(os.path.join(folder, item["name"]), "wb") as f:
+                    f.write(b"x")
+            page_token = resp.get("nextPageToken")
+            if not page_token: break
+    return sorted(info["months"], reverse=True)
+
+
+async def scenario_list(h: BenchHarness, destination: str) -> list[BenchResult]:
+    args = h.args
+    h.set_destination(destination)
+    month_names = populate_archive(h, destination, args.files, args.months)
+    latest = month_names[0]
+    results = []
+
+    def repeat(fn):
+        return lambda: [fn for _ in range(args.repeat)]
+
+    async def list_all():
+        await nasbot.files_list.callback(FakeInteraction(h.user, h.channel, h.guild), year_month=None, keyword=None)
+
+    async def list_month():
+        await nasbot.files_list.callback(FakeInteraction(h.user, h.channel, h.guild), year_month=latest, keyword=None)
+
+    async def list_keyword():
+        await nasbot.files_list.callback(FakeInteraction(h.user, h.channel, h.guild), year_month=None, keyword="猫")
+
+    async def autocomplete_empty():
+        await nasbot.filename_autocomplete(FakeInteraction(h.user, h.channel, h.guild), "")
+
+    async def autocomplete_month():
+        await nasbot.filename_autocomplete(FakeInteraction(h.user, h.channel, h.guild), f"{latest}/photo")
+
+    label = f"[{destination}] {args.files} files/{args.months} months"
+    for name, fn in (("files list (all)", list_all), ("files list (year_month)", list_month),
+                     ("files list (keyword)", list_keyword), ("autocomplete ''", autocomplete_empty),
+                     ("autocomplete 'YYYYMM/…'", autocomplete_month)):
+        results.append(await h.measure(f"{name} {label}", repeat(fn), args.repeat, "requests", concurrency=1))
+    return results
+
+
+async def scenario_parse(h: BenchHarness) -> BenchResult:
+    names = [f"2024050{i % 9 + 1}_風景_猫_空_photo{i:06d}.jpg" for i in range(h.args.files)]
+
+    async def run():
+        for name in names:
+            nasbot.parse_bot_filename(name)
+
+    return await h.measure(f"parse_bot_filename x{len(names)}", lambda: [run], len(names), "names", concurrency=1)
+
+
+async def scenario_components(h: BenchHarness) -> list[BenchResult]:
+    """ get_tags_from_gemini と upload_to_gdrive 単体の同時実行性能 """
+    args = h.args
+    rng = random.Random(args.seed)
+    path = os.path.join(h.workdir, "component.png")
+    with open(path, "wb") as f:
+        f.write(make_image_bytes(rng))
+    n = args.albums * args.images_per_album
+
+    def tag_jobs():
+        return [lambda: nasbot.get_tags_from_gemini(path, "component.png", "image/png") for _ in range(n)]
+
+    def upload_jobs():
+        return [lambda i=i: nasbot.upload_to_gdrive(path, f"component_{i}.png", "image/png") for i in range(n)]
+
+    return [await h.measure(f"get_tags_from_gemini x{n}", tag_jobs, n, "calls", concurrency=args.concurrency),
+            await h.measure(f"upload_to_gdrive x{n}", upload_jobs, n, "calls", concurrency=args.concurrency)]
+
+
+async def scenario_drive(h: BenchHarness) -> list[BenchResult]:
+    """ Drive ヘルパー関数単体のクエリ数・走査件数 (エミュレータ上の大規模アーカイブ) """
+    args = h.args
+    months = populate_archive(h, "gdrive", args.files, args.months)
+    latest = months[0]
+    latest_id = (await nasbot.get_gdrive_folder_id_by_name(h.drive.root_id, latest, h.drive))
+    sample = h.drive.files().list(q=f"'{latest_id}' in parents", pageSize=1, fields="files(name)").execute()["files"][0]["name"]
+    results = []
+
+    def repeat(fn):
+        return lambda: [fn for _ in range(args.repeat)]
+
+    cases = (
+        ("list_gdrive_subfolders", lambda: nasbot.list_gdrive_subfolders(h.drive.root_id, h.drive, name_pattern_re=r"^\d{6}$")),
+        ("list_files_in_gdrive_folder (month)", lambda: nasbot.list_files_in_gdrive_folder(latest_id, h.drive)),
+        ("list_files_in_gdrive_folder (keyword)", lambda: nasbot.list_files_in_gdrive_folder(latest_id, h.drive, keyword="猫")),
+        ("get_gdrive_file_id_from_filepath", lambda: nasbot.get_gdrive_file_id_from_filepath(f"{latest}/{sample}", h.drive, h.drive.root_id)),
+    )
+    for name, fn in cases:
+        h.drive.reset_stats()
+        result = await h.measure(f"{name} [{args.files} files/{args.months} months]", repeat(fn), args.repeat, "requests", concurrency=1)
+        result.calls["drive.items_scanned"] = h.drive.snapshot_stats()["items_scanned"]
+        results.append(result)
+    return results
+
+
+def load_trace(path: str) -> list[dict]:
+    """ bot.py の TrafficRecorder が書いたトレース (JSONL) を時刻順のイベント列にする。
+        記録を止めて再開した場合 (header が複数ある) は、前の区間の最後のイベントの後ろにつなげる """
+    events: list[dict] = []
+    offset = last_t = 0.0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip(): continue
+            event = json.loads(line)
+            if event.get("type") == "header":
+                offset = last_t
+                continue
+            event["t"] = offset + float(event.get("t", 0.0))
+            last_t = max(last_t, event["t"])
+            events.append(event)
+    events.sort(key=lambda e: e["t"])
+    return events
+
+
+class TraceReplayer:
+    """ トレースのイベントを記録時の間隔の 1/speed で bot.py のハンドラへ流し、種類ごとに
+        予定時刻からの待ち時間 (queue delay) と完了までの時間 (latency) を集計する """
+    BASE_IMAGE_LIMIT = 2000 # 事前に作っておく画像の種類の上限 (超えた分は使い回す)
+
+    def __init__(self, h: BenchHarness, events: list[dict], speed: float):
+        self.h = h
+        self.events = events
+        self.speed = speed
+        self.rng = random.Random(h.args.seed)
+        self.users: dict[str, FakeUser] = {}
+        self.channels: dict[str, FakeChannel] = {}
+        self.guilds: dict[str, FakeGuild] = {}
+        self.latencies: dict[str, list[float]] = {}
+        self.queue_delays: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.admission_waits: dict[int, float] = {}
+        self._next_id = 900000
+        # 画像の生成は再生中の待ち時間に含めないよう先に済ませる (別々の画像にして知覚ハッシュのタグ再利用を避ける)
+        image_count = sum(1 for e in events for a in self._attachment_specs(e) if (a.get("content_type") or "").startswith("image/"))
+        self.base_images = [make_image_bytes(self.rng, 128) for _ in range(min(image_count, self.BASE_IMAGE_LIMIT))]
+        self._image_index = 0
+
+    @staticmethod
+    def _attachment_specs(event: dict) -> list[dict]:
+        specs = list(event.get("attachments") or [])
+        specs.extend(v["attachment"] for v in (event.get("args") or {}).values() if isinstance(v, dict) and "attachment" in v)
+        return specs
+
+    def _new_id(self) -> int:
+        self._next_id += 1
+        return self._next_id
+
+    def user(self, pseudonym: str | None) -> FakeUser:
+        if pseudonym is None: return self.h.user
+        if pseudonym not in self.users: self.users[pseudonym] = FakeUser(self._new_id(), f"replay-{pseudonym}")
+        return self.users[pseudonym]
+
+    def channel(self, pseudonym: str | None) -> FakeChannel:
+        if pseudonym is None: return self.h.channel
+        if pseudonym not in self.channels:
+            self.channels[pseudonym] = FakeChannel(self.h.discord_profile, self.h.counter, channel_id=self._new_id())
+        return self.channels[pseudonym]
+
+    def guild(self, pseudonym: str | None) -> FakeGuild:
+        if pseudonym is None: return self.h.guild
+        if pseudonym not in self.guilds: self.guilds[pseudonym] = FakeGuild(self._new_id())
+        return self.guilds[pseudonym]
+
+    def attachment(self, spec: dict) -> FakeAttachment:
+        """ 記録されたサイズ・種類の添付を作る。画像は有効な PNG の末尾を埋めてサイズを合わせる """
+        size = max(1, int(spec.get("size") or 1))
+        content_type = spec.get("content_type") or "application/octet-stream"
+        if content_type.startswith("image/") and self.base_images:
+            data = self.base_images[self._image_index % len(self.base_images)]
+            self._image_index += 1
+            data += bytes(max(0, size - len(data)))
+        else:
+            data = bytes(size)
+        attachment_id = self._new_id()
+        ext = spec.get("ext") or mimetypes.guess_extension(content_type) or ""
+        return FakeAttachment(attachment_id, f"replay{attachment_id}{ext}", data, content_type)
+
+    def argument(self, value):
+        """ 匿名化された引数を再生用の値に戻す (文字列は年月の部分 + 同じ長さの埋め草) """
+        if isinstance(value, dict):
+            if "redacted" in value: return value.get("prefix", "") + "x" * int(value["redacted"])
+            if "attachment" in value: return self.attachment(value["attachment"])
+            return None # ユーザー・チャンネルなどの指定は再生しない
+        return value
+
+    @staticmethod
+    def resolve_command(qualified_name: str):
+        names = qualified_name.split()
+        command = nasbot.bot.tree.get_command(names[0]) if names else None
+        for name in names[1:]:
+            command = command.get_command(name) if isinstance(command, nasbot.app_commands.Group) else None
+        return command if isinstance(command, nasbot.app_commands.Command) else None
+
+    async def _timed_admit(self, message, attachment, status):
+        started = time.perf_counter()
+        try:
+            return await self._original_admit(message, attachment, status)
+        finally:
+            self.admission_waits[message.id] = max(self.admission_waits.get(message.id, 0.0), time.perf_counter() - started)
+
+    async def run_message(self, event: dict):
+        message = FakeMessage(self._new_id(), self.user(event.get("user")), self.channel(event.get("channel")),
+                              self.guild(event.get("guild")), [self.attachment(spec) for spec in event.get("attachments") or []])
+        await nasbot.on_message(message)
+        while True: # ライトバック取り込みでは on_message が受け付けだけで返るので、全添付の処理が終わるまで待つ
+            board = nasbot.ingest_status_boards.get(message.id)
+            if board is None or board.finished: break
+            await asyncio.sleep(0.01)
+        return self.admission_waits.pop(message.id, 0.0)
+
+    async def run_interaction(self, event: dict):
+        command = self.resolve_command(event.get("command", ""))
+        if command is None: raise LookupError(f"unknown command: {event.get('command')}")
+        guild = self.guild(event.get("guild"))
+        interaction = FakeInteraction(self.user(event.get("user")), self.channel(event.get("channel")), guild)
+        await nasbot.enter_guild_context(guild)
+        args = event.get("args") or {}
+        if event["type"] == "autocomplete":
+            parameter = command._params.get(event.get("focused") or "") # CommandParameter (変換とオートコンプリートの関数を持つ)
+            if parameter is None or not parameter.autocomplete: raise LookupError(f"no autocomplete: {event.get('command')}")
+            await parameter.autocomplete(interaction, self.argument(args.get(parameter.name)) or "")
+            return 0.0
+        kwargs = {}
+        for name, value in args.items():
+            parameter = command._params.get(name)
+            if parameter is None: continue
+            kwargs[name] = await parameter.transform(interaction, self.argument(value))
+        await command.callback(interaction, **kwargs)
+        return 0.0
+
+    async def run_event(self, event: dict, due: float):
+        loop = asyncio.get_running_loop()
+        dispatch_lag = loop.time() - due
+        key = "message" if event["type"] == "message" else f"{event['type']} /{event.get('command', '?')}"
+        try:
+            if event["type"] == "message": waited = await self.run_message(event)
+            else: waited = await self.run_interaction(event)
+        except Exception as e:
+            if key not in self.errors: print(f"replay: {key} failed: {e!r}", file=sys.stderr)
+            self.errors[key] = self.errors.get(key, 0) + 1
+            return
+        self.latencies.setdefault(key, []).append(loop.time() - due)
+        self.queue_delays.setdefault(key, []).append(dispatch_lag + waited)
+
+    async def run(self) -> float:
+        loop = asyncio.get_running_loop()
+        self._original_admit = nasbot.ingest_admission.admit
+        nasbot.ingest_admission.admit = self._timed_admit # 受け付け制御での待ち時間も queue delay に含める
+        try:
+            started = loop.time()
+            tasks = []
+            for event in self.events:
+                due = started + event["t"] / self.speed
+                if due > loop.time(): await asyncio.sleep(due - loop.time())
+                tasks.append(asyncio.create_task(self.run_event(event, due)))
+            await asyncio.gather(*tasks)
+            return loop.time() - started
+        finally:
+            del nasbot.ingest_admission.admit
+
+
+async def scenario_replay(h: BenchHarness, destination: str) -> list[BenchResult]:
+    """ 記録した実トラフィックを --speed 倍速で再生する。コマンドの対象として --files/--months のアーカイブを先に作る """
+    args = h.args
+    if not args.trace:
+        raise SystemExit("--scenario replay には --trace でトレースファイルを指定してください")
+    if args.speed <= 0:
+        raise SystemExit("--speed は正の値を指定してください")
+    h.set_destination(destination)
+    populate_archive(h, destination, args.files, args.months)
+    replayer = TraceReplayer(h, load_trace(args.trace), args.speed)
+    h.counter.reset()
+    tracemalloc.start()
+    elapsed = await replayer.run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    label = f"replay[{destination}] x{args.speed:g}"
+    results = [BenchResult(f"{label} all events", [v for vs in replayer.latencies.values() for v in vs], elapsed,
+                           len(replayer.events), "events", peak, h.counter.counts | {"errors": sum(replayer.errors.values())},
+                           queue_delays=[v for vs in replayer.queue_delays.values() for v in vs])]
+    for key in sorted(replayer.latencies.keys() | replayer.errors.keys()):
+        latencies = replayer.latencies.get(key, [])
+        results.append(BenchResult(f"{label} {key}", latencies, elapsed, len(latencies), "events", peak,
+                                   {"errors": replayer.errors.get(key, 0)}, queue_delays=replayer.queue_delays.get(key, [])))
+    return results
+
+
+SCENARIOS = ("ingest", "list", "drive", "parse", "components")
+
+
+async def run_benchmarks(args) -> list[BenchResult]:
+    results: list[BenchResult] = []
+    destinations = ["local", "gdrive"] if args.destination == "both" else [args.destination]
+    for scenario in (SCENARIOS if args.scenario == "all" else [args.scenario]): # replay はトレースが要るので all に含めない
+        for destination in destinations if scenario in ("ingest", "list", "replay") else [None]:
+            with BenchHarness(args) as h:
+                if scenario == "ingest":
+                    results.extend(await scenario_ingest(h, destination))
+                elif scenario == "list":
+                    results.extend(await scenario_list(h, destination))
+                elif scenario == "drive":
+                    results.extend(await scenario_drive(h))
+                elif scenario == "parse":
+                    results.append(await scenario_parse(h))
+                elif scenario == "components":
+                    results.extend(await scenario_components(h))
+                elif scenario == "replay":
+                    results.extend(await scenario_replay(h, destination))
+    return results
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description="DisMagicNAS オフラインベンチマーク")
+    p.add_argument("--scenario", choices=("all",) + SCENARIOS + ("replay",), default="all")
+    p.add_argument("--destination", choices=("local", "gdrive", "both"), default="both")
+    p.add_argument("--albums", type=int, default=50, help="ingest: 同時に投稿されるメッセージ数")
+    p.add_argument("--images-per-album", type=int, default=10, help="ingest: 1メッセージあたりの画像数")
+    p.add_argument("--files", type=int, default=10000, help="list/drive/parse: アーカイブのファイル数")
+    p.add_argument("--months", type=int, default=60, help="list/drive: 年月フォルダ数")
+    p.add_argument("--repeat", type=int, default=5, help="list/drive: 各リクエストの繰り返し回数")
+    p.add_argument("--concurrency", type=int, default=16, help="components: 同時実行数")
+    p.add_argument("--gemini-latency", type=float, default=0.05, help="Gemini 呼び出しの平均遅延 (秒)")
+    p.add_argument("--gemini-tail-rate", type=float, default=0.0, help="Gemini 呼び出しのうち遅延が tail-latency 秒延びる割合 (0-1)")
+    p.add_argument("--gemini-tail-latency", type=float, default=0.0, help="遅い Gemini 呼び出しに追加する遅延 (秒)")
+    p.add_argument("--gemini-fallback-latency", type=float, default=None,
+                   help="予備のモデルの平均遅延 (秒)。指定すると応答の遅い呼び出しを予備のモデルにもヘッジする")
+    p.add_argument("--drive-latency", type=float, default=0.005, help="Drive API 呼び出しの平均遅延 (秒)")
+    p.add_argument("--discord-latency", type=float, default=0.0, help="Discord 送信・編集の平均遅延 (秒)")
+    p.add_argument("--error-rate", type=float, default=0.0, help="Gemini/Drive 呼び出しのエラー注入率 (0-1)")
+    p.add_argument("--duplicate-ratio", type=float, default=0.0, help="ingest: 既出画像を再投稿する割合 (0-1)")
+    p.add_argument("--no-batch", action="store_true", help="Gemini のバッチタグ付けを無効にして計測する")
+    p.add_argument("--write-back", action="store_true", help="ライトバック取り込み (受け付け後にバックグラウンド処理) で計測する")
+    p.add_argument("--trace", help="replay: bot.py で記録したトレース (traffic_trace.jsonl)")
+    p.add_argument("--speed", type=float, default=1.0, help="replay: 再生速度の倍率 (1, 10, 100 など)")
+    p.add_argument("--seed", type=int, default=1234)
+    p.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+    p.add_argument("--quiet", action="store_true", help="bot.py のログ出力を抑制する")
+    return p
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    real_stdout = sys.stdout
+    if args.quiet or args.json:
+        sys.stdout = open(os.devnull, "w", encoding="utf-8")
+    try:
+        load_bot_module()
+        results = asyncio.run(run_benchmarks(args))
+    finally:
+        if sys.stdout is not real_stdout:
+            sys.stdout.close()
+            sys.stdout = real_stdout
+    if args.json:
+        print(json.dumps([r.to_dict() for r in results], ensure_ascii=False, indent=2))
+    else:
+        for r in results:
+            print(r.format())
+
+
+if __name__ == "__main__":
+    main()
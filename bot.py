@@ -7,29 +7,83 @@ import asyncio # asyncio をインポート
 import json
 import asyncio
 import sys
+import time
+import shutil
+import stat
+import hashlib
+import abc
+import zipfile
+import mimetypes
+import math
+import heapq
+import unicodedata
+import contextvars
+import collections
+import multiprocessing
+import threading
+import concurrent.futures
+import warnings
+import importlib
+import importlib.util
 from dotenv import load_dotenv
-import google.generativeai as genai
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
-from PIL import Image
 from discord import app_commands
 import io # GDriveからダウンロードする際に使用
 
 
 if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-    
-# Google Drive API 関連のインポート
+
+class LazyImport:
+    """ 最初に使われたときにモジュール (またはその属性) を読み込む。
+        google.generativeai などの重いライブラリを起動時に読み込まないので、BOT とワーカープロセスの起動が速くなる """
+    def __init__(self, module_name: str, attribute: str | None = None, on_load=None):
+        self._module_name = module_name
+        self._attribute = attribute
+        self._on_load = on_load
+        self._target = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._target is None:
+            with self._lock: # バックグラウンドの準備処理と同時に使われても1回だけ読み込む
+                if self._target is None:
+                    target = importlib.import_module(self._module_name)
+                    if self._attribute: target = getattr(target, self._attribute)
+                    if self._on_load: self._on_load(target)
+                    self._target = target
+        return self._target
+
+    def __getattr__(self, name):
+        if name.startswith("_"): raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+genai = LazyImport("google.generativeai")
+HarmCategory = LazyImport("google.generativeai.types", "HarmCategory")
+HarmBlockThreshold = LazyImport("google.generativeai.types", "HarmBlockThreshold")
+# 展開爆弾の上限はサムネイル・ギャラリーなど他の Pillow 処理でも有効にする (IMAGE_MAX_PIXELS は設定の読み込み後に決まる)
+Image = LazyImport("PIL.Image", on_load=lambda module: setattr(module, "MAX_IMAGE_PIXELS", IMAGE_MAX_PIXELS))
+ImageOps = LazyImport("PIL.ImageOps")
+ImageDraw = LazyImport("PIL.ImageDraw")
+ImageFont = LazyImport("PIL.ImageFont")
+
+# Google Drive API 関連 (有無だけを確認し、読み込みは最初に使うときに行う)
 try:
-    from google.oauth2 import service_account
-    from googleapiclient.discovery import build
-    from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload # MediaIoBaseDownload を追加
-    google_drive_libs_available = True
-except ImportError:
+    google_drive_libs_available = all(importlib.util.find_spec(name) is not None for name in ("google.oauth2", "googleapiclient"))
+except ModuleNotFoundError:
     google_drive_libs_available = False
+if not google_drive_libs_available:
     print("警告: Google Drive関連のライブラリが見つかりません。`pip install google-api-python-client google-auth-httplib2 google-auth` を実行してください。")
+service_account = LazyImport("google.oauth2.service_account")
+build = LazyImport("googleapiclient.discovery", "build")
+MediaFileUpload = LazyImport("googleapiclient.http", "MediaFileUpload")
+MediaIoBaseDownload = LazyImport("googleapiclient.http", "MediaIoBaseDownload")
 
 # --- 設定ファイル名 ---
 CONFIG_FILE_NAME = "config.json"
+COMMAND_SYNC_STATE_FILE_NAME = "command_sync_state.json" # 最後に同期したスラッシュコマンド定義のハッシュ
 
 # --- デフォルト設定 ---
 DEFAULT_CONFIG = {
@@ -37,10 +91,75 @@ DEFAULT_CONFIG = {
     "default_gemini_model": "gemini-1.5-flash-latest",
     "tagging_prompt_file": "Tagging_prompt.txt",
     "base_upload_folder": "uploads",
-    "upload_destination": "local",   # "local" or "gdrive"
+    "upload_destination": "local",   # "local", "gdrive" or "tiered" (ローカルに保存し、古いファイルを Drive へ移動)
     "gdrive_service_account_key_path": "service-account-key.json",
     "gdrive_target_folder_id": None,
-    "gdrive_create_ym_folders": True
+    "gdrive_create_ym_folders": True,
+    "gemini_batch_tagging": True,         # 複数画像を1回のGemini呼び出しでまとめてタグ付けする
+    "gemini_batch_max_images": 8,         # 1バッチあたりの最大画像数
+    "gemini_batch_window_seconds": 1.0,   # 処理中のバッチがあるとき、この秒数内に届いた画像を同じバッチにまとめる (待ちがなければすぐ送る)
+    "phash_index_file": "phash_index.jsonl",  # 知覚ハッシュ索引 (base_upload_folder 内に保存)
+    "phash_duplicate_threshold": 6,       # この距離以下の画像は重複とみなし、タグを再利用する
+    "tag_cache_file": "tag_cache.jsonl",  # タグ付け結果のキャッシュ (base_upload_folder 内に保存)
+    "tag_cache_max_entries": 50000,       # キャッシュする件数の上限 (超えたら使われていないものから捨てる、0: キャッシュしない)
+    "phash_similar_threshold": 12,        # /files similar の既定の検索距離
+    "thumbnail_folder_name": "thumbnails",  # サムネイル保存先 (base_upload_folder 内)
+    "thumbnail_max_size": 320,            # サムネイルの長辺 (px)
+    "thumbnail_quality": 70,              # WebP 品質
+    "ffmpeg_path": None,                  # 動画ポスターフレーム用。未指定なら PATH 上の ffmpeg を使う
+    "gallery_columns": 5,                 # /files gallery の1行あたりのタイル数
+    "gallery_tile_size": 200,             # タイルの一辺 (px)
+    "gallery_max_tiles_per_sheet": 50,    # 1枚のコンタクトシートに載せる最大ファイル数
+    "gallery_font_path": None,            # ラベル用フォント (日本語対応)。未指定なら一般的な場所から探す
+    "tiered_migrate_after_days": 30,      # tiered: この日数より古いローカルファイルを Drive へ移動する
+    "tiered_disk_usage_high_percent": 85, # tiered: ディスク使用率がこれを超えたら古い順に Drive へ移動する
+    "tiered_disk_usage_low_percent": 75,  # tiered: 使用率超過時はこの値を下回るまで移動する
+    "tiered_mover_interval_minutes": 30,  # tiered: 移動処理の実行間隔
+    "write_back_ingest": False,           # True: 添付を受け付けたらすぐ返信し、タグ付け・保存はバックグラウンドで行う
+    "write_back_workers": 16,             # バックグラウンド処理の同時実行数 (Geminiのバッチが埋まるようにバッチ上限より多めに)
+    "write_back_max_retries": 5,          # 失敗時の再試行回数
+    "write_back_retry_base_seconds": 10,  # 再試行までの待ち時間 (回数ごとに倍になる)
+    "ingest_journal_file": "ingest_journal.jsonl",  # 未完了ジョブのジャーナル (base_upload_folder 内に保存)
+    "retag_concurrency": 4,               # /files retag の同時処理数
+    "retag_rate_per_minute": 60,          # /files retag で1分間に処理するファイル数の上限
+    "retag_state_file": "retag_job.json", # /files retag の進捗 (チェックポイント) (base_upload_folder 内に保存)
+    "search_index_file": "search_index.jsonl", # /files search の全文検索索引 (base_upload_folder 内に保存)
+    "gdrive_shards": [],                  # 追加の Drive 保存先 [{"name": "shard2", "service_account_key_path": "...", "folder_id": "..."}]
+    "gdrive_placement_policy": "round_robin", # 新規ファイルの保存先シャードの決め方: "round_robin", "least_used" or "hash"
+    "per_guild_storage": False,           # True: サーバーごとに保存先 (base_upload_folder/guilds/<サーバーID>、Drive は guild_<サーバーID> フォルダ) を分ける
+    "guild_settings": {},                 # サーバーごとの上書き設定 {"<サーバーID>": {"upload_destination": ..., "base_upload_folder": ..., "gdrive_target_folder_id": ..., "guild_ingest_concurrency": ...}}
+    "guild_ingest_concurrency": 16,       # 1サーバーあたりの取り込みの同時実行数 (混雑したサーバーが他のサーバーの取り込みを止めないように)
+    "gateway_auto_sharded": False,        # True: AutoShardedBot でゲートウェイ接続をシャードに分ける (多数のサーバーに参加する場合)
+    "gateway_shard_count": None,          # シャード数。未指定なら Discord の推奨値
+    "ingest_worker_processes": 0,         # 取り込みの重い処理を任せるワーカープロセス数 (0: BOTと同じプロセス, "auto": CPUコア数)。1以上ではライトバック取り込みになる
+    "ingest_worker_concurrency": 8,       # ワーカープロセス1つあたりの同時処理数 (Gemini のバッチが埋まるように)
+    "ingest_worker_timeout_seconds": 600, # ワーカープロセスへの1要求の待ち時間の上限 (超えたらジョブを再試行する)
+    "image_worker_processes": 2,          # 画像処理 (検証・ハッシュ・サムネイル) のプロセス数 (0: BOTのプロセス内のスレッドで実行)
+    "image_worker_timeout_seconds": 30,   # 画像1件の処理の上限秒数 (超えたらワーカーを作り直す)
+    "image_worker_max_tasks_per_child": 200, # この件数を処理したワーカープロセスは入れ替える
+    "image_max_bytes": 100 * 1024 * 1024, # 画像処理を行うファイルサイズの上限
+    "image_max_pixels": 64_000_000,       # これを超える画素数の画像は展開爆弾とみなして処理しない
+    "local_fs_threads": 8,                # ローカル保存先のファイル操作を行うスレッド数 (遅い NAS ではI/O待ちが重なるので多めに)
+    "ingest_user_files_per_minute": 30,   # 1ユーザーが1分間に取り込めるファイル数 (0: 無制限。サーバーごとに上書き可)
+    "ingest_user_mb_per_minute": 1024,    # 1ユーザーが1分間に取り込めるサイズ (MB)
+    "ingest_channel_files_per_minute": 120, # 1チャンネルで1分間に取り込めるファイル数
+    "ingest_channel_mb_per_minute": 4096, # 1チャンネルで1分間に取り込めるサイズ (MB)
+    "ingest_quota_max_wait_seconds": 120, # 上限を超えた添付はこの秒数までなら待って処理し、それ以上なら断る
+    "ingest_max_queue_depth": 64,         # BOT全体で同時に受け付ける (処理中・ライトバック待ちの) 添付の数 (0: 無制限)
+    "ingest_max_waiting": 500,            # 同時受け付け数が上限のときに順番待ちにできる添付の数。超えたら断る
+    "ingest_status_edit_interval_seconds": 3, # 取り込み状況メッセージ (投稿ごとに1つ) を編集する最短の間隔
+    "autocomplete_listing_ttl_seconds": 300, # オートコンプリート用の年月フォルダのファイル一覧をキャッシュする秒数
+    "autocomplete_prefetch_recent_months": 3, # 新しい方からこの数の年月フォルダの一覧を常にキャッシュしておく
+    "circuit_breaker_failure_threshold": 5, # Drive / Gemini の呼び出しがこの回数続けて失敗したら一時的に呼び出しを止める
+    "circuit_breaker_open_seconds": 60,   # 呼び出しを止める秒数 (過ぎたら1回だけ試し、成功すれば再開する)
+    "gemini_timeout_seconds": 60,         # Gemini のタグ生成1回の待ち時間の上限
+    "gemini_fallback_model": None,        # 応答が遅いときに同じリクエストを送る予備のモデル (None: ヘッジしない)
+    "gemini_hedge_percentile": 90,        # 主モデルの直近の応答時間のこのパーセンタイルを過ぎたら予備のモデルにも送る
+    "gemini_hedge_initial_delay_seconds": 10, # 応答時間の記録が少ない間の締め切り
+    "degraded_queue_file": "degraded_queue.json", # 障害中に後回しにした Drive へのアップロード・タグ付けの一覧 (base_upload_folder 内に保存)
+    "degraded_drain_interval_seconds": 30, # 後回しにした処理を再開できるか確認する間隔
+    "traffic_recording": False,           # 投稿・コマンドの匿名化したトレースを記録する (benchmark.py --scenario replay で再生)
+    "traffic_trace_file": "traffic_trace.jsonl" # トレースの保存先 (base_upload_folder 内)
 }
 
 # --- 設定読み込み関数 ---
@@ -90,6 +209,73 @@ GDRIVE_SERVICE_ACCOUNT_KEY_PATH = bot_config.get("gdrive_service_account_key_pat
 GDRIVE_TARGET_FOLDER_ID = bot_config.get("gdrive_target_folder_id")
 GDRIVE_CREATE_YM_FOLDERS = bot_config.get("gdrive_create_ym_folders", DEFAULT_CONFIG["gdrive_create_ym_folders"])
 
+GEMINI_BATCH_TAGGING = bot_config.get("gemini_batch_tagging", DEFAULT_CONFIG["gemini_batch_tagging"])
+GEMINI_BATCH_MAX_IMAGES = bot_config.get("gemini_batch_max_images", DEFAULT_CONFIG["gemini_batch_max_images"])
+GEMINI_BATCH_WINDOW_SECONDS = bot_config.get("gemini_batch_window_seconds", DEFAULT_CONFIG["gemini_batch_window_seconds"])
+
+PHASH_INDEX_FILE = bot_config.get("phash_index_file", DEFAULT_CONFIG["phash_index_file"])
+TAG_CACHE_FILE = bot_config.get("tag_cache_file", DEFAULT_CONFIG["tag_cache_file"])
+TAG_CACHE_MAX_ENTRIES = bot_config.get("tag_cache_max_entries", DEFAULT_CONFIG["tag_cache_max_entries"])
+PHASH_DUPLICATE_THRESHOLD = bot_config.get("phash_duplicate_threshold", DEFAULT_CONFIG["phash_duplicate_threshold"])
+PHASH_SIMILAR_THRESHOLD = bot_config.get("phash_similar_threshold", DEFAULT_CONFIG["phash_similar_threshold"])
+
+THUMBNAIL_FOLDER_NAME = bot_config.get("thumbnail_folder_name", DEFAULT_CONFIG["thumbnail_folder_name"])
+THUMBNAIL_MAX_SIZE = bot_config.get("thumbnail_max_size", DEFAULT_CONFIG["thumbnail_max_size"])
+THUMBNAIL_QUALITY = bot_config.get("thumbnail_quality", DEFAULT_CONFIG["thumbnail_quality"])
+FFMPEG_PATH = bot_config.get("ffmpeg_path") or shutil.which("ffmpeg")
+
+GALLERY_COLUMNS = bot_config.get("gallery_columns", DEFAULT_CONFIG["gallery_columns"])
+GALLERY_TILE_SIZE = bot_config.get("gallery_tile_size", DEFAULT_CONFIG["gallery_tile_size"])
+GALLERY_MAX_TILES_PER_SHEET = bot_config.get("gallery_max_tiles_per_sheet", DEFAULT_CONFIG["gallery_max_tiles_per_sheet"])
+GALLERY_FONT_PATH = bot_config.get("gallery_font_path")
+
+TIERED_MIGRATE_AFTER_DAYS = bot_config.get("tiered_migrate_after_days", DEFAULT_CONFIG["tiered_migrate_after_days"])
+TIERED_DISK_USAGE_HIGH_PERCENT = bot_config.get("tiered_disk_usage_high_percent", DEFAULT_CONFIG["tiered_disk_usage_high_percent"])
+TIERED_DISK_USAGE_LOW_PERCENT = bot_config.get("tiered_disk_usage_low_percent", DEFAULT_CONFIG["tiered_disk_usage_low_percent"])
+TIERED_MOVER_INTERVAL_MINUTES = bot_config.get("tiered_mover_interval_minutes", DEFAULT_CONFIG["tiered_mover_interval_minutes"])
+
+WRITE_BACK_INGEST = bot_config.get("write_back_ingest", DEFAULT_CONFIG["write_back_ingest"])
+WRITE_BACK_WORKERS = bot_config.get("write_back_workers", DEFAULT_CONFIG["write_back_workers"])
+WRITE_BACK_MAX_RETRIES = bot_config.get("write_back_max_retries", DEFAULT_CONFIG["write_back_max_retries"])
+WRITE_BACK_RETRY_BASE_SECONDS = bot_config.get("write_back_retry_base_seconds", DEFAULT_CONFIG["write_back_retry_base_seconds"])
+INGEST_JOURNAL_FILE = bot_config.get("ingest_journal_file", DEFAULT_CONFIG["ingest_journal_file"])
+
+RETAG_CONCURRENCY = bot_config.get("retag_concurrency", DEFAULT_CONFIG["retag_concurrency"])
+RETAG_RATE_PER_MINUTE = bot_config.get("retag_rate_per_minute", DEFAULT_CONFIG["retag_rate_per_minute"])
+RETAG_STATE_FILE = bot_config.get("retag_state_file", DEFAULT_CONFIG["retag_state_file"])
+
+SEARCH_INDEX_FILE = bot_config.get("search_index_file", DEFAULT_CONFIG["search_index_file"])
+
+GDRIVE_SHARDS_CONFIG = bot_config.get("gdrive_shards", DEFAULT_CONFIG["gdrive_shards"])
+GDRIVE_PLACEMENT_POLICY = bot_config.get("gdrive_placement_policy", DEFAULT_CONFIG["gdrive_placement_policy"])
+
+PER_GUILD_STORAGE = bot_config.get("per_guild_storage", DEFAULT_CONFIG["per_guild_storage"])
+
+GATEWAY_AUTO_SHARDED = bot_config.get("gateway_auto_sharded", DEFAULT_CONFIG["gateway_auto_sharded"])
+GATEWAY_SHARD_COUNT = bot_config.get("gateway_shard_count", DEFAULT_CONFIG["gateway_shard_count"])
+INGEST_WORKER_PROCESSES = bot_config.get("ingest_worker_processes", DEFAULT_CONFIG["ingest_worker_processes"])
+INGEST_WORKER_PROCESSES = (os.cpu_count() or 1) if INGEST_WORKER_PROCESSES == "auto" else int(INGEST_WORKER_PROCESSES or 0)
+INGEST_WORKER_CONCURRENCY = bot_config.get("ingest_worker_concurrency", DEFAULT_CONFIG["ingest_worker_concurrency"])
+INGEST_WORKER_TIMEOUT_SECONDS = bot_config.get("ingest_worker_timeout_seconds", DEFAULT_CONFIG["ingest_worker_timeout_seconds"])
+
+IMAGE_WORKER_PROCESSES = bot_config.get("image_worker_processes", DEFAULT_CONFIG["image_worker_processes"])
+IMAGE_WORKER_TIMEOUT_SECONDS = bot_config.get("image_worker_timeout_seconds", DEFAULT_CONFIG["image_worker_timeout_seconds"])
+IMAGE_WORKER_MAX_TASKS_PER_CHILD = bot_config.get("image_worker_max_tasks_per_child", DEFAULT_CONFIG["image_worker_max_tasks_per_child"])
+IMAGE_MAX_BYTES = bot_config.get("image_max_bytes", DEFAULT_CONFIG["image_max_bytes"])
+IMAGE_MAX_PIXELS = bot_config.get("image_max_pixels", DEFAULT_CONFIG["image_max_pixels"])
+LOCAL_FS_THREADS = bot_config.get("local_fs_threads", DEFAULT_CONFIG["local_fs_threads"])
+INGEST_STATUS_EDIT_INTERVAL_SECONDS = bot_config.get("ingest_status_edit_interval_seconds", DEFAULT_CONFIG["ingest_status_edit_interval_seconds"])
+AUTOCOMPLETE_LISTING_TTL_SECONDS = bot_config.get("autocomplete_listing_ttl_seconds", DEFAULT_CONFIG["autocomplete_listing_ttl_seconds"])
+AUTOCOMPLETE_PREFETCH_RECENT_MONTHS = bot_config.get("autocomplete_prefetch_recent_months", DEFAULT_CONFIG["autocomplete_prefetch_recent_months"])
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = bot_config.get("circuit_breaker_failure_threshold", DEFAULT_CONFIG["circuit_breaker_failure_threshold"])
+CIRCUIT_BREAKER_OPEN_SECONDS = bot_config.get("circuit_breaker_open_seconds", DEFAULT_CONFIG["circuit_breaker_open_seconds"])
+GEMINI_TIMEOUT_SECONDS = bot_config.get("gemini_timeout_seconds", DEFAULT_CONFIG["gemini_timeout_seconds"])
+GEMINI_HEDGE_PERCENTILE = bot_config.get("gemini_hedge_percentile", DEFAULT_CONFIG["gemini_hedge_percentile"])
+GEMINI_HEDGE_INITIAL_DELAY_SECONDS = bot_config.get("gemini_hedge_initial_delay_seconds", DEFAULT_CONFIG["gemini_hedge_initial_delay_seconds"])
+DEGRADED_QUEUE_FILE = bot_config.get("degraded_queue_file", DEFAULT_CONFIG["degraded_queue_file"])
+DEGRADED_DRAIN_INTERVAL_SECONDS = bot_config.get("degraded_drain_interval_seconds", DEFAULT_CONFIG["degraded_drain_interval_seconds"])
+TRAFFIC_TRACE_FILE = bot_config.get("traffic_trace_file", DEFAULT_CONFIG["traffic_trace_file"])
+
 DEFAULT_TAGGING_PROMPT_TEXT = (
     "このファイルの内容を詳細に分析し、関連性の高いキーワードを5つ提案してください。"
     "各キーワードは簡潔な日本語で、ハイフン(-)で連結可能な形式でお願いします。"
@@ -115,20 +301,32 @@ gemini_model_instance = None
 current_gemini_model = DEFAULT_GEMINI_MODEL
 gdrive_service = None
 
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
+def create_gemini_model(model_name: str):
+    return genai.GenerativeModel(
+        model_name,
+        safety_settings={ HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+                         HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+                         HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+                         HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,})
+
+def initialize_gemini():
+    """ Gemini クライアントを初期化する (google.generativeai の読み込みを含むので、起動時はバックグラウンドのスレッドで呼ぶ) """
+    global gemini_model_instance
+    if not GEMINI_API_KEY:
+        print("情報: GEMINI_API_KEYが設定されていません。Gemini API関連の機能は利用できません。")
+        return
     try:
-        gemini_model_instance = genai.GenerativeModel(
-            current_gemini_model,
-            safety_settings={ HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-                             HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-                             HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-                             HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,})
+        genai.configure(api_key=GEMINI_API_KEY)
+        gemini_model_instance = create_gemini_model(current_gemini_model)
         print(f"Geminiモデル '{current_gemini_model}' の初期化に成功しました。")
     except Exception as e:
         print(f"エラー: デフォルトのGeminiモデル '{current_gemini_model}' の初期化に失敗しました: {e}")
         gemini_model_instance = None
-else: print("情報: GEMINI_API_KEYが設定されていません。Gemini API関連の機能は利用できません。")
+
+def build_gdrive_service_from_key(creds_path: str):
+    scopes = ['https://www.googleapis.com/auth/drive']
+    creds = service_account.Credentials.from_service_account_file(creds_path, scopes=scopes)
+    return build('drive', 'v3', credentials=creds, cache_discovery=False)
 
 def initialize_gdrive_service():
     global gdrive_service, google_drive_libs_available
@@ -136,6 +334,7 @@ def initialize_gdrive_service():
         gdrive_service = None
         print("Google Drive機能はライブラリが不足しているため無効です。")
         return
+    initialize_gdrive_shards() # 追加のシャード (設定されていれば)
 
     creds_path = GDRIVE_SERVICE_ACCOUNT_KEY_PATH
     if not creds_path or not os.path.exists(creds_path):
@@ -143,9 +342,7 @@ def initialize_gdrive_service():
         gdrive_service = None
         return
     try:
-        scopes = ['https://www.googleapis.com/auth/drive']
-        creds = service_account.Credentials.from_service_account_file(creds_path, scopes=scopes)
-        gdrive_service = build('drive', 'v3', credentials=creds, cache_discovery=False)
+        gdrive_service = build_gdrive_service_from_key(creds_path)
         print("Google Driveサービスが正常に初期化されました。")
     except Exception as e:
         print(f"Google Driveサービスの初期化に失敗しました: {e}")
@@ -154,7 +351,10 @@ def initialize_gdrive_service():
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True # メンバーインテントの追加
-bot = commands.Bot(command_prefix='/', intents=intents)
+if GATEWAY_AUTO_SHARDED: # ゲートウェイ接続を複数のシャードに分けて受け持つ
+    bot = commands.AutoShardedBot(command_prefix='/', intents=intents, shard_count=GATEWAY_SHARD_COUNT)
+else:
+    bot = commands.Bot(command_prefix='/', intents=intents)
 
 # --- ヘルパー関数 ---
 def sanitize_filename_component(text): return re.sub(r'[\\/*?:"<>|\s]', '_', text)
@@ -164,12 +364,11 @@ def get_file_icon(extension): # 現在未使用
     elif ext in ['.mp4', '.mov', '.avi', '.mkv', '.webm']: return "🎬"
     elif ext in ['.txt', '.md', '.doc', '.pdf']: return "📄"
     else: return "📁"
-def create_year_month_folder_if_not_exists(base_folder_from_config):
+async def create_year_month_folder_if_not_exists(base_folder_from_config):
     now = datetime.datetime.now()
     year_month_folder_name = now.strftime("%Y%m")
     year_month_folder_path = os.path.join(base_folder_from_config, year_month_folder_name)
-    if not os.path.exists(year_month_folder_path):
-        os.makedirs(year_month_folder_path)
+    if await local_storage.makedirs(year_month_folder_path):
         print(f"ローカル年月フォルダ '{year_month_folder_path}' を作成しました。")
     return year_month_folder_path
 def parse_bot_filename(filename_str: str) -> dict:
@@ -217,7 +416,7 @@ def save_bot_config(new_settings: dict):
         should_reinitialize_gdrive = path_changed
         if "gdrive_target_folder_id" in new_settings and new_settings["gdrive_target_folder_id"]:
             should_reinitialize_gdrive = True
-        if "upload_destination" in new_settings and new_settings["upload_destination"] == "gdrive":
+        if "upload_destination" in new_settings and new_settings["upload_destination"] in ("gdrive", "tiered"):
              # GDrive宛に変更されたが、サービスがまだ初期化されていない場合も初期化
             if not gdrive_service and GDRIVE_TARGET_FOLDER_ID and GDRIVE_SERVICE_ACCOUNT_KEY_PATH:
                  should_reinitialize_gdrive = True
@@ -264,13 +463,93 @@ def extract_gdrive_folder_id_from_string(input_string: str) -> str:
     return input_string.strip()
 
 # --- Google Drive API 用ヘルパー関数 ---
-async def execute_gdrive_api_call(func, *args, **kwargs):
-    """ Google Drive APIの同期的な呼び出しを非同期に実行するラッパー """
+# --- サーキットブレーカー (Drive / Gemini の障害時は呼び出しを止めて縮退運転する) ---
+class DependencyUnavailableError(RuntimeError):
+    """ Drive / Gemini のサーキットブレーカーが開いているか、呼び出しが障害とみなせる失敗をした """
+
+def is_outage_error(error: Exception) -> bool:
+    """ サービス側の障害とみなす失敗か。4xx (429 を除く) は要求の問題なので障害に数えない """
+    status = getattr(getattr(error, "resp", None), "status", None) or getattr(error, "code", None)
+    try: status = int(status)
+    except (TypeError, ValueError): return True # 接続エラー・タイムアウトなど
+    return status >= 500 or status == 429
+
+class CircuitBreaker:
+    """
+    連続して failure_threshold 回失敗したら「開」にし、open_seconds の間は呼び出しをすぐに断る。
+    時間が過ぎたら1回だけ呼び出しを通し (半開)、成功すれば閉じて待機中の処理 (on_close) を再開させる。
+    """
+    def __init__(self, name: str, failure_threshold: int, open_seconds: float):
+        self.name = name
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.open_seconds = open_seconds
+        self.state = "closed" # "closed" / "open" / "half_open"
+        self.failures = 0
+        self.opened_at = 0.0 # 開いた (または半開で試行を始めた) 時刻
+        self.trips = 0
+        self.on_close: list = []
+
+    @property
+    def available(self) -> bool:
+        return self.state == "closed"
+
+    def ready(self) -> bool:
+        """ 今呼び出せば通るか (閉じている、または開いてから時間が過ぎて試せる)。試行枠は消費しない """
+        return self.state == "closed" or time.monotonic() - self.opened_at >= self.open_seconds
+
+    def allow(self) -> bool:
+        """ 呼び出してよいか。半開では1回だけ通す (結果が記録されないまま open_seconds 過ぎたら次を通す) """
+        if self.state == "closed": return True
+        if not self.ready(): return False
+        self.state, self.opened_at = "half_open", time.monotonic()
+        return True
+
+    def record_success(self):
+        self.failures = 0
+        if self.state == "closed": return
+        self.state = "closed"
+        print(f"{self.name} のサーキットブレーカーを閉じました (呼び出しを再開します)。")
+        for callback in self.on_close: callback()
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            if self.state == "closed": self.trips += 1
+            self.state, self.opened_at = "open", time.monotonic()
+            print(f"{self.name} の呼び出しが {self.failures} 回続けて失敗したため、{self.open_seconds} 秒間呼び出しを止めます。")
+
+    def record(self, error: Exception | None):
+        if error is None or not is_outage_error(error): self.record_success()
+        else: self.record_failure()
+
+    def status_text(self) -> str:
+        labels = {"closed": "正常", "open": "停止中", "half_open": "再開を試行中"}
+        return f"{labels[self.state]} (連続失敗 {self.failures} 回 / 停止 {self.trips} 回)"
+
+drive_breakers: dict[str, CircuitBreaker] = {} # シャード名 -> ブレーカー (429 などはサービスアカウントごとなので、シャードごとに分ける)
+drive_breaker_on_close: list = [] # どのシャードのブレーカーが閉じたときにも呼ぶ処理 (全シャードで共有)
+gemini_breaker = CircuitBreaker("Gemini API", CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_OPEN_SECONDS)
+
+def get_drive_breaker(shard_name: str) -> CircuitBreaker:
+    if shard_name not in drive_breakers:
+        breaker = drive_breakers[shard_name] = CircuitBreaker(
+            f"Google Drive ({shard_name})", CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_OPEN_SECONDS)
+        breaker.on_close = drive_breaker_on_close
+    return drive_breakers[shard_name]
+
+async def execute_gdrive_api_call(func, *args, service=None, **kwargs):
+    """ Google Drive APIの同期的な呼び出しを非同期に実行するラッパー。失敗したら None
+        service を使うシャードのブレーカーが開いている間は呼ばずに DependencyUnavailableError """
+    breaker = drive_breaker_for_service(service)
+    if not breaker.allow(): raise DependencyUnavailableError(f"{breaker.name} の呼び出しを停止中です")
     try:
-        return await asyncio.to_thread(func, *args, **kwargs)
+        result = await asyncio.to_thread(func, *args, **kwargs)
     except Exception as e:
         print(f"Error executing GDrive API call {func.__name__ if hasattr(func, '__name__') else 'unknown_func'}: {e}")
+        breaker.record(e)
         return None 
+    breaker.record_success()
+    return result
 
 async def get_gdrive_folder_id_by_name(parent_id: str, folder_name: str, service) -> str | None:
     """ 指定された親フォルダIDの下にある特定の名前のフォルダIDを取得 """
@@ -282,7 +561,7 @@ async def get_gdrive_folder_id_by_name(parent_id: str, folder_name: str, service
         if folders:
             return folders[0].get('id')
         return None
-    return await execute_gdrive_api_call(_api_call)
+    return await execute_gdrive_api_call(_api_call, service=service)
 
 async def list_gdrive_subfolders(parent_id: str, service, name_pattern_re: str | None = None) -> list[dict]:
     """ 指定された親フォルダIDの直下にあるサブフォルダの一覧を返す (ページネーション対応、名前降順ソート) """
@@ -297,7 +576,7 @@ async def list_gdrive_subfolders(parent_id: str, service, name_pattern_re: str |
                                     pageToken=page_token_val).execute()
     page_token = None
     while True:
-        response = await execute_gdrive_api_call(_api_call_page, page_token)
+        response = await execute_gdrive_api_call(_api_call_page, page_token, service=service)
         if response is None: break 
         for folder in response.get('files', []):
             if name_pattern_re:
@@ -310,8 +589,9 @@ async def list_gdrive_subfolders(parent_id: str, service, name_pattern_re: str |
             break
     return sorted(folders_found, key=lambda x: x['name'], reverse=True) # 名前で降順ソート
 
-async def list_files_in_gdrive_folder(folder_id: str, service, keyword: str | None = None) -> list[dict]:
-    """ 指定されたGoogle DriveのフォルダID内のファイル一覧を返す (ページネーション対応、名前昇順ソート) """
+async def list_files_in_gdrive_folder(folder_id: str, service, keyword: str | None = None, extra_clauses: list[str] | None = None) -> list[dict]:
+    """ 指定されたGoogle DriveのフォルダID内のファイル一覧を返す (ページネーション対応、名前昇順ソート)
+        extra_clauses は q に and でつなぐ追加条件 """
     if not service: return []
     files_found = []
     def _api_call_page(page_token_val=None):
@@ -319,13 +599,15 @@ async def list_files_in_gdrive_folder(folder_id: str, service, keyword: str | No
         if keyword: 
             sanitized_keyword = keyword.replace("'", "\\'") 
             query += f" and name contains '{sanitized_keyword}'"
+        for clause in extra_clauses or []:
+            query += f" and {clause}"
         return service.files().list(q=query,
                                     spaces='drive',
                                     fields='nextPageToken, files(id, name, createdTime, webViewLink, mimeType, size)', # size も取得
                                     pageToken=page_token_val).execute()
     page_token = None
     while True:
-        response = await execute_gdrive_api_call(_api_call_page, page_token)
+        response = await execute_gdrive_api_call(_api_call_page, page_token, service=service)
         if response is None: break 
         for file_item in response.get('files', []):
             files_found.append(file_item)
@@ -383,6 +665,561 @@ async def download_gdrive_file_to_bytesio(service, file_id: str) -> io.BytesIO |
         print(f"Error downloading GDrive file {file_id} to memory: {e}")
         return None
 
+def download_gdrive_file_to_path_sync(service, file_id: str, dest_path: str, chunk_size: int = 8 * 1024 * 1024) -> bool:
+    """ GDriveからファイルをチャンク単位でダウンロードし、ローカルファイルに書き出す (同期。メモリに全体を載せない) """
+    try:
+        request = service.files().get_media(fileId=file_id)
+        with open(dest_path, "wb") as fh:
+            downloader = MediaIoBaseDownload(fh, request, chunksize=chunk_size)
+            done = False
+            while not done:
+                _, done = downloader.next_chunk()
+        return True
+    except Exception as e:
+        print(f"Error downloading GDrive file {file_id} to '{dest_path}': {e}")
+        if os.path.exists(dest_path):
+            try: os.remove(dest_path)
+            except OSError: pass
+        return False
+
+async def download_gdrive_file_to_path(service, file_id: str, dest_path: str) -> bool:
+    if not service or not file_id: return False
+    return await asyncio.to_thread(download_gdrive_file_to_path_sync, service, file_id, dest_path)
+
+# --- Google Drive シャード (複数のサービスアカウント / ルートフォルダ) ---
+class DriveShard:
+    """ Drive の保存先 1 つ分。サービスアカウントごとのクォータと容量を分けるため、新規ファイルはシャードに振り分ける """
+    def __init__(self, name: str, key_path: str | None = None, folder_id: str | None = None, service=None):
+        self.name = name
+        self.key_path = key_path
+        self.folder_id = folder_id
+        self.service = service
+        self.used_bytes: int | None = None # storageQuota.usage (最後に確認した値)
+        self.uploaded_bytes = 0            # used_bytes の確認後にこの BOT がアップロードした量
+        self.uploaded_files = 0
+
+    @property
+    def available(self) -> bool:
+        return bool(self.service and self.folder_id)
+
+    @property
+    def estimated_used_bytes(self) -> int:
+        return (self.used_bytes or 0) + self.uploaded_bytes
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        return get_drive_breaker(self.name) # サーバーごとのフォルダを指すシャードも同じサービスアカウントなので共有する
+
+primary_gdrive_shard = DriveShard("primary") # gdrive_service_account_key_path / gdrive_target_folder_id の保存先
+extra_gdrive_shards: list[DriveShard] = []
+GDRIVE_FILE_SHARDS_MAX = 50000 # ファイルID -> シャードの記録の上限 (超えたら古いものから忘れる。忘れても全シャードを探せば分かる)
+gdrive_file_shards: collections.OrderedDict[str, DriveShard] = collections.OrderedDict() # Drive のファイルID -> そのファイルがあるシャード
+gdrive_round_robin_counter = 0
+
+def remember_gdrive_file_shard(file_id: str | None, shard: DriveShard):
+    if not file_id: return
+    gdrive_file_shards[file_id] = shard
+    gdrive_file_shards.move_to_end(file_id)
+    while len(gdrive_file_shards) > GDRIVE_FILE_SHARDS_MAX:
+        gdrive_file_shards.popitem(last=False)
+
+def forget_gdrive_file_shard(file_id: str | None):
+    gdrive_file_shards.pop(file_id, None)
+
+def drive_breaker_for_service(service) -> CircuitBreaker:
+    """ service を使うシャードのブレーカー (分からなければ主シャードのもの) """
+    if service is not None and service is not gdrive_service:
+        for shard in extra_gdrive_shards:
+            if shard.service is service: return shard.breaker
+    return primary_gdrive_shard.breaker
+
+def gdrive_breakers_closed() -> bool:
+    """ どれかのシャードのブレーカーが閉じている (Drive 全体が障害中ではない) """
+    return any(shard.breaker.available for shard in get_gdrive_shards() or [primary_gdrive_shard])
+
+def gdrive_breakers_ready() -> bool:
+    """ どれかのシャードが今呼び出せる (閉じているか、開いてから時間が過ぎて試せる) """
+    return any(shard.breaker.ready() for shard in get_gdrive_shards() or [primary_gdrive_shard])
+
+def initialize_gdrive_shards():
+    """ gdrive_shards の設定から追加のシャードを作る (主シャードは initialize_gdrive_service が担当) """
+    extra_gdrive_shards.clear()
+    for i, shard_config in enumerate(GDRIVE_SHARDS_CONFIG or []):
+        name = shard_config.get("name") or f"shard{i + 2}"
+        key_path, folder_id = shard_config.get("service_account_key_path"), shard_config.get("folder_id")
+        if not key_path or not os.path.exists(key_path) or not folder_id:
+            print(f"警告: Driveシャード '{name}' のキーファイルまたはフォルダIDが無効なため、使用しません。")
+            continue
+        try:
+            extra_gdrive_shards.append(DriveShard(name, key_path, folder_id, build_gdrive_service_from_key(key_path)))
+            print(f"Driveシャード '{name}' を初期化しました。")
+        except Exception as e:
+            print(f"Driveシャード '{name}' の初期化に失敗しました: {e}")
+
+def get_gdrive_shards() -> list[DriveShard]:
+    """ 利用可能なシャードの一覧 (主シャードが先頭)。主シャードは現在の gdrive_service / GDRIVE_TARGET_FOLDER_ID を使う
+        (処理中のサーバーが分離されていれば、そのサーバーのフォルダを指すシャード) """
+    primary_gdrive_shard.service, primary_gdrive_shard.folder_id = gdrive_service, GDRIVE_TARGET_FOLDER_ID
+    guild_ctx = get_current_guild_context()
+    if guild_ctx.isolated: # 分離されたサーバーは各シャードのサーバー用フォルダを使う
+        return guild_ctx.scope_shards([shard for shard in [primary_gdrive_shard, *extra_gdrive_shards] if shard.service])
+    return [shard for shard in [primary_gdrive_shard, *extra_gdrive_shards] if shard.available]
+
+def gdrive_available() -> bool:
+    return bool(get_gdrive_shards())
+
+def choose_gdrive_shard(drive_filename: str) -> DriveShard | None:
+    """ gdrive_placement_policy に従って新規ファイルの保存先シャードを選ぶ (ブレーカーが開いているシャードは避ける) """
+    global gdrive_round_robin_counter
+    shards = get_gdrive_shards()
+    ready_shards = [shard for shard in shards if shard.breaker.ready()]
+    if ready_shards: shards = ready_shards # すべて止まっていれば従来通り選び、呼び出し側でブレーカーに断らせる
+    if len(shards) <= 1: return shards[0] if shards else None
+    if GDRIVE_PLACEMENT_POLICY == "hash":
+        digest = hashlib.sha256(drive_filename.encode("utf-8")).digest()
+        return shards[int.from_bytes(digest[:8], "big") % len(shards)]
+    if GDRIVE_PLACEMENT_POLICY == "least_used":
+        return min(shards, key=lambda shard: shard.estimated_used_bytes)
+    gdrive_round_robin_counter += 1
+    return shards[gdrive_round_robin_counter % len(shards)]
+
+def get_gdrive_shard_for_file(file_id: str | None, shard_name: str | None = None) -> DriveShard:
+    """ 一覧取得・検索・アップロードで分かったファイルIDのシャード。不明なら shard_name のシャード、それも無ければ主シャード """
+    shards = get_gdrive_shards()
+    if file_id in gdrive_file_shards: return gdrive_file_shards[file_id]
+    return next((shard for shard in shards if shard.name == shard_name), primary_gdrive_shard)
+
+def gdrive_service_for_file(file_id: str | None, shard_name: str | None = None):
+    return get_gdrive_shard_for_file(file_id, shard_name).service
+
+async def find_gdrive_file(filepath: str) -> tuple[DriveShard | None, str | None]:
+    """ filepath (YYYYMM/ファイル名) を全シャードで同時に探し、(シャード, ファイルID) を返す。見つからなければ (None, None) """
+    shards = get_gdrive_shards()
+    results = await asyncio.gather(*(get_gdrive_file_id_from_filepath(filepath, shard.service, shard.folder_id) for shard in shards))
+    for shard, (file_id, _) in zip(shards, results):
+        if file_id:
+            remember_gdrive_file_shard(file_id, shard)
+            return shard, file_id
+    return None, None
+
+async def refresh_gdrive_shard_usage():
+    """ 各シャードの使用量 (storageQuota.usage) を取り直す (least_used の判断とリバランス用) """
+    async def refresh(shard: DriveShard):
+        try: about = await execute_gdrive_api_call(shard.service.about().get(fields="storageQuota").execute, service=shard.service)
+        except DependencyUnavailableError: return # 停止中のシャードは前回の値のまま
+        if about and about.get("storageQuota", {}).get("usage") is not None:
+            shard.used_bytes = int(about["storageQuota"]["usage"])
+            shard.uploaded_bytes = 0
+    await asyncio.gather(*(refresh(shard) for shard in get_gdrive_shards()))
+
+# --- サーバー (ギルド) ごとの設定・保存先 ---
+class GuildContext:
+    """
+    サーバーごとの設定と保存先。per_guild_storage が有効か guild_settings に設定があるサーバーは「分離」され、
+    ローカルは base_upload_folder/guilds/<サーバーID>、Drive は各シャードの guild_<サーバーID> フォルダに保存する。
+    分離されていないサーバーは従来どおり共通の保存先を使う。
+    """
+    def __init__(self, guild_id: int | None):
+        self.guild_id = guild_id
+        self.key = str(guild_id) if guild_id is not None else None
+        self._ingest_semaphore: asyncio.Semaphore | None = None
+        self._ingest_semaphore_limit = 0
+        self.drive_folder_ids: dict[str, str] = {} # シャード名 -> このサーバーの Drive ルートフォルダID
+        self.drive_shard_views: dict[str, DriveShard] = {}
+        self.drive_roots_lock = asyncio.Lock() # 同じサーバーのイベントが同時に来てもフォルダを二重に作らない
+        self.drive_roots_task: asyncio.Task | None = None
+
+    @property
+    def overrides(self) -> dict:
+        if self.key is None: return {}
+        return (bot_config.get("guild_settings") or {}).get(self.key) or {}
+
+    @property
+    def isolated(self) -> bool:
+        return self.key is not None and (bool(PER_GUILD_STORAGE) or bool(self.overrides))
+
+    def setting(self, key: str):
+        overrides = self.overrides
+        if key in overrides: return overrides[key]
+        return bot_config.get(key, DEFAULT_CONFIG.get(key))
+
+    @property
+    def ingest_semaphore(self) -> asyncio.Semaphore:
+        """ 取り込みの同時実行数の上限。guild_ingest_concurrency が変わったら作り直す
+            (実行中の取り込みは古いセマフォを返すので、切り替え直後だけ新旧の合計まで同時に走る) """
+        limit = max(1, int(self.setting("guild_ingest_concurrency")))
+        if self._ingest_semaphore is None or self._ingest_semaphore_limit != limit:
+            self._ingest_semaphore, self._ingest_semaphore_limit = asyncio.Semaphore(limit), limit
+        return self._ingest_semaphore
+
+    @property
+    def base_upload_folder(self) -> str:
+        if not self.isolated: return BASE_UPLOAD_FOLDER
+        return self.overrides.get("base_upload_folder") or os.path.join(BASE_UPLOAD_FOLDER, "guilds", self.key)
+
+    @property
+    def label(self) -> str:
+        return f"サーバー {self.key}" if self.isolated else "共通"
+
+    def reset_drive_roots(self):
+        self.drive_folder_ids.clear()
+        self.drive_shard_views.clear()
+
+    async def ensure_drive_roots(self):
+        """ 分離されたサーバーの Drive ルートフォルダ (シャードごと) を用意する。一度解決したらキャッシュする """
+        if not self.isolated: return
+        override_folder_id = self.overrides.get("gdrive_target_folder_id")
+        if override_folder_id and gdrive_service: self.drive_folder_ids["primary"] = override_folder_id
+        shards = [primary_gdrive_shard, *extra_gdrive_shards]
+        if all(shard.name in self.drive_folder_ids for shard in shards): return
+        async with self.drive_roots_lock:
+            for shard in shards:
+                if shard.name in self.drive_folder_ids: continue
+                parent_id = GDRIVE_TARGET_FOLDER_ID if shard is primary_gdrive_shard else shard.folder_id
+                service = gdrive_service if shard is primary_gdrive_shard else shard.service
+                if not (service and parent_id): continue
+                folder_id = await execute_gdrive_api_call(get_or_create_drive_folder, parent_id, f"guild_{self.key}", service, service=service)
+                if folder_id: self.drive_folder_ids[shard.name] = folder_id
+
+    def drive_roots_resolved(self) -> bool:
+        if not self.isolated: return True
+        shards = [shard for shard in (primary_gdrive_shard, *extra_gdrive_shards) if shard.service]
+        return all(shard.name in self.drive_folder_ids for shard in shards)
+
+    def prefetch_drive_roots(self):
+        """ ensure_drive_roots をバックグラウンドで行う (インタラクションの応答期限内に Drive を呼ばないように) """
+        if self.drive_roots_resolved() or (self.drive_roots_task and not self.drive_roots_task.done()): return
+        async def run():
+            try: await self.ensure_drive_roots()
+            except Exception as e: print(f"{self.label} の Drive フォルダの準備に失敗しました: {e}")
+        self.drive_roots_task = asyncio.create_task(run())
+
+    def scope_shards(self, shards: list[DriveShard]) -> list[DriveShard]:
+        """ 共通のシャード一覧を、このサーバーのルートフォルダを指すシャードに置き換える (未解決のシャードは除く) """
+        if not self.isolated: return shards
+        views = []
+        for shard in shards:
+            folder_id = self.drive_folder_ids.get(shard.name)
+            if not folder_id: continue
+            view = self.drive_shard_views.get(shard.name)
+            if view is None or view.folder_id != folder_id:
+                view = self.drive_shard_views[shard.name] = DriveShard(shard.name, shard.key_path, folder_id)
+            view.service = shard.service
+            views.append(view)
+        return views
+
+guild_contexts: dict[int | None, GuildContext] = {}
+current_guild_context: contextvars.ContextVar[GuildContext | None] = contextvars.ContextVar("current_guild_context", default=None)
+storage_scoped_objects: dict[tuple[str, str], object] = {} # (種類, 保存先の絶対パス) -> 索引などのインスタンス
+
+def get_guild_context(guild_id: int | None) -> GuildContext:
+    if guild_id not in guild_contexts: guild_contexts[guild_id] = GuildContext(guild_id)
+    return guild_contexts[guild_id]
+
+def get_current_guild_context() -> GuildContext:
+    return current_guild_context.get() or get_guild_context(None)
+
+async def enter_guild_context(guild, resolve_drive_roots: bool = True) -> GuildContext:
+    """ イベント (メッセージ・インタラクション・バックグラウンドジョブ) の処理対象のサーバーを設定する。
+        ContextVar はタスクごとなので、同時に処理している他のサーバーのイベントには影響しない。
+        resolve_drive_roots=False なら Drive のフォルダはその場で用意せず、バックグラウンドで用意する """
+    guild_id = guild if guild is None or isinstance(guild, int) else guild.id
+    guild_ctx = get_guild_context(guild_id)
+    current_guild_context.set(guild_ctx)
+    if not resolve_drive_roots:
+        if guild_ctx.isolated and gdrive_service: guild_ctx.prefetch_drive_roots()
+    elif guild_ctx.isolated and gdrive_service:
+        try: await guild_ctx.ensure_drive_roots()
+        except Exception as e: print(f"{guild_ctx.label} の Drive フォルダの準備に失敗しました: {e}")
+    return guild_ctx
+
+def get_base_upload_folder() -> str:
+    return get_current_guild_context().base_upload_folder
+
+def get_upload_destination() -> str:
+    return get_current_guild_context().setting("upload_destination")
+
+def get_storage_scoped(kind: str, factory):
+    """ 保存先 (ローカルのルートフォルダ) ごとに1つのインスタンスを返す。同じ保存先を共有するサーバーは同じ索引を使う """
+    key = (kind, os.path.abspath(get_base_upload_folder()))
+    if key not in storage_scoped_objects: storage_scoped_objects[key] = factory()
+    return storage_scoped_objects[key]
+
+def known_guild_contexts() -> list[GuildContext]:
+    """ 参加中のサーバーと guild_settings のサーバーのコンテキスト。保存先が同じものは1つにまとめる """
+    guild_ids = [None, *(guild.id for guild in bot.guilds)]
+    guild_ids += [int(key) for key in (bot_config.get("guild_settings") or {}) if str(key).isdigit()]
+    contexts, seen_roots = [], set()
+    for guild_id in guild_ids:
+        guild_ctx = get_guild_context(guild_id)
+        root = os.path.abspath(guild_ctx.base_upload_folder)
+        if root in seen_roots: continue
+        seen_roots.add(root)
+        contexts.append(guild_ctx)
+    return contexts
+
+def save_guild_settings(guild_ctx: GuildContext, new_settings: dict):
+    """ 分離されたサーバーでは guild_settings に、それ以外では共通の設定として保存する """
+    if not guild_ctx.isolated:
+        save_bot_config(new_settings)
+        return
+    all_settings = dict(bot_config.get("guild_settings") or {})
+    all_settings[guild_ctx.key] = {**(all_settings.get(guild_ctx.key) or {}), **new_settings}
+    save_bot_config({"guild_settings": all_settings})
+    guild_ctx.reset_drive_roots()
+
+# --- ローカルストレージ (非同期ファイルシステム) ---
+LocalEntry = collections.namedtuple("LocalEntry", ["name", "path", "is_dir", "size", "mtime"])
+
+def is_year_month_name(name: str) -> bool:
+    return len(name) == 6 and name.isdigit()
+
+def scan_local_dir(folder: str, with_stat: bool = False) -> list[LocalEntry] | None:
+    """ os.scandir でフォルダを1回だけ走査し、種別 (と with_stat ならサイズ・更新日時) を同時に読む。
+        種別は readdir の結果から分かるので、ファイルごとの isfile/getsize 呼び出しが要らない。フォルダが無ければ None """
+    entries = []
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                    if not is_dir and not entry.is_file(): continue
+                    stat_result = entry.stat() if with_stat and not is_dir else None
+                except OSError: continue # 走査中に削除された
+                entries.append(LocalEntry(entry.name, entry.path, is_dir,
+                                          stat_result.st_size if stat_result else None,
+                                          stat_result.st_mtime if stat_result else None))
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    entries.sort(key=lambda e: e.name)
+    return entries
+
+def scan_local_months(root: str, months: list[str] | None = None,
+                      with_stat: bool = False) -> dict[str, list[LocalEntry]] | None:
+    """ 保存先のルートの年月フォルダ (YYYYMM) ごとに、その中のファイルを返す (新しい年月順)。
+        months を渡すとその年月だけを走査する。ルートが無ければ None """
+    if months is None:
+        root_entries = scan_local_dir(root)
+        if root_entries is None: return None
+        months = sorted((e.name for e in root_entries if e.is_dir and is_year_month_name(e.name)), reverse=True)
+    result = {}
+    for ym in months:
+        entries = scan_local_dir(os.path.join(root, ym), with_stat)
+        if entries is not None: result[ym] = [e for e in entries if not e.is_dir]
+    return result
+
+def stat_local_file(path: str) -> os.stat_result | None:
+    """ 通常ファイルなら stat の結果、無い・フォルダなら None (exists + isfile + getsize + getmtime を1回で) """
+    try: stat_result = os.stat(path)
+    except OSError: return None
+    return stat_result if stat.S_ISREG(stat_result.st_mode) else None
+
+def make_local_dirs(path: str) -> bool:
+    """ フォルダを作成する。既にあった場合は False (同時に作成しようとしても True になるのは1つだけ) """
+    try: os.makedirs(path)
+    except FileExistsError: return False
+    return True
+
+def write_local_file(path: str, data: bytes) -> int:
+    with open(path, "wb") as f:
+        return f.write(data)
+
+def remove_local_file(path: str) -> bool:
+    try: os.remove(path)
+    except FileNotFoundError: return False
+    return True
+
+class LocalStorage:
+    """ ローカル保存先のファイル操作の層。
+        すべてのI/Oを専用のスレッドで行うので、遅い NAS 上の保存先でもイベントループ (ゲートウェイ) を止めない。
+        asyncio.to_thread と同じく ContextVar (処理中のサーバー) をスレッドに引き継ぐ """
+    def __init__(self, max_workers: int):
+        self.max_workers = max(1, int(max_workers or 1))
+        self.executor = None
+
+    def _get_executor(self) -> concurrent.futures.ThreadPoolExecutor:
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="localfs")
+        return self.executor
+
+    async def run(self, func, *args):
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self._get_executor(), context.run, func, *args)
+
+    async def scan(self, folder: str, with_stat: bool = False) -> list[LocalEntry] | None:
+        return await self.run(scan_local_dir, folder, with_stat)
+
+    async def scan_months(self, root: str, months: list[str] | None = None,
+                          with_stat: bool = False) -> dict[str, list[LocalEntry]] | None:
+        return await self.run(scan_local_months, root, months, with_stat)
+
+    async def list_months(self, root: str) -> list[str] | None:
+        """ ルート直下の年月フォルダ名 (新しい順)。ルートが無ければ None """
+        entries = await self.scan(root)
+        if entries is None: return None
+        return sorted((e.name for e in entries if e.is_dir and is_year_month_name(e.name)), reverse=True)
+
+    async def stat(self, path: str) -> os.stat_result | None:
+        return await self.run(stat_local_file, path)
+
+    async def stat_many(self, paths: list[str]) -> list[os.stat_result | None]:
+        """ 複数のパスを1回のスレッド呼び出しでまとめて stat する """
+        return await self.run(lambda: [stat_local_file(p) for p in paths])
+
+    async def is_file(self, path: str) -> bool:
+        return await self.stat(path) is not None
+
+    async def exists(self, path: str) -> bool:
+        return await self.run(os.path.exists, path)
+
+    async def makedirs(self, path: str) -> bool:
+        return await self.run(make_local_dirs, path)
+
+    async def rename(self, src: str, dst: str):
+        await self.run(os.rename, src, dst)
+
+    async def replace(self, src: str, dst: str):
+        await self.run(os.replace, src, dst)
+
+    async def move(self, src: str, dst: str):
+        await self.run(shutil.move, src, dst)
+
+    async def write_bytes(self, path: str, data: bytes) -> int:
+        return await self.run(write_local_file, path, data)
+
+    async def save_attachment(self, attachment, path: str) -> int:
+        """ 添付ファイルをダウンロードして保存する (attachment.save はファイルの書き込みをイベントループ上で行うため) """
+        return await self.write_bytes(path, await attachment.read())
+
+    async def remove(self, path: str) -> bool:
+        """ ファイルを削除する。無かった場合は False """
+        return await self.run(remove_local_file, path)
+
+local_storage = LocalStorage(LOCAL_FS_THREADS)
+
+# --- 追記型 JSONL ストア (索引・キャッシュ・ジャーナル共通) ---
+def read_jsonl_records(path: str) -> list[dict] | None:
+    """ JSONL ファイルの全レコード。ファイルが無ければ None。壊れた行 (書き込み途中で止まった最終行など) は読み飛ばす """
+    records = []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip(): continue
+                try: records.append(json.loads(line))
+                except json.JSONDecodeError: continue
+    except FileNotFoundError:
+        return None
+    return records
+
+def write_jsonl_records(path: str, data, append: bool, fsync: bool = False):
+    """ data (JSONL のテキストかレコードのリスト) を追記する。append でなければ一時ファイル経由でファイル全体を置き換える """
+    if not isinstance(data, str):
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in data)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    target_path = path if append else path + ".tmp"
+    with open(target_path, "a" if append else "w", encoding="utf-8") as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    if not append: os.replace(target_path, path)
+
+class JsonlStore(abc.ABC):
+    """
+    変更を JSONL ファイルに追記し、初回アクセス時 (保存先が変わったときも) に再生して復元する索引・キャッシュの共通部分。
+    読み込み・追記・圧縮はすべて local_storage のスレッドで行う。書き込みは1つのタスクが呼び出し順に行い、
+    続けて積まれた同じファイルへの追記は1回にまとめる。
+    サブクラスは path・_reset・_replay・_snapshot・_live_count を実装し (実装漏れは生成時に TypeError)、使う前に ensure_loaded() を待つ。
+    """
+    label = "JSONL ファイル" # ログ用の名前
+    fsync = False            # 追記のたびにディスクへ書き出すか (ジャーナル用)
+
+    def __init__(self):
+        self._log_lines = 0 # ファイルの行数 (圧縮の判断用)
+        self._loaded_path: str | None = None
+        self._load_lock = asyncio.Lock()
+        self._writes: collections.deque = collections.deque() # (パス, 追記か, データ, 完了の Future)
+        self._writer: asyncio.Task | None = None
+
+    @property
+    @abc.abstractmethod
+    def path(self) -> str: ...
+    @abc.abstractmethod
+    def _reset(self): ...
+    @abc.abstractmethod
+    def _replay(self, record: dict): ...
+    @abc.abstractmethod
+    def _snapshot(self) -> list[dict]: ... # 圧縮後のファイルの中身
+    @abc.abstractmethod
+    def _live_count(self) -> int: ...
+    def _on_loaded(self, found: bool): pass
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded_path == self.path
+
+    async def ensure_loaded(self):
+        """ まだ読み込んでいなければファイルを再生して復元する """
+        if self.loaded: return
+        async with self._load_lock:
+            path = self.path
+            if self._loaded_path == path: return
+            await self.flush() # 前の保存先への書き込みを済ませてから読む
+            try: records = await local_storage.run(read_jsonl_records, path)
+            except Exception as e:
+                print(f"{self.label} '{path}' の読み込み中にエラー: {e}")
+                records = None
+            self._reset()
+            for record in records or ():
+                try: self._replay(record)
+                except (KeyError, TypeError, ValueError) as e: print(f"{self.label} '{path}' の不正な行を読み飛ばしました: {e}")
+            self._log_lines = len(records or ())
+            self._loaded_path = path
+            self._on_loaded(records is not None)
+            if self._log_lines > 2 * self._live_count() + 100:
+                self._compact()
+
+    def _append(self, record: dict) -> asyncio.Future:
+        """ レコードを追記する。戻り値の Future は書き込みが終わると成否 (bool) になる """
+        self._log_lines += 1
+        return self._enqueue(True, json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _compact(self) -> asyncio.Future | None:
+        """ 現在の内容だけのファイルに書き直す (読み込み前の内容で上書きしないよう、読み込み済みのときだけ) """
+        if not self.loaded: return None
+        snapshot = self._snapshot()
+        self._log_lines = len(snapshot)
+        return self._enqueue(False, snapshot)
+
+    def _enqueue(self, append: bool, data) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._writes.append((self.path, append, data, future))
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_pending())
+        return future
+
+    async def _write_pending(self):
+        while self._writes:
+            path, append, data, future = self._writes.popleft()
+            futures = [future]
+            while append and self._writes and self._writes[0][0] == path and self._writes[0][1]:
+                _, _, more_data, more_future = self._writes.popleft()
+                data += more_data
+                futures.append(more_future)
+            try:
+                await local_storage.run(write_jsonl_records, path, data, append, self.fsync)
+                succeeded = True
+            except Exception as e:
+                print(f"{self.label}への書き込みに失敗しました: {e}")
+                succeeded = False
+            for f in futures:
+                if not f.done(): f.set_result(succeeded)
+
+    async def flush(self):
+        """ 積まれている書き込みがすべて終わるまで待つ """
+        while self._writer is not None and not self._writer.done():
+            await asyncio.shield(self._writer)
+
 # --- 管理者チェック ---
 def is_admin():
     async def predicate(interaction: discord.Interaction):
@@ -400,6 +1237,95 @@ def is_admin():
             return False
     return app_commands.check(predicate)
 
+# --- Gemini のヘッジ付きリクエスト (応答が遅いときは予備のモデルにも送る) ---
+class GeminiHedgedRequests:
+    """
+    Gemini の生成リクエストを送り、主モデルの直近の応答時間の gemini_hedge_percentile パーセンタイルまでに
+    応答が無ければ gemini_fallback_model にも同じリクエストを送る (ヘッジ)。先に返った有効な応答を使い、もう一方は取り消す。
+    ヘッジするのは遅い側の (100 - パーセンタイル)% 程度なので、呼び出しの増加もその程度に収まる。
+    全体の待ち時間の上限は gemini_timeout_seconds。
+    """
+    WINDOW = 200     # 締め切りの計算に使う直近の応答時間の数 (単体・バッチ別)
+    MIN_SAMPLES = 20 # これより少ない間は gemini_hedge_initial_delay_seconds を締め切りにする
+
+    def __init__(self):
+        self.latencies = {"single": collections.deque(maxlen=self.WINDOW), "batch": collections.deque(maxlen=self.WINDOW)}
+        self.stats = {"requests": 0, "hedged": 0, "primary_wins": 0, "fallback_wins": 0}
+        self.worker_stats: dict[int, dict] = {} # 取り込みワーカープロセスごとの stats (pid -> 最新の値)
+        self._fallback: tuple[str, object] | None = None # (モデル名, モデル)
+
+    @staticmethod
+    def fallback_name() -> str | None:
+        name = bot_config.get("gemini_fallback_model") or None
+        return None if name == current_gemini_model else name
+
+    def fallback_model(self):
+        name = self.fallback_name()
+        if not name or not gemini_model_instance: return None
+        if self._fallback is None or self._fallback[0] != name:
+            self._fallback = (name, create_gemini_model(name))
+        return self._fallback[1]
+
+    def deadline(self, kind: str) -> float:
+        samples = sorted(self.latencies[kind])
+        if len(samples) < self.MIN_SAMPLES: return GEMINI_HEDGE_INITIAL_DELAY_SECONDS
+        return samples[min(len(samples) - 1, int(len(samples) * GEMINI_HEDGE_PERCENTILE / 100))]
+
+    def totals(self) -> dict:
+        totals = dict(self.stats)
+        for worker_stats in self.worker_stats.values():
+            for key in totals: totals[key] += worker_stats.get(key, 0)
+        return totals
+
+    async def generate(self, kind: str, contents: list, generation_config: dict, is_valid):
+        """ 有効な応答 (is_valid(response) が真) を返す。両方が失敗したら主モデルの例外を送出する。
+            どちらも無効な応答だった場合は後に返った方をそのまま返す (解釈の失敗は呼び出し側で扱う) """
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        self.stats["requests"] += 1
+        primary = asyncio.ensure_future(gemini_model_instance.generate_content_async(contents, generation_config=generation_config))
+        tasks = {primary: "primary"}
+        try:
+            fallback_model = self.fallback_model()
+            if fallback_model is not None:
+                deadline = min(self.deadline(kind), GEMINI_TIMEOUT_SECONDS)
+                done, _ = await asyncio.wait({primary}, timeout=deadline)
+                if not done:
+                    self.stats["hedged"] += 1
+                    print(f"Gemini API: {current_gemini_model} が {deadline:.1f} 秒以内に応答しないため、{self._fallback[0]} にも送信します。")
+                    tasks[asyncio.ensure_future(fallback_model.generate_content_async(contents, generation_config=generation_config))] = "fallback"
+            pending, errors, invalid_response = set(tasks), {}, None
+            while pending:
+                remaining = GEMINI_TIMEOUT_SECONDS - (loop.time() - started)
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, remaining), return_when=asyncio.FIRST_COMPLETED)
+                if not done: raise asyncio.TimeoutError(f"Gemini API が {GEMINI_TIMEOUT_SECONDS} 秒以内に応答しませんでした")
+                for task in done:
+                    role = tasks[task]
+                    if role == "primary": self.latencies[kind].append(loop.time() - started)
+                    if task.exception() is not None:
+                        errors[role] = task.exception()
+                        continue
+                    response = task.result()
+                    if not is_valid(response) and pending: # もう一方の応答を待つ
+                        invalid_response = response
+                        continue
+                    if len(tasks) > 1: self.stats[f"{role}_wins"] += 1
+                    return response
+            if invalid_response is not None: return invalid_response
+            raise errors.get("primary") or errors["fallback"]
+        finally:
+            for task, role in tasks.items():
+                if not task.done():
+                    task.cancel()
+                    if role == "primary": self.latencies[kind].append(loop.time() - started) # 打ち切った時間を下限として数える
+                elif not task.cancelled(): task.exception() # 使わなかった側の例外も回収済みにする
+
+gemini_hedger = GeminiHedgedRequests()
+
+def gemini_response_has_text(response) -> bool:
+    try: return bool(response.text.strip())
+    except Exception: return False # ブロックされた応答などは text の参照で例外になる
+
 # --- Gemini タグ生成 ---
 async def get_tags_from_gemini(file_path, original_filename, mime_type):
     global gemini_model_instance
@@ -407,35 +1333,41 @@ async def get_tags_from_gemini(file_path, original_filename, mime_type):
         print("Geminiモデルが初期化されていないため、タグ生成をスキップします。")
         return "notags"
 
+    if not gemini_breaker.allow():
+        raise DependencyUnavailableError("Gemini API の呼び出しを停止中です")
+
     print(f"Gemini APIにファイル '{original_filename}' (MIMEタイプ: {mime_type}) を送信してタグを生成します...")
     uploaded_file_resource = None
+    response = None
     try:
         # display_name は必須ではないが、デバッグ等に役立つ可能性がある
         # mime_type も指定できるはずだが、現状のSDKではupload_fileの引数に直接はない模様。
         # genai.upload_file は内部でファイルタイプを推測するか、汎用的なタイプとして扱う
-        uploaded_file_resource = genai.upload_file(path=file_path, display_name=original_filename)
+        uploaded_file_resource = await asyncio.to_thread(genai.upload_file, path=file_path, display_name=original_filename)
         print(f"Gemini APIにファイル '{original_filename}' (ID: {uploaded_file_resource.name}) をアップロードしました。")
 
         prompt = load_tagging_prompt()
-        response = await gemini_model_instance.generate_content_async(
-            [prompt, uploaded_file_resource],
-            generation_config={"response_mime_type": "text/plain"}
-        )
+        response = await gemini_hedger.generate( # 応答が遅いときは予備のモデルにも送り、それでも遅ければ障害として数える
+            "single", [prompt, uploaded_file_resource], {"response_mime_type": "text/plain"}, gemini_response_has_text)
+        gemini_breaker.record_success()
         
         if response.text.strip() == "タグ抽出不可":
             print("Gemini API: タグ抽出不可と判断されました。")
             return "notags"
             
-        tags = response.text.strip()
-        sanitized_tags = sanitize_filename_component(tags)
-        print(f"Gemini APIから取得したタグ: '{sanitized_tags}'")
-        return sanitized_tags if sanitized_tags else "notags"
+        tags_str = format_tags_for_filename(split_gemini_tag_text(response.text)) # バッチと同じ形式にそろえる
+        print(f"Gemini APIから取得したタグ: '{tags_str}'")
+        return tags_str
 
     except Exception as e:
         print(f"Gemini APIでのタグ生成中にエラーが発生しました: {e}")
         # エラーレスポンスに詳細が含まれているか確認 (例: response.prompt_feedback)
         if hasattr(e, 'response') and hasattr(e.response, 'prompt_feedback'):
             print(f"Gemini API Prompt Feedback: {e.response.prompt_feedback}")
+        if response is None and is_outage_error(e): # 障害ならタグなしで確定させず、呼び出し側で後回しにできるようにする
+            gemini_breaker.record_failure()
+            raise DependencyUnavailableError(f"Gemini API: {type(e).__name__}: {e}") from e
+        gemini_breaker.record_success() # 応答はあった (内容の問題)
         return "notags"
     finally:
         if uploaded_file_resource and hasattr(uploaded_file_resource, 'name'):
@@ -446,74 +1378,1762 @@ async def get_tags_from_gemini(file_path, original_filename, mime_type):
              except Exception as e_del:
                  print(f"Gemini APIからアップロードされたファイル {uploaded_file_resource.name} の削除中にエラー: {e_del}")
 
-# --- GDrive フォルダ操作 (同期) ---
-def get_or_create_drive_folder(parent_folder_id: str, folder_name: str) -> str | None:
-    if not gdrive_service or not google_drive_libs_available:
-        print("Driveサービスが利用不可のため、フォルダ操作はできません。")
+# --- Gemini バッチタグ生成 ---
+GEMINI_BATCH_INSTRUCTION = (
+    "これから {count} 個のファイルを順番に添付します。各ファイルについて上記の指示に従ってタグを付け、"
+    "JSON配列で返してください。index は 0 から始まるファイル番号、tags はタグ文字列の配列です。"
+    "タグ抽出が難しいファイルは tags を空配列にしてください。"
+)
+GEMINI_BATCH_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "index": {"type": "integer"},
+            "tags": {"type": "array", "items": {"type": "string"}},
+        },
+        "required": ["index", "tags"],
+    },
+}
+
+def format_tags_for_filename(tags: list[str]) -> str:
+    """ タグのリストをファイル名用の文字列 (ハイフン区切り) に変換する。タグ部分にアンダースコアは含めない """
+    cleaned = []
+    for tag in tags:
+        tag_component = sanitize_filename_component(tag.strip()).replace("_", "").replace("-", "")
+        if tag_component and tag_component != "タグ抽出不可" and tag_component not in cleaned:
+            cleaned.append(tag_component)
+    return "-".join(cleaned) if cleaned else "notags"
+
+def split_gemini_tag_text(text: str) -> list[str]:
+    """ 1件ずつのタグ付けの応答 (既定のプロンプトはハイフン区切り、カンマ・改行区切りの応答もある) をタグのリストに分ける """
+    return [tag for tag in re.split(r"[-,、，\n]", text) if tag.strip()]
+
+def parse_gemini_batch_response(response_text: str, count: int) -> dict[int, str]:
+    """ バッチ応答 (JSON) を検証し、正しく解釈できたエントリだけを {index: タグ文字列} で返す """
+    try:
+        entries = json.loads(response_text)
+    except (json.JSONDecodeError, TypeError) as e:
+        print(f"Gemini API: バッチ応答のJSON解析に失敗しました: {e}")
+        return {}
+    if not isinstance(entries, list):
+        print("Gemini API: バッチ応答がJSON配列ではありません。")
+        return {}
+    results: dict[int, str] = {}
+    for entry in entries:
+        if not isinstance(entry, dict): continue
+        index, tags = entry.get("index"), entry.get("tags")
+        if not isinstance(index, int) or isinstance(index, bool) or not 0 <= index < count or index in results: continue
+        if not isinstance(tags, list) or not all(isinstance(t, str) for t in tags): continue
+        results[index] = format_tags_for_filename(tags)
+    return results
+
+async def get_tags_from_gemini_batch(items: list[tuple[str, str, str]]) -> dict[int, str]:
+    """
+    複数ファイル (file_path, original_filename, mime_type) を1回のリクエストでタグ付けする。
+    検証を通ったエントリのみ {items内のindex: タグ文字列} で返す (失敗時は空dict)。
+    """
+    if not gemini_model_instance:
+        return {}
+    if not gemini_breaker.allow():
+        raise DependencyUnavailableError("Gemini API の呼び出しを停止中です")
+    print(f"Gemini APIに {len(items)} 件のファイルをまとめて送信してタグを生成します...")
+    uploaded_resources = []
+    response = None
+    try:
+        for file_path, original_filename, _ in items:
+            uploaded_resources.append(await asyncio.to_thread(genai.upload_file, path=file_path, display_name=original_filename))
+
+        contents = [load_tagging_prompt(), GEMINI_BATCH_INSTRUCTION.format(count=len(items))]
+        for index, resource in enumerate(uploaded_resources):
+            contents.extend([f"ファイル {index}: {items[index][1]}", resource])
+        response = await gemini_hedger.generate(
+            "batch", contents, {"response_mime_type": "application/json", "response_schema": GEMINI_BATCH_RESPONSE_SCHEMA},
+            lambda candidate: gemini_response_has_text(candidate) and bool(parse_gemini_batch_response(candidate.text, len(items))))
+        gemini_breaker.record_success()
+        results = parse_gemini_batch_response(response.text, len(items))
+        print(f"Gemini APIバッチ応答: {len(results)}/{len(items)} 件のタグを取得しました。")
+        return results
+    except Exception as e:
+        print(f"Gemini APIでのバッチタグ生成中にエラーが発生しました: {e}")
+        if response is None and is_outage_error(e): # 障害なら個別の再試行はせず、バッチ全体を後回しにさせる
+            gemini_breaker.record_failure()
+            raise DependencyUnavailableError(f"Gemini API: {type(e).__name__}: {e}") from e
+        gemini_breaker.record_success()
+        return {}
+    finally:
+        for resource in uploaded_resources:
+            try: await asyncio.to_thread(genai.delete_file, resource.name)
+            except Exception as e_del: print(f"Gemini APIからアップロードされたファイル {resource.name} の削除中にエラー: {e_del}")
+
+class GeminiTagBatcher:
+    """ 短い時間窓に届いた画像のタグ付け要求をまとめ、1回のGemini呼び出しで処理する """
+    def __init__(self):
+        self._pending: list[tuple[tuple[str, str, str], asyncio.Future]] = []
+        self._flush_handle: asyncio.Handle | None = None
+        self._running_tasks: set[asyncio.Task] = set()
+
+    async def request_tags(self, file_path: str, original_filename: str, mime_type: str) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(((file_path, original_filename, mime_type), future))
+        if len(self._pending) >= max(1, GEMINI_BATCH_MAX_IMAGES):
+            self._flush()
+        elif len(self._pending) == 1 and not self._running_tasks: # 他に待っている要求がなければ窓を待たずに送る (同じ周回で届いた分はまとめる)
+            self._flush_handle = loop.call_soon(self._flush)
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(GEMINI_BATCH_WINDOW_SECONDS, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if not batch: return
+        task = asyncio.create_task(self._run_batch(batch))
+        self._running_tasks.add(task)
+        task.add_done_callback(self._on_batch_done)
+
+    def _on_batch_done(self, task: asyncio.Task):
+        self._running_tasks.discard(task)
+        if self._pending and not self._running_tasks: # 処理中に溜まった分は窓の終わりを待たずに送る
+            self._flush()
+
+    async def _run_batch(self, batch: list[tuple[tuple[str, str, str], asyncio.Future]]):
+        items = [item for item, _ in batch]
+        try:
+            if len(items) == 1:
+                results = {0: await get_tags_from_gemini(*items[0])}
+            else:
+                results = await get_tags_from_gemini_batch(items)
+                retry_indexes = [i for i in range(len(items)) if i not in results]
+                if retry_indexes:
+                    print(f"Gemini APIバッチ応答で {len(retry_indexes)} 件が不正または欠落していたため、個別に再試行します。")
+                    retried = await asyncio.gather(*(get_tags_from_gemini(*items[i]) for i in retry_indexes))
+                    results.update(zip(retry_indexes, retried))
+            for index, (_, future) in enumerate(batch):
+                if not future.done(): future.set_result(results.get(index, "notags"))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done(): future.set_exception(e)
+
+gemini_tag_batcher = GeminiTagBatcher()
+
+# --- タグ付け結果のキャッシュ (内容のハッシュ・モデル・プロンプトごと) ---
+def compute_file_sha256(path: str) -> str | None:
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""): digest.update(chunk)
+    except OSError as e:
+        print(f"ファイル '{path}' のハッシュの計算に失敗しました: {e}")
         return None
+    return digest.hexdigest()
+
+tagging_prompt_fingerprint: tuple | None = None # (プロンプトファイルの (mtime, サイズ), プロンプトのハッシュ)
+
+def tagging_prompt_hash() -> str:
+    """ 現在のタグ付けプロンプトのハッシュ。プロンプトファイルが変わったときだけ読み直す """
+    global tagging_prompt_fingerprint
     try:
-        query = f"mimeType='application/vnd.google-apps.folder' and trashed=false and name='{folder_name}' and '{parent_folder_id}' in parents"
-        response = gdrive_service.files().list(q=query, spaces='drive', fields='files(id, name)').execute()
-        folders = response.get('files', [])
-        if folders:
-            print(f"Driveフォルダ '{folder_name}' が見つかりました (ID: {folders[0].get('id')})。")
-            return folders[0].get('id')
+        prompt_stat = os.stat(TAGGING_PROMPT_FILE)
+        signature = (prompt_stat.st_mtime_ns, prompt_stat.st_size)
+    except OSError:
+        signature = None
+    if tagging_prompt_fingerprint is None or tagging_prompt_fingerprint[0] != signature:
+        tagging_prompt_fingerprint = (signature, hashlib.sha256(load_tagging_prompt().encode("utf-8")).hexdigest()[:12])
+    return tagging_prompt_fingerprint[1]
+
+class TagCache(JsonlStore):
+    """
+    Gemini のタグ付け結果を (ファイル内容の SHA-256, モデル名, プロンプトのハッシュ) をキーに保持する。
+    モデルやプロンプトを変えるとキーが変わるので、古い結果は使われずに追い出される。
+    tag_cache_max_entries 件を超えたら最も長く使われていないものから捨てる (LRU)。
+    変更は base_upload_folder 内の JSONL に追記し、起動後の初回アクセス時に再生して復元する。
+    """
+    label = "タグのキャッシュ"
+
+    def __init__(self):
+        super().__init__()
+        self.entries: collections.OrderedDict[str, str] = collections.OrderedDict() # キー -> tags_str (古い順)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def path(self) -> str:
+        return os.path.join(get_base_upload_folder(), TAG_CACHE_FILE)
+
+    @staticmethod
+    def make_key(content_hash: str) -> str:
+        return f"{content_hash}:{current_gemini_model}:{tagging_prompt_hash()}"
+
+    def _reset(self):
+        self.entries.clear()
+
+    def _replay(self, record: dict):
+        self.entries[record["key"]] = record["tags"]
+        self.entries.move_to_end(record["key"])
+
+    def _snapshot(self) -> list[dict]:
+        return [{"key": key, "tags": tags} for key, tags in self.entries.items()] # 使われた順に書くので、再生後も LRU の順序が残る
+
+    def _live_count(self) -> int:
+        return len(self.entries)
+
+    def _on_loaded(self, found: bool):
+        self._evict()
+        if found: print(f"タグのキャッシュを読み込みました ({len(self.entries)} 件)。")
+
+    def _evict(self):
+        while len(self.entries) > max(0, TAG_CACHE_MAX_ENTRIES):
+            self.entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: str | None) -> str | None:
+        if key is None or TAG_CACHE_MAX_ENTRIES <= 0: return None
+        tags = self.entries.get(key)
+        if tags is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return tags
+
+    def put(self, key: str | None, tags_str: str):
+        """ タグが付いた結果だけを保存する (notags は失敗の場合もあるので、次回は Gemini に問い合わせ直す) """
+        if key is None or TAG_CACHE_MAX_ENTRIES <= 0 or tags_str == "notags": return
+        if self.entries.get(key) == tags_str: return
+        self.entries[key] = tags_str
+        self.entries.move_to_end(key)
+        self._evict()
+        self._append({"key": key, "tags": tags_str})
+        if self._log_lines > 2 * max(len(self.entries), TAG_CACHE_MAX_ENTRIES) + 100:
+            self._compact()
+
+async def get_tag_cache() -> TagCache:
+    tag_cache = get_storage_scoped("tag_cache", TagCache)
+    await tag_cache.ensure_loaded()
+    return tag_cache
+
+async def lookup_cached_tags(file_path: str, original_filename: str) -> tuple[str | None, str | None]:
+    """ Gemini を呼ぶ前にキャッシュを引く。(キャッシュのキー, キャッシュ済みのタグ) を返す """
+    if TAG_CACHE_MAX_ENTRIES <= 0: return None, None
+    content_hash = await local_storage.run(compute_file_sha256, file_path)
+    if content_hash is None: return None, None
+    cache_key = TagCache.make_key(content_hash)
+    cached_tags = (await get_tag_cache()).get(cache_key)
+    if cached_tags: print(f"'{original_filename}' は同じ内容・モデル・プロンプトでタグ付け済みのため、キャッシュのタグを使います: {cached_tags}")
+    return cache_key, cached_tags
+
+async def query_gemini_tags(file_path: str, original_filename: str, mime_type: str | None) -> str:
+    """ キャッシュを使わずに Gemini に問い合わせる。画像はバッチモードが有効ならバッチャー経由で処理する """
+    if GEMINI_BATCH_TAGGING and mime_type and mime_type.startswith("image/"):
+        return await gemini_tag_batcher.request_tags(file_path, original_filename, mime_type)
+    return await get_tags_from_gemini(file_path, original_filename, mime_type)
+
+async def request_gemini_tags(file_path: str, original_filename: str, mime_type: str | None) -> str:
+    """ 取り込み処理からのタグ付け入口。同じ内容・モデル・プロンプトでタグ付け済みならキャッシュの結果を返す """
+    cache_key, cached_tags = await lookup_cached_tags(file_path, original_filename)
+    if cached_tags: return cached_tags
+    tags_str = await query_gemini_tags(file_path, original_filename, mime_type)
+    (await get_tag_cache()).put(cache_key, tags_str)
+    return tags_str
+
+# --- 知覚ハッシュ (類似画像検索・重複検出) ---
+def compute_image_dhash(source) -> int | None:
+    """ 画像 (パスまたはファイルオブジェクト) の 64bit dHash を計算する。画像として読めない場合は None """
+    try:
+        with Image.open(source) as img:
+            img.draft("L", (64, 64)) # JPEGは縮小デコードで高速化
+            pixels = list(img.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    except Exception as e:
+        print(f"知覚ハッシュの計算に失敗しました: {e}")
+        return None
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+async def compute_image_dhash_async(source) -> int | None:
+    return await image_workers.dhash(source)
+
+def hamming_distance(a: int, b: int) -> int: return (a ^ b).bit_count()
+
+class BKTree:
+    """ ハミング距離による BK-tree。ノードは [hash, keys, {距離: 子ノード}] """
+    def __init__(self):
+        self.root = None
+
+    def add(self, hash_value: int, key: str):
+        if self.root is None:
+            self.root = [hash_value, [key], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(hash_value, node[0])
+            if distance == 0:
+                node[1].append(key)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hash_value, [key], {}]
+                return
+            node = child
+
+    def search(self, hash_value: int, max_distance: int) -> list[tuple[int, str]]:
+        results = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(hash_value, node[0])
+            if distance <= max_distance:
+                results.extend((distance, key) for key in node[1])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return sorted(results)
+
+class PerceptualHashIndex(JsonlStore):
+    """
+    保存済み画像 ("YYYYMM/ファイル名") の知覚ハッシュとタグを保持する索引。
+    変更は base_upload_folder 内の JSONL に追記し、起動後の初回アクセス時に再生して復元する。
+    """
+    label = "知覚ハッシュ索引"
+
+    def __init__(self):
+        super().__init__()
+        self.entries: dict[str, tuple[int, str]] = {} # filepath -> (hash, tags_str)
+        self.tree = BKTree()
+        self._stale = 0
+
+    @property
+    def path(self) -> str:
+        return os.path.join(get_base_upload_folder(), PHASH_INDEX_FILE)
+
+    def _reset(self):
+        self.entries.clear()
+        self.tree = BKTree()
+        self._stale = 0
+
+    def _replay(self, record: dict):
+        if record.get("op") == "remove": self.entries.pop(record["path"], None)
+        else: self.entries[record["path"]] = (int(record["hash"], 16), record.get("tags", "notags"))
+
+    def _snapshot(self) -> list[dict]:
+        return [{"op": "add", "path": filepath, "hash": f"{hash_value:016x}", "tags": tags}
+                for filepath, (hash_value, tags) in self.entries.items()]
+
+    def _live_count(self) -> int:
+        return len(self.entries)
+
+    def _on_loaded(self, found: bool):
+        self._rebuild_tree()
+        if found: print(f"知覚ハッシュ索引を読み込みました ({len(self.entries)} 件)。")
+
+    def _rebuild_tree(self):
+        self.tree = BKTree()
+        for filepath, (hash_value, _) in self.entries.items():
+            self.tree.add(hash_value, filepath)
+        self._stale = 0
+
+    def add(self, filepath: str, hash_value: int, tags_str: str):
+        if filepath in self.entries: self._stale += 1
+        self.entries[filepath] = (hash_value, tags_str)
+        self.tree.add(hash_value, filepath)
+        self._append({"op": "add", "path": filepath, "hash": f"{hash_value:016x}", "tags": tags_str})
+
+    def remove(self, filepath: str):
+        if self.entries.pop(filepath, None) is None: return
+        self._stale += 1
+        self._append({"op": "remove", "path": filepath})
+        if self._stale > len(self.entries) // 2 + 100:
+            self._rebuild_tree()
+
+    def get(self, filepath: str) -> tuple[int, str] | None:
+        return self.entries.get(filepath)
+
+    def search(self, hash_value: int, max_distance: int, exclude: str | None = None) -> list[tuple[int, str, str]]:
+        """ 距離 max_distance 以内の (距離, filepath, tags_str) を距離順に返す (削除済みの項目は除外) """
+        results = []
+        for distance, filepath in self.tree.search(hash_value, max_distance):
+            entry = self.entries.get(filepath)
+            if not entry or hamming_distance(entry[0], hash_value) != distance: continue # 古いハッシュのノード
+            if filepath == exclude or any(filepath == r[1] for r in results): continue
+            results.append((distance, filepath, entry[1]))
+        return results
+
+    def find_duplicate(self, hash_value: int) -> tuple[int, str, str] | None:
+        """ タグ付きの重複 (距離 PHASH_DUPLICATE_THRESHOLD 以内) を1件返す """
+        for match in self.search(hash_value, PHASH_DUPLICATE_THRESHOLD):
+            if match[2] != "notags": return match
+        return None
+
+async def get_phash_index() -> PerceptualHashIndex:
+    phash_index = get_storage_scoped("phash_index", PerceptualHashIndex)
+    await phash_index.ensure_loaded()
+    return phash_index
+
+# --- サムネイル ---
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv', '.webm')
+
+def get_thumbnail_path(filepath: str) -> str:
+    """ 保存済みファイル (YYYYMM/ファイル名) に対応するサムネイル (WebP) のローカルパス """
+    ym_dir_name, filename = filepath.split('/', 1)
+    return os.path.join(get_base_upload_folder(), THUMBNAIL_FOLDER_NAME, ym_dir_name, f"{filename}.webp")
+
+def create_image_thumbnail(source, thumb_path: str) -> bool:
+    """ 画像 (パスまたはファイルオブジェクト) から WebP サムネイルを作成する """
+    try:
+        with Image.open(source) as img:
+            img.draft("RGB", (THUMBNAIL_MAX_SIZE, THUMBNAIL_MAX_SIZE))
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((THUMBNAIL_MAX_SIZE, THUMBNAIL_MAX_SIZE))
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "transparency" in img.info or img.mode in ("LA", "PA") else "RGB")
+            os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+            img.save(thumb_path, "WEBP", quality=THUMBNAIL_QUALITY, method=4)
+        return True
+    except Exception as e:
+        print(f"サムネイルの作成に失敗しました ({thumb_path}): {e}")
+        return False
+
+async def create_video_poster(video_path: str, thumb_path: str, timeout_seconds: float = 30.0) -> bool:
+    """ ffmpeg で動画の先頭付近から1フレームを取り出し、WebP サムネイルにする (ffmpeg が無ければ何もしない) """
+    if not FFMPEG_PATH: return False
+    proc = None
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, "-v", "error", "-ss", "1", "-i", video_path, "-frames:v", "1",
+            "-vf", f"scale='min({THUMBNAIL_MAX_SIZE},iw)':-2", "-f", "image2pipe", "-vcodec", "png", "-",
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        frame_png, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout_seconds)
+        if not frame_png: # 1秒未満の動画は先頭フレームで再試行
+            proc = await asyncio.create_subprocess_exec(
+                FFMPEG_PATH, "-v", "error", "-i", video_path, "-frames:v", "1",
+                "-vf", f"scale='min({THUMBNAIL_MAX_SIZE},iw)':-2", "-f", "image2pipe", "-vcodec", "png", "-",
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            frame_png, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout_seconds)
+        if not frame_png:
+            print(f"動画のポスターフレームを取得できませんでした ({video_path}): {stderr.decode(errors='ignore').strip()}")
+            return False
+        return await image_workers.thumbnail(io.BytesIO(frame_png), thumb_path)
+    except asyncio.TimeoutError:
+        print(f"動画のポスターフレーム取得がタイムアウトしました ({video_path})")
+        if proc and proc.returncode is None: proc.kill()
+        return False
+    except Exception as e:
+        print(f"動画のポスターフレーム取得中にエラー ({video_path}): {e}")
+        return False
+
+async def render_thumbnail(source_path: str, thumb_path: str, ext: str) -> bool:
+    """ 拡張子 ext のファイルから thumb_path にサムネイルを作成する (対象外・失敗時は False) """
+    if ext in IMAGE_EXTENSIONS:
+        return await image_workers.thumbnail(source_path, thumb_path)
+    if ext in VIDEO_EXTENSIONS:
+        return await create_video_poster(source_path, thumb_path)
+    return False
+
+async def generate_thumbnail(source_path: str, filepath: str) -> str | None:
+    """ 保存したファイルのサムネイルを作成し、そのパスを返す (対象外・失敗時は None) """
+    thumb_path = get_thumbnail_path(filepath)
+    created = await render_thumbnail(source_path, thumb_path, os.path.splitext(filepath)[1].lower())
+    return thumb_path if created else None
+
+async def get_or_create_thumbnail(filepath: str) -> str | None:
+    """ サムネイルがあればそのパスを返す。ローカル保存のファイルで未作成なら、その場で作成する """
+    try: thumb_path = get_thumbnail_path(filepath)
+    except ValueError: return None
+    if await local_storage.is_file(thumb_path): return thumb_path
+    if get_upload_destination() in ("local", "tiered"):
+        ym_dir_name, filename = filepath.split('/', 1)
+        full_path = os.path.join(get_base_upload_folder(), ym_dir_name, filename)
+        if await local_storage.is_file(full_path):
+            return await generate_thumbnail(full_path, filepath)
+    return None
+
+async def remove_thumbnail(filepath: str):
+    try:
+        await local_storage.remove(get_thumbnail_path(filepath))
+    except Exception as e:
+        print(f"サムネイルの削除に失敗しました ({filepath}): {e}")
+
+# --- 画像処理ワーカー (プロセスプール) ---
+EXIF_SUMMARY_TAGS = {0x010F: "make", 0x0110: "model", 0x0112: "orientation", 0x0132: "datetime"}
+EXIF_IFD_SUMMARY_TAGS = {0x9003: "datetime_original"} # Exif IFD (0x8769) 内のタグ
+
+def read_exif_summary(img) -> dict:
+    """ 表示用に主な EXIF 項目 (メーカー・機種・向き・日時) を取り出す """
+    summary = {}
+    try:
+        exif = img.getexif()
+        for tag_id, key in EXIF_SUMMARY_TAGS.items():
+            if exif.get(tag_id) is not None: summary[key] = str(exif.get(tag_id)).strip("\x00 ")
+        exif_ifd = exif.get_ifd(0x8769)
+        for tag_id, key in EXIF_IFD_SUMMARY_TAGS.items():
+            if exif_ifd.get(tag_id) is not None: summary[key] = str(exif_ifd.get(tag_id)).strip("\x00 ")
+    except Exception as e:
+        print(f"EXIF の読み取りに失敗しました: {e}")
+    return summary
+
+def analyze_image_file(path: str, max_bytes: int, max_pixels: int) -> dict:
+    """ 取り込む画像の検査 (ワーカーで実行)。サイズ上限・展開爆弾 (画素数)・破損の検査、EXIF の読み取り、知覚ハッシュの計算 """
+    result = {"error": None, "hash": None, "width": None, "height": None, "format": None, "exif": {}}
+    try:
+        file_size = os.path.getsize(path)
+        if max_bytes and file_size > max_bytes:
+            result["error"] = f"ファイルサイズ ({file_size // (1024*1024)}MB) が画像処理の上限 ({max_bytes // (1024*1024)}MB) を超えています"
+            return result
+        with warnings.catch_warnings(): # 画素数はこの後で検査する
+            warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+            img = Image.open(path) # ヘッダーだけを読み、画素はまだ展開しない
+        with img:
+            result.update(width=img.width, height=img.height, format=img.format)
+            if max_pixels and img.width * img.height > max_pixels:
+                result["error"] = f"画素数 ({img.width}x{img.height}) が上限 ({max_pixels}) を超えています (展開爆弾の可能性)"
+                return result
+            img.verify()
+        with Image.open(path) as img: # verify 後は同じオブジェクトを使えない
+            result["exif"] = read_exif_summary(img)
+    except Exception as img_err:
+        result["error"] = str(img_err)
+        return result
+    result["hash"] = compute_image_dhash(path)
+    return result
+
+def image_worker_main(conn):
+    """ 画像処理ワーカープロセスの本体。起動したら pid を送り、(関数, 引数) を1件ずつ受け取って (成功したか, 結果かエラー文) を返す """
+    conn.send(os.getpid())
+    while True:
+        try: task = conn.recv()
+        except EOFError: return
+        if task is None: return
+        func, args = task
+        try: result = (True, func(*args))
+        except Exception as e: result = (False, f"{type(e).__name__}: {e}")
+        conn.send(result)
+
+class ImageWorker:
+    """ 画像処理ワーカープロセス1つ。同時に1件しか処理しないので、止まったときはこのプロセスだけを終了すればよい """
+    def __init__(self):
+        mp_context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = mp_context.Pipe()
+        self.process = mp_context.Process(target=image_worker_main, args=(child_conn,), name="image-worker", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+        self.ready: concurrent.futures.Future = concurrent.futures.Future() # 起動したらワーカーの pid
+        threading.Thread(target=self._wait_ready, name="image-worker-ready", daemon=True).start()
+
+    def _wait_ready(self):
+        try: self.ready.set_result(self.conn.recv())
+        except Exception as e: self.ready.set_exception(e)
+
+    def call(self, func, args: tuple, timeout: float):
+        """ 1件処理する。timeout 秒で終わらなければこのワーカーを強制終了して TimeoutError """
+        self.ready.result(timeout=timeout)
+        self.tasks += 1
+        self.conn.send((func, args))
+        if not self.conn.poll(timeout):
+            self.kill()
+            raise TimeoutError
+        ok, result = self.conn.recv() # ワーカーが落ちていれば EOFError
+        if not ok: raise RuntimeError(result)
+        return result
+
+    def retire(self):
+        try: self.conn.send(None) # 受け取った時点で終了する
+        except OSError: pass
+        self.conn.close()
+
+    def kill(self):
+        if self.process.is_alive(): self.process.kill()
+        self.conn.close()
+
+class ImageWorkerService:
+    """
+    Pillow の処理 (検証・展開爆弾の検査・EXIF・縮小・ハッシュ) を別プロセスのワーカーで実行し、イベントループを止めない。
+    image_worker_processes 本の受け渡し用スレッドがそれぞれ自分のワーカープロセスを1つ持ち、1件ずつ処理させる。
+    1件が image_worker_timeout_seconds を超えたり、ワーカーが異常終了したりした場合は、そのワーカーだけを作り直す。
+    ワーカーは image_worker_max_tasks_per_child 件ごとに入れ替える (メモリの断片化対策)。
+    image_worker_processes が 0 のときはスレッドで実行する。
+    """
+    def __init__(self):
+        self.dispatcher: concurrent.futures.ThreadPoolExecutor | None = None
+        self.workers: list[ImageWorker] = [] # 起動済みのワーカー (受け渡し用スレッドに割り当て済みのものを含む)
+        self.spare_workers: list[ImageWorker] = [] # 先に起動しておき、まだスレッドに割り当てていないワーカー
+        self.workers_lock = threading.Lock()
+        self.thread_state = threading.local() # 受け渡し用スレッドごとのワーカー
+        self.recycled = 0
+        self.timeouts = 0
+
+    def start(self) -> list[concurrent.futures.Future]:
+        """ ワーカーを先に起動しておく (起動にかかる時間を最初の画像の処理時間に含めないため)。各ワーカーの pid の Future を返す """
+        if IMAGE_WORKER_PROCESSES <= 0: return []
+        if self.dispatcher is None:
+            self.dispatcher = concurrent.futures.ThreadPoolExecutor(max_workers=IMAGE_WORKER_PROCESSES, thread_name_prefix="image-worker")
+        with self.workers_lock:
+            self.workers = [worker for worker in self.workers if worker.process.is_alive()]
+            self.spare_workers = [worker for worker in self.spare_workers if worker in self.workers]
+            while len(self.workers) < IMAGE_WORKER_PROCESSES:
+                worker = ImageWorker()
+                self.workers.append(worker)
+                self.spare_workers.append(worker)
+            return [worker.ready for worker in self.workers]
+
+    def _replace(self, worker: ImageWorker | None) -> ImageWorker:
+        """ このスレッドのワーカーを新しいもの (先に起動しておいたものがあればそれ) に取り替える """
+        with self.workers_lock:
+            if worker in self.workers: self.workers.remove(worker)
+            replacement = self.spare_workers.pop() if self.spare_workers else None
+            if replacement is None:
+                replacement = ImageWorker()
+                self.workers.append(replacement)
+        self.thread_state.worker = replacement
+        return replacement
+
+    def _call(self, func, args: tuple):
+        """ 受け渡し用スレッドで実行する。他のスレッドのワーカーには触れない """
+        worker = getattr(self.thread_state, "worker", None)
+        if worker is None or not worker.process.is_alive(): worker = self._replace(worker)
+        elif IMAGE_WORKER_MAX_TASKS_PER_CHILD and worker.tasks >= IMAGE_WORKER_MAX_TASKS_PER_CHILD:
+            worker.retire()
+            self.recycled += 1
+            worker = self._replace(worker)
+        for attempt in range(2): # ワーカーが異常終了していた場合は新しいワーカーで1回だけやり直す
+            try: return worker.call(func, args, IMAGE_WORKER_TIMEOUT_SECONDS)
+            except TimeoutError:
+                self.timeouts += 1
+                self.recycled += 1
+                self._replace(worker)
+                print(f"画像処理ワーカーを作り直しました ({func.__name__} が {IMAGE_WORKER_TIMEOUT_SECONDS} 秒以内に終わりませんでした)。")
+                raise RuntimeError(f"画像処理が {IMAGE_WORKER_TIMEOUT_SECONDS} 秒以内に終わりませんでした")
+            except (EOFError, OSError):
+                worker.kill()
+                self.recycled += 1
+                worker = self._replace(worker)
+                print("画像処理ワーカーが異常終了したため作り直しました。")
+                if attempt: raise RuntimeError("画像処理のワーカープロセスが異常終了しました")
+
+    async def run(self, func, *args):
+        if IMAGE_WORKER_PROCESSES <= 0:
+            return await asyncio.wait_for(asyncio.to_thread(func, *args), IMAGE_WORKER_TIMEOUT_SECONDS)
+        self.start()
+        return await asyncio.get_running_loop().run_in_executor(self.dispatcher, self._call, func, args)
+
+    async def inspect(self, path: str) -> dict:
+        """ analyze_image_file の結果。タイムアウトなども "error" に入れて返す """
+        try: return await self.run(analyze_image_file, path, IMAGE_MAX_BYTES, IMAGE_MAX_PIXELS)
+        except Exception as e:
+            return {"error": str(e), "hash": None, "width": None, "height": None, "format": None, "exif": {}}
+
+    async def dhash(self, source) -> int | None:
+        try: return await self.run(compute_image_dhash, source)
+        except Exception as e:
+            print(f"知覚ハッシュの計算に失敗しました: {e}")
+            return None
+
+    async def thumbnail(self, source, thumb_path: str) -> bool:
+        try: return await self.run(create_image_thumbnail, source, thumb_path)
+        except Exception as e:
+            print(f"サムネイルの作成に失敗しました ({thumb_path}): {e}")
+            return False
+
+image_workers = ImageWorkerService()
+
+# --- 検索式 (例: "tag:猫 type:video size>50MB date:20240101..20240331") ---
+QUERY_SIZE_RE = re.compile(r"^size(>=|<=|>|<)(\d+(?:\.\d+)?)([kmgt]?i?b?)$", re.IGNORECASE)
+QUERY_SIZE_UNITS = {"": 1, "b": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+QUERY_TYPE_ALIASES = {"image": "image", "画像": "image", "video": "video", "動画": "video", "other": "other", "その他": "other"}
+QUERY_NO_TAGS_VALUES = ("none", "notags", "なし")
+
+def parse_query_date(text: str, is_end: bool) -> str | None:
+    """ YYYYMMDD / YYYYMM / YYYY (区切りの - や / は無視) を範囲の端の "YYYYMMDD" にする """
+    digits = text.replace("-", "").replace("/", "")
+    if not digits.isdigit() or len(digits) not in (4, 6, 8): return None
+    if len(digits) == 8: return digits
+    if len(digits) == 6: return digits + ("31" if is_end else "01")
+    return digits + ("1231" if is_end else "0101")
+
+class FileQuery:
+    """
+    /files list の検索式を解析した結果。ファイル名から分かる条件 (キーワード・タグ・種類・日付) と
+    サイズ条件を持ち、アップロード先ごとの実行計画 (Drive の q 句・年月フォルダの絞り込み・全文検索索引) に変換する。
+    日付はファイル名の保存日 (YYYYMMDD) を基準にする。
+    """
+    def __init__(self):
+        self.keywords: list[str] = []   # ファイル名の部分一致 (従来の keyword と同じ)
+        self.tags: list[str] = []       # タグの部分一致 (すべて満たす)
+        self.no_tags = False
+        self.file_type: str | None = None # "image" / "video" / "other"
+        self.min_size: float | None = None
+        self.max_size: float | None = None
+        self.date_from: str | None = None # "YYYYMMDD" (含む)
+        self.date_to: str | None = None
+        self.plan: list[str] = []       # 実行した計画の説明 (表示用)
+
+    @property
+    def has_size_filter(self) -> bool:
+        return self.min_size is not None or self.max_size is not None
+
+    def month_in_range(self, year_month: str) -> bool:
+        if self.date_from and year_month < self.date_from[:6]: return False
+        if self.date_to and year_month > self.date_to[:6]: return False
+        return True
+
+    def matches_name(self, fname: str) -> bool:
+        """ ファイル名だけで判定できる条件をすべて満たすか """
+        fname_lower = fname.lower()
+        if any(kw not in fname_lower for kw in self.keywords): return False
+        parsed_info = parse_bot_filename(fname)
+        if self.no_tags and parsed_info["tags_raw"] != "notags": return False
+        if self.tags:
+            file_tags = [normalize_search_text(t) for t in parsed_info["tags_raw"].split("-")] if parsed_info["tags_raw"] != "notags" else []
+            if not all(any(tag in ft for ft in file_tags) for tag in self.tags): return False
+        if self.file_type:
+            ext = parsed_info["extension"].lower()
+            kind = "image" if ext in IMAGE_EXTENSIONS else "video" if ext in VIDEO_EXTENSIONS else "other"
+            if kind != self.file_type: return False
+        if self.date_from or self.date_to:
+            if not parsed_info["date"].isdigit(): return False
+            if self.date_from and parsed_info["date"] < self.date_from: return False
+            if self.date_to and parsed_info["date"] > self.date_to: return False
+        return True
+
+    def matches_size(self, size: int | None) -> bool:
+        if not self.has_size_filter: return True
+        if size is None: return False
+        if self.min_size is not None and size < self.min_size: return False
+        if self.max_size is not None and size > self.max_size: return False
+        return True
+
+    def drive_clauses(self) -> list[str]:
+        """ Drive の q に追加できる条件。結果が本来の条件の上位集合になるものだけを返す
+            (name contains は語の前方一致なのでタグの部分一致には使わない。
+             createdTime は保存日以降にしかならないが、tiered の移動や再試行で遅れることがあるため下限のみ) """
+        clauses = []
+        for kw in self.keywords:
+            sanitized_keyword = kw.replace("'", "\\'")
+            clauses.append(f"name contains '{sanitized_keyword}'")
+        if self.file_type in ("image", "video"):
+            # content_type 不明で保存されたファイルも取りこぼさないよう octet-stream も含める
+            clauses.append(f"(mimeType contains '{self.file_type}/' or mimeType = 'application/octet-stream')")
+        if self.date_from:
+            start = datetime.datetime.strptime(self.date_from, "%Y%m%d").astimezone(datetime.timezone.utc)
+            clauses.append(f"createdTime >= '{start.strftime('%Y-%m-%dT%H:%M:%S')}'")
+        return clauses
+
+    def describe(self) -> str:
+        parts = [f"`{kw}`" for kw in self.keywords] + [f"tag:`{t}`" for t in self.tags]
+        if self.no_tags: parts.append("タグなし")
+        if self.file_type: parts.append(f"type:`{self.file_type}`")
+        if self.min_size is not None: parts.append(f"size≥{self.min_size / 1024 / 1024:.1f}MB")
+        if self.max_size is not None: parts.append(f"size≤{self.max_size / 1024 / 1024:.1f}MB")
+        if self.date_from or self.date_to: parts.append(f"date:`{self.date_from or ''}..{self.date_to or ''}`")
+        return " ".join(parts)
+
+def parse_file_query(text: str | None) -> tuple[FileQuery, str | None]:
+    """ 検索式を FileQuery にする。戻り値は (FileQuery, エラーメッセージ)
+        書式: 語 (ファイル名の部分一致) / tag:猫 / tag:none / type:image|video|other / size>50MB / date:20240101..20240331 """
+    query = FileQuery()
+    if not text: return query, None
+    for token in unicodedata.normalize("NFKC", text).split(): # 全角の記号・英数字も受け付ける
+        lower = token.lower()
+        size_match = QUERY_SIZE_RE.match(lower)
+        if size_match:
+            op, number, unit = size_match.groups()
+            size_bytes = float(number) * QUERY_SIZE_UNITS[unit[:1]]
+            if op.startswith(">"): query.min_size = size_bytes + (0 if op == ">=" else 1)
+            else: query.max_size = size_bytes - (0 if op == "<=" else 1)
+            continue
+        if lower.startswith("size"):
+            return query, f"サイズ条件 `{token}` を解釈できません。例: `size>50MB`、`size<=500KB`"
+        field, sep, value = token.partition(":")
+        if not sep or not value:
+            query.keywords.append(lower)
+            continue
+        field = field.lower()
+        if field == "tag":
+            if value.lower() in QUERY_NO_TAGS_VALUES: query.no_tags = True
+            else: query.tags.extend(normalize_search_text(t) for t in re.split(r"[,、]+", value) if normalize_search_text(t))
+        elif field == "type":
+            file_type = QUERY_TYPE_ALIASES.get(value.lower())
+            if not file_type: return query, f"種類 `{value}` は指定できません。`image`、`video`、`other` のいずれかです。"
+            query.file_type = file_type
+        elif field == "date":
+            start_text, range_sep, end_text = value.partition("..")
+            date_from = parse_query_date(start_text, is_end=False) if start_text else None
+            date_to = parse_query_date(end_text if range_sep else start_text, is_end=True) if (end_text or not range_sep) else None
+            if (start_text and not date_from) or (range_sep and end_text and not date_to) or not (date_from or date_to):
+                return query, f"日付 `{value}` を解釈できません。例: `date:20240101..20240331`、`date:202405`"
+            query.date_from, query.date_to = date_from, date_to
+        elif field in ("uploader", "user"):
+            return query, "投稿者はファイル名に記録されていないため、絞り込みに使えません。"
         else:
-            print(f"Driveフォルダ '{folder_name}' が見つからないため、作成します...")
-            file_metadata = {
-                'name': folder_name,
-                'mimeType': 'application/vnd.google-apps.folder',
-                'parents': [parent_folder_id]
-            }
-            folder = gdrive_service.files().create(body=file_metadata, fields='id').execute()
-            print(f"Driveフォルダ '{folder_name}' を作成しました (ID: {folder.get('id')})。")
-            return folder.get('id')
+            return query, f"不明な条件 `{field}:` です。使える条件: `tag:` `type:` `size>` `size<` `date:`"
+    return query, None
+
+# --- 保存済みファイルの一覧取得 ---
+def parse_tag_filter(tag_filter: str | None) -> list[str]:
+    """ "猫 風景" や "猫,風景" のようなタグ指定を小文字のタグのリストにする """
+    if not tag_filter: return []
+    return [t for t in re.split(r"[\s,、-]+", tag_filter.strip().lower()) if t]
+
+def file_matches_tags(parsed_info: dict, required_tags: list[str]) -> bool:
+    """ ファイル名のタグ部分に、指定タグがすべて含まれるか """
+    if not required_tags: return True
+    file_tags = [t.lower() for t in parsed_info["tags_raw"].split("-")]
+    return all(any(req in ft for ft in file_tags) for req in required_tags)
+
+async def collect_local_files(year_month: str | None, keyword: str | None, required_tags: list[str],
+                              query: FileQuery | None = None) -> tuple[list[dict], str | None]:
+    """ ローカルの年月フォルダからファイル一覧を集める (query があれば年月フォルダを日付範囲で絞り込み、サイズは必要な時だけ調べる)
+        走査は local_storage のスレッドで os.scandir を使い、年月フォルダごとに1回で種別とサイズを読む """
+    base_folder = get_base_upload_folder()
+    if year_month:
+        months = [year_month]
+    else:
+        months = await local_storage.list_months(base_folder)
+        if months is None:
+            return [], f"ベースアップロードフォルダ '{base_folder}' がローカルに見つかりません。"
+    if query and months:
+        scanned_count = len(months)
+        months = [ym for ym in months if query.month_in_range(ym)]
+        query.plan.append(f"ローカル: 年月フォルダ {len(months)}/{scanned_count} 件を走査"
+                          + (" (サイズはメモリ内で判定)" if query.has_size_filter else ""))
+        if not months: return [], None # 日付範囲に該当する年月が無い
+    with_size = bool(query and query.has_size_filter)
+    try:
+        scanned = await local_storage.scan_months(base_folder, months, with_stat=with_size)
     except Exception as e:
-        print(f"Driveフォルダ '{folder_name}' の検索または作成中にエラー: {e}")
+        print(f"ローカルフォルダ '{base_folder}' のスキャン中にエラー: {e}")
+        scanned = {}
+    if not scanned:
+        if year_month: return [], f"指定された年月フォルダ '{year_month}' はローカルに見つかりません。"
+        return [], "検索対象のローカルフォルダが見つかりません。"
+
+    found_files_details = []
+    for current_year_month_name, entries in scanned.items():
+        for entry in entries:
+            fname = entry.name
+            if keyword and keyword.lower() not in fname.lower():
+                continue
+            parsed_info = parse_bot_filename(fname)
+            if not file_matches_tags(parsed_info, required_tags):
+                continue
+            if query:
+                if not query.matches_name(fname): continue
+                if with_size and not query.matches_size(entry.size): continue
+            found_files_details.append({
+                "fullname": fname, "date": parsed_info["date"],
+                "tags": parsed_info["tags_display"],
+                "original_name": parsed_info["original_stem"],
+                "year_month": current_year_month_name,
+                "size": entry.size,
+                "tier": "local"
+            })
+    return found_files_details, None
+
+async def collect_gdrive_files(year_month: str | None, keyword: str | None, required_tags: list[str],
+                              query: FileQuery | None = None) -> tuple[list[dict], str | None]:
+    """ Google Drive の年月フォルダからファイル一覧を集める (query があれば年月フォルダを絞り込み、条件の一部を q に含める)
+        シャードが複数あれば同時に問い合わせてまとめる """
+    shards = get_gdrive_shards()
+    if not shards:
+        if not gdrive_service:
+            return [], "Google Driveサービスが初期化されていません。設定を確認してください。"
+        return [], "Google DriveのメインターゲットフォルダIDが設定されていません。"
+    async def collect(shard: DriveShard) -> tuple[list[dict], str | None]:
+        try:
+            return await collect_gdrive_shard_files(shard, year_month, keyword, required_tags, query,
+                                                    plan_label="Drive" if len(shards) == 1 else f"Drive[{shard.name}]")
+        except DependencyUnavailableError as e:
+            return [], f"{e}。しばらくしてからもう一度お試しください。"
+    results = await asyncio.gather(*(collect(shard) for shard in shards))
+    if len(results) == 1: return results[0]
+
+    found_files_details, seen_paths, errors = [], set(), []
+    for shard_files, shard_error in results:
+        if shard_error: errors.append(shard_error)
+        for f in shard_files:
+            if (f["year_month"], f["fullname"]) in seen_paths: continue # リバランス途中で両方にある場合は先のシャードを優先
+            seen_paths.add((f["year_month"], f["fullname"]))
+            found_files_details.append(f)
+    if not found_files_details and len(errors) == len(results):
+        return [], errors[0]
+    found_files_details.sort(key=lambda f: f["fullname"])
+    found_files_details.sort(key=lambda f: f["year_month"], reverse=True)
+    return found_files_details, None
+
+async def collect_gdrive_shard_files(shard: DriveShard, year_month: str | None, keyword: str | None, required_tags: list[str],
+                                    query: FileQuery | None = None, plan_label: str = "Drive") -> tuple[list[dict], str | None]:
+    """ 1つのシャードの年月フォルダからファイル一覧を集める """
+    found_files_details = []
+    gdrive_folders_to_scan_info = []
+    if year_month:
+        ym_folder_id = await get_gdrive_folder_id_by_name(shard.folder_id, year_month, shard.service)
+        if ym_folder_id:
+            gdrive_folders_to_scan_info.append({'id': ym_folder_id, 'name': year_month})
+    else:
+        subfolders = await list_gdrive_subfolders(shard.folder_id, shard.service, name_pattern_re=r"^\d{6}$")
+        gdrive_folders_to_scan_info.extend(subfolders)
+    extra_clauses = None
+    if query and gdrive_folders_to_scan_info:
+        scanned_count = len(gdrive_folders_to_scan_info)
+        gdrive_folders_to_scan_info = [f for f in gdrive_folders_to_scan_info if query.month_in_range(f['name'])]
+        extra_clauses = query.drive_clauses()
+        query.plan.append(f"{plan_label}: 年月フォルダ {len(gdrive_folders_to_scan_info)}/{scanned_count} 件"
+                          + (f"、q に {len(extra_clauses)} 条件" if extra_clauses else ""))
+        if not gdrive_folders_to_scan_info: return [], None
+
+    if not gdrive_folders_to_scan_info:
+        msg = "検索対象の年月フォルダがGoogle Drive上に見つかりません。"
+        if year_month: msg = f"指定された年月フォルダ '{year_month}' はGoogle Drive上に見つかりません。"
+        return [], msg
+
+    for folder_info in gdrive_folders_to_scan_info:
+        try:
+            files_in_gdrive = await list_files_in_gdrive_folder(folder_info['id'], shard.service, keyword=keyword, extra_clauses=extra_clauses)
+            if files_in_gdrive is None:
+                print(f"Google Driveフォルダ '{folder_info['name']}' (ID: {folder_info['id']}) のファイル一覧取得に失敗しました。")
+                continue
+            for gfile in files_in_gdrive:
+                gfile_name = gfile.get("name")
+                if not gfile_name: continue
+                parsed_info = parse_bot_filename(gfile_name)
+                if not file_matches_tags(parsed_info, required_tags):
+                    continue
+                file_size = int(gfile["size"]) if gfile.get("size") else None
+                if query and not (query.matches_name(gfile_name) and query.matches_size(file_size)):
+                    continue
+                remember_gdrive_file_shard(gfile.get("id"), shard)
+                found_files_details.append({
+                    "fullname": gfile_name, "date": parsed_info["date"],
+                    "tags": parsed_info["tags_display"],
+                    "original_name": parsed_info["original_stem"],
+                    "year_month": folder_info['name'],
+                    "size": file_size,
+                    "gdrive_id": gfile.get("id"),
+                    "gdrive_link": gfile.get("webViewLink"),
+                    "gdrive_shard": shard.name,
+                    "tier": "gdrive"
+                })
+        except DependencyUnavailableError:
+            raise
+        except Exception as e:
+            print(f"Google Driveフォルダ '{folder_info['name']}' の処理中にエラー: {e}")
+    return found_files_details, None
+
+async def collect_indexed_files(year_month: str | None, query: FileQuery) -> list[dict] | None:
+    """ タグ条件のある検索式を全文検索索引から解決する (フォルダの走査をしない)
+        索引が未構築、または保存先が local 以外の場合は None を返す
+        (Drive のファイルは ID・リンク・サイズや削除の有無を Drive に問い合わせる必要があるため、通常の一覧に任せる) """
+    if get_upload_destination() != "local" or not query.tags: return None
+    search_index = await get_search_index()
+    if not search_index.is_built(): return None
+    candidates = None
+    for tag in query.tags:
+        tag_candidates = search_index.lookup_all(tag)
+        candidates = tag_candidates if candidates is None else candidates & tag_candidates
+    query.plan.append(f"全文検索索引: タグで {len(candidates)}/{len(search_index.doc_ids)} 件に絞り込み")
+
+    matched_paths = []
+    for filepath in sorted(candidates):
+        ym_dir_name, fname = filepath.split('/', 1)
+        if year_month and ym_dir_name != year_month: continue
+        if not query.month_in_range(ym_dir_name) or not query.matches_name(fname): continue
+        matched_paths.append((ym_dir_name, fname))
+    base_folder = get_base_upload_folder() # 存在確認とサイズはまとめて1回のスレッド呼び出しで
+    local_stats = await local_storage.stat_many([os.path.join(base_folder, ym, fname) for ym, fname in matched_paths])
+
+    found_files_details = []
+    for (ym_dir_name, fname), stat_result in zip(matched_paths, local_stats):
+        if stat_result is None: continue # 索引だけに残っている項目
+        file_size = stat_result.st_size # 通常の一覧と同じくサイズも表示する
+        if query.has_size_filter and not query.matches_size(file_size): continue
+        parsed_info = parse_bot_filename(fname)
+        found_files_details.append({
+            "fullname": fname, "date": parsed_info["date"],
+            "tags": parsed_info["tags_display"],
+            "original_name": parsed_info["original_stem"],
+            "year_month": ym_dir_name,
+            "size": file_size,
+            "tier": "local"
+        })
+    found_files_details.sort(key=lambda f: f["year_month"], reverse=True) # 年月は新しい順、月内は名前順
+    return found_files_details
+
+async def collect_stored_files(year_month: str | None = None, keyword: str | None = None,
+                               tag_filter: str | None = None, query: FileQuery | None = None) -> tuple[list[dict], str | None]:
+    """ 現在のアップロード先から保存済みファイルの一覧を集める。戻り値は (ファイル情報のリスト, エラーメッセージ)
+        tiered の場合はローカルと Drive の両方を集め、両方にあるファイルはローカル側を優先する
+        query (検索式) を渡すと、全文検索索引 → Drive の q 句・年月フォルダの絞り込み → メモリ内の判定 の順に安い方法で解決する。
+        実行した計画は query.plan に残る """
+    required_tags = parse_tag_filter(tag_filter)
+    current_upload_dest = get_upload_destination()
+    if year_month and not (len(year_month) == 6 and year_month.isdigit()):
+        return [], "年月の指定が正しくありません。YYYYMM形式で入力してください (例: 202305)。"
+    if query:
+        query.plan.clear()
+        indexed_files = await collect_indexed_files(year_month, query)
+        if indexed_files is not None:
+            return indexed_files, None
+
+    if current_upload_dest == "local":
+        return await collect_local_files(year_month, keyword, required_tags, query)
+    if current_upload_dest == "gdrive":
+        return await collect_gdrive_files(year_month, keyword, required_tags, query)
+    if current_upload_dest == "tiered":
+        local_files, local_error = await collect_local_files(year_month, keyword, required_tags, query)
+        if gdrive_available():
+            drive_files, drive_error = await collect_gdrive_files(year_month, keyword, required_tags, query)
+        else:
+            drive_files, drive_error = [], "Google Driveサービスが利用できません。"
+        if local_error and drive_error:
+            return [], local_error
+        local_paths = {(f["year_month"], f["fullname"]) for f in local_files}
+        merged = local_files + [f for f in drive_files if (f["year_month"], f["fullname"]) not in local_paths]
+        merged.sort(key=lambda f: f["fullname"])
+        merged.sort(key=lambda f: f["year_month"], reverse=True) # 年月は新しい順、月内は名前順
+        return merged, None
+    return [], f"不明なアップロード先が設定されています: {current_upload_dest}"
+
+async def resolve_file_tier(filepath: str) -> str:
+    """ 保存済みファイル (YYYYMM/ファイル名) を扱う層 ("local" / "gdrive") を返す
+        tiered の場合はローカルにあればローカル、無ければ Drive。それ以外はアップロード先の設定そのまま """
+    current_upload_dest = get_upload_destination()
+    if current_upload_dest == "gdrive" and (await get_degraded_queue()).contains("drive", filepath):
+        return "local" # Drive の障害中にローカルへ一時保存したもの
+    if current_upload_dest != "tiered": return current_upload_dest
+    try:
+        ym_dir_name, filename = filepath.split('/', 1)
+    except ValueError:
+        return "local"
+    if await local_storage.is_file(os.path.join(get_base_upload_folder(), ym_dir_name, filename)): return "local"
+    return "gdrive" if gdrive_available() else "local"
+
+# --- 全文検索 (/files search) ---
+KANA_FOLD_TABLE = str.maketrans({chr(c): chr(c - 0x60) for c in range(0x30A1, 0x30F7)}) # カタカナ -> ひらがな
+SEARCH_SEPARATORS_RE = re.compile(r"[\s_\-.,、。・/()\[\]「」【】]+")
+SEARCH_TAG_WEIGHT = 2.0 # タグ部分の一致を元ファイル名より重く数える
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+def normalize_search_text(text: str) -> str:
+    """ NFKC 正規化 (全角/半角の統一)・小文字化・カタカナのひらがな化を行い、区切り文字を空白にする """
+    text = unicodedata.normalize("NFKC", text).lower().translate(KANA_FOLD_TABLE)
+    return SEARCH_SEPARATORS_RE.sub(" ", text).strip()
+
+def search_ngrams(text: str, with_unigrams: bool = True) -> list[str]:
+    """ 正規化したテキストを区切りごとに文字 bigram (と unigram) に分解する """
+    grams = []
+    for segment in normalize_search_text(text).split():
+        if with_unigrams or len(segment) == 1: grams.extend(segment)
+        grams.extend(segment[i:i + 2] for i in range(len(segment) - 1))
+    return grams
+
+class SearchIndex(JsonlStore):
+    """
+    保存済みファイル ("YYYYMM/ファイル名") のタグと元ファイル名に対する文字 n-gram の転置索引。BM25 で順位付けする。
+    変更は base_upload_folder 内の JSONL に追記し、起動後の初回アクセス時に再生して復元する。
+    全件の再構築が済んでいない索引 (built でない) は検索に使わない。
+    """
+    label = "全文検索索引"
+
+    def __init__(self):
+        super().__init__()
+        self.doc_ids: dict[str, int] = {}          # filepath -> 文書ID
+        self.doc_paths: list[str | None] = []      # 文書ID -> filepath (削除済みは None)
+        self.doc_lengths: list[float] = []
+        self.postings: dict[str, dict[int, float]] = {} # n-gram -> {文書ID: 重み付き出現数}
+        self.total_length = 0.0
+        self.built = False
+        self.rebuild_lock = asyncio.Lock()
+        self._changes_during_rebuild: list[tuple[str, str]] | None = None # 再構築中の (op, filepath)。再構築の最後に再生する
+
+    @property
+    def path(self) -> str:
+        return os.path.join(get_base_upload_folder(), SEARCH_INDEX_FILE)
+
+    def _reset(self):
+        self.doc_ids.clear()
+        self.doc_paths.clear()
+        self.doc_lengths.clear()
+        self.postings.clear()
+        self.total_length = 0.0
+        self.built = False
+
+    def _replay(self, record: dict):
+        if record.get("op") == "built": self.built = True
+        elif record.get("op") == "remove": self._remove_doc(record["path"])
+        else: self._add_doc(record["path"])
+
+    def _snapshot(self) -> list[dict]:
+        return ([{"op": "built"}] if self.built else []) + [{"op": "add", "path": filepath} for filepath in self.doc_ids]
+
+    def _live_count(self) -> int:
+        return len(self.doc_ids)
+
+    def _on_loaded(self, found: bool):
+        if found: print(f"全文検索索引を読み込みました ({len(self.doc_ids)} 件)。")
+
+    @staticmethod
+    def _document_terms(filepath: str) -> dict[str, float]:
+        parsed = parse_bot_filename(filepath.split('/', 1)[-1])
+        terms: dict[str, float] = {}
+        if parsed["tags_raw"] != "notags":
+            for gram in search_ngrams(parsed["tags_raw"]): terms[gram] = terms.get(gram, 0.0) + SEARCH_TAG_WEIGHT
+        for gram in search_ngrams(parsed["original_stem"]): terms[gram] = terms.get(gram, 0.0) + 1.0
+        return terms
+
+    def _add_doc(self, filepath: str):
+        doc_id = self.doc_ids.get(filepath)
+        if doc_id is not None: self._remove_doc(filepath) # 同じファイルの追加し直しは同じ文書IDを使い回す
+        terms = self._document_terms(filepath)
+        length = sum(terms.values())
+        if doc_id is None:
+            doc_id = len(self.doc_paths)
+            self.doc_paths.append(filepath)
+            self.doc_lengths.append(length)
+        else:
+            self.doc_paths[doc_id] = filepath
+            self.doc_lengths[doc_id] = length
+        self.doc_ids[filepath] = doc_id
+        self.total_length += length
+        for gram, weight in terms.items():
+            self.postings.setdefault(gram, {})[doc_id] = weight
+
+    def _remove_doc(self, filepath: str) -> bool:
+        doc_id = self.doc_ids.pop(filepath, None)
+        if doc_id is None: return False
+        for gram in self._document_terms(filepath):
+            posting = self.postings.get(gram)
+            if posting is None: continue
+            posting.pop(doc_id, None)
+            if not posting: del self.postings[gram]
+        self.doc_paths[doc_id] = None
+        self.total_length -= self.doc_lengths[doc_id]
+        return True
+
+    def add(self, filepath: str):
+        self._add_doc(filepath)
+        self._append({"op": "add", "path": filepath})
+        if self._changes_during_rebuild is not None: self._changes_during_rebuild.append(("add", filepath))
+
+    def remove(self, filepath: str):
+        if self._changes_during_rebuild is not None: self._changes_during_rebuild.append(("remove", filepath))
+        if self._remove_doc(filepath):
+            self._append({"op": "remove", "path": filepath})
+
+    def rename(self, old_filepath: str, new_filepath: str):
+        self.remove(old_filepath)
+        self.add(new_filepath)
+
+    async def rebuild(self, only_if_unbuilt: bool = False) -> tuple[int, str | None]:
+        """ 現在のアップロード先の全ファイルから索引を作り直す。戻り値は (件数, エラーメッセージ) """
+        async with self.rebuild_lock:
+            await self.ensure_loaded()
+            if only_if_unbuilt and self.built: return len(self.doc_ids), None # 待っている間に他の呼び出しが構築済み
+            self._changes_during_rebuild = [] # 一覧の取得中に届いた追加・削除は、作り直した索引に後から反映する
+            try:
+                stored_files, error_msg = await collect_stored_files()
+                changes = self._changes_during_rebuild
+            finally:
+                self._changes_during_rebuild = None
+            if error_msg: return 0, error_msg
+            # ここから入れ替えまでは await しないので、検索が作りかけの索引を見ることはない
+            self._reset()
+            for f in stored_files:
+                self._add_doc(f"{f['year_month']}/{f['fullname']}")
+            for op, filepath in changes:
+                if op == "add": self._add_doc(filepath)
+                else: self._remove_doc(filepath)
+            self.built = True
+            self._compact()
+            print(f"全文検索索引を再構築しました ({len(self.doc_ids)} 件)。")
+            return len(self.doc_ids), None
+
+    def lookup_all(self, text: str) -> set[str]:
+        """ text の n-gram をすべて含むファイルの集合 (部分一致の候補。誤字は許容しない) """
+        doc_ids = None
+        for gram in set(search_ngrams(text, with_unigrams=False)):
+            posting = self.postings.get(gram, {})
+            doc_ids = set(posting) if doc_ids is None else doc_ids & posting.keys()
+            if not doc_ids: return set()
+        return {self.doc_paths[doc_id] for doc_id in doc_ids or ()}
+
+    def is_built(self) -> bool:
+        return self.built
+
+    async def ensure_built(self) -> str | None:
+        """ 未構築なら再構築する。エラー時はメッセージを返す """
+        if self.built: return None
+        _, error_msg = await self.rebuild(only_if_unbuilt=True)
+        return error_msg
+
+    def search(self, query: str, limit: int = 25) -> list[tuple[float, str]]:
+        """ query に一致するファイルを (スコア, filepath) のスコア順で返す
+            bigram の一部が一致しなくても (誤字・脱字) 一定数一致すれば候補にする。
+            走査するのは query の n-gram の転置リストだけなので、索引全体の件数には比例しない """
+        query_terms: dict[str, int] = {}
+        for gram in search_ngrams(query, with_unigrams=False):
+            query_terms[gram] = query_terms.get(gram, 0) + 1
+        if not query_terms or not self.doc_ids: return []
+
+        query_length = len(normalize_search_text(query).replace(" ", ""))
+        allowed_typos = 0 if query_length <= 2 else 1 if query_length <= 5 else 2
+        min_matched = max(1, sum(query_terms.values()) - 2 * allowed_typos) # 1文字の誤りで bigram は最大2つ外れる
+
+        doc_count = len(self.doc_ids)
+        average_length = self.total_length / doc_count if doc_count else 1.0
+        scores: dict[int, float] = {}
+        matched: dict[int, int] = {}
+        for gram, query_tf in query_terms.items():
+            posting = self.postings.get(gram)
+            if not posting: continue
+            idf = math.log(1 + (doc_count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, tf in posting.items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[doc_id] / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + query_tf * idf * tf * (BM25_K1 + 1) / (tf + norm)
+                matched[doc_id] = matched.get(doc_id, 0) + query_tf
+        candidates = ((score, self.doc_paths[doc_id]) for doc_id, score in scores.items() if matched[doc_id] >= min_matched)
+        return heapq.nlargest(limit, candidates) # 同点なら filepath (年月) の新しい方が先
+
+async def get_search_index() -> SearchIndex:
+    search_index = get_storage_scoped("search_index", SearchIndex)
+    await search_index.ensure_loaded()
+    return search_index
+
+# --- コンタクトシート (/files gallery) ---
+GALLERY_CACHE_DIR_NAME = "_gallery" # サムネイルフォルダ内のキャッシュ置き場
+GALLERY_FONT_CANDIDATES = (
+    "C:/Windows/Fonts/meiryo.ttc", "C:/Windows/Fonts/msgothic.ttc", "C:/Windows/Fonts/YuGothM.ttc",
+    "/System/Library/Fonts/ヒラギノ角ゴシック W3.ttc", "/System/Library/Fonts/Hiragino Sans GB.ttc",
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc", "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
+)
+_gallery_font_cache = {}
+
+def load_gallery_font(size: int):
+    """ ラベル用のフォントを読み込む。日本語フォントが見つからなければ Pillow の既定フォントを使う """
+    if size in _gallery_font_cache: return _gallery_font_cache[size]
+    font = None
+    for candidate in ((GALLERY_FONT_PATH,) if GALLERY_FONT_PATH else ()) + GALLERY_FONT_CANDIDATES:
+        if candidate and os.path.isfile(candidate):
+            try:
+                font = ImageFont.truetype(candidate, size)
+                break
+            except Exception as e:
+                print(f"ギャラリー用フォント '{candidate}' の読み込みに失敗しました: {e}")
+    if font is None:
+        try: font = ImageFont.load_default(size=size)
+        except TypeError: font = ImageFont.load_default() # 古い Pillow はサイズ指定不可
+    _gallery_font_cache[size] = font
+    return font
+
+def wrap_label(draw, text: str, font, max_width: int, max_lines: int = 2) -> list[str]:
+    """ ラベルを枠幅で折り返す。最終行に収まらない分は中央を省略する (拡張子が残るように) """
+    lines = []
+    while text and len(lines) < max_lines - 1 and draw.textlength(text, font=font) > max_width:
+        cut = len(text)
+        while cut > 1 and draw.textlength(text[:cut], font=font) > max_width: cut -= 1
+        lines.append(text[:cut])
+        text = text[cut:]
+    if draw.textlength(text, font=font) > max_width:
+        head, tail = text[:len(text) // 2], text[len(text) // 2:]
+        while head and tail:
+            if len(head) >= len(tail): head = head[:-1]
+            else: tail = tail[1:]
+            text = f"{head}…{tail}"
+            if draw.textlength(text, font=font) <= max_width: break
+    lines.append(text)
+    return lines
+
+def render_contact_sheet(entries: list[tuple[str, str | None]], columns: int, tile_size: int) -> "Image.Image":
+    """ (ラベル, サムネイルパス) のリストからグリッド画像を作る。サムネイルが無いものはプレースホルダを描く """
+    font_size = max(10, tile_size // 14)
+    font = load_gallery_font(font_size)
+    padding = 6
+    label_lines = 2
+    line_height = font_size + 2
+    label_height = line_height * label_lines + padding
+    cell_w, cell_h = tile_size + padding * 2, tile_size + padding + label_height
+    columns = max(1, min(columns, len(entries)))
+    rows = (len(entries) + columns - 1) // columns
+    sheet = Image.new("RGB", (cell_w * columns, cell_h * rows), (32, 34, 37))
+    draw = ImageDraw.Draw(sheet)
+    for index, (label, thumb_path) in enumerate(entries):
+        x0, y0 = (index % columns) * cell_w + padding, (index // columns) * cell_h + padding
+        tile = None
+        if thumb_path:
+            try:
+                with Image.open(thumb_path) as img:
+                    img.thumbnail((tile_size, tile_size))
+                    tile = img.convert("RGBA")
+            except Exception as e:
+                print(f"ギャラリー用サムネイルの読み込みに失敗しました ({thumb_path}): {e}")
+        if tile:
+            offset = (x0 + (tile_size - tile.width) // 2, y0 + (tile_size - tile.height) // 2)
+            sheet.paste(tile, offset, tile)
+        else:
+            draw.rectangle((x0, y0, x0 + tile_size - 1, y0 + tile_size - 1), fill=(54, 57, 63))
+            ext = os.path.splitext(label)[1].upper() or "FILE"
+            draw.text((x0 + tile_size // 2, y0 + tile_size // 2), ext, fill=(185, 187, 190), font=font, anchor="mm")
+        for line_index, line in enumerate(wrap_label(draw, label, font, tile_size, label_lines)):
+            draw.text((x0, y0 + tile_size + padding // 2 + line_index * line_height), line, fill=(220, 221, 222), font=font)
+    return sheet
+
+def encode_contact_sheet(sheet: "Image.Image", max_bytes: int) -> bytes | None:
+    """ JPEG にエンコードし、上限サイズに収まるまで品質・解像度を下げる。収まらなければ None """
+    current = sheet
+    for _ in range(4):
+        for quality in (85, 70, 55, 40):
+            buffer = io.BytesIO()
+            current.save(buffer, "JPEG", quality=quality, optimize=True)
+            if buffer.tell() <= max_bytes: return buffer.getvalue()
+        current = current.resize((max(1, current.width * 3 // 4), max(1, current.height * 3 // 4)), Image.LANCZOS)
+    return None
+
+def build_contact_sheets(entries: list[tuple[str, str | None]], max_bytes: int) -> list[bytes]:
+    """ エントリをシートに分割して描画・エンコードする。上限に収まらないシートはタイル数を半分にして作り直す """
+    sheets, start = [], 0
+    per_sheet = max(1, GALLERY_MAX_TILES_PER_SHEET)
+    while start < len(entries):
+        chunk = entries[start:start + per_sheet]
+        encoded = encode_contact_sheet(render_contact_sheet(chunk, GALLERY_COLUMNS, GALLERY_TILE_SIZE), max_bytes)
+        if encoded is None:
+            if per_sheet == 1:
+                print(f"コンタクトシートが上限サイズに収まりませんでした: {chunk[0][0]}")
+                start += 1
+                continue
+            per_sheet = max(1, per_sheet // 2)
+            continue
+        sheets.append(encoded)
+        start += len(chunk)
+    return sheets
+
+def get_gallery_cache_paths(scope_key: str) -> tuple[str, str]:
+    """ 絞り込み条件ごとのキャッシュ (マニフェストJSON, シート画像のファイル名接頭辞) """
+    cache_dir = os.path.join(get_base_upload_folder(), THUMBNAIL_FOLDER_NAME, GALLERY_CACHE_DIR_NAME)
+    scope_hash = hashlib.sha1(scope_key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{scope_hash}.json"), os.path.join(cache_dir, scope_hash)
+
+def load_cached_gallery(scope_key: str, signature: str) -> list[str] | None:
+    """ 署名 (ファイル一覧と描画設定) が一致するキャッシュ済みシートがあればそのパスを返す """
+    manifest_path, _ = get_gallery_cache_paths(scope_key)
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
         return None
+    sheet_paths = manifest.get("sheets", [])
+    if manifest.get("signature") != signature or not sheet_paths: return None
+    if not all(os.path.isfile(p) for p in sheet_paths): return None
+    return sheet_paths
+
+def store_gallery_cache(scope_key: str, signature: str, sheets: list[bytes]) -> list[str]:
+    """ シートを書き出してマニフェストを更新し、前回のシートで不要になったものを削除する """
+    manifest_path, sheet_prefix = get_gallery_cache_paths(scope_key)
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    old_paths = []
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            old_paths = json.load(f).get("sheets", [])
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    sheet_paths = []
+    for i, data in enumerate(sheets, start=1):
+        sheet_path = f"{sheet_prefix}_{signature[:8]}_{i}.jpg"
+        with open(sheet_path, "wb") as f:
+            f.write(data)
+        sheet_paths.append(sheet_path)
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump({"scope": scope_key, "signature": signature, "sheets": sheet_paths}, f, ensure_ascii=False)
+    for old_path in old_paths:
+        if old_path not in sheet_paths and os.path.exists(old_path):
+            try: os.remove(old_path)
+            except OSError as e: print(f"古いコンタクトシートの削除に失敗しました ({old_path}): {e}")
+    return sheet_paths
+
+async def get_gallery_thumbnail(file_info: dict, download_semaphore: asyncio.Semaphore) -> str | None:
+    """ ギャラリー用のサムネイルを用意する。Drive の画像でサムネイルが無い場合はダウンロードして作成する """
+    filepath = f"{file_info['year_month']}/{file_info['fullname']}"
+    thumb_path = await get_or_create_thumbnail(filepath)
+    if thumb_path or not file_info.get("gdrive_id") or not gdrive_available(): return thumb_path
+    if os.path.splitext(file_info["fullname"])[1].lower() not in IMAGE_EXTENSIONS: return None
+    async with download_semaphore:
+        file_bytes_io = await download_gdrive_file_to_bytesio(gdrive_service_for_file(file_info["gdrive_id"]), file_info["gdrive_id"])
+    if not file_bytes_io: return None
+    thumb_path = get_thumbnail_path(filepath)
+    created = await image_workers.thumbnail(file_bytes_io, thumb_path)
+    return thumb_path if created else None
+
+# --- ZIP エクスポート (/files export) ---
+EXPORT_DOWNLOAD_CONCURRENCY = 3 # Drive からの同時ダウンロード数 (ダウンロード済みで未書き込みのファイル数の上限も兼ねる)
+EXPORT_PART_MARGIN_BYTES = 256 * 1024 # multipart 送信のオーバーヘッド分の余裕
+EXPORT_STORED_EXTENSIONS = IMAGE_EXTENSIONS + VIDEO_EXTENSIONS + ('.mp3', '.m4a', '.ogg', '.flac', '.zip', '.7z', '.rar', '.gz', '.pdf')
+
+class ZipPartWriter:
+    """ ファイルを順に ZIP へ書き込み、パートごとのサイズ上限を超えないように分割する (同期。スレッドから呼ぶ)
+        1パートに収まらない大きなファイルは `.001`, `.002`... の断片に分けて連続するパートに格納する """
+    ENTRY_OVERHEAD = 30 + 46 + 2 * 28  # ローカルヘッダ + セントラルディレクトリ + ZIP64 拡張フィールド
+    END_OVERHEAD = 22 + 56 + 20        # 終端レコード (ZIP64 を含む)
+    COPY_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, out_dir: str, base_name: str, max_part_bytes: int):
+        self.out_dir = out_dir
+        self.base_name = base_name
+        self.max_part_bytes = max_part_bytes
+        self.part_number = 0
+        self.split_files = 0
+        self.zip = None
+        self.part_path = None
+        self.central_bytes = 0
+
+    def _entry_cost(self, arcname: str, size: int, compress_type: int) -> int:
+        name_len = len(arcname.encode("utf-8"))
+        cost = size + self.ENTRY_OVERHEAD + name_len * 2
+        if compress_type == zipfile.ZIP_DEFLATED: cost += size // 1000 + 64 # 圧縮できないデータでの deflate の膨張分
+        return cost
+
+    def _used_bytes(self) -> int:
+        if not self.zip: return 0
+        return self.zip.fp.tell() + self.central_bytes + self.END_OVERHEAD
+
+    def _open_part(self):
+        self.part_number += 1
+        self.part_path = os.path.join(self.out_dir, f"{self.base_name}_part{self.part_number:03d}.zip")
+        self.zip = zipfile.ZipFile(self.part_path, "w", allowZip64=True)
+        self.central_bytes = 0
+
+    def finish_part(self) -> str | None:
+        """ 書き込み中のパートを閉じてそのパスを返す (空なら None) """
+        if not self.zip: return None
+        self.zip.close()
+        finished_path, self.zip, self.part_path = self.part_path, None, None
+        return finished_path
+
+    def _write_entry(self, source, arcname: str, size: int, compress_type: int, date_time: tuple):
+        zinfo = zipfile.ZipInfo(arcname, date_time=date_time)
+        zinfo.compress_type = compress_type
+        zinfo.file_size = size
+        with self.zip.open(zinfo, "w") as dest:
+            remaining = size
+            while remaining > 0:
+                chunk = source.read(min(self.COPY_CHUNK_SIZE, remaining))
+                if not chunk: break
+                dest.write(chunk)
+                remaining -= len(chunk)
+        self.central_bytes += 46 + 28 + len(arcname.encode("utf-8"))
+
+    def add_file(self, source_path: str, arcname: str) -> list[str]:
+        """ ファイルを追加し、その過程で書き終えたパートのパスを返す """
+        finished = []
+        size = os.path.getsize(source_path)
+        date_time = time.localtime(os.path.getmtime(source_path))[:6]
+        if date_time[0] < 1980: date_time = (1980, 1, 1, 0, 0, 0)
+        ext = os.path.splitext(arcname)[1].lower()
+        compress_type = zipfile.ZIP_STORED if ext in EXPORT_STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+        cost = self._entry_cost(arcname, size, compress_type)
+
+        with open(source_path, "rb") as source:
+            if cost + self.END_OVERHEAD <= self.max_part_bytes:
+                if self.zip and self._used_bytes() + cost > self.max_part_bytes:
+                    finished.append(self.finish_part())
+                if not self.zip: self._open_part()
+                self._write_entry(source, arcname, size, compress_type, date_time)
+                return finished
+            # 1パートに収まらないので断片に分ける (無圧縮で格納し、受け取り側で連結する)
+            self.split_files += 1
+            piece_index, offset = 0, 0
+            while offset < size:
+                piece_index += 1
+                piece_name = f"{arcname}.{piece_index:03d}"
+                if not self.zip: self._open_part()
+                capacity = self.max_part_bytes - self._used_bytes() - self._entry_cost(piece_name, 0, zipfile.ZIP_STORED)
+                if capacity < self.COPY_CHUNK_SIZE and self.zip.infolist():
+                    finished.append(self.finish_part())
+                    self._open_part()
+                    capacity = self.max_part_bytes - self._used_bytes() - self._entry_cost(piece_name, 0, zipfile.ZIP_STORED)
+                piece_size = min(capacity, size - offset)
+                self._write_entry(source, piece_name, piece_size, zipfile.ZIP_STORED, date_time)
+                offset += piece_size
+                if offset < size: finished.append(self.finish_part())
+        return finished
+
+# --- GDrive フォルダ操作 (同期) ---
+def get_or_create_drive_folder(parent_folder_id: str, folder_name: str, service=None) -> str | None:
+    """ 同期関数。execute_gdrive_api_call 経由で呼ぶ (API のエラーはそのまま送出し、ブレーカーに数えさせる) """
+    service = service or gdrive_service
+    if not service or not google_drive_libs_available:
+        print("Driveサービスが利用不可のため、フォルダ操作はできません。")
+        return None
+    query = f"mimeType='application/vnd.google-apps.folder' and trashed=false and name='{folder_name}' and '{parent_folder_id}' in parents"
+    response = service.files().list(q=query, spaces='drive', fields='files(id, name)').execute()
+    folders = response.get('files', [])
+    if folders:
+        print(f"Driveフォルダ '{folder_name}' が見つかりました (ID: {folders[0].get('id')})。")
+        return folders[0].get('id')
+    else:
+        print(f"Driveフォルダ '{folder_name}' が見つからないため、作成します...")
+        file_metadata = {
+            'name': folder_name,
+            'mimeType': 'application/vnd.google-apps.folder',
+            'parents': [parent_folder_id]
+        }
+        folder = service.files().create(body=file_metadata, fields='id').execute()
+        print(f"Driveフォルダ '{folder_name}' を作成しました (ID: {folder.get('id')})。")
+        return folder.get('id')
+
+async def delete_gdrive_file(service, file_id: str) -> bool:
+    """ Drive のファイルを削除する。失敗したら False (ブレーカーが開いていれば DependencyUnavailableError) """
+    if await execute_gdrive_api_call(service.files().delete(fileId=file_id).execute, service=service) is None: return False
+    forget_gdrive_file_shard(file_id)
+    return True
 
 # --- GDrive アップロード (同期呼び出し含む) ---
-async def upload_to_gdrive(local_file_path: str, drive_filename: str, attachment_content_type: str) -> dict | None:
-    if not gdrive_service or not google_drive_libs_available:
+async def upload_to_gdrive(local_file_path: str, drive_filename: str, attachment_content_type: str, year_month: str | None = None,
+                          shard: DriveShard | None = None) -> dict | None:
+    """ Drive にアップロードする。shard を省略すると配置ポリシーでシャードを選ぶ。戻り値のファイル情報には "shard" (シャード名) が入る """
+    if not google_drive_libs_available:
         print("Google Driveサービスが利用できないため、アップロードをスキップします。")
         return None
-    if not GDRIVE_TARGET_FOLDER_ID:
-        print("Google DriveのターゲットフォルダIDが設定されていません。アップロードをスキップします。")
+    shard = shard or choose_gdrive_shard(drive_filename)
+    if not shard:
+        if not gdrive_service: print("Google Driveサービスが利用できないため、アップロードをスキップします。")
+        else: print("Google DriveのターゲットフォルダIDが設定されていません。アップロードをスキップします。")
         return None
 
-    parent_id_to_upload = GDRIVE_TARGET_FOLDER_ID
-    if GDRIVE_CREATE_YM_FOLDERS:
-        now = datetime.datetime.now()
-        year_month_folder_name = now.strftime("%Y%m")
-        # get_or_create_drive_folder は同期関数なので、ここではそのまま呼び出す
-        # 大量アップロード時にはここも非同期化の検討が必要になるかもしれないが、現状は許容
-        ym_drive_folder_id = get_or_create_drive_folder(GDRIVE_TARGET_FOLDER_ID, year_month_folder_name)
-        if ym_drive_folder_id:
-            parent_id_to_upload = ym_drive_folder_id
-        else:
-            print(f"年月フォルダ '{year_month_folder_name}' の準備に失敗したため、設定されたメインターゲットフォルダにアップロードします。")
+    parent_id_to_upload = shard.folder_id
+    try:
+        if GDRIVE_CREATE_YM_FOLDERS:
+            year_month_folder_name = year_month or datetime.datetime.now().strftime("%Y%m") # 指定が無ければ今月
+            ym_drive_folder_id = await execute_gdrive_api_call(get_or_create_drive_folder, shard.folder_id, year_month_folder_name,
+                                                               shard.service, service=shard.service)
+            if ym_drive_folder_id:
+                parent_id_to_upload = ym_drive_folder_id
+            else:
+                print(f"年月フォルダ '{year_month_folder_name}' の準備に失敗したため、設定されたメインターゲットフォルダにアップロードします。")
+        if not shard.breaker.allow(): raise DependencyUnavailableError(f"{shard.breaker.name} の呼び出しを停止中です")
+    except DependencyUnavailableError:
+        print(f"Google Drive ({shard.name}) の呼び出しを停止中のため、'{drive_filename}' のアップロードを見送ります。")
+        return None
 
     file_metadata = {'name': drive_filename, 'parents': [parent_id_to_upload]}
     try:
         mime_type = attachment_content_type if attachment_content_type else 'application/octet-stream'
         media = MediaFileUpload(local_file_path, mimetype=mime_type, resumable=True)
-        print(f"Google Drive ({parent_id_to_upload}) へ '{drive_filename}' をアップロード開始...")
+        print(f"Google Drive ({shard.name}: {parent_id_to_upload}) へ '{drive_filename}' をアップロード開始...")
         
-        # gdrive_service.files().create().execute() はブロッキングコール
+        # service.files().create().execute() はブロッキングコール
         # asyncio.to_thread を使って非同期に実行
         uploaded_file = await asyncio.to_thread(
-            gdrive_service.files().create(
+            shard.service.files().create(
                 body=file_metadata,
                 media_body=media,
                 fields='id, name, webViewLink, thumbnailLink, size'
             ).execute
         )
         print(f"ファイル '{uploaded_file.get('name')}' がGoogle Driveにアップロードされました。ID: {uploaded_file.get('id')}, Link: {uploaded_file.get('webViewLink')}")
+        shard.breaker.record_success()
+        remember_gdrive_file_shard(uploaded_file.get('id'), shard)
+        shard.uploaded_files += 1
+        uploaded_size = uploaded_file.get('size')
+        if not uploaded_size:
+            local_stat = await local_storage.stat(local_file_path)
+            uploaded_size = local_stat.st_size if local_stat else 0
+        shard.uploaded_bytes += int(uploaded_size)
+        uploaded_file["shard"] = shard.name
         return uploaded_file
     except Exception as e:
         print(f"Google Driveへのファイルアップロード中にエラーが発生しました: {e}")
+        shard.breaker.record(e)
         return None
 
+# --- 階層化ストレージ (tiered): ローカルから Drive への移動 ---
+tier_migration_lock = asyncio.Lock()
+tier_mover_task = None
+
+def get_disk_usage() -> tuple[float, int, int]:
+    """ ベースフォルダのあるディスクの (使用率%, 使用バイト数, 全体バイト数) """
+    usage = shutil.disk_usage(get_base_upload_folder() if os.path.exists(get_base_upload_folder()) else ".")
+    return (usage.used / usage.total * 100 if usage.total else 0.0), usage.used, usage.total
+
+def select_tier_migration_candidates(now: float | None = None) -> tuple[list[dict], float]:
+    """ Drive へ移動するローカルファイルを選ぶ。戻り値は (候補のリスト (古い順), 現在のディスク使用率)
+        一定日数より古いファイルに加え、ディスク使用率が上限を超えていれば下限を下回るまで古い順に追加する """
+    now = now or time.time()
+    local_files = []
+    for ym, entries in (scan_local_months(get_base_upload_folder(), with_stat=True) or {}).items():
+        for entry in entries:
+            local_files.append({"filepath": f"{ym}/{entry.name}", "year_month": ym, "fullname": entry.name,
+                                "local_path": entry.path, "mtime": entry.mtime, "size": entry.size})
+    local_files.sort(key=lambda f: f["mtime"])
+
+    usage_percent, used_bytes, total_bytes = get_disk_usage()
+    age_limit = now - TIERED_MIGRATE_AFTER_DAYS * 86400
+    candidates = [f for f in local_files if f["mtime"] < age_limit]
+    if usage_percent > TIERED_DISK_USAGE_HIGH_PERCENT:
+        bytes_to_free = used_bytes - total_bytes * TIERED_DISK_USAGE_LOW_PERCENT / 100
+        bytes_to_free -= sum(f["size"] for f in candidates)
+        for f in local_files:
+            if bytes_to_free <= 0: break
+            if f["mtime"] >= age_limit:
+                candidates.append(f)
+                bytes_to_free -= f["size"]
+    return candidates, usage_percent
+
+async def migrate_file_to_gdrive(candidate: dict) -> bool:
+    """ 1ファイルを Drive へ移動する。アップロード (または既存コピーの確認) が済んでからローカルを削除する
+        Drive のブレーカーが開いていれば DependencyUnavailableError (それ以外の失敗は False) """
+    filepath, local_path = candidate["filepath"], candidate["local_path"]
+    existing_shard, existing_id = await find_gdrive_file(filepath)
+    if existing_id: # 前回の移動がアップロード後に中断していた場合など
+        metadata = await execute_gdrive_api_call(existing_shard.service.files().get(fileId=existing_id, fields="size").execute,
+                                                 service=existing_shard.service)
+        if metadata is None: return False # サイズを確認できない
+        uploaded_size = int(metadata.get("size", -1))
+        local_stat = await local_storage.stat(local_path)
+        if local_stat is not None and uploaded_size != local_stat.st_size: # 途中で切れたアップロードなど: 消してアップロードし直す
+            print(f"Drive上のコピーのサイズ ({uploaded_size}) がローカル ({local_stat.st_size}) と一致しないため、アップロードし直します: {filepath}")
+            if not await delete_gdrive_file(existing_shard.service, existing_id): return False
+            existing_id = None
+    if not existing_id:
+        mime_type = mimetypes.guess_type(candidate["fullname"])[0]
+        uploaded = await upload_to_gdrive(local_path, candidate["fullname"], mime_type, year_month=candidate["year_month"])
+        if not uploaded:
+            if not gdrive_breakers_closed(): raise DependencyUnavailableError("Google Drive の呼び出しを停止中です")
+            return False
+        existing_id, uploaded_size = uploaded.get("id"), int(uploaded.get("size", -1))
+    local_stat = await local_storage.stat(local_path)
+    if local_stat is None:
+        # 移動中にユーザーがローカルのファイルを削除した: Drive 側のコピーも消して整合させる
+        await delete_gdrive_file(gdrive_service_for_file(existing_id), existing_id)
+        print(f"移動中に削除されたため、Drive上のコピーも削除しました: {filepath}")
+        return False
+    if uploaded_size != local_stat.st_size:
+        print(f"Drive上のサイズ ({uploaded_size}) がローカル ({local_stat.st_size}) と一致しないため、ローカルを残します: {filepath}")
+        return False
+    await local_storage.remove(local_path)
+    print(f"'{filepath}' を Google Drive へ移動しました。")
+    return True
+
+async def run_tier_migration() -> dict:
+    """ tiered モードの移動処理を1回実行し、結果の集計を返す """
+    stats = {"candidates": 0, "moved": 0, "failed": 0, "moved_bytes": 0, "usage_before": 0.0, "usage_after": 0.0}
+    if get_upload_destination() != "tiered": return stats
+    if not gdrive_available():
+        print("tiered: Google Driveサービスが利用できないため、移動処理をスキップします。")
+        return stats
+    async with tier_migration_lock:
+        candidates, stats["usage_before"] = await local_storage.run(select_tier_migration_candidates)
+        stats["candidates"] = len(candidates)
+        semaphore = asyncio.Semaphore(2)
+        async def migrate_one(candidate: dict):
+            async with semaphore:
+                try: moved = await migrate_file_to_gdrive(candidate)
+                except Exception as e:
+                    print(f"'{candidate['filepath']}' の Drive への移動中にエラー: {e}")
+                    moved = False
+            if moved:
+                stats["moved"] += 1
+                stats["moved_bytes"] += candidate["size"]
+            else:
+                stats["failed"] += 1
+        await asyncio.gather(*(migrate_one(c) for c in candidates))
+        stats["usage_after"] = (await local_storage.run(get_disk_usage))[0]
+    if stats["candidates"]:
+        print(f"tiered 移動処理: {stats['moved']}/{stats['candidates']} 件を移動 ({round(stats['moved_bytes'] / (1024*1024), 2)} MB), "
+              f"ディスク使用率 {stats['usage_before']:.1f}% -> {stats['usage_after']:.1f}%")
+    return stats
+
+async def tier_mover_loop():
+    """ tiered モードのときに定期的に移動処理を実行するバックグラウンドタスク """
+    while True:
+        for guild_ctx in known_guild_contexts(): # サーバーごとの保存先を順に処理する
+            try:
+                await enter_guild_context(guild_ctx.guild_id)
+                await run_tier_migration()
+            except Exception as e:
+                print(f"tiered 移動処理 ({guild_ctx.label}) でエラーが発生しました: {e}")
+        await asyncio.sleep(max(1, TIERED_MOVER_INTERVAL_MINUTES) * 60)
+
+def start_tier_mover():
+    """ 移動処理のバックグラウンドタスクを開始する (既に動いていれば何もしない。tiered 以外では各回で何もしない) """
+    global tier_mover_task
+    if tier_mover_task is None or tier_mover_task.done():
+        tier_mover_task = asyncio.create_task(tier_mover_loop())
+
+# --- Drive シャードのリバランス ---
+gdrive_rebalance_lock = asyncio.Lock()
+
+async def move_gdrive_file_between_shards(file_info: dict, source: DriveShard, target: DriveShard) -> bool:
+    """ 1ファイルを別のシャードへ移す。移動先へのアップロードとサイズ確認が済んでから移動元を削除する """
+    filepath = f"{file_info['year_month']}/{file_info['fullname']}"
+    temp_dir = os.path.join(get_base_upload_folder(), "temp")
+    await local_storage.makedirs(temp_dir)
+    temp_path = os.path.join(temp_dir, f"rebalance_{file_info['gdrive_id']}{os.path.splitext(file_info['fullname'])[1]}")
+    try:
+        if not await download_gdrive_file_to_path(source.service, file_info["gdrive_id"], temp_path): return False
+        mime_type = mimetypes.guess_type(file_info["fullname"])[0]
+        uploaded = await upload_to_gdrive(temp_path, file_info["fullname"], mime_type, year_month=file_info["year_month"], shard=target)
+        if not uploaded: return False
+        temp_stat = await local_storage.stat(temp_path)
+        if not temp_stat or int(uploaded.get("size", -1)) != temp_stat.st_size:
+            print(f"移動先のサイズが一致しないため、移動元を残します: {filepath}")
+            await delete_gdrive_file(target.service, uploaded["id"])
+            return False
+        if not await delete_gdrive_file(source.service, file_info["gdrive_id"]):
+            print(f"移動元のコピーを削除できなかったため、移動先のコピーを削除します: {filepath}")
+            await delete_gdrive_file(target.service, uploaded["id"])
+            return False
+        print(f"'{filepath}' を Driveシャード '{source.name}' から '{target.name}' へ移動しました。")
+        return True
+    finally:
+        await local_storage.remove(temp_path)
+
+async def rebalance_gdrive_shards(max_files: int) -> dict:
+    """ シャード間の保存量 (アーカイブ内のファイルサイズの合計) が揃うように、多いシャードから少ないシャードへ移す """
+    stats = {"moved": 0, "failed": 0, "moved_bytes": 0, "before": {}, "after": {}}
+    shards = get_gdrive_shards()
+    if len(shards) < 2: return stats
+    async with gdrive_rebalance_lock:
+        try: listings = await asyncio.gather(*(collect_gdrive_shard_files(shard, None, None, []) for shard in shards))
+        except DependencyUnavailableError as e: # 一部のシャードの一覧が欠けたまま偏りを判断しない
+            print(f"Driveシャードのリバランスを中止しました: {e}")
+            return stats
+        files_by_shard = {shard.name: sorted((f for f in files if f.get("size")), key=lambda f: f["size"], reverse=True)
+                          for shard, (files, _) in zip(shards, listings)}
+        used = {name: sum(f["size"] for f in files) for name, files in files_by_shard.items()}
+        stats["before"] = dict(used)
+        shard_by_name = {shard.name: shard for shard in shards}
+        while stats["moved"] + stats["failed"] < max_files:
+            source_name = max(used, key=used.get)
+            target_name = min(used, key=used.get)
+            gap = (used[source_name] - used[target_name]) / 2
+            # 差の半分以下で最大のファイルを移す (移しても逆転しない)
+            candidate = next((f for f in files_by_shard[source_name] if f["size"] <= gap), None)
+            if not candidate: break
+            files_by_shard[source_name].remove(candidate)
+            try: moved = await move_gdrive_file_between_shards(candidate, shard_by_name[source_name], shard_by_name[target_name])
+            except DependencyUnavailableError as e:
+                print(f"Driveシャードのリバランスを中断しました: {e}")
+                break
+            if moved:
+                used[source_name] -= candidate["size"]
+                used[target_name] += candidate["size"]
+                stats["moved"] += 1
+                stats["moved_bytes"] += candidate["size"]
+            else:
+                stats["failed"] += 1
+        stats["after"] = dict(used)
+    print(f"Driveシャードのリバランス完了: {stats}")
+    return stats
+
 # --- 確認ビュー (ファイル削除用) ---
 class ConfirmDeleteView(discord.ui.View):
     def __init__(self, author_id: int, file_path_to_delete: str, filename_display: str): # file_path_to_delete はローカルパスまたはGDrive ID
@@ -547,168 +3167,1790 @@ class ConfirmDeleteView(discord.ui.View):
         await interaction.response.edit_message(content=f"ファイル `{self.filename_display}` の削除はキャンセルされました。", view=self)
         self.stop()
 
-    async def on_timeout(self):
-        if self.confirmed is None:
-            for item in self.children:
-                item.disabled = True
-            if self.interaction_message:
-                try:
-                    await self.interaction_message.edit(content=f"ファイル `{self.filename_display}` の削除確認がタイムアウトしました。", view=self)
-                except discord.NotFound: pass
-                except discord.HTTPException as e: print(f"タイムアウト時のメッセージ編集エラー: {e}")
-            self.stop()
+    async def on_timeout(self):
+        if self.confirmed is None:
+            for item in self.children:
+                item.disabled = True
+            if self.interaction_message:
+                try:
+                    await self.interaction_message.edit(content=f"ファイル `{self.filename_display}` の削除確認がタイムアウトしました。", view=self)
+                except discord.NotFound: pass
+                except discord.HTTPException as e: print(f"タイムアウト時のメッセージ編集エラー: {e}")
+            self.stop()
+
+# --- 取り込み状況の表示 (投稿ごとに1つのメッセージにまとめる) ---
+class IngestStatusBoard:
+    """
+    1つの投稿の添付ファイルの取り込み状況を1つのメッセージにまとめて表示する。各ファイルの状況の更新は行を書き換えるだけで、
+    メッセージの編集は ingest_status_edit_interval_seconds に1回までにまとめる (チャンネルのレート制限に当たらないように)。
+    """
+    MARKS = {"running": "⏳", "done": "✅", "failed": "⚠️"}
+    MAX_CONTENT_LENGTH = 1900 # Discord のメッセージ上限 (2000文字) より少し短く
+
+    def __init__(self, source_id: int, channel, message=None):
+        self.source_id = source_id # 投稿 (再起動後は状況メッセージ) のID
+        self.channel = channel
+        self.message = message # 再起動後のライトバックジョブでは既存のメッセージ (部分メッセージ) を引き継ぐ
+        self.rows: dict[str, list] = {} # 行キー -> [状態, 表示内容]
+        self.rendered: str | None = None
+        self.last_edit = 0.0
+        self.send_lock = asyncio.Lock()
+        self.flusher: asyncio.Task | None = None
+
+    def line(self, key: str, text: str) -> "IngestStatusLine":
+        self.set(key, "running", text)
+        return IngestStatusLine(self, key)
+
+    @property
+    def finished(self) -> bool:
+        return all(state != "running" for state, _ in self.rows.values())
+
+    def set(self, key: str, state: str, text: str):
+        self.rows[key] = [state, text]
+        if self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self._flush())
+
+    def render(self) -> str:
+        done = sum(1 for state, _ in self.rows.values() if state == "done")
+        failed = sum(1 for state, _ in self.rows.values() if state == "failed")
+        header = f"取り込み状況: 完了 {done}/{len(self.rows)} 件" + (f" (失敗 {failed} 件)" if failed else "")
+        lines = [f"{self.MARKS[state]} {text}" for state, text in self.rows.values()]
+        content = "\n".join([header, *lines])
+        if len(content) > self.MAX_CONTENT_LENGTH: # 長すぎる場合は各行を1行目だけにし、それでも長ければ末尾を省く
+            lines = [line.split("\n", 1)[0] for line in lines]
+            content = header
+            for index, line in enumerate(lines):
+                if len(content) + len(line) + 20 > self.MAX_CONTENT_LENGTH:
+                    content += f"\n… 他 {len(lines) - index} 件"
+                    break
+                content += "\n" + line
+        return content
+
+    async def ensure_sent(self):
+        """ 状況メッセージがまだなければ送信する (ライトバックのジャーナルにメッセージIDを記録するため) """
+        async with self.send_lock:
+            if self.message is not None: return
+            content = self.render()
+            try:
+                self.message = await self.channel.send(content)
+                self.rendered, self.last_edit = content, time.monotonic()
+            except discord.HTTPException as e: print(f"取り込み状況メッセージの送信に失敗しました: {e}")
+
+    async def _flush(self):
+        """ 最後の編集から間隔を空けて、溜まった更新をまとめて1回の編集で反映する。変化がなくなったら終わる """
+        try:
+            while True:
+                if self.message is None:
+                    await self.ensure_sent()
+                    if self.message is None: return
+                    continue
+                wait_seconds = self.last_edit + INGEST_STATUS_EDIT_INTERVAL_SECONDS - time.monotonic()
+                if wait_seconds > 0: await asyncio.sleep(wait_seconds)
+                content = self.render()
+                if content == self.rendered: break
+                self.rendered, self.last_edit = content, time.monotonic()
+                try: await self.message.edit(content=content)
+                except discord.HTTPException as e: print(f"取り込み状況メッセージの編集に失敗しました: {e}")
+        finally:
+            if self.finished and ingest_status_boards.get(self.source_id) is self: del ingest_status_boards[self.source_id]
+
+class IngestStatusLine:
+    """ 状況メッセージの中の、添付ファイル1件分の行 """
+    def __init__(self, board: IngestStatusBoard, key: str):
+        self.board, self.key = board, key
+
+    def update(self, text: str):
+        self.board.set(self.key, "running", text)
+
+    def done(self, text: str):
+        self.board.set(self.key, "done", text)
+
+    def fail(self, text: str):
+        self.board.set(self.key, "failed", text)
+
+    @property
+    def running(self) -> bool:
+        return self.board.rows[self.key][0] == "running"
+
+    @property
+    def message_id(self) -> int | None:
+        return getattr(self.board.message, "id", None)
+
+ingest_status_boards: dict[int, IngestStatusBoard] = {} # 投稿のID -> 更新中のボード (全ファイルの表示が終わったら外す)
+
+def get_ingest_status_board(source_id: int, channel, message=None) -> IngestStatusBoard:
+    board = ingest_status_boards.get(source_id)
+    if board is None: board = ingest_status_boards[source_id] = IngestStatusBoard(source_id, channel, message)
+    return board
+
+# --- 取り込みの受け付け制御 (ユーザー・チャンネルごとの上限と順番待ち) ---
+class TokenBucket:
+    """ 1分あたり rate_per_minute まで (同じ量まではまとめて) 取り込めるトークンバケット。予約した分だけ残量は負になりうる """
+    def __init__(self, rate_per_minute: float):
+        self.rate_per_minute = rate_per_minute
+        self.tokens = rate_per_minute
+        self.updated = time.monotonic()
+
+    def configure(self, rate_per_minute: float):
+        if rate_per_minute == self.rate_per_minute: return
+        self._refill()
+        self.rate_per_minute = rate_per_minute
+        self.tokens = min(self.tokens, rate_per_minute)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate_per_minute, self.tokens + (now - self.updated) * self.rate_per_minute / 60.0)
+        self.updated = now
+
+    def wait_seconds(self, amount: float) -> float:
+        """ amount を取り出せるまでの秒数 (1回分はバケットの容量までとして扱う) """
+        self._refill()
+        deficit = min(amount, self.rate_per_minute) - self.tokens
+        return deficit * 60.0 / self.rate_per_minute if deficit > 0 else 0.0
+
+    def take(self, amount: float):
+        self._refill()
+        self.tokens -= min(amount, self.rate_per_minute)
+
+    def refund(self, amount: float):
+        self._refill()
+        self.tokens = min(self.rate_per_minute, self.tokens + min(amount, self.rate_per_minute))
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.rate_per_minute
+
+class IngestAdmission:
+    """
+    添付ファイルの取り込みの受け付け制御。ユーザー・チャンネルごとにファイル数とサイズのトークンバケットで流量を抑え、
+    BOT全体で同時に受け付ける件数を ingest_max_queue_depth までにする。上限を超えた添付は順番待ちにして位置を返信し、
+    待ちきれない量 (待ち時間・順番待ちの上限超え) は断る。過負荷でもタスクやスプールが際限なく増えないようにする。
+    """
+    BUCKET_LIMITS = (("user", "files", "ingest_user_files_per_minute"), ("user", "bytes", "ingest_user_mb_per_minute"),
+                     ("channel", "files", "ingest_channel_files_per_minute"), ("channel", "bytes", "ingest_channel_mb_per_minute"))
+    MAX_BUCKETS = 10000 # これを超えたら満タンに戻ったバケットを捨てる
+
+    def __init__(self):
+        self.buckets: dict[tuple, TokenBucket] = {}
+        self.active = 0 # 受け付け中 (処理中・ライトバック待ち) の添付の数
+        self.waiting: collections.deque[asyncio.Future] = collections.deque()
+        self.tickets: set[int] = set()
+        self.ticket_counter = 0
+        self.stats = {"admitted": 0, "delayed": 0, "queued": 0, "rejected": 0}
+
+    @staticmethod
+    def global_limit(key: str) -> int:
+        return int(bot_config.get(key, DEFAULT_CONFIG[key]) or 0)
+
+    def _charges(self, message, attachment) -> list[tuple[TokenBucket, float]]:
+        """ この添付で消費する (バケット, 量) の一覧。上限 0 のバケットは対象外 """
+        guild_ctx = get_current_guild_context()
+        owners = {"user": message.author.id, "channel": message.channel.id}
+        if len(self.buckets) > self.MAX_BUCKETS:
+            self.buckets = {key: bucket for key, bucket in self.buckets.items() if not bucket.full}
+        charges = []
+        for scope, unit, setting_key in self.BUCKET_LIMITS:
+            limit = float(guild_ctx.setting(setting_key) or 0)
+            if limit <= 0: continue
+            rate, amount = (limit, 1) if unit == "files" else (limit * 1024 * 1024, attachment.size or 0)
+            key = (scope, unit, owners[scope])
+            bucket = self.buckets.get(key)
+            if bucket is None: bucket = self.buckets[key] = TokenBucket(rate)
+            else: bucket.configure(rate)
+            charges.append((bucket, amount))
+        return charges
+
+    async def admit(self, message, attachment, status: IngestStatusLine) -> int | None:
+        """ 受け付けたらチケット番号を返す (処理が終わったら release する)。断った場合は返信して None """
+        charges = self._charges(message, attachment)
+        delay = max((bucket.wait_seconds(amount) for bucket, amount in charges), default=0.0)
+        max_wait = float(get_current_guild_context().setting("ingest_quota_max_wait_seconds") or 0)
+        if delay > max_wait:
+            self.stats["rejected"] += 1
+            status.fail(
+                f"ファイル '{attachment.filename}' は受け付けられませんでした。アップロードの上限 (ユーザー・チャンネルごとの1分あたりの件数・サイズ) を超えています。"
+                f"約 {math.ceil(delay)} 秒後に再送してください。")
+            return None
+        for bucket, amount in charges: bucket.take(amount)
+        if delay > 0:
+            self.stats["delayed"] += 1
+            status.update(f"ファイル '{attachment.filename}' はアップロードの上限に達しているため、約 {math.ceil(delay)} 秒後に処理します。")
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError: # 取り込まなかった分は上限に数えない
+                for bucket, amount in charges: bucket.refund(amount)
+                raise
+
+        max_depth = self.global_limit("ingest_max_queue_depth")
+        if not max_depth or (self.active < max_depth and not self.waiting):
+            self.active += 1
+        else:
+            if len(self.waiting) >= self.global_limit("ingest_max_waiting"):
+                for bucket, amount in charges: bucket.refund(amount)
+                self.stats["rejected"] += 1
+                status.fail(f"混雑しているため、ファイル '{attachment.filename}' は受け付けられませんでした。しばらくしてから再送してください。")
+                return None
+            slot = asyncio.get_running_loop().create_future()
+            self.waiting.append(slot)
+            self.stats["queued"] += 1
+            status.update(f"混雑しているため、ファイル '{attachment.filename}' は順番待ちです (待ち {len(self.waiting)} 番目)。順番が来たら処理します。")
+            try:
+                await slot
+            except asyncio.CancelledError:
+                if slot.done() and not slot.cancelled(): self._release_slot() # 譲られた枠は次の添付へ
+                elif slot in self.waiting: self.waiting.remove(slot)
+                for bucket, amount in charges: bucket.refund(amount)
+                raise
+        self.ticket_counter += 1
+        self.tickets.add(self.ticket_counter)
+        self.stats["admitted"] += 1
+        return self.ticket_counter
+
+    def release(self, ticket: int | None):
+        if ticket is None or ticket not in self.tickets: return
+        self.tickets.discard(ticket)
+        self._release_slot()
+
+    def _release_slot(self):
+        """ 順番待ちの先頭に枠をそのまま譲る。待ちがなければ受け付け中の数を減らす """
+        while self.waiting:
+            slot = self.waiting.popleft()
+            if not slot.done():
+                slot.set_result(None)
+                return
+        self.active -= 1
+
+ingest_admission = IngestAdmission()
+
+# --- 添付ファイルの取り込み ---
+async def process_attachment(message, ctx, attachment):
+    """ 添付ファイル1件分の取り込み処理 (検証・一時保存・タグ付け・保存先への格納) """
+    allowed_image_types = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+    allowed_video_types = ('.mp4', '.mov', '.avi', '.mkv', '.webm')
+    file_ext = os.path.splitext(attachment.filename)[1].lower()
+
+    if not (file_ext in allowed_image_types or file_ext in allowed_video_types):
+        # await message.channel.send(f"ファイル '{attachment.filename}' の形式 ({file_ext}) はサポートされていません。画像または動画ファイルをアップロードしてください。")
+        # サポート外形式はログにのみ残し、ユーザーには通知しない運用も検討 (チャンネルがログで溢れるのを防ぐため)
+        print(f"Skipping unsupported file type: {attachment.filename} ({file_ext})")
+        return
+
+    status = get_ingest_status_board(message.id, message.channel).line(str(attachment.id), f"ファイル '{attachment.filename}' を受け付けました。")
+    limit_bytes = 8 * 1024 * 1024 
+    if ctx.guild and hasattr(ctx.guild, 'filesize_limit'):
+        limit_bytes = ctx.guild.filesize_limit
+    
+    if attachment.size > limit_bytes:
+         status.fail(f"ファイル '{attachment.filename}' ({attachment.size // 1024 // 1024}MB) はサイズが大きすぎます (サーバー上限: {limit_bytes // 1024 // 1024}MB)。")
+         return
+
+    ticket = await ingest_admission.admit(message, attachment, status) # 上限を超えた分は待たせるか断る
+    if ticket is None: return
+    try:
+        if WRITE_BACK_INGEST or ingest_process_pool.enabled: # 受け付けだけ行い、タグ付けと保存はバックグラウンドに任せる
+            if await write_back_ingest.submit(message, attachment, status, ticket): ticket = None # ジョブの完了時に返す
+            return
+
+        async with get_current_guild_context().ingest_semaphore: # サーバーごとの同時実行数の上限 (他のサーバーの取り込みは待たせない)
+            try: await ingest_attachment_now(message, attachment, file_ext, status)
+            finally:
+                if status.running: status.fail(f"ファイル '{attachment.filename}' の処理が中断されました。")
+    finally:
+        ingest_admission.release(ticket)
+
+async def ingest_attachment_now(message, attachment, file_ext: str, status: IngestStatusLine):
+    """ 添付ファイルを一時保存し、タグ付けして保存先へ格納するまでをその場で行う (ライトバック取り込みでない場合) """
+    temp_dir = os.path.join(get_base_upload_folder(), "temp")
+    try: await local_storage.makedirs(temp_dir)
+    except Exception as e:
+        print(f"一時フォルダ '{temp_dir}' の作成に失敗: {e}")
+        status.fail(f"'{attachment.filename}' の処理中に内部エラーが発生しました（一時フォルダ作成不可）。")
+        return
+    
+    temp_save_path = os.path.join(temp_dir, f"temp_{attachment.id}_{sanitize_filename_component(attachment.filename)}")
+    
+    try:
+        await local_storage.save_attachment(attachment, temp_save_path)
+    except Exception as e_save:
+        print(f"一時ファイル '{temp_save_path}' の保存に失敗: {e_save}")
+        status.fail(f"ファイル '{attachment.filename}' の一時保存に失敗しました。")
+        return
+
+    status.update(f"ファイル '{attachment.filename}' を処理中... 自動タグ付けを開始します。")
+    
+    tags_str = "notags"
+    image_hash = None
+    duplicate_of = None # (距離, filepath, tags_str)
+    tagging_deferred = False # Gemini の障害中はタグなしで保存し、タグ付けを後回しにする
+    if file_ext in IMAGE_EXTENSIONS: # Gemini の有無にかかわらず検査する
+        image_info = await image_workers.inspect(temp_save_path) # 検証・展開爆弾の検査・ハッシュは別プロセスで
+        if image_info["error"]:
+            status.fail(f"ファイル '{attachment.filename}' は有効な画像ではないようです。処理を中断します。({image_info['error']})")
+            await local_storage.remove(temp_save_path)
+            return
+        image_hash = image_info["hash"]
+    if gemini_model_instance:
+        try:
+            if image_hash is not None:
+                duplicate_of = (await get_phash_index()).find_duplicate(image_hash)
+
+            if duplicate_of:
+                tags_str = duplicate_of[2]
+                print(f"類似画像 '{duplicate_of[1]}' (距離 {duplicate_of[0]}) のタグを再利用します: {tags_str}")
+            else:
+                tags_str = await request_gemini_tags(temp_save_path, attachment.filename, attachment.content_type)
+        except DependencyUnavailableError as e:
+            print(f"Gemini が利用できないため、タグ付けを後回しにします: {e}")
+            status.update(f"ファイル '{attachment.filename}' を処理中... (Gemini が応答しないため、タグ付けは後で行います)")
+            tags_str, tagging_deferred = "notags", True
+        except Exception as e:
+            print(f"タグ付け処理中にエラー: {e}")
+            status.update(f"ファイル '{attachment.filename}' のタグ付け中にエラーが発生しました。タグなしで処理を続行します。")
+            tags_str = "notags"
+    else:
+        status.update(f"ファイル '{attachment.filename}' を処理中... (Gemini API未設定のためタグ付けスキップ)")
+
+    date_str = datetime.datetime.now().strftime("%Y%m%d")
+    original_filename_no_ext, original_ext = os.path.splitext(attachment.filename)
+    sanitized_original_filename = sanitize_filename_component(original_filename_no_ext)
+    new_filename = f"{date_str}_{tags_str}_{sanitized_original_filename}{original_ext}"
+    
+    display_tags_on_message = tags_str.replace("_", "-") if tags_str != "notags" else "なし"
+    reuse_note = f"\n(類似画像 `{duplicate_of[1]}` のタグを再利用しました)" if duplicate_of else ""
+    if tagging_deferred: reuse_note += "\n(Gemini が応答しないため、タグ付けは復旧後に行います)"
+    
+    # 現在のアップロード先をbot_configから再取得（コマンドで変更された場合に対応）
+    current_upload_dest_on_message = get_upload_destination()
+    store_locally = current_upload_dest_on_message in ("local", "tiered") # tiered も新しいファイルはまずローカルに置く
+    drive_deferred = False
+
+    if current_upload_dest_on_message == "gdrive":
+        if gdrive_available():
+            gdrive_file_info = await upload_to_gdrive(temp_save_path, new_filename, attachment.content_type)
+            if gdrive_file_info:
+                file_link = gdrive_file_info.get('webViewLink', 'リンク不明')
+                stored_filepath = f"{datetime.datetime.now().strftime('%Y%m')}/{new_filename}"
+                if image_hash is not None:
+                    (await get_phash_index()).add(stored_filepath, image_hash, tags_str)
+                (await get_search_index()).add(stored_filepath)
+                get_month_listing_cache().note_added(stored_filepath)
+                if tagging_deferred: (await get_degraded_queue()).add("tag", stored_filepath)
+                status.done(
+                    f"ファイル '{attachment.filename}' をGoogle Driveにアップロードし、'{new_filename}' として保存しました。\n"
+                    f"自動タグ: `{display_tags_on_message}`{reuse_note}\nリンク: <{file_link}>"
+                )
+                await generate_thumbnail(temp_save_path, stored_filepath) # 一時ファイル削除前に作成
+            else: # Drive の障害中はローカルに置いておき、復旧後にアップロードする
+                print(f"'{new_filename}' を Drive にアップロードできなかったため、ローカルに一時保存します。")
+                store_locally = drive_deferred = True
+        else:
+            status.fail(f"Google Driveが設定されていないか、サービスが利用できないため、'{attachment.filename}' のアップロードをスキップしました。ローカルにも保存されません。")
+        
+        if not store_locally:
+            try:
+                if await local_storage.remove(temp_save_path): print(f"一時ファイル '{temp_save_path}' を削除しました。")
+            except Exception as e_rm: print(f"一時ファイル '{temp_save_path}' の削除失敗: {e_rm}")
+
+    if store_locally:
+        local_ym_folder = await create_year_month_folder_if_not_exists(get_base_upload_folder())
+        final_save_path = os.path.join(local_ym_folder, new_filename)
+        try:
+            await local_storage.rename(temp_save_path, final_save_path)
+            print(f"ファイル '{attachment.filename}' を '{final_save_path}' に保存しました。")
+            stored_filepath = f"{os.path.basename(local_ym_folder)}/{new_filename}"
+            if image_hash is not None:
+                (await get_phash_index()).add(stored_filepath, image_hash, tags_str)
+            (await get_search_index()).add(stored_filepath)
+            get_month_listing_cache().note_added(stored_filepath)
+            if tagging_deferred: (await get_degraded_queue()).add("tag", stored_filepath)
+            if drive_deferred:
+                (await get_degraded_queue()).add("drive", stored_filepath)
+                reuse_note += "\n(Google Drive に接続できないため、ローカルに一時保存しました。復旧後に自動でアップロードします)"
+            status.done(
+                f"ファイル '{attachment.filename}' をローカルに保存しました: '{new_filename}'\n自動タグ: `{display_tags_on_message}`{reuse_note}"
+            )
+            await generate_thumbnail(final_save_path, stored_filepath)
+        except Exception as e:
+            print(f"ローカル保存エラー: {e}")
+            status.fail(f"'{attachment.filename}' のローカル保存中にエラーが発生しました。")
+            try: # rename失敗時は一時ファイルを削除
+                if await local_storage.remove(temp_save_path): print(f"エラー発生のため一時ファイル '{temp_save_path}' を削除しました。")
+            except Exception as e_rm: print(f"一時ファイル '{temp_save_path}' の削除失敗: {e_rm}")
+    elif current_upload_dest_on_message != "gdrive":
+        print(f"不明なアップロード先が設定されています: {current_upload_dest_on_message}")
+        status.fail(f"アップロード先の設定が不明なため、'{attachment.filename}' の処理を中断しました。")
+        try:
+            if await local_storage.remove(temp_save_path): print(f"不明なアップロード先のため一時ファイル '{temp_save_path}' を削除しました。")
+        except Exception as e_rm: print(f"一時ファイル '{temp_save_path}' の削除失敗: {e_rm}")
+
+# --- 取り込みワーカープロセス ---
+class IngestProcessPool:
+    """
+    取り込みの重い処理 (画像の検証・知覚ハッシュ・Gemini タグ付け・Drive アップロード・サムネイル) を別プロセスの
+    ワーカーで実行する。ワーカーはそれぞれ自前の Drive / Gemini クライアントを持ち、要求と結果はプロセス間キューで
+    やり取りする。ingest_worker_processes が 0 のときは各メソッドがこのプロセス内でそのまま処理する。
+    """
+    def __init__(self):
+        self.processes: list = []
+        self.request_queue = None
+        self.response_queue = None
+        self.pending: dict[int, asyncio.Future] = {}
+        self._next_request_id = 0
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._reader: threading.Thread | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return INGEST_WORKER_PROCESSES > 0
+
+    def alive_count(self) -> int:
+        return sum(1 for process in self.processes if process.is_alive())
+
+    def start(self):
+        """ ワーカープロセスを起動する。終了したワーカーがあれば起動し直す """
+        self._loop = asyncio.get_running_loop()
+        if self.alive_count() >= INGEST_WORKER_PROCESSES: return
+        mp_context = multiprocessing.get_context("spawn") # 親のイベントループやスレッドを引き継がない
+        if self.request_queue is None:
+            self.request_queue, self.response_queue = mp_context.Queue(), mp_context.Queue()
+            self._reader = threading.Thread(target=self._read_responses, name="ingest-worker-responses", daemon=True)
+            self._reader.start()
+        self.processes = [process for process in self.processes if process.is_alive()]
+        while len(self.processes) < INGEST_WORKER_PROCESSES:
+            process = mp_context.Process(target=ingest_worker_main, name=f"ingest-worker-{len(self.processes) + 1}",
+                                         args=(self.request_queue, self.response_queue, INGEST_WORKER_CONCURRENCY), daemon=True)
+            process.start()
+            self.processes.append(process)
+        print(f"取り込みワーカープロセスを起動しました ({len(self.processes)} プロセス)。")
+
+    def stop(self):
+        for _ in self.processes:
+            self.request_queue.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive(): process.terminate()
+        self.processes = []
+
+    def _read_responses(self):
+        while True:
+            response = self.response_queue.get()
+            if self._loop and not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(self._resolve, response)
+
+    def _resolve(self, response: dict):
+        if "gemini_hedge" in response: gemini_hedger.worker_stats[response["pid"]] = response["gemini_hedge"]
+        future = self.pending.pop(response["id"], None)
+        if future is None or future.done(): return
+        if "error" in response:
+            error_type = DependencyUnavailableError if response.get("unavailable") else RuntimeError
+            future.set_exception(error_type(response["error"]))
+        else: future.set_result(response["result"])
+
+    async def call(self, op: str, **kwargs):
+        """ ワーカープロセスに処理を依頼して結果を待つ。ワーカーが落ちた場合はタイムアウトで例外になる (ジョブ側で再試行) """
+        self.start()
+        self._next_request_id += 1
+        request_id = self._next_request_id
+        future = self._loop.create_future()
+        self.pending[request_id] = future
+        self.request_queue.put({"id": request_id, "op": op, "kwargs": kwargs})
+        try:
+            return await asyncio.wait_for(future, INGEST_WORKER_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"取り込みワーカーが {INGEST_WORKER_TIMEOUT_SECONDS} 秒以内に応答しませんでした ({op})")
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def inspect_image(self, path: str) -> tuple[str | None, int | None]:
+        if not self.enabled:
+            image_info = await image_workers.inspect(path)
+            return image_info["error"], image_info["hash"]
+        result = await self.call("inspect", path=path)
+        return result["error"], int(result["hash"], 16) if result["hash"] else None
+
+    async def request_tags(self, path: str, original_filename: str, mime_type: str | None) -> str:
+        if not self.enabled: return await request_gemini_tags(path, original_filename, mime_type)
+        cache_key, cached_tags = await lookup_cached_tags(path, original_filename) # キャッシュはこのプロセスで持つ
+        if cached_tags: return cached_tags
+        if not gemini_breaker.allow(): raise DependencyUnavailableError("Gemini API の呼び出しを停止中です")
+        try:
+            tags_str = await self.call("tag", path=path, original_filename=original_filename, mime_type=mime_type,
+                                       model=current_gemini_model, fallback_model=gemini_hedger.fallback_name())
+        except DependencyUnavailableError:
+            gemini_breaker.record_failure() # ワーカーでの結果をこのプロセスのブレーカーにも反映する
+            raise
+        gemini_breaker.record_success()
+        (await get_tag_cache()).put(cache_key, tags_str)
+        return tags_str
+
+    async def upload(self, path: str, drive_filename: str, mime_type: str | None, year_month: str) -> dict | None:
+        """ シャードの選択と記録はこのプロセスで行い、アップロードだけをワーカーが行う """
+        if not self.enabled: return await upload_to_gdrive(path, drive_filename, mime_type, year_month=year_month)
+        shard = choose_gdrive_shard(drive_filename)
+        if not shard or not shard.breaker.allow(): return None
+        uploaded = await self.call("upload", path=path, drive_filename=drive_filename, mime_type=mime_type,
+                                   year_month=year_month, shard_name=shard.name, folder_id=shard.folder_id)
+        if uploaded: shard.breaker.record_success()
+        else: shard.breaker.record_failure()
+        if uploaded:
+            remember_gdrive_file_shard(uploaded.get("id"), shard)
+            shard.uploaded_files += 1
+            uploaded_size = uploaded.get("size")
+            if not uploaded_size:
+                local_stat = await local_storage.stat(path)
+                uploaded_size = local_stat.st_size if local_stat else 0
+            shard.uploaded_bytes += int(uploaded_size)
+        return uploaded
+
+    async def thumbnail(self, source_path: str, filepath: str) -> str | None:
+        if not self.enabled: return await generate_thumbnail(source_path, filepath)
+        thumb_path = get_thumbnail_path(filepath)
+        created = await self.call("thumbnail", source_path=source_path, thumb_path=thumb_path, ext=os.path.splitext(filepath)[1].lower())
+        return thumb_path if created else None
+
+ingest_process_pool = IngestProcessPool()
+
+def use_gemini_model(model_name: str):
+    """ ワーカープロセスで、親プロセスの現在のモデル (/gemini set で変更される) に合わせる """
+    global current_gemini_model, gemini_model_instance
+    if model_name == current_gemini_model or not GEMINI_API_KEY: return
+    gemini_model_instance = create_gemini_model(model_name)
+    current_gemini_model = model_name
+
+async def run_ingest_worker_op(op: str, kwargs: dict):
+    """ ワーカープロセスでの処理本体 """
+    if op == "inspect":
+        image_info = await image_workers.inspect(kwargs["path"])
+        return {"error": image_info["error"], "hash": f"{image_info['hash']:016x}" if image_info["hash"] is not None else None}
+    if op == "tag":
+        use_gemini_model(kwargs["model"])
+        bot_config["gemini_fallback_model"] = kwargs.get("fallback_model") # 親で変更された予備のモデルに合わせる
+        if not gemini_model_instance: return "notags"
+        return await query_gemini_tags(kwargs["path"], kwargs["original_filename"], kwargs["mime_type"]) # キャッシュは親プロセスが引く
+    if op == "upload":
+        get_gdrive_shards() # 主シャードを gdrive_service / GDRIVE_TARGET_FOLDER_ID で更新する
+        base_shard = next((shard for shard in [primary_gdrive_shard, *extra_gdrive_shards] if shard.name == kwargs["shard_name"]), None)
+        if not base_shard or not base_shard.service:
+            raise RuntimeError(f"ワーカープロセスで Drive シャード '{kwargs['shard_name']}' が利用できません")
+        shard = DriveShard(base_shard.name, base_shard.key_path, kwargs["folder_id"], base_shard.service) # 親が選んだフォルダ (サーバーごとのフォルダを含む)
+        return await upload_to_gdrive(kwargs["path"], kwargs["drive_filename"], kwargs["mime_type"], year_month=kwargs["year_month"], shard=shard)
+    if op == "thumbnail":
+        return await render_thumbnail(kwargs["source_path"], kwargs["thumb_path"], kwargs["ext"])
+    raise ValueError(f"不明な処理です: {op}")
+
+async def ingest_worker_loop(request_queue, response_queue, concurrency: int):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    tasks = set()
+
+    async def handle(request: dict):
+        try:
+            response = {"id": request["id"], "result": await run_ingest_worker_op(request["op"], request["kwargs"])}
+        except Exception as e:
+            response = {"id": request["id"], "error": f"{type(e).__name__}: {e}", "unavailable": isinstance(e, DependencyUnavailableError)}
+        finally:
+            semaphore.release()
+        if request["op"] == "tag": # ヘッジの集計は親プロセスで合算して表示する
+            response |= {"gemini_hedge": dict(gemini_hedger.stats), "pid": os.getpid()}
+        response_queue.put(response)
+
+    while True:
+        await semaphore.acquire() # 同時処理数に空きがあるときだけ次の要求を取る (空いている他のワーカーに回す)
+        request = await loop.run_in_executor(None, request_queue.get)
+        if request is None: break
+        task = asyncio.create_task(handle(request))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks: await asyncio.gather(*tasks, return_exceptions=True)
+
+def ingest_worker_main(request_queue, response_queue, concurrency: int):
+    """ 取り込みワーカープロセスのエントリーポイント。Drive / Gemini のクライアントはこのプロセスで作る """
+    global IMAGE_WORKER_PROCESSES
+    IMAGE_WORKER_PROCESSES = 0 # デーモンプロセスは子プロセスを作れないので、画像処理はこのプロセスのスレッドで行う
+    initialize_gemini()
+    initialize_gdrive_service()
+    asyncio.run(ingest_worker_loop(request_queue, response_queue, concurrency))
+
+# --- ライトバック取り込み (受け付け後にバックグラウンドでタグ付け・保存) ---
+class IngestJournal(JsonlStore):
+    """
+    受け付け済みで保存が終わっていない取り込みジョブのジャーナル。
+    変更は base_upload_folder 内の JSONL に追記 (fsync) し、起動時に再生して未完了ジョブを復元する。
+    """
+    label = "取り込みジャーナル"
+    fsync = True
+
+    def __init__(self):
+        super().__init__()
+        self.jobs: dict[str, dict] = {}
+
+    @property
+    def path(self) -> str:
+        return os.path.join(BASE_UPLOAD_FOLDER, INGEST_JOURNAL_FILE)
+
+    def _reset(self):
+        self.jobs.clear()
+
+    def _replay(self, record: dict):
+        if record.get("op") == "add": self.jobs[record["id"]] = record["job"]
+        elif record.get("op") == "update" and record["id"] in self.jobs: self.jobs[record["id"]].update(record["fields"])
+        elif record.get("op") == "done": self.jobs.pop(record["id"], None)
+
+    def _snapshot(self) -> list[dict]:
+        return [{"op": "add", "id": job_id, "job": dict(job)} for job_id, job in self.jobs.items()] # 書き込みはスレッドで行うので複製する
+
+    def _live_count(self) -> int:
+        return len(self.jobs)
+
+    def _on_loaded(self, found: bool):
+        if self.jobs: print(f"取り込みジャーナルから未完了のジョブを {len(self.jobs)} 件復元しました。")
+
+    def add(self, job: dict) -> asyncio.Future:
+        """ ジョブを登録する。戻り値の Future はディスクに書き出されると完了する (受け付けの返信はその後に行う) """
+        self.jobs[job["id"]] = job
+        return self._append({"op": "add", "id": job["id"], "job": job})
+
+    def update(self, job_id: str, **fields):
+        if job_id not in self.jobs: return
+        self.jobs[job_id].update(fields)
+        self._append({"op": "update", "id": job_id, "fields": fields})
+
+    def finish(self, job_id: str):
+        if self.jobs.pop(job_id, None) is None: return
+        self._append({"op": "done", "id": job_id})
+        if not self.jobs and self._log_lines > 100: self._compact()
+
+    def get(self, job_id: str) -> dict | None:
+        return self.jobs.get(job_id)
+
+    def pending(self) -> list[dict]:
+        return sorted(self.jobs.values(), key=lambda job: job["accepted_at"])
+
+class GuildFairQueue:
+    """
+    サーバーごとの FIFO をラウンドロビンで取り出すキュー。実行中の件数が上限 (guild_ingest_concurrency) に
+    達したサーバーは後回しにするので、大量に投稿したサーバーのジョブが他のサーバーのジョブを待たせない。
+    """
+    def __init__(self):
+        self.queues: dict[int | None, collections.deque] = {}
+        self.order: collections.deque = collections.deque() # 待ちジョブのあるサーバー (次に取り出す順)
+        self.running: collections.Counter = collections.Counter()
+        self.unfinished = 0
+        self._wakeup = asyncio.Event()
+        self._all_done = asyncio.Event()
+        self._all_done.set()
+
+    def qsize(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    def put_nowait(self, guild_id: int | None, item):
+        if guild_id not in self.queues: self.queues[guild_id] = collections.deque()
+        if not self.queues[guild_id] and guild_id not in self.order: self.order.append(guild_id)
+        self.queues[guild_id].append(item)
+        self.unfinished += 1
+        self._all_done.clear()
+        self._wakeup.set()
+
+    def _pop_ready(self):
+        """ 実行中の件数が上限未満のサーバーを順番に取り出す。全サーバーが上限なら None (task_done まで待つ) """
+        guild_id = next((g for g in self.order if self.running[g] < self._limit(g)), None)
+        if guild_id is None: return None
+        self.order.remove(guild_id)
+        item = self.queues[guild_id].popleft()
+        if self.queues[guild_id]: self.order.append(guild_id) # 次の順番は最後尾
+        self.running[guild_id] += 1
+        return guild_id, item
+
+    @staticmethod
+    def _limit(guild_id: int | None) -> int:
+        return max(1, int(get_guild_context(guild_id).setting("guild_ingest_concurrency")))
+
+    async def get(self) -> tuple[int | None, object]:
+        while True:
+            ready = self._pop_ready()
+            if ready: return ready
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    def task_done(self, guild_id: int | None):
+        self.running[guild_id] -= 1
+        self.unfinished -= 1
+        if self.unfinished <= 0: self._all_done.set()
+        self._wakeup.set() # 上限で待たされていたサーバーのジョブを取り出せるようにする
+
+    async def join(self):
+        await self._all_done.wait()
+
+class WriteBackIngest:
+    """
+    ライトバック取り込み。添付ファイルをローカルのスプールに保存してジャーナルに記録したらすぐに返信し、
+    タグ付け・リネーム・保存先への格納はワーカーが行う。失敗したジョブは間隔を倍にしながら再試行する。
+    """
+    def __init__(self):
+        self.journal = IngestJournal()
+        self.queue: GuildFairQueue | None = None
+        self.workers: list[asyncio.Task] = []
+        self.status_lines: dict[str, IngestStatusLine] = {} # job_id -> 状況メッセージの行 (再起動後は既存のメッセージを引き継ぐ)
+        self.admission_tickets: dict[str, int] = {} # job_id -> 受け付け制御のチケット (再起動前のジョブは持たない)
+        self.retry_tasks: set[asyncio.Task] = set() # 再試行待ちのジョブを時間が来たらキューに戻すタスク
+
+    @property
+    def spool_dir(self) -> str:
+        return os.path.join(BASE_UPLOAD_FOLDER, "spool")
+
+    async def start(self):
+        """ ワーカーを起動し、ジャーナルに残っている未完了ジョブを再投入する """
+        if self.workers and not all(w.done() for w in self.workers): return
+        await self.journal.ensure_loaded()
+        if self.workers and not all(w.done() for w in self.workers): return # 読み込みを待つ間に他の呼び出しが起動済み
+        self.queue = GuildFairQueue()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(max(1, WRITE_BACK_WORKERS))]
+        for job in self.journal.pending():
+            self.journal.update(job["id"], status="queued", attempts=0, resumed=True)
+            self.queue.put_nowait(job.get("guild_id"), job["id"])
+
+    async def submit(self, message, attachment, status: IngestStatusLine, admission_ticket: int | None = None) -> bool:
+        """ 添付をスプールに保存してジョブを登録する。登録できたら True (チケットはジョブの完了時に返す) """
+        await self.start()
+        await local_storage.makedirs(self.spool_dir)
+        job_id = f"{message.id}_{attachment.id}"
+        spool_path = os.path.join(self.spool_dir, f"{job_id}_{sanitize_filename_component(attachment.filename)}")
+        try:
+            await local_storage.save_attachment(attachment, spool_path)
+        except Exception as e_save:
+            print(f"スプールへの保存に失敗 ({spool_path}): {e_save}")
+            status.fail(f"ファイル '{attachment.filename}' の一時保存に失敗しました。")
+            return False
+        now = datetime.datetime.now()
+        original_stem, original_ext = os.path.splitext(attachment.filename)
+        provisional_name = f"{now.strftime('%Y%m%d')}_notags_{sanitize_filename_component(original_stem)}{original_ext}"
+        status.update(
+            f"ファイル '{attachment.filename}' を受け付けました。仮のファイル名: `{now.strftime('%Y%m')}/{provisional_name}`\n"
+            f"自動タグ付けと保存をバックグラウンドで行います...")
+        await status.board.ensure_sent() # 再起動後も同じメッセージを更新できるように ID をジャーナルに残す
+        job = {
+            "id": job_id, "spool_path": spool_path, "original_filename": attachment.filename,
+            "content_type": attachment.content_type, "channel_id": message.channel.id,
+            "status_message_id": status.message_id, "accepted_at": now.isoformat(),
+            "date_str": now.strftime("%Y%m%d"), "year_month": now.strftime("%Y%m"),
+            "destination": get_upload_destination(), "guild_id": get_current_guild_context().guild_id,
+            "tags": None, "image_hash": None, "duplicate_of": None, "attempts": 0, "status": "queued",
+        }
+        await self.journal.add(job) # ジャーナルに書き出せてから受け付けたことにする
+        self.status_lines[job_id] = status
+        if admission_ticket is not None: self.admission_tickets[job_id] = admission_ticket
+        self.queue.put_nowait(job["guild_id"], job_id)
+        return True
+
+    def _edit_status(self, job: dict, content: str, state: str = "running"):
+        """ 状況メッセージのこのジョブの行を書き換える (編集はボードがまとめて行う) """
+        status = self.status_lines.get(job["id"])
+        if status is None and job.get("status_message_id"):
+            channel = bot.get_channel(job["channel_id"])
+            if channel and hasattr(channel, "get_partial_message"):
+                board = get_ingest_status_board(job["status_message_id"], channel, channel.get_partial_message(job["status_message_id"]))
+                status = self.status_lines[job["id"]] = board.line(job["id"], content)
+        if status is None: return
+        status.board.set(status.key, state, content)
+
+    async def _drop(self, job: dict):
+        self.journal.finish(job["id"])
+        self.status_lines.pop(job["id"], None)
+        ingest_admission.release(self.admission_tickets.pop(job["id"], None))
+        try: await local_storage.remove(job["spool_path"])
+        except OSError as e: print(f"スプールファイルの削除に失敗しました ({job['spool_path']}): {e}")
+
+    async def _worker(self):
+        while True:
+            guild_id, job_id = await self.queue.get()
+            try:
+                job = self.journal.get(job_id)
+                if job:
+                    await enter_guild_context(guild_id) # 保存先・索引はジョブを受け付けたサーバーのもの
+                    await self._run(job)
+            except Exception as e:
+                print(f"取り込みジョブ {job_id} の処理中に予期しないエラー: {e}")
+            finally:
+                self.queue.task_done(guild_id)
+
+    async def _run(self, job: dict):
+        self.journal.update(job["id"], status="running")
+        try:
+            if job["tags"] is None and not await self._tag(job): return
+            await self._store(job)
+        except Exception as e:
+            self._schedule_retry(job, e)
+
+    async def _tag(self, job: dict) -> bool:
+        """ 検証・知覚ハッシュ・タグ付け。無効な画像でジョブを破棄した場合は False """
+        spool_path, filename = job["spool_path"], job["original_filename"]
+        if not await local_storage.exists(spool_path):
+            print(f"スプールファイルが見つからないため、ジョブ {job['id']} を破棄します。")
+            self._edit_status(job, f"ファイル '{filename}' の一時ファイルが見つからないため、処理を中断しました。", "failed")
+            await self._drop(job)
+            return False
+        file_ext = os.path.splitext(filename)[1].lower()
+        image_hash, duplicate_of = None, None
+        if file_ext in IMAGE_EXTENSIONS:
+            img_err, image_hash = await ingest_process_pool.inspect_image(spool_path)
+            if img_err:
+                self._edit_status(job, f"ファイル '{filename}' は有効な画像ではないようです。処理を中断します。({img_err})", "failed")
+                await self._drop(job)
+                return False
+            if image_hash is not None: duplicate_of = (await get_phash_index()).find_duplicate(image_hash)
+        if duplicate_of:
+            tags_str = duplicate_of[2]
+            print(f"類似画像 '{duplicate_of[1]}' (距離 {duplicate_of[0]}) のタグを再利用します: {tags_str}")
+        elif gemini_model_instance:
+            try:
+                tags_str = await ingest_process_pool.request_tags(spool_path, filename, job["content_type"])
+            except DependencyUnavailableError as e: # Gemini の障害中はタグなしで保存し、復旧後にタグ付けする
+                print(f"Gemini が利用できないため、ジョブ {job['id']} のタグ付けを後回しにします: {e}")
+                tags_str, job["defer_tagging"] = "notags", True
+        else:
+            tags_str = "notags"
+        self.journal.update(job["id"], tags=tags_str, image_hash=f"{image_hash:016x}" if image_hash is not None else None,
+                            duplicate_of=duplicate_of[1] if duplicate_of else None, defer_tagging=job.get("defer_tagging", False))
+        display_tags = tags_str.replace("_", "-") if tags_str != "notags" else "なし"
+        self._edit_status(job, f"ファイル '{filename}' のタグ付けが完了しました。自動タグ: `{display_tags}`\n保存しています...")
+        return True
+
+    async def _store(self, job: dict):
+        filename, tags_str = job["original_filename"], job["tags"]
+        original_stem, original_ext = os.path.splitext(filename)
+        new_filename = f"{job['date_str']}_{tags_str}_{sanitize_filename_component(original_stem)}{original_ext}"
+        stored_filepath = f"{job['year_month']}/{new_filename}"
+        display_tags = tags_str.replace("_", "-") if tags_str != "notags" else "なし"
+        reuse_note = f"\n(類似画像 `{job['duplicate_of']}` のタグを再利用しました)" if job.get("duplicate_of") else ""
+        if job.get("defer_tagging"): reuse_note += "\n(Gemini が応答しないため、タグ付けは復旧後に行います)"
+        spool_path = job["spool_path"]
+        drive_deferred = False
+
+        if job["destination"] == "gdrive":
+            if not gdrive_available():
+                raise RuntimeError("Google Driveが設定されていないか、サービスが利用できません")
+            # 再試行・再起動時はアップロード済みかを確認し、二重にアップロードしない
+            existing_id = None
+            if job.get("attempts") or job.get("resumed"):
+                try: _, existing_id = await find_gdrive_file(stored_filepath)
+                except DependencyUnavailableError: drive_deferred = True # アップロード済みかは復旧後の移動処理で確かめる
+            file_link = None
+            if not existing_id and not drive_deferred:
+                uploaded = await ingest_process_pool.upload(spool_path, new_filename, job["content_type"], job["year_month"])
+                # ブレーカーが開いている (Drive の障害中) ならローカルに置いて後でアップロードし、そうでなければ再試行する
+                if not uploaded and gdrive_breakers_closed(): raise RuntimeError("Google Driveへのアップロードに失敗しました")
+                drive_deferred = not uploaded
+                if uploaded: file_link = uploaded.get("webViewLink")
+            if not drive_deferred:
+                await ingest_process_pool.thumbnail(spool_path, stored_filepath)
+                done_message = (f"ファイル '{filename}' をGoogle Driveにアップロードし、'{new_filename}' として保存しました。\n"
+                                f"自動タグ: `{display_tags}`{reuse_note}" + (f"\nリンク: <{file_link}>" if file_link else ""))
+        if job["destination"] != "gdrive" or drive_deferred:
+            local_ym_folder = os.path.join(get_base_upload_folder(), job["year_month"])
+            await local_storage.makedirs(local_ym_folder)
+            final_save_path = os.path.join(local_ym_folder, new_filename)
+            if await local_storage.exists(spool_path):
+                await local_storage.move(spool_path, final_save_path) # サーバーごとの保存先は別のディスクのこともある
+            elif not await local_storage.exists(final_save_path):
+                raise RuntimeError("スプールファイルが見つかりません")
+            print(f"ファイル '{filename}' を '{final_save_path}' に保存しました。")
+            await ingest_process_pool.thumbnail(final_save_path, stored_filepath)
+            if drive_deferred:
+                (await get_degraded_queue()).add("drive", stored_filepath)
+                reuse_note += "\n(Google Drive に接続できないため、ローカルに一時保存しました。復旧後に自動でアップロードします)"
+            done_message = f"ファイル '{filename}' をローカルに保存しました: '{new_filename}'\n自動タグ: `{display_tags}`{reuse_note}"
+
+        if job.get("image_hash"):
+            (await get_phash_index()).add(stored_filepath, int(job["image_hash"], 16), tags_str)
+        (await get_search_index()).add(stored_filepath)
+        get_month_listing_cache().note_added(stored_filepath)
+        if job.get("defer_tagging"): (await get_degraded_queue()).add("tag", stored_filepath)
+        self._edit_status(job, done_message, "done")
+        await self._drop(job)
+
+    def _schedule_retry(self, job: dict, error: Exception):
+        attempts = job.get("attempts", 0) + 1
+        filename = job["original_filename"]
+        if attempts > WRITE_BACK_MAX_RETRIES: # 再試行を使い切ったら失敗として表示し、以降は最長の間隔で試し続ける
+            delay = WRITE_BACK_RETRY_BASE_SECONDS * (2 ** WRITE_BACK_MAX_RETRIES)
+            print(f"取り込みジョブ {job['id']} は {WRITE_BACK_MAX_RETRIES} 回の再試行後も失敗しました ({error})。{delay} 秒ごとに再試行を続けます。")
+            self.journal.update(job["id"], attempts=attempts, status="failed", last_error=str(error))
+            ingest_admission.release(self.admission_tickets.pop(job["id"], None)) # 長く残るジョブなので枠を空ける
+            self._edit_status(job, (
+                f"ファイル '{filename}' の保存に失敗しました: {error}\n"
+                f"ファイルはサーバーに保持されており、{delay} 秒ごと (およびBOTの再起動時) に再試行されます。"), "failed")
+        else:
+            delay = WRITE_BACK_RETRY_BASE_SECONDS * (2 ** (attempts - 1))
+            print(f"取り込みジョブ {job['id']} が失敗しました ({error})。{delay} 秒後に再試行します ({attempts}/{WRITE_BACK_MAX_RETRIES})。")
+            self.journal.update(job["id"], attempts=attempts, status="retrying", last_error=str(error))
+            self._edit_status(job, (
+                f"ファイル '{filename}' の処理中にエラーが発生しました: {error}\n{delay} 秒後に再試行します ({attempts}/{WRITE_BACK_MAX_RETRIES})。"))
+        task = asyncio.create_task(self._requeue_later(job, delay))
+        self.retry_tasks.add(task) # 参照を持っておかないと待っている間にタスクが回収されることがある
+        task.add_done_callback(self.retry_tasks.discard)
+
+    async def _requeue_later(self, job: dict, delay: float):
+        await asyncio.sleep(delay)
+        if self.journal.get(job["id"]) is not None: self.queue.put_nowait(job.get("guild_id"), job["id"])
+
+    async def drain(self):
+        """ キューが空になるまで待つ (再試行待ちのジョブは含まない) """
+        if self.queue: await self.queue.join()
+
+write_back_ingest = WriteBackIngest()
+
+# --- 一括再タグ付け (/files retag) ---
+class AsyncRateLimiter:
+    """ 1分あたり rate_per_minute 回までに呼び出し間隔を揃える簡易レートリミッタ """
+    def __init__(self, rate_per_minute: float):
+        self.interval = 60.0 / rate_per_minute if rate_per_minute and rate_per_minute > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.interval: return
+        async with self._lock:
+            now = time.monotonic()
+            wait_seconds = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if wait_seconds > 0: await asyncio.sleep(wait_seconds)
+
+async def rename_stored_file(target: dict, new_filename: str) -> bool:
+    """ 保存済みファイルをリネームし、知覚ハッシュ索引とサムネイルも新しい名前に付け替える
+        target は {"filepath": "YYYYMM/ファイル名", "tier": "local"|"gdrive", "gdrive_id": ..., "gdrive_shard": ...} """
+    old_filepath = target["filepath"]
+    ym_dir_name, old_filename = old_filepath.split('/', 1)
+    new_filepath = f"{ym_dir_name}/{new_filename}"
+    if target["tier"] == "local":
+        old_path = os.path.join(get_base_upload_folder(), ym_dir_name, old_filename)
+        new_path = os.path.join(get_base_upload_folder(), ym_dir_name, new_filename)
+        if await local_storage.exists(new_path):
+            print(f"リネーム先 '{new_filepath}' が既に存在するため、'{old_filepath}' はリネームしません。")
+            return False
+        await local_storage.rename(old_path, new_path)
+    else:
+        target_service = gdrive_service_for_file(target["gdrive_id"], target.get("gdrive_shard"))
+        updated = await execute_gdrive_api_call(
+            target_service.files().update(fileId=target["gdrive_id"], body={"name": new_filename}, fields="id, name").execute,
+            service=target_service)
+        if not updated: return False
+
+    phash_index = await get_phash_index()
+    hash_entry = phash_index.get(old_filepath)
+    if hash_entry:
+        phash_index.remove(old_filepath)
+        phash_index.add(new_filepath, hash_entry[0], parse_bot_filename(new_filename)["tags_raw"])
+    (await get_search_index()).rename(old_filepath, new_filepath)
+    get_month_listing_cache().note_renamed(old_filepath, new_filepath)
+    (await get_degraded_queue()).note_renamed(old_filepath, new_filepath)
+    try:
+        old_thumb, new_thumb = get_thumbnail_path(old_filepath), get_thumbnail_path(new_filepath)
+        if await local_storage.exists(old_thumb): await local_storage.replace(old_thumb, new_thumb)
+    except OSError as e:
+        print(f"サムネイルの付け替えに失敗しました ({old_filepath}): {e}")
+    return True
+
+async def retag_stored_file(target: dict) -> str:
+    """ 1ファイルを再タグ付けし、結果 ("renamed" / "unchanged" / "failed") を返す """
+    ym_dir_name, old_filename = target["filepath"].split('/', 1)
+    parsed_info = parse_bot_filename(old_filename)
+    original_name = f"{parsed_info['original_stem']}{parsed_info['extension']}"
+    mime_type = mimetypes.guess_type(old_filename)[0]
+    temp_path = None
+    if target["tier"] == "local":
+        source_path = os.path.join(get_base_upload_folder(), ym_dir_name, old_filename)
+        if not await local_storage.is_file(source_path): return "failed" # 開始後に削除・リネームされた
+    else:
+        temp_dir = os.path.join(get_base_upload_folder(), "temp")
+        await local_storage.makedirs(temp_dir)
+        temp_path = os.path.join(temp_dir, f"retag_{target['gdrive_id']}{parsed_info['extension']}")
+        service = gdrive_service_for_file(target["gdrive_id"], target.get("gdrive_shard"))
+        if not await download_gdrive_file_to_path(service, target["gdrive_id"], temp_path): return "failed"
+        source_path = temp_path
+    try:
+        new_tags = await request_gemini_tags(source_path, original_name, mime_type)
+    finally:
+        if temp_path: await local_storage.remove(temp_path)
+
+    if new_tags == "notags" and parsed_info["tags_raw"] != "notags":
+        return "failed" # タグ付けに失敗した場合は既存のタグを残す
+    if new_tags == parsed_info["tags_raw"]: return "unchanged"
+    if parsed_info["date"] == "不明": # ボットの命名規則に沿っていないファイル
+        new_filename = f"{datetime.datetime.now().strftime('%Y%m%d')}_{new_tags}_{sanitize_filename_component(parsed_info['original_stem'])}{parsed_info['extension']}"
+    else:
+        new_filename = f"{parsed_info['date']}_{new_tags}_{parsed_info['original_stem']}{parsed_info['extension']}"
+    if not await rename_stored_file(target, new_filename): return "failed"
+    print(f"再タグ付け: '{target['filepath']}' -> '{ym_dir_name}/{new_filename}'")
+    return "renamed"
+
+class RetagManager:
+    """
+    既存ファイルの一括再タグ付けジョブ。対象一覧と処理済みの一覧を base_upload_folder 内の JSON に
+    チェックポイントとして保存するので、中止・BOT再起動の後も続きから再開できる。同時に動くジョブは1つだけ。
+    """
+    CHECKPOINT_EVERY = 10
+    PROGRESS_EDIT_INTERVAL = 15.0
+
+    def __init__(self):
+        self.state: dict | None = None
+        self.task: asyncio.Task | None = None
+        self._since_checkpoint = 0
+        self._last_progress_edit = 0.0
+
+    @property
+    def path(self) -> str:
+        return os.path.join(get_base_upload_folder(), RETAG_STATE_FILE)
+
+    def load(self) -> dict | None:
+        if self.state is None and os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.state = json.load(f)
+            except Exception as e:
+                print(f"再タグ付けの進捗ファイル '{self.path}' の読み込みに失敗しました: {e}")
+        return self.state
+
+    def checkpoint(self):
+        if not self.state: return
+        self.state["updated_at"] = datetime.datetime.now().isoformat(timespec="seconds")
+        tmp_path = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.state, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"再タグ付けの進捗の保存に失敗しました: {e}")
+        self._since_checkpoint = 0
+
+    def is_running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def progress_text(self) -> str:
+        state = self.load()
+        if not state: return "再タグ付けジョブはありません。"
+        counts = state["counts"]
+        done = len(state["completed"])
+        total = len(state["targets"])
+        status_labels = {"running": "実行中", "cancelled": "中止", "completed": "完了", "interrupted": "中断 (再開待ち)"}
+        scope = state["scope"]
+        scope_parts = [f"年月: `{scope['year_month']}`" if scope.get("year_month") else None,
+                       f"タグ: `{scope['tag']}`" if scope.get("tag") else None,
+                       "notags のみ" if scope.get("notags_only") else None]
+        scope_text = " | ".join(p for p in scope_parts if p) or "すべて"
+        if self.is_running(): status = "実行中"
+        elif state["status"] == "running": status = status_labels["interrupted"] # BOT再起動後でタスクが無い
+        else: status = status_labels.get(state["status"], state["status"])
+        return (f"🏷️ 再タグ付け [{status}] ({scope_text}, モデル: `{state['model']}`)\n"
+                f"進捗 {done}/{total} 件 / 変更 {counts['renamed']} 件 / 変更なし {counts['unchanged']} 件 / 失敗 {counts['failed']} 件")
+
+    async def _report_progress(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last_progress_edit < self.PROGRESS_EDIT_INTERVAL: return
+        self._last_progress_edit = now
+        state = self.state
+        channel = bot.get_channel(state.get("channel_id")) if state.get("channel_id") else None
+        if not channel or not state.get("message_id") or not hasattr(channel, "get_partial_message"): return
+        try: await channel.get_partial_message(state["message_id"]).edit(content=self.progress_text())
+        except discord.HTTPException as e: print(f"再タグ付けの進捗メッセージの編集に失敗しました: {e}")
+
+    def start(self, targets: list[dict], scope: dict, channel_id: int | None, message_id: int | None, started_by: str):
+        prompt_text = load_tagging_prompt()
+        self.state = {
+            "scope": scope, "model": current_gemini_model,
+            "prompt_hash": hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()[:12],
+            "targets": targets, "completed": [], "counts": {"renamed": 0, "unchanged": 0, "failed": 0},
+            "status": "running", "channel_id": channel_id, "message_id": message_id, "started_by": started_by,
+            "started_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        }
+        self.checkpoint()
+        self.task = asyncio.create_task(self._run())
+
+    def resume(self) -> bool:
+        state = self.load()
+        if not state or state["status"] == "completed" or self.is_running(): return False
+        state["status"] = "running"
+        self.checkpoint()
+        self.task = asyncio.create_task(self._run())
+        return True
+
+    def cancel(self) -> bool:
+        if not self.is_running(): return False
+        self.state["status"] = "cancelled"
+        self.task.cancel()
+        return True
+
+    async def _run(self):
+        state = self.state
+        completed = set(state["completed"])
+        pending = [t for t in state["targets"] if t["filepath"] not in completed]
+        limiter = AsyncRateLimiter(RETAG_RATE_PER_MINUTE)
+        semaphore = asyncio.Semaphore(max(1, RETAG_CONCURRENCY))
+        print(f"再タグ付けを開始します: 残り {len(pending)} 件 (モデル: {current_gemini_model})")
+
+        async def retag_one(target: dict):
+            async with semaphore:
+                await limiter.acquire()
+                try: result = await retag_stored_file(target)
+                except Exception as e:
+                    print(f"'{target['filepath']}' の再タグ付け中にエラー: {e}")
+                    result = "failed"
+            state["counts"][result] += 1
+            state["completed"].append(target["filepath"])
+            self._since_checkpoint += 1
+            if self._since_checkpoint >= self.CHECKPOINT_EVERY: self.checkpoint()
+            await self._report_progress()
+
+        try:
+            await asyncio.gather(*(retag_one(t) for t in pending))
+            state["status"] = "completed"
+            print(f"再タグ付けが完了しました: {state['counts']}")
+        except asyncio.CancelledError:
+            if state["status"] == "running": state["status"] = "interrupted" # 中止コマンド以外 (BOT終了など)
+            print(f"再タグ付けを停止しました ({state['status']})。")
+        finally:
+            self.checkpoint()
+            await self._report_progress(force=True)
+
+def get_retag_manager() -> RetagManager:
+    return get_storage_scoped("retag_manager", RetagManager)
+
+# --- 縮退運転中に後回しにした処理 (Drive へのアップロード・タグ付け) ---
+class DegradedModeQueue:
+    """
+    Drive / Gemini が使えない間に後回しにした処理の一覧 (保存先ごとに1つ)。
+    "drive": Drive 宛てだがローカルに一時保存したファイル、"tag": タグなし (notags) で保存したファイル。
+    障害以外の理由で失敗した処理は一覧に残したまま失敗回数 (attempts) を数え、次の排出で再び試す。
+    base_upload_folder 内の JSON に保存するので、BOTを再起動しても続きから処理する。
+    読み込み・保存は local_storage のスレッドで行う (保存はバックグラウンドで、続けて変わった分はまとめて書く)。
+    """
+    KINDS = ("drive", "tag")
+
+    def __init__(self):
+        self.path = os.path.join(get_base_upload_folder(), DEGRADED_QUEUE_FILE)
+        self.items: dict[str, list[str]] | None = None
+        self.attempts: dict[str, dict[str, int]] = {kind: {} for kind in self.KINDS} # 種類 -> {filepath: 失敗回数}
+        self._load_lock = asyncio.Lock()
+        self._dirty = False
+        self._writer: asyncio.Task | None = None
+
+    def _read(self) -> tuple[dict[str, list[str]], dict[str, dict[str, int]]]:
+        items = {kind: [] for kind in self.KINDS}
+        attempts = {kind: {} for kind in self.KINDS}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f: saved = json.load(f)
+                for kind in self.KINDS:
+                    items[kind] = list(saved.get(kind) or [])
+                    attempts[kind] = dict((saved.get("attempts") or {}).get(kind) or {})
+            except Exception as e:
+                print(f"後回しにした処理の一覧 '{self.path}' の読み込みに失敗しました: {e}")
+        return items, attempts
+
+    async def ensure_loaded(self):
+        if self.items is not None: return
+        async with self._load_lock:
+            if self.items is None: self.items, self.attempts = await local_storage.run(self._read)
+
+    def _load(self) -> dict[str, list[str]]:
+        if self.items is None: raise RuntimeError("DegradedModeQueue を読み込む前に参照しました (get_degraded_queue を使ってください)")
+        return self.items
+
+    def _write(self, text: str):
+        tmp_path = self.path + ".tmp"
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, self.path)
+
+    def _save(self):
+        self._dirty = True
+        if self._writer is None or self._writer.done(): self._writer = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self):
+        while self._dirty:
+            self._dirty = False
+            try: await local_storage.run(self._write, json.dumps(self.items | {"attempts": self.attempts}, ensure_ascii=False))
+            except Exception as e:
+                print(f"後回しにした処理の一覧の保存に失敗しました: {e}")
+
+    async def flush(self):
+        if self._writer: await asyncio.shield(self._writer)
+
+    def pending(self, kind: str) -> list[str]:
+        return list(self._load()[kind])
+
+    def contains(self, kind: str, filepath: str) -> bool:
+        return filepath in self._load()[kind]
+
+    def add(self, kind: str, filepath: str):
+        if filepath in self._load()[kind]: return
+        self.items[kind].append(filepath)
+        self._save()
+        degraded_drain_wakeup.set()
+
+    def requeue(self, kind: str, filepath: str, attempts: int):
+        """ 排出中に一旦外した処理を失敗回数ごと一覧に戻す (排出処理は起こさず、次の周回まで待つ) """
+        if filepath not in self._load()[kind]: self.items[kind].append(filepath)
+        if attempts: self.attempts[kind][filepath] = attempts
+        self._save()
+
+    def remove(self, kind: str, filepath: str):
+        if filepath not in self._load()[kind]: return
+        self.items[kind].remove(filepath)
+        self.attempts[kind].pop(filepath, None)
+        self._save()
+
+    def note_failure(self, kind: str, filepath: str) -> int:
+        """ 障害以外の理由で失敗した処理の失敗回数を1つ増やす (一覧には残す)。増やした後の回数を返す """
+        self._load()
+        self.attempts[kind][filepath] = self.attempts[kind].get(filepath, 0) + 1
+        self._save()
+        return self.attempts[kind][filepath]
+
+    def failed_count(self, kind: str) -> int:
+        return len(self.attempts[kind])
+
+    def note_removed(self, filepath: str):
+        for kind in self.KINDS: self.remove(kind, filepath)
+
+    def note_renamed(self, old_filepath: str, new_filepath: str):
+        changed = False
+        for kind, entries in self._load().items():
+            if old_filepath in entries:
+                entries[entries.index(old_filepath)] = new_filepath
+                if old_filepath in self.attempts[kind]: self.attempts[kind][new_filepath] = self.attempts[kind].pop(old_filepath)
+                changed = True
+        if changed: self._save()
+
+async def get_degraded_queue() -> DegradedModeQueue:
+    queue = get_storage_scoped("degraded_queue", DegradedModeQueue)
+    await queue.ensure_loaded()
+    return queue
+
+degraded_drain_wakeup = asyncio.Event() # ブレーカーが閉じた・後回しの処理が増えたときに排出処理を起こす
+degraded_drain_task = None
+drive_breaker_on_close.append(degraded_drain_wakeup.set)
+gemini_breaker.on_close.append(degraded_drain_wakeup.set)
+
+async def drain_degraded_queue() -> dict:
+    """ 現在の保存先の後回しにした処理を、依存先が使える間だけ順に実行する。タグ付け (リネーム) を先に行う """
+    queue = await get_degraded_queue()
+    stats = {"tagged": 0, "uploaded": 0}
+    for filepath in queue.pending("tag"):
+        if not gemini_model_instance or not gemini_breaker.ready(): break
+        attempts = queue.attempts["tag"].get(filepath, 0)
+        queue.remove("tag", filepath) # リネームで filepath が変わるので先に外す
+        try:
+            tier = await resolve_file_tier(filepath)
+            target = {"filepath": filepath, "tier": tier}
+            if tier == "local" and not await local_storage.is_file(os.path.join(get_base_upload_folder(), *filepath.split('/', 1))):
+                continue # 削除された
+            if tier == "gdrive":
+                shard, target["gdrive_id"] = await find_gdrive_file(filepath)
+                if not target["gdrive_id"]: continue # 削除された
+                target["gdrive_shard"] = shard.name
+            result = await retag_stored_file(target)
+        except DependencyUnavailableError: # Drive / Gemini の障害: 残りは復旧後に
+            queue.requeue("tag", filepath, attempts)
+            break
+        except Exception as e:
+            result = "failed"
+            print(f"後回しにしたタグ付け '{filepath}' に失敗しました: {e}")
+        if result == "renamed": stats["tagged"] += 1
+        elif result == "failed": # 一覧に戻して次の排出で再び試す (他のファイルの処理は続ける)
+            queue.requeue("tag", filepath, attempts)
+            print(f"後回しにしたタグ付け '{filepath}' は次の機会に再試行します (失敗 {queue.note_failure('tag', filepath)} 回)")
+
+    if get_upload_destination() != "gdrive": # ローカル・tiered に切り替えられた場合はローカルのままでよい
+        for filepath in queue.pending("drive"): queue.remove("drive", filepath)
+        return stats
+    for filepath in queue.pending("drive"):
+        if not gdrive_available() or not gdrive_breakers_ready(): break
+        year_month, filename = filepath.split('/', 1)
+        local_path = os.path.join(get_base_upload_folder(), year_month, filename)
+        if not await local_storage.is_file(local_path): # 削除・リネームされた
+            queue.remove("drive", filepath)
+            continue
+        candidate = {"filepath": filepath, "year_month": year_month, "fullname": filename, "local_path": local_path}
+        try: moved = await migrate_file_to_gdrive(candidate)
+        except DependencyUnavailableError: break # Drive の障害: 残りは復旧後に
+        except Exception as e:
+            print(f"後回しにした '{filepath}' の Drive へのアップロード中にエラー: {e}")
+            moved = False
+        if not moved: # このファイルだけの失敗は一覧に残して次のファイルへ
+            print(f"後回しにした '{filepath}' の Drive へのアップロードは次の機会に再試行します (失敗 {queue.note_failure('drive', filepath)} 回)")
+            continue
+        queue.remove("drive", filepath)
+        stats["uploaded"] += 1
+    return stats
+
+async def degraded_queue_drainer_loop():
+    while True:
+        degraded_drain_wakeup.clear() # 実行中に追加された分は次の周回で拾う
+        for guild_ctx in known_guild_contexts():
+            try:
+                await enter_guild_context(guild_ctx.guild_id)
+                degraded_queue = await get_degraded_queue()
+                if not any(degraded_queue.pending(kind) for kind in DegradedModeQueue.KINDS): continue
+                stats = await drain_degraded_queue()
+                if stats["tagged"] or stats["uploaded"]:
+                    print(f"後回しにした処理を実行しました ({guild_ctx.label}): タグ付け {stats['tagged']} 件 / Drive へのアップロード {stats['uploaded']} 件")
+            except Exception as e:
+                print(f"後回しにした処理の実行 ({guild_ctx.label}) でエラーが発生しました: {e}")
+        try: await asyncio.wait_for(degraded_drain_wakeup.wait(), max(1, DEGRADED_DRAIN_INTERVAL_SECONDS))
+        except asyncio.TimeoutError: pass
+
+def start_degraded_queue_drainer():
+    global degraded_drain_task
+    if degraded_drain_task is None or degraded_drain_task.done():
+        degraded_drain_task = asyncio.create_task(degraded_queue_drainer_loop())
+
+# --- トラフィックの記録 (負荷試験用の匿名化したトレース) ---
+TRACE_STRUCTURAL_PREFIX_RE = re.compile(r"^\d{6}/") # 年月 (YYYYMM/) の部分は内容を含まないのでそのまま残す (数字だけの入力は伏せる)
+
+class TrafficRecorder:
+    """
+    添付付きの投稿とスラッシュコマンド・オートコンプリートを JSONL のトレースとして記録する (traffic_recording が有効なときだけ)。
+    ユーザー・チャンネル・サーバーは記録の開始ごとに作る秘密のソルトでハッシュした仮名にし、ファイル名や検索語などの
+    文字列は年月の部分と長さだけを残す。記録するのは時刻 (記録開始からの秒数)・添付のサイズと種類・コマンド名と引数の形。
+    benchmark.py --scenario replay --trace <ファイル> で等倍・10倍・100倍などの速度で再生できる。
+    ファイルの読み書きは local_storage のスレッドで行う (記録する行はためておき、書き込み中に増えた分はまとめて書く)。
+    """
+    def __init__(self):
+        self.path: str | None = None
+        self.file = None
+        self.started_at = 0.0
+        self.events = 0
+        self._salt = b""
+        self._pending_lines: list[str] = []
+        self._writer: asyncio.Task | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.file is not None
+
+    @staticmethod
+    def _open(path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        return open(path, "a", encoding="utf-8", buffering=1) # 1行ずつ書き出す (BOTが落ちても途中まで残る)
+
+    async def start(self, path: str):
+        if self.enabled: return
+        try:
+            self.file = await local_storage.run(self._open, path)
+        except OSError as e:
+            print(f"トラフィックの記録を開始できませんでした ({path}): {e}")
+            return
+        self.path, self.events = path, 0
+        self._salt = os.urandom(16)
+        self.started_at = time.monotonic()
+        # 以前の記録に追記する場合は header から別の区間として扱う (再生時は前の区間の後ろにつなげる)
+        self._write({"type": "header", "version": 1, "recorded_at": datetime.datetime.now().strftime("%Y-%m-%dT%H:%M")})
+        print(f"トラフィックの記録を開始しました: {path}")
+
+    async def stop(self):
+        if not self.enabled: return
+        file, self.file = self.file, None # 以降の記録は受け付けない
+        if self._writer: await asyncio.shield(self._writer) # ためてある行を書き終えてから閉じる
+        await local_storage.run(file.close)
+        print(f"トラフィックの記録を停止しました ({self.events} 件): {self.path}")
+
+    def _write(self, event: dict):
+        self._pending_lines.append(json.dumps(event, ensure_ascii=False) + "\n")
+        if self._writer is None or self._writer.done(): self._writer = asyncio.create_task(self._write_pending(self.file))
+
+    async def _write_pending(self, file):
+        while self._pending_lines:
+            lines, self._pending_lines = self._pending_lines, []
+            try:
+                await local_storage.run(file.writelines, lines)
+            except (OSError, ValueError) as e:
+                print(f"トラフィックの記録に失敗したため、記録を停止します: {e}")
+                self._pending_lines.clear()
+                if self.file is file:
+                    self.file = None
+                    await local_storage.run(file.close)
+                return
+
+    def _record(self, event_type: str, **fields):
+        self.events += 1
+        self._write({"t": round(time.monotonic() - self.started_at, 3), "type": event_type} | fields)
+
+    def pseudonym(self, prefix: str, snowflake) -> str | None:
+        if snowflake is None: return None
+        return prefix + hashlib.blake2b(str(snowflake).encode(), key=self._salt, digest_size=5).hexdigest()
+
+    @staticmethod
+    def anonymize_text(value: str) -> dict:
+        """ 文字列の引数は年月の部分 (例 "202405/") と残りの長さだけにする """
+        prefix = TRACE_STRUCTURAL_PREFIX_RE.match(value)
+        prefix = prefix.group(0) if prefix else ""
+        return {"prefix": prefix, "redacted": len(value) - len(prefix)}
+
+    @staticmethod
+    def describe_attachment(attachment) -> dict:
+        return {"size": attachment.size, "content_type": attachment.content_type,
+                "ext": os.path.splitext(attachment.filename)[1].lower()[:10]}
+
+    def record_message(self, message):
+        if not self.enabled or not message.attachments: return
+        self._record("message", user=self.pseudonym("u", message.author.id), channel=self.pseudonym("c", message.channel.id),
+                     guild=self.pseudonym("g", message.guild.id if message.guild else None),
+                     attachments=[self.describe_attachment(attachment) for attachment in message.attachments])
+
+    def record_interaction(self, interaction: discord.Interaction):
+        if not self.enabled: return
+        if interaction.type == discord.InteractionType.application_command: event_type = "command"
+        elif interaction.type == discord.InteractionType.autocomplete: event_type = "autocomplete"
+        else: return
+        data = interaction.data or {}
+        names, options = [data.get("name", "")], data.get("options") or []
+        while len(options) == 1 and options[0].get("type") in (1, 2): # サブコマンド (グループ) をたどる
+            names.append(options[0]["name"])
+            options = options[0].get("options") or []
+        command = interaction.command if isinstance(interaction.command, app_commands.Command) else None
+        resolved_attachments = (data.get("resolved") or {}).get("attachments") or {}
+        args, focused = {}, None
+        for option in options:
+            name, value, option_type = option.get("name"), option.get("value"), option.get("type")
+            if option.get("focused"): focused = name
+            if option_type == 3 and isinstance(value, str):
+                parameter = command.get_parameter(name) if command else None
+                choices = {choice.value for choice in parameter.choices} if parameter else set()
+                args[name] = value if value in choices else self.anonymize_text(value) # 選択肢の値はそのまま
+            elif option_type in (4, 5, 10): args[name] = value # 数値・真偽値
+            elif option_type == 11:
+                attachment = resolved_attachments.get(str(value)) or {}
+                args[name] = {"attachment": {"size": attachment.get("size", 0), "content_type": attachment.get("content_type"),
+                                             "ext": os.path.splitext(attachment.get("filename", ""))[1].lower()[:10]}}
+            else: args[name] = {"id": self.pseudonym("x", value)} # ユーザー・チャンネル・ロールなど
+        fields = {"user": self.pseudonym("u", interaction.user.id if interaction.user else None),
+                  "channel": self.pseudonym("c", interaction.channel_id), "guild": self.pseudonym("g", interaction.guild_id),
+                  "command": " ".join(names), "args": args}
+        if event_type == "autocomplete": fields["focused"] = focused
+        self._record(event_type, **fields)
+
+traffic_recorder = TrafficRecorder()
+
+def traffic_trace_path() -> str:
+    return os.path.join(BASE_UPLOAD_FOLDER, TRAFFIC_TRACE_FILE)
+
+# --- 起動処理 (クライアントの準備・スラッシュコマンドの同期) ---
+class ClientWarmup:
+    """ Gemini / Drive クライアントの初期化 (重いライブラリの読み込みを含む) をバックグラウンドのスレッドで行う。
+        ゲートウェイへの接続と並行して進み、準備中に届いたメッセージ・コマンドは wait() で完了を待つ """
+    def __init__(self):
+        self.task: asyncio.Task | None = None
+        self.elapsed: float | None = None
+
+    def start(self):
+        if self.task is None: self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        started = time.monotonic()
+        results = await asyncio.gather(asyncio.to_thread(initialize_gemini), asyncio.to_thread(initialize_gdrive_service),
+                                       asyncio.to_thread(Image.load), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception): print(f"クライアントの準備中にエラーが発生しました: {result}")
+        self.elapsed = time.monotonic() - started
+        print(f"Gemini / Google Drive クライアントの準備が完了しました ({self.elapsed:.2f} 秒)。")
+
+    @property
+    def done(self) -> bool:
+        return self.task is None or self.task.done()
+
+    async def wait(self):
+        if self.done: return
+        await asyncio.shield(self.task)
+
+client_warmup = ClientWarmup()
+
+def compute_command_tree_hash() -> str:
+    """ 登録するスラッシュコマンド定義 (名前・説明・引数・権限など、Discord に送る内容そのもの) のハッシュ """
+    payload = sorted((command.to_dict(bot.tree) for command in bot.tree.get_commands()),
+                     key=lambda command: (command.get("type", 1), command["name"]))
+    source = json.dumps({"application_id": bot.application_id, "commands": payload}, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+def read_synced_command_hash() -> str | None:
+    try:
+        with open(COMMAND_SYNC_STATE_FILE_NAME, "r", encoding="utf-8") as f:
+            return json.load(f).get("hash")
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def write_synced_command_hash(command_hash: str):
+    with open(COMMAND_SYNC_STATE_FILE_NAME, "w", encoding="utf-8") as f:
+        json.dump({"hash": command_hash, "synced_at": datetime.datetime.now().isoformat()}, f)
+
+async def sync_command_tree_if_changed():
+    """ コマンド定義が前回の同期から変わった場合だけ bot.tree.sync() を呼ぶ (再起動のたびに同期してレート制限に掛からないように) """
+    command_hash = compute_command_tree_hash()
+    synced_hash = await local_storage.run(read_synced_command_hash)
+    if synced_hash == command_hash:
+        print("スラッシュコマンドの定義に変更が無いため、同期を省略しました。")
+        return
+    try:
+        await bot.tree.sync()
+    except Exception as e:
+        print(f"スラッシュコマンドの同期に失敗しました: {e}")
+        return
+    await local_storage.run(write_synced_command_hash, command_hash)
+    print("スラッシュコマンドを同期しました。")
+
+async def prepare_bot():
+    """ ログイン直後・ゲートウェイ接続前に1回だけ呼ばれる (setup_hook。再接続では呼ばれない) """
+    client_warmup.start()
+    await sync_command_tree_if_changed()
+
+bot.setup_hook = prepare_bot
+bot_started = False # on_ready は再接続のたびに呼ばれるので、起動時の処理は1回だけ行う
 
 # --- BOTイベント ---
 @bot.event
 async def on_ready():
-    global current_gemini_model, UPLOAD_DESTINATION # UPLOAD_DESTINATION もグローバル参照するように
+    global current_gemini_model, UPLOAD_DESTINATION, bot_started # UPLOAD_DESTINATION もグローバル参照するように
+    if bot_started:
+        print(f'{bot.user.name} としてゲートウェイに再接続しました (サーバー数: {len(bot.guilds)})')
+        return
+    bot_started = True
     print(f'{bot.user.name} としてログインしました (ID: {bot.user.id})')
     print(f'監視中のサーバー数: {len(bot.guilds)}')
+    if GATEWAY_AUTO_SHARDED:
+        print(f'ゲートウェイ: AutoShardedBot ({bot.shard_count} シャード)')
     print(f'ベースアップロードフォルダ(ローカル): {os.path.abspath(BASE_UPLOAD_FOLDER)}')
     
     # bot_config から最新のアップロード先を読み込む
     UPLOAD_DESTINATION = bot_config.get("upload_destination", DEFAULT_CONFIG["upload_destination"])
     print(f'現在のアップロード先: {UPLOAD_DESTINATION}')
+    if PER_GUILD_STORAGE or bot_config.get("guild_settings"):
+        print(f'サーバーごとの保存先: {"すべてのサーバー" if PER_GUILD_STORAGE else "guild_settings のサーバー"} '
+              f'({os.path.abspath(os.path.join(BASE_UPLOAD_FOLDER, "guilds"))} 以下)')
     print(f'Geminiコマンド管理者ロール: {ADMIN_ROLE_NAMES}')
-    if gemini_model_instance:
-        print(f'使用中Geminiモデル: {current_gemini_model}')
-    else:
-        print('Geminiモデルは初期化されていません。')
     
     load_tagging_prompt()
 
-    if not os.path.exists(BASE_UPLOAD_FOLDER):
+    if not await local_storage.exists(BASE_UPLOAD_FOLDER):
         try: # ベースフォルダ作成失敗時のエラーハンドリング
-            os.makedirs(BASE_UPLOAD_FOLDER)
+            await local_storage.makedirs(BASE_UPLOAD_FOLDER)
             print(f"ベースフォルダ '{BASE_UPLOAD_FOLDER}' を作成しました。")
         except Exception as e:
             print(f"エラー: ベースフォルダ '{BASE_UPLOAD_FOLDER}' の作成に失敗しました: {e}")
 
+    if bot_config.get("traffic_recording", DEFAULT_CONFIG["traffic_recording"]):
+        await traffic_recorder.start(traffic_trace_path())
 
-    initialize_gdrive_service() # Google Driveサービスを初期化 (起動時に一度行う)
-
-    try:
-        await bot.tree.sync()
-        print("スラッシュコマンドを同期しました。")
-    except Exception as e:
-        print(f"スラッシュコマンドの同期に失敗しました: {e}")
+    await client_warmup.wait() # Drive のシャード・Gemini モデルを使う処理の前に準備の完了を待つ
+    if gemini_model_instance:
+        print(f'使用中Geminiモデル: {current_gemini_model}')
+    else:
+        print('Geminiモデルは初期化されていません。')
+    if gdrive_service:
+        for guild_ctx in known_guild_contexts(): guild_ctx.prefetch_drive_roots() # 分離されたサーバーの Drive フォルダを先に用意しておく
+    if len(get_gdrive_shards()) > 1:
+        print(f"Google Drive シャード: {[shard.name for shard in get_gdrive_shards()]} (配置: {GDRIVE_PLACEMENT_POLICY})")
+        if GDRIVE_PLACEMENT_POLICY == "least_used":
+            asyncio.create_task(refresh_gdrive_shard_usage())
+    start_tier_mover()
+    start_autocomplete_prefetch()
+    start_degraded_queue_drainer()
+    image_workers.start()
+    if ingest_process_pool.enabled:
+        ingest_process_pool.start()
+    await write_back_ingest.journal.ensure_loaded()
+    if WRITE_BACK_INGEST or ingest_process_pool.enabled or write_back_ingest.journal.pending(): # 前回の未完了ジョブも再開する
+        await write_back_ingest.start()
+    for guild_ctx in known_guild_contexts():
+        token = current_guild_context.set(guild_ctx) # 再開したジョブのタスクはこのサーバーのコンテキストを引き継ぐ
+        retag_state = get_retag_manager().load()
+        if retag_state and retag_state["status"] in ("running", "interrupted") and get_retag_manager().resume():
+            print(f"前回中断された再タグ付けジョブを再開しました。({guild_ctx.label})")
+        current_guild_context.reset(token)
     print('------')
 
 @bot.event
 async def on_message(message):
     if message.author == bot.user: return
+    traffic_recorder.record_message(message) # 到着時刻を記録するので準備待ちより前
+    await client_warmup.wait() # 起動直後はタグ付け・アップロードのクライアントの準備を待つ
+    await enter_guild_context(message.guild) # このイベントの保存先・設定はメッセージのサーバーのもの
     if message.attachments:
         ctx = await bot.get_context(message) # サーバー情報などのため
-        for attachment in message.attachments:
-            allowed_image_types = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
-            allowed_video_types = ('.mp4', '.mov', '.avi', '.mkv', '.webm')
-            file_ext = os.path.splitext(attachment.filename)[1].lower()
-
-            if not (file_ext in allowed_image_types or file_ext in allowed_video_types):
-                # await message.channel.send(f"ファイル '{attachment.filename}' の形式 ({file_ext}) はサポートされていません。画像または動画ファイルをアップロードしてください。")
-                # サポート外形式はログにのみ残し、ユーザーには通知しない運用も検討 (チャンネルがログで溢れるのを防ぐため)
-                print(f"Skipping unsupported file type: {attachment.filename} ({file_ext})")
-                continue
+        attachment_slots = asyncio.Semaphore(max(1, GEMINI_BATCH_MAX_IMAGES)) # 1投稿の同時処理数は1バッチ分まで
+        async def process_with_slot(attachment):
+            async with attachment_slots: await process_attachment(message, ctx, attachment)
+        await asyncio.gather(*(process_with_slot(attachment) for attachment in message.attachments))
 
-            limit_bytes = 8 * 1024 * 1024 
-            if ctx.guild and hasattr(ctx.guild, 'filesize_limit'):
-                limit_bytes = ctx.guild.filesize_limit
-            
-            if attachment.size > limit_bytes:
-                 await message.channel.send(f"ファイル '{attachment.filename}' ({attachment.size // 1024 // 1024}MB) はサイズが大きすぎます (サーバー上限: {limit_bytes // 1024 // 1024}MB)。")
-                 continue
+    await bot.process_commands(message)
 
-            temp_dir = os.path.join(BASE_UPLOAD_FOLDER, "temp")
-            if not os.path.exists(temp_dir):
-                try: os.makedirs(temp_dir)
-                except Exception as e:
-                    print(f"一時フォルダ '{temp_dir}' の作成に失敗: {e}")
-                    await message.channel.send(f"'{attachment.filename}' の処理中に内部エラーが発生しました（一時フォルダ作成不可）。")
-                    continue
-            
-            temp_save_path = os.path.join(temp_dir, f"temp_{attachment.id}_{sanitize_filename_component(attachment.filename)}")
-            
-            try:
-                await attachment.save(temp_save_path)
-            except Exception as e_save:
-                print(f"一時ファイル '{temp_save_path}' の保存に失敗: {e_save}")
-                await message.channel.send(f"ファイル '{attachment.filename}' の一時保存に失敗しました。")
-                continue
+async def resolve_interaction_guild(interaction: discord.Interaction) -> bool:
+    """ スラッシュコマンドとオートコンプリートの前に、対象のサーバーのコンテキストを一度だけ設定する。
+        起動直後でクライアントの準備が済んでいなければ、応答期限 (3秒) を過ぎないように待たずに断る """
+    if not client_warmup.done:
+        if interaction.type == discord.InteractionType.application_command:
+            await interaction.response.send_message("BOTを起動中です。数秒後にもう一度お試しください。", ephemeral=True)
+        return False
+    await enter_guild_context(interaction.guild_id, resolve_drive_roots=False) # 応答 (defer) 前に Drive を呼ばない
+    return True
+
+bot.tree.interaction_check = resolve_interaction_guild
+
+async def handle_app_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+    """ Drive / Gemini の停止中に中断したコマンドには、その旨を返信する (応答しないままにしない) """
+    original = getattr(error, "original", None)
+    if not isinstance(original, DependencyUnavailableError):
+        return await app_commands.CommandTree.on_error(bot.tree, interaction, error)
+    print(f"/{interaction.command.qualified_name if interaction.command else '?'} を中断しました: {original}")
+    message = f"{original}。しばらくしてからもう一度お試しください。"
+    try:
+        if interaction.response.is_done(): await interaction.followup.send(message, ephemeral=True)
+        else: await interaction.response.send_message(message, ephemeral=True)
+    except discord.HTTPException as e:
+        print(f"エラーの通知に失敗しました: {e}")
 
-            processing_msg = await message.channel.send(f"ファイル '{attachment.filename}' を処理中... 自動タグ付けを開始します。")
-            
-            tags_str = "notags"
-            if gemini_model_instance:
-                try:
-                    if file_ext in allowed_image_types:
-                        try:
-                            img = Image.open(temp_save_path)
-                            img.verify()
-                            img.close()
-                        except Exception as img_err:
-                            await processing_msg.edit(content=f"ファイル '{attachment.filename}' は有効な画像ではないようです。処理を中断します。({img_err})")
-                            if os.path.exists(temp_save_path): os.remove(temp_save_path)
-                            continue
-                    
-                    tags_str = await get_tags_from_gemini(temp_save_path, attachment.filename, attachment.content_type)
-                except Exception as e:
-                    print(f"タグ付け処理中にエラー: {e}")
-                    await processing_msg.edit(content=f"ファイル '{attachment.filename}' のタグ付け中にエラーが発生しました。タグなしで処理を続行します。")
-                    tags_str = "notags"
-            else:
-                await processing_msg.edit(content=f"ファイル '{attachment.filename}' を処理中... (Gemini API未設定のためタグ付けスキップ)")
+bot.tree.on_error = handle_app_command_error
 
-            date_str = datetime.datetime.now().strftime("%Y%m%d")
-            original_filename_no_ext, original_ext = os.path.splitext(attachment.filename)
-            sanitized_original_filename = sanitize_filename_component(original_filename_no_ext)
-            new_filename = f"{date_str}_{tags_str}_{sanitized_original_filename}{original_ext}"
-            
-            display_tags_on_message = tags_str.replace("_", "-") if tags_str != "notags" else "なし"
-            
-            # 現在のアップロード先をbot_configから再取得（コマンドで変更された場合に対応）
-            current_upload_dest_on_message = bot_config.get("upload_destination", DEFAULT_CONFIG["upload_destination"])
-
-            if current_upload_dest_on_message == "gdrive":
-                if gdrive_service and GDRIVE_TARGET_FOLDER_ID:
-                    gdrive_file_info = await upload_to_gdrive(temp_save_path, new_filename, attachment.content_type)
-                    if gdrive_file_info:
-                        file_link = gdrive_file_info.get('webViewLink', 'リンク不明')
-                        await processing_msg.edit(content=(
-                            f"ファイル '{attachment.filename}' をGoogle Driveにアップロードし、'{new_filename}' として保存しました。\n"
-                            f"自動タグ: `{display_tags_on_message}`\nリンク: <{file_link}>"
-                        ))
-                    else:
-                        await processing_msg.edit(content=f"ファイル '{attachment.filename}' のGoogle Driveへのアップロードに失敗しました。ローカルにも保存されませんでした。")
-                else:
-                    await processing_msg.edit(content=f"Google Driveが設定されていないか、サービスが利用できないため、'{attachment.filename}' のアップロードをスキップしました。ローカルにも保存されません。")
-                
-                if os.path.exists(temp_save_path):
-                    try: os.remove(temp_save_path); print(f"一時ファイル '{temp_save_path}' を削除しました。")
-                    except Exception as e_rm: print(f"一時ファイル '{temp_save_path}' の削除失敗: {e_rm}")
-
-            elif current_upload_dest_on_message == "local":
-                local_ym_folder = create_year_month_folder_if_not_exists(BASE_UPLOAD_FOLDER)
-                final_save_path = os.path.join(local_ym_folder, new_filename)
-                try:
-                    os.rename(temp_save_path, final_save_path)
-                    print(f"ファイル '{attachment.filename}' を '{final_save_path}' に保存しました。")
-                    await processing_msg.edit(content=(
-                        f"ファイル '{attachment.filename}' をローカルに保存しました: '{new_filename}'\n自動タグ: `{display_tags_on_message}`"
-                    ))
-                except Exception as e:
-                    print(f"ローカル保存エラー: {e}")
-                    await processing_msg.edit(content=f"'{attachment.filename}' のローカル保存中にエラーが発生しました。")
-                    if os.path.exists(temp_save_path): # rename失敗時は一時ファイルを削除
-                        try: os.remove(temp_save_path); print(f"エラー発生のため一時ファイル '{temp_save_path}' を削除しました。")
-                        except Exception as e_rm: print(f"一時ファイル '{temp_save_path}' の削除失敗: {e_rm}")
-            else:
-                print(f"不明なアップロード先が設定されています: {current_upload_dest_on_message}")
-                await processing_msg.edit(content=f"アップロード先の設定が不明なため、'{attachment.filename}' の処理を中断しました。")
-                if os.path.exists(temp_save_path):
-                    try: os.remove(temp_save_path); print(f"不明なアップロード先のため一時ファイル '{temp_save_path}' を削除しました。")
-                    except Exception as e_rm: print(f"一時ファイル '{temp_save_path}' の削除失敗: {e_rm}")
-            
-    await bot.process_commands(message)
+@bot.event
+async def on_interaction(interaction: discord.Interaction):
+    traffic_recorder.record_interaction(interaction)
+
+# --- オートコンプリート用の年月フォルダ一覧のキャッシュ ---
+async def fetch_month_names(destination: str) -> list[str]:
+    """ 保存先にある年月フォルダ名 (新しい順)。tiered ではローカルと Drive の和集合 """
+    names = set()
+    if destination in ("local", "tiered"):
+        names.update(await local_storage.list_months(get_base_upload_folder()) or [])
+    if destination in ("gdrive", "tiered") and gdrive_available():
+        for shard in get_gdrive_shards():
+            names.update(folder["name"] for folder in await list_gdrive_subfolders(shard.folder_id, shard.service, name_pattern_re=r"^\d{6}$"))
+    return sorted(names, reverse=True)
+
+async def fetch_month_file_names(destination: str, year_month: str) -> list[str]:
+    """ 年月フォルダ内のファイル名 (ローカル → 各シャードの順、重複は除く) """
+    names = []
+    if destination in ("local", "tiered"):
+        names.extend(entry.name for entry in await local_storage.scan(os.path.join(get_base_upload_folder(), year_month)) or [] if not entry.is_dir)
+    if destination in ("gdrive", "tiered") and gdrive_available():
+        for shard in get_gdrive_shards():
+            folder_id = await get_gdrive_folder_id_by_name(shard.folder_id, year_month, shard.service)
+            if not folder_id: continue
+            names.extend(file_item["name"] for file_item in await list_files_in_gdrive_folder(folder_id, shard.service) if file_item.get("name"))
+    return list(dict.fromkeys(names))
+
+class MonthListingCache:
+    """
+    オートコンプリート用に、年月フォルダごとのファイル名一覧をメモリに持つ (保存先ごとに1つ)。
+    年月が入力された時点で一覧を先読みし、以降の入力はキャッシュの絞り込みだけで返す。アップロード・削除・リネームは
+    キャッシュ済みの一覧に直接反映し、その間に取得中だった一覧は古い可能性があるので保存しない。
+    """
+    def __init__(self):
+        self.destination: str | None = None
+        self.listings: dict[str, tuple[float, list[str]]] = {} # 年月 -> (取得時刻, ファイル名一覧)
+        self.month_names: tuple[float, list[str]] | None = None
+        self.loading: dict[str, asyncio.Task] = {}
+        self.generations: collections.Counter = collections.Counter() # 年月ごとの変更回数 (取得中の一覧が古くなったかの判定用)
+
+    def _check_destination(self):
+        destination = get_upload_destination()
+        if destination != self.destination: # 保存先が変わったら全て取り直す
+            self.destination = destination
+            self.listings.clear()
+            self.month_names = None
+            self.loading.clear()
+
+    @staticmethod
+    def _fresh(fetched_at: float) -> bool:
+        return time.monotonic() - fetched_at < AUTOCOMPLETE_LISTING_TTL_SECONDS
+
+    def cached(self, year_month: str) -> list[str] | None:
+        self._check_destination()
+        entry = self.listings.get(year_month)
+        return entry[1] if entry and self._fresh(entry[0]) else None
+
+    def prefetch(self, year_month: str) -> asyncio.Task | None:
+        """ キャッシュがなければ一覧の取得を始める (取得中なら同じタスクを返す) """
+        if self.cached(year_month) is not None: return None
+        return self._start_load(year_month)
+
+    def _start_load(self, year_month: str) -> asyncio.Task:
+        task = self.loading.get(year_month)
+        if task is None or task.done():
+            task = self.loading[year_month] = asyncio.create_task(self._load(year_month))
+        return task
+
+    async def get(self, year_month: str) -> list[str]:
+        names = self.cached(year_month)
+        if names is not None: return names
+        return await asyncio.shield(self.prefetch(year_month)) # オートコンプリートが打ち切られても取得は続けてキャッシュする
+
+    async def _load(self, year_month: str) -> list[str]:
+        destination, generation = self.destination, self.generations[year_month]
+        try:
+            names = await fetch_month_file_names(destination, year_month)
+        except Exception as e:
+            print(f"年月フォルダ '{year_month}' の一覧の取得中にエラー: {e}")
+            return []
+        finally:
+            if self.loading.get(year_month) is asyncio.current_task(): del self.loading[year_month]
+        if self.destination == destination and self.generations[year_month] == generation:
+            self.listings[year_month] = (time.monotonic(), names)
+        return names
+
+    async def months(self) -> list[str]:
+        self._check_destination()
+        if self.month_names is None or not self._fresh(self.month_names[0]):
+            self.month_names = (time.monotonic(), await fetch_month_names(self.destination))
+        return self.month_names[1]
+
+    async def prefetch_recent(self, count: int):
+        """ 新しい方から count 個の年月の一覧を、キャッシュの有効期限の半分を過ぎていたら取り直す """
+        for year_month in (await self.months())[:count]:
+            entry = self.listings.get(year_month)
+            if entry is None or time.monotonic() - entry[0] > AUTOCOMPLETE_LISTING_TTL_SECONDS / 2: self._start_load(year_month)
+
+    def _changed(self, filepath: str) -> tuple[str, str, list[str] | None]:
+        year_month, filename = filepath.split('/', 1)
+        self.generations[year_month] += 1
+        self.loading.pop(year_month, None)
+        entry = self.listings.get(year_month)
+        return year_month, filename, entry[1] if entry else None
+
+    def note_added(self, filepath: str):
+        year_month, filename, names = self._changed(filepath)
+        if names is not None and filename not in names: names.append(filename)
+        if self.month_names and year_month not in self.month_names[1]:
+            self.month_names = (self.month_names[0], sorted([*self.month_names[1], year_month], reverse=True))
+
+    def note_removed(self, filepath: str):
+        _, filename, names = self._changed(filepath)
+        if names is not None and filename in names: names.remove(filename)
+
+    def note_renamed(self, old_filepath: str, new_filepath: str):
+        self.note_removed(old_filepath)
+        self.note_added(new_filepath)
+
+def get_month_listing_cache() -> MonthListingCache:
+    return get_storage_scoped("month_listing_cache", MonthListingCache)
+
+autocomplete_prefetch_task = None
+
+async def autocomplete_prefetch_loop():
+    """ 各保存先の新しい年月フォルダの一覧を、キャッシュが切れる前に取り直しておくバックグラウンドタスク """
+    while True:
+        for guild_ctx in known_guild_contexts():
+            try:
+                await enter_guild_context(guild_ctx.guild_id)
+                await get_month_listing_cache().prefetch_recent(AUTOCOMPLETE_PREFETCH_RECENT_MONTHS)
+            except Exception as e:
+                print(f"オートコンプリートの一覧の先読み ({guild_ctx.label}) でエラーが発生しました: {e}")
+        await asyncio.sleep(max(10, AUTOCOMPLETE_LISTING_TTL_SECONDS * 0.8))
+
+def start_autocomplete_prefetch():
+    global autocomplete_prefetch_task
+    if AUTOCOMPLETE_PREFETCH_RECENT_MONTHS > 0 and (autocomplete_prefetch_task is None or autocomplete_prefetch_task.done()):
+        autocomplete_prefetch_task = asyncio.create_task(autocomplete_prefetch_loop())
 
 # --- オートコンプリート用の関数 ---
 async def gemini_model_autocomplete(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
@@ -729,43 +4971,45 @@ async def gemini_model_autocomplete(interaction: discord.Interaction, current: s
     return choices
 
 async def year_month_autocomplete(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
-    choices = []
-    current_upload_dest = bot_config.get("upload_destination", DEFAULT_CONFIG["upload_destination"])
+    current_upload_dest = get_upload_destination()
+    ym_folders = set()
 
-    if current_upload_dest == "local":
-        ym_folders = set()
-        if not os.path.exists(BASE_UPLOAD_FOLDER): return []
+    if current_upload_dest in ("local", "tiered"):
         try:
-            for item in os.listdir(BASE_UPLOAD_FOLDER):
-                if os.path.isdir(os.path.join(BASE_UPLOAD_FOLDER, item)) and len(item) == 6 and item.isdigit():
-                    ym_folders.add(item)
-            
-            for folder_name in sorted(list(ym_folders), reverse=True): 
-                if current.lower() in folder_name.lower():
-                    choices.append(app_commands.Choice(name=folder_name, value=folder_name))
-                if len(choices) >= 25: break
+            ym_folders.update(await local_storage.list_months(get_base_upload_folder()) or [])
         except Exception as e:
             print(f"year_month_autocomplete (local) 中にエラー: {e}")
             return [] # エラー時は空を返す
-            
-    elif current_upload_dest == "gdrive":
-        if not gdrive_service or not GDRIVE_TARGET_FOLDER_ID:
+
+    if current_upload_dest in ("gdrive", "tiered"):
+        if not gdrive_available():
             print("year_month_autocomplete (gdrive): GDriveサービス未初期化またはターゲットフォルダID未設定")
-            return []
-        try:
-            subfolders = await list_gdrive_subfolders(GDRIVE_TARGET_FOLDER_ID, gdrive_service, name_pattern_re=r"^\d{6}$")
-            if subfolders: # list_gdrive_subfolders は名前降順でソート済み
-                for folder_info in subfolders:
-                    folder_name = folder_info['name']
-                    if current.lower() in folder_name.lower():
-                        choices.append(app_commands.Choice(name=folder_name, value=folder_name))
-                    if len(choices) >= 25: break
-        except Exception as e:
-            print(f"year_month_autocomplete (gdrive) 中にエラー: {e}")
-            return [] # エラー時は空を返す
-            
+            if current_upload_dest == "gdrive": return []
+        else:
+            try:
+                subfolder_lists = await asyncio.gather(*(list_gdrive_subfolders(shard.folder_id, shard.service, name_pattern_re=r"^\d{6}$")
+                                                         for shard in get_gdrive_shards()))
+                ym_folders.update(folder_info['name'] for subfolders in subfolder_lists for folder_info in subfolders)
+            except Exception as e:
+                print(f"year_month_autocomplete (gdrive) 中にエラー: {e}")
+                return [] # エラー時は空を返す
+
+    choices = []
+    for folder_name in sorted(ym_folders, reverse=True):
+        if current.lower() in folder_name.lower():
+            choices.append(app_commands.Choice(name=folder_name, value=folder_name))
+        if len(choices) >= 25: break
     return choices
 
+def build_filepath_choice(filepath: str) -> app_commands.Choice[str]:
+    """ "YYYYMM/ファイル名" を name/value とも 100 文字以内のオートコンプリート候補にする """
+    year_month_dir_name, fname = filepath.split('/', 1)
+    suffix = f" (in {year_month_dir_name})"
+    display_fname = fname
+    if len(fname) > 100 - len(suffix):
+        display_fname = fname[:max(0, 100 - len(suffix) - 3)] + "..."
+    return app_commands.Choice(name=f"{display_fname}{suffix}"[:100], value=filepath[:100])
+
 # [bot.py の修正箇所]
 
 async def filename_autocomplete(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
@@ -774,115 +5018,41 @@ async def filename_autocomplete(interaction: discord.Interaction, current: str)
     current_filename_part_to_search = current
     # bot_config はグローバル変数を直接参照するか、load_bot_config() で毎回読み込むか検討
     # ここでは前回提示したコードの通り、グローバル bot_config を参照する想定
-    current_upload_dest = bot_config.get("upload_destination", DEFAULT_CONFIG["upload_destination"])
+    current_upload_dest = get_upload_destination()
+
+    # 年月の指定が無い入力は全文検索索引から順位付きで候補を返す (索引が未構築・一致なしなら従来の走査)
+    search_index = await get_search_index()
+    if current.strip() and '/' not in current and not current.strip().isdigit() and search_index.is_built():
+        hits = search_index.search(current, limit=25)
+        if hits:
+            return [build_filepath_choice(filepath) for _, filepath in hits]
 
     if '/' in current and len(current.split('/')[0]) == 6 and current.split('/')[0].isdigit():
         parts = current.split('/', 1)
         specific_ym_folder_name = parts[0]
         current_filename_part_to_search = parts[1] if len(parts) > 1 else ""
 
-    if current_upload_dest == "local":
-        folders_to_search_paths = []
+    listing_cache = get_month_listing_cache()
+    try:
         if specific_ym_folder_name:
-            path_to_check = os.path.join(BASE_UPLOAD_FOLDER, specific_ym_folder_name)
-            if os.path.isdir(path_to_check):
-                folders_to_search_paths.append(path_to_check)
-        else: 
-            if os.path.exists(BASE_UPLOAD_FOLDER):
-                for item in sorted(os.listdir(BASE_UPLOAD_FOLDER), reverse=True): 
-                    item_path = os.path.join(BASE_UPLOAD_FOLDER, item)
-                    if os.path.isdir(item_path) and len(item) == 6 and item.isdigit():
-                        folders_to_search_paths.append(item_path)
-        
-        for folder_path in folders_to_search_paths:
-            year_month_dir_name = os.path.basename(folder_path) # "YYYYMM"
-            try:
-                for fname in sorted(os.listdir(folder_path)): 
-                    if os.path.isfile(os.path.join(folder_path, fname)):
-                        if current_filename_part_to_search.lower() in fname.lower():
-                            # --- 表示名 (name) の生成 ---
-                            suffix = f" (in {year_month_dir_name})"
-                            allowed_fname_len_for_display = 100 - len(suffix) 
-                            display_fname = fname
-                            if len(fname) > allowed_fname_len_for_display:
-                                display_fname = fname[:max(0, allowed_fname_len_for_display - 3)] + "..."
-                            
-                            final_choice_name = f"{display_fname}{suffix}"
-                            if len(final_choice_name) > 100: # 更なる最終チェック
-                                final_choice_name = final_choice_name[:97] + "..."
-                            
-                            # --- 値 (value) の生成と調整 ---
-                            base_value = f"{year_month_dir_name}/{fname}"
-                            value_to_set = base_value
-                            if len(base_value) > 100:
-                                prefix = f"{year_month_dir_name}/"
-                                # prefix の7文字 + ファイル名の最大長
-                                max_fname_len_for_value = 100 - len(prefix)
-                                if max_fname_len_for_value < 1: # ほぼありえないが YYYYMM/ が長すぎる場合
-                                    value_to_set = base_value[:100] # 単純に先頭100文字
-                                else:
-                                    value_to_set = f"{prefix}{fname[:max_fname_len_for_value]}"
-                            
-                            choices.append(app_commands.Choice(name=final_choice_name, value=value_to_set))
-                            if len(choices) >= 25: break
-            except Exception as e:
-                print(f"filename_autocomplete (local) でフォルダ '{folder_path}' のスキャン中にエラー: {e}")
+            folders_to_search_names = [specific_ym_folder_name]
+        else:
+            folders_to_search_names = await listing_cache.months()
+            typed = current.strip()
+            matching_months = [name for name in folders_to_search_names if name.startswith(typed)] if typed.isdigit() else []
+            if matching_months: # 年月を入力し始めたら、該当する (新しい方の) 年月の一覧を先読みしておく
+                for year_month_dir_name in matching_months[:2]: listing_cache.prefetch(year_month_dir_name)
+                folders_to_search_names, current_filename_part_to_search = matching_months, ""
+
+        for year_month_dir_name in folders_to_search_names: # "YYYYMM" (新しい順)
+            keyword = current_filename_part_to_search.lower()
+            for fname in await listing_cache.get(year_month_dir_name):
+                if keyword in fname.lower():
+                    choices.append(build_filepath_choice(f"{year_month_dir_name}/{fname}"))
+                    if len(choices) >= 25: break
             if len(choices) >= 25: break
-            
-    elif current_upload_dest == "gdrive":
-        if not gdrive_service or not GDRIVE_TARGET_FOLDER_ID:
-            print("filename_autocomplete (gdrive): GDriveサービス未初期化またはターゲットフォルダID未設定")
-            return []
-
-        gdrive_folders_to_scan_info = [] 
-        try:
-            if specific_ym_folder_name:
-                ym_folder_id = await get_gdrive_folder_id_by_name(GDRIVE_TARGET_FOLDER_ID, specific_ym_folder_name, gdrive_service)
-                if ym_folder_id:
-                    gdrive_folders_to_scan_info.append({'id': ym_folder_id, 'name': specific_ym_folder_name})
-            else:
-                subfolders = await list_gdrive_subfolders(GDRIVE_TARGET_FOLDER_ID, gdrive_service, name_pattern_re=r"^\d{6}$")
-                gdrive_folders_to_scan_info.extend(subfolders)
-
-            for folder_info in gdrive_folders_to_scan_info:
-                folder_id_to_scan = folder_info['id']
-                current_year_month_name = folder_info['name'] # "YYYYMM"
-                
-                files_in_gdrive = await list_files_in_gdrive_folder(folder_id_to_scan, gdrive_service, keyword=current_filename_part_to_search)
-                if files_in_gdrive: 
-                    for gfile in files_in_gdrive:
-                        gfile_name = gfile.get("name")
-                        if not gfile_name: continue
-                        
-                        # --- 表示名 (name) の生成 ---
-                        suffix = f" (in {current_year_month_name})"
-                        allowed_gfname_len_for_display = 100 - len(suffix)
-                        display_gfname = gfile_name
-                        if len(gfile_name) > allowed_gfname_len_for_display:
-                             display_gfname = gfile_name[:max(0, allowed_gfname_len_for_display - 3)] + "..."
-
-                        final_choice_name = f"{display_gfname}{suffix}"
-                        if len(final_choice_name) > 100: # 更なる最終チェック
-                            final_choice_name = final_choice_name[:97] + "..."
-
-                        # --- 値 (value) の生成と調整 ---
-                        base_value = f"{current_year_month_name}/{gfile_name}"
-                        value_to_set = base_value
-                        if len(base_value) > 100:
-                            prefix = f"{current_year_month_name}/"
-                            max_gfname_len_for_value = 100 - len(prefix)
-                            if max_gfname_len_for_value < 1:
-                                value_to_set = base_value[:100]
-                            else:
-                                value_to_set = f"{prefix}{gfile_name[:max_gfname_len_for_value]}"
-                        
-                        choices.append(app_commands.Choice(name=final_choice_name, value=value_to_set))
-                        if len(choices) >= 25: break
-                if len(choices) >= 25: break
-        except Exception as e:
-            print(f"filename_autocomplete (gdrive) 中にエラー: {e}")
-            return []
-            
+    except Exception as e:
+        print(f"filename_autocomplete ({current_upload_dest}) 中にエラー: {e}")
     return choices
 
 # --- コマンドグループの定義 ---
@@ -900,106 +5070,20 @@ async def upload_guide(interaction: discord.Interaction):
 
 # --- /files サブコマンド ---
 @files_group.command(name="list", description="保存されているファイルの一覧を表示します。")
-@app_commands.describe(year_month="表示する年月 (例: 202305)。", keyword="ファイル名やタグに含まれるキーワードで絞り込みます。")
+@app_commands.describe(year_month="表示する年月 (例: 202305)。",
+                       keyword="キーワードまたは検索式 (例: 猫 / tag:猫 type:video size>50MB date:20240101..20240331 / tag:none)")
 @app_commands.autocomplete(year_month=year_month_autocomplete)
 async def files_list(interaction: discord.Interaction, year_month: str = None, keyword: str = None):
     await interaction.response.defer()
-    found_files_details = [] 
-    current_upload_dest = bot_config.get("upload_destination", DEFAULT_CONFIG["upload_destination"])
-
-    if current_upload_dest == "local":
-        search_paths = [] 
-        if year_month:
-            if not (len(year_month) == 6 and year_month.isdigit()):
-                await interaction.followup.send("年月の指定が正しくありません。YYYYMM形式で入力してください (例: 202305)。")
-                return
-            target_ym_folder = os.path.join(BASE_UPLOAD_FOLDER, year_month)
-            if os.path.exists(target_ym_folder) and os.path.isdir(target_ym_folder):
-                search_paths.append(target_ym_folder)
-            else:
-                await interaction.followup.send(f"指定された年月フォルダ '{year_month}' はローカルに見つかりません。")
-                return
-        else:
-            if os.path.exists(BASE_UPLOAD_FOLDER):
-                for item in sorted(os.listdir(BASE_UPLOAD_FOLDER), reverse=True): 
-                    item_path = os.path.join(BASE_UPLOAD_FOLDER, item)
-                    if os.path.isdir(item_path) and len(item) == 6 and item.isdigit():
-                        search_paths.append(item_path)
-            
-        if not search_paths:
-            msg = "検索対象のローカルフォルダが見つかりません。"
-            if year_month: msg = f"指定された年月フォルダ '{year_month}' はローカルに見つかりません。"
-            elif not os.path.exists(BASE_UPLOAD_FOLDER): msg = f"ベースアップロードフォルダ '{BASE_UPLOAD_FOLDER}' がローカルに見つかりません。"
-            await interaction.followup.send(msg)
-            return
-
-        for folder_to_scan in search_paths:
-            try:
-                current_year_month_name = os.path.basename(folder_to_scan)
-                for fname in sorted(os.listdir(folder_to_scan)):
-                    if os.path.isfile(os.path.join(folder_to_scan, fname)):
-                        if keyword and keyword.lower() not in fname.lower():
-                            continue
-                        parsed_info = parse_bot_filename(fname)
-                        found_files_details.append({
-                            "fullname": fname, "date": parsed_info["date"], 
-                            "tags": parsed_info["tags_display"], 
-                            "original_name": parsed_info["original_stem"], 
-                            "year_month": current_year_month_name
-                        })
-            except Exception as e:
-                print(f"ローカルフォルダ '{folder_to_scan}' のスキャン中にエラー: {e}")
-                
-    elif current_upload_dest == "gdrive":
-        if not gdrive_service:
-            await interaction.followup.send("Google Driveサービスが初期化されていません。設定を確認してください。")
-            return
-        if not GDRIVE_TARGET_FOLDER_ID:
-            await interaction.followup.send("Google DriveのメインターゲットフォルダIDが設定されていません。")
-            return
-
-        gdrive_folders_to_scan_info = [] 
-        if year_month:
-            if not (len(year_month) == 6 and year_month.isdigit()):
-                await interaction.followup.send("年月の指定が正しくありません。YYYYMM形式で入力してください (例: 202305)。")
-                return
-            
-            ym_folder_id = await get_gdrive_folder_id_by_name(GDRIVE_TARGET_FOLDER_ID, year_month, gdrive_service)
-            if ym_folder_id:
-                gdrive_folders_to_scan_info.append({'id': ym_folder_id, 'name': year_month})
-            else:
-                await interaction.followup.send(f"指定された年月フォルダ '{year_month}' はGoogle Drive上に見つかりません。")
-                return
-        else:
-            subfolders = await list_gdrive_subfolders(GDRIVE_TARGET_FOLDER_ID, gdrive_service, name_pattern_re=r"^\d{6}$")
-            gdrive_folders_to_scan_info.extend(subfolders) 
-        
-        if not gdrive_folders_to_scan_info:
-            msg = "検索対象の年月フォルダがGoogle Drive上に見つかりません。"
-            if year_month: msg = f"指定された年月フォルダ '{year_month}' はGoogle Drive上に見つかりません。"
-            await interaction.followup.send(msg)
-            return
-
-        for folder_info in gdrive_folders_to_scan_info:
-            try:
-                files_in_gdrive = await list_files_in_gdrive_folder(folder_info['id'], gdrive_service, keyword=keyword)
-                if files_in_gdrive is None: 
-                    print(f"Google Driveフォルダ '{folder_info['name']}' (ID: {folder_info['id']}) のファイル一覧取得に失敗しました。")
-                    continue
-                for gfile in files_in_gdrive:
-                    gfile_name = gfile.get("name")
-                    if not gfile_name: continue
-                    parsed_info = parse_bot_filename(gfile_name)
-                    found_files_details.append({
-                        "fullname": gfile_name, "date": parsed_info["date"], 
-                        "tags": parsed_info["tags_display"], 
-                        "original_name": parsed_info["original_stem"], 
-                        "year_month": folder_info['name'], 
-                        "gdrive_id": gfile.get("id"), 
-                        "gdrive_link": gfile.get("webViewLink") 
-                    })
-            except Exception as e:
-                print(f"Google Driveフォルダ '{folder_info['name']}' の処理中にエラー: {e}")
+    current_upload_dest = get_upload_destination()
+    file_query, error_msg = parse_file_query(keyword)
+    if error_msg:
+        await interaction.followup.send(error_msg, ephemeral=True)
+        return
+    found_files_details, error_msg = await collect_stored_files(year_month, query=file_query)
+    if error_msg:
+        await interaction.followup.send(error_msg)
+        return
 
     # --- 共通のEmbed作成・送信処理 ---
     if not found_files_details:
@@ -1012,13 +5096,17 @@ async def files_list(interaction: discord.Interaction, year_month: str = None, k
     embed = discord.Embed(title="ファイル一覧", color=discord.Color.blue())
     description_parts = []
     if year_month: description_parts.append(f"年月: `{year_month}`")
-    if keyword: description_parts.append(f"キーワード: `{keyword}`")
+    if keyword: description_parts.append(f"条件: {file_query.describe()}")
     if description_parts:
         embed.description = "絞り込み条件: " + " | ".join(description_parts)
     
-    embed.set_footer(text=f"アップロード先: {current_upload_dest}")
+    embed.set_footer(text=f"アップロード先: {current_upload_dest}" + (f" | 実行計画: {' / '.join(file_query.plan)}" if file_query.plan else ""))
 
     MAX_FILES_IN_EMBED = 10 
+    # 表示するファイルのサムネイル (プレビュー) をまとめて用意する (Discordの添付上限は10件)
+    thumbnail_paths = await asyncio.gather(*(get_or_create_thumbnail(f"{f['year_month']}/{f['fullname']}")
+                                             for f in found_files_details[:MAX_FILES_IN_EMBED]))
+    preview_files = []
     for i, file_info in enumerate(found_files_details):
         if i >= MAX_FILES_IN_EMBED:
             embed.add_field(name="...", value=f"他 {len(found_files_details) - MAX_FILES_IN_EMBED} 件のファイルがあります。", inline=False)
@@ -1028,14 +5116,22 @@ async def files_list(interaction: discord.Interaction, year_month: str = None, k
         field_value = (f"元ファイル名: `{file_info['original_name']}`\n"
                        f"タグ: `{file_info['tags']}`\n"
                        f"保存日: `{file_info['date']}` (in `{file_info['year_month']}`)")
-        if current_upload_dest == "gdrive" and file_info.get('gdrive_link'):
+        if file_info.get('size') is not None:
+            field_value += f"\nサイズ: {file_info['size'] / 1024 / 1024:.2f} MB"
+        if current_upload_dest == "tiered":
+            field_value += f"\n保存層: `{'ローカル' if file_info.get('tier') == 'local' else 'Google Drive'}`"
+        if file_info.get('gdrive_link'):
              field_value += f"\n[Google Driveで開く]({file_info['gdrive_link']})"
+        if thumbnail_paths[i]:
+            preview_name = f"preview_{i + 1}.webp"
+            preview_files.append(discord.File(thumbnail_paths[i], filename=preview_name))
+            field_value += f"\nプレビュー: `{preview_name}`"
         embed.add_field(name=field_name, value=field_value, inline=False)
 
     if not embed.fields: 
         await interaction.followup.send("表示できるファイル情報がありません。")
         return
-    await interaction.followup.send(embed=embed)
+    await interaction.followup.send(embed=embed, files=preview_files)
 
 
 @files_group.command(name="info", description="指定された保存済みファイルの詳細情報を表示します。")
@@ -1043,7 +5139,7 @@ async def files_list(interaction: discord.Interaction, year_month: str = None, k
 @app_commands.autocomplete(filepath=filename_autocomplete)
 async def files_info(interaction: discord.Interaction, filepath: str):
     await interaction.response.defer()
-    current_upload_dest = bot_config.get("upload_destination", DEFAULT_CONFIG["upload_destination"])
+    current_upload_dest = await resolve_file_tier(filepath) # tiered の場合はファイルのある層 ("local" / "gdrive")
 
     try:
         ym_dir_name, filename = filepath.split('/', 1)
@@ -1052,13 +5148,14 @@ async def files_info(interaction: discord.Interaction, filepath: str):
         return
 
     if current_upload_dest == "local":
-        full_path = os.path.join(BASE_UPLOAD_FOLDER, ym_dir_name, filename)
-        if not os.path.exists(full_path) or not os.path.isfile(full_path):
+        full_path = os.path.join(get_base_upload_folder(), ym_dir_name, filename)
+        file_stat = await local_storage.stat(full_path) # 存在確認・サイズ・更新日時を1回で
+        if file_stat is None:
             await interaction.followup.send(f"ファイル `{filepath}` がローカルに見つかりません。")
             return
         try:
             parsed_info = parse_bot_filename(filename)
-            file_size_bytes = os.path.getsize(full_path)
+            file_size_bytes = file_stat.st_size
             file_size_mb = round(file_size_bytes / (1024 * 1024), 2)
             
             embed = discord.Embed(title=f"ファイル情報 (ローカル): {filename}", color=discord.Color.green())
@@ -1070,22 +5167,36 @@ async def files_info(interaction: discord.Interaction, filepath: str):
             embed.add_field(name="拡張子", value=f"`{parsed_info['extension']}`", inline=True)
             embed.add_field(name="抽出されたタグ", value=f"`{parsed_info['tags_display']}`", inline=True)
             embed.add_field(name="抽出された日付", value=f"`{parsed_info['date']}`", inline=True)
+            if parsed_info['extension'].lower() in IMAGE_EXTENSIONS:
+                image_info = await image_workers.inspect(full_path)
+                if image_info["width"]:
+                    embed.add_field(name="画像", value=f"{image_info['width']}x{image_info['height']} ({image_info['format']})", inline=True)
+                exif = image_info["exif"]
+                if exif.get("datetime_original") or exif.get("datetime"):
+                    embed.add_field(name="撮影日時 (EXIF)", value=exif.get("datetime_original") or exif.get("datetime"), inline=True)
+                if exif.get("make") or exif.get("model"):
+                    embed.add_field(name="カメラ (EXIF)", value=" ".join(v for v in (exif.get("make"), exif.get("model")) if v), inline=True)
             try:
-                m_time = os.path.getmtime(full_path)
+                m_time = file_stat.st_mtime
                 modified_time = datetime.datetime.fromtimestamp(m_time).strftime('%Y-%m-%d %H:%M:%S')
                 embed.add_field(name="最終更新日時 (サーバー)", value=modified_time, inline=False)
             except Exception as e_time: print(f"最終更新日時の取得エラー: {e_time}")
-            await interaction.followup.send(embed=embed)
+            thumb_path = await get_or_create_thumbnail(filepath)
+            if thumb_path:
+                embed.set_thumbnail(url="attachment://thumbnail.webp")
+                await interaction.followup.send(embed=embed, file=discord.File(thumb_path, filename="thumbnail.webp"))
+            else:
+                await interaction.followup.send(embed=embed)
         except Exception as e:
             print(f"/files info (local) 処理中にエラー: {e}")
             await interaction.followup.send(f"ローカルファイル情報の取得中にエラーが発生しました: {e}")
 
     elif current_upload_dest == "gdrive":
-        if not gdrive_service or not GDRIVE_TARGET_FOLDER_ID:
+        if not gdrive_available():
             await interaction.followup.send("Google Driveサービスが利用できないか、ターゲットフォルダが設定されていません。", ephemeral=True)
             return
 
-        gdrive_file_id, _ = await get_gdrive_file_id_from_filepath(filepath, gdrive_service, GDRIVE_TARGET_FOLDER_ID)
+        gdrive_shard, gdrive_file_id = await find_gdrive_file(filepath)
 
         if not gdrive_file_id:
             await interaction.followup.send(f"ファイル `{filepath}` がGoogle Driveに見つかりません。")
@@ -1093,7 +5204,8 @@ async def files_info(interaction: discord.Interaction, filepath: str):
         
         try:
             file_metadata = await execute_gdrive_api_call(
-                gdrive_service.files().get(fileId=gdrive_file_id, fields="id, name, mimeType, size, createdTime, modifiedTime, webViewLink, description, parents").execute
+                gdrive_shard.service.files().get(fileId=gdrive_file_id, fields="id, name, mimeType, size, createdTime, modifiedTime, webViewLink, description, parents").execute,
+                service=gdrive_shard.service
             )
             if not file_metadata:
                 await interaction.followup.send(f"Google Driveからファイル `{filename}` のメタデータの取得に失敗しました。")
@@ -1109,6 +5221,8 @@ async def files_info(interaction: discord.Interaction, filepath: str):
             if file_metadata.get('webViewLink'):
                 embed.add_field(name="Google Driveリンク", value=f"[ファイルを開く]({file_metadata.get('webViewLink')})", inline=False)
             embed.add_field(name="年月フォルダ", value=f"`{ym_dir_name}`", inline=True)
+            if len(get_gdrive_shards()) > 1:
+                embed.add_field(name="Driveシャード", value=f"`{gdrive_shard.name}`", inline=True)
             embed.add_field(name="ファイルサイズ", value=f"{file_size_bytes} Bytes ({file_size_mb} MB)", inline=True)
             embed.add_field(name="MIMEタイプ", value=f"`{file_metadata.get('mimeType', '不明')}`", inline=True)
             embed.add_field(name="元ファイル名 (拡張子除く)", value=f"`{parsed_info['original_stem']}`", inline=False)
@@ -1125,7 +5239,12 @@ async def files_info(interaction: discord.Interaction, filepath: str):
             if file_metadata.get('description'):
                  embed.add_field(name="説明 (Drive)", value=file_metadata.get('description'), inline=False)
 
-            await interaction.followup.send(embed=embed)
+            thumb_path = await get_or_create_thumbnail(f"{ym_dir_name}/{gdrive_actual_filename}")
+            if thumb_path:
+                embed.set_thumbnail(url="attachment://thumbnail.webp")
+                await interaction.followup.send(embed=embed, file=discord.File(thumb_path, filename="thumbnail.webp"))
+            else:
+                await interaction.followup.send(embed=embed)
         except Exception as e:
             print(f"/files info (gdrive) 処理中にエラー: {e}")
             await interaction.followup.send(f"Google Driveファイル情報の取得中にエラーが発生しました: {e}")
@@ -1135,7 +5254,7 @@ async def files_info(interaction: discord.Interaction, filepath: str):
 @app_commands.autocomplete(filepath=filename_autocomplete)
 async def files_delete(interaction: discord.Interaction, filepath: str):
     await interaction.response.defer() 
-    current_upload_dest = bot_config.get("upload_destination", DEFAULT_CONFIG["upload_destination"])
+    current_upload_dest = await resolve_file_tier(filepath) # tiered の場合はファイルのある層 ("local" / "gdrive")
 
     try:
         ym_dir_name, filename_to_delete_display = filepath.split('/', 1)
@@ -1147,18 +5266,21 @@ async def files_delete(interaction: discord.Interaction, filepath: str):
     delete_target_description = "" # メッセージ用
 
     if current_upload_dest == "local":
-        full_path = os.path.join(BASE_UPLOAD_FOLDER, ym_dir_name, filename_to_delete_display)
-        if not os.path.exists(full_path) or not os.path.isfile(full_path):
+        full_path = os.path.join(get_base_upload_folder(), ym_dir_name, filename_to_delete_display)
+        if not await local_storage.is_file(full_path):
             await interaction.followup.send(f"ファイル `{filepath}` がローカルに見つかりません。")
             return
         identifier_for_delete = full_path
         delete_target_description = "ローカル"
         
     elif current_upload_dest == "gdrive":
-        if not gdrive_service or not GDRIVE_TARGET_FOLDER_ID:
+        if not gdrive_available():
             await interaction.followup.send("Google Driveサービスが利用できないか、ターゲットフォルダが設定されていません。", ephemeral=True)
             return
-        gdrive_file_id, _ = await get_gdrive_file_id_from_filepath(filepath, gdrive_service, GDRIVE_TARGET_FOLDER_ID)
+        try: gdrive_shard, gdrive_file_id = await find_gdrive_file(filepath)
+        except DependencyUnavailableError as e:
+            await interaction.followup.send(f"{e}。しばらくしてからもう一度お試しください。", ephemeral=True)
+            return
         if not gdrive_file_id:
             await interaction.followup.send(f"ファイル `{filepath}` がGoogle Driveに見つかりません。")
             return
@@ -1184,13 +5306,25 @@ async def files_delete(interaction: discord.Interaction, filepath: str):
     if view.confirmed is True:
         try:
             if current_upload_dest == "local":
-                os.remove(identifier_for_delete) # identifier_for_delete は full_path
+                if get_upload_destination() == "tiered" and gdrive_available():
+                    # 移動処理の途中で Drive にもコピーがある場合は、先にそちらを削除して復活しないようにする
+                    # (Drive が止まっていて確認・削除できなければ、ローカルも消さずにエラーにする)
+                    drive_copy_shard, drive_copy_id = await find_gdrive_file(filepath)
+                    if drive_copy_id and not await delete_gdrive_file(drive_copy_shard.service, drive_copy_id):
+                        raise RuntimeError("Google Drive 上のコピーを削除できませんでした")
+                if not await local_storage.remove(identifier_for_delete): # identifier_for_delete は full_path
+                    raise FileNotFoundError(f"ファイル '{identifier_for_delete}' は既に存在しません")
                 print(f"ユーザー {interaction.user} によってローカルファイル {identifier_for_delete} が削除されました。")
             elif current_upload_dest == "gdrive":
-                await execute_gdrive_api_call(
-                    gdrive_service.files().delete(fileId=identifier_for_delete).execute # identifier_for_delete は gdrive_file_id
-                )
+                # identifier_for_delete は gdrive_file_id
+                if not await delete_gdrive_file(gdrive_service_for_file(identifier_for_delete), identifier_for_delete):
+                    raise RuntimeError("Google Drive の削除 API が失敗しました")
                 print(f"ユーザー {interaction.user} によってGDriveファイル {identifier_for_delete} (元名: {filename_to_delete_display}) が削除されました。")
+            (await get_phash_index()).remove(filepath)
+            (await get_search_index()).remove(filepath)
+            get_month_listing_cache().note_removed(filepath)
+            (await get_degraded_queue()).note_removed(filepath)
+            await remove_thumbnail(filepath)
             
             await interaction_message.edit(content=f"ファイル `{filename_to_delete_display}` ({delete_target_description}) を削除しました。(実行者: {interaction.user.mention})", view=None)
         except Exception as e:
@@ -1204,7 +5338,7 @@ async def files_delete(interaction: discord.Interaction, filepath: str):
 @app_commands.autocomplete(filepath=filename_autocomplete)
 async def files_get(interaction: discord.Interaction, filepath: str):
     await interaction.response.defer()
-    current_upload_dest = bot_config.get("upload_destination", DEFAULT_CONFIG["upload_destination"])
+    current_upload_dest = await resolve_file_tier(filepath) # tiered の場合はファイルのある層 ("local" / "gdrive")
 
     try:
         ym_dir_name, filename_to_get = filepath.split('/', 1)
@@ -1213,13 +5347,14 @@ async def files_get(interaction: discord.Interaction, filepath: str):
         return
 
     if current_upload_dest == "local":
-        full_path = os.path.join(BASE_UPLOAD_FOLDER, ym_dir_name, filename_to_get)
-        if not os.path.exists(full_path) or not os.path.isfile(full_path):
+        full_path = os.path.join(get_base_upload_folder(), ym_dir_name, filename_to_get)
+        file_stat = await local_storage.stat(full_path)
+        if file_stat is None:
             await interaction.followup.send(f"ファイル `{filepath}` がローカルに見つかりません。")
             return
         
         limit_bytes = interaction.guild.filesize_limit if interaction.guild else (8 * 1024 * 1024)
-        file_size_bytes = os.path.getsize(full_path)
+        file_size_bytes = file_stat.st_size
         if file_size_bytes > limit_bytes:
             await interaction.followup.send(
                 f"ファイル `{filename_to_get}` ({round(file_size_bytes / (1024*1024), 2)} MB) はDiscordの送信サイズ上限 ({round(limit_bytes / (1024*1024), 2)} MB) を超えています。"
@@ -1233,18 +5368,19 @@ async def files_get(interaction: discord.Interaction, filepath: str):
             await interaction.followup.send(f"ファイル `{filename_to_get}` の送信中にエラーが発生しました: {e}")
 
     elif current_upload_dest == "gdrive":
-        if not gdrive_service or not GDRIVE_TARGET_FOLDER_ID:
+        if not gdrive_available():
             await interaction.followup.send("Google Driveサービスが利用できないか、ターゲットフォルダが設定されていません。", ephemeral=True)
             return
 
-        gdrive_file_id, _ = await get_gdrive_file_id_from_filepath(filepath, gdrive_service, GDRIVE_TARGET_FOLDER_ID)
+        gdrive_shard, gdrive_file_id = await find_gdrive_file(filepath)
         if not gdrive_file_id:
             await interaction.followup.send(f"ファイル `{filepath}` がGoogle Driveに見つかりません。")
             return
 
         try:
             gfile_meta = await execute_gdrive_api_call(
-                gdrive_service.files().get(fileId=gdrive_file_id, fields="size, name").execute
+                gdrive_shard.service.files().get(fileId=gdrive_file_id, fields="size, name").execute,
+                service=gdrive_shard.service
             )
             if not gfile_meta:
                  await interaction.followup.send(f"ファイル `{filename_to_get}` のメタデータ取得に失敗しました。")
@@ -1260,7 +5396,7 @@ async def files_get(interaction: discord.Interaction, filepath: str):
                 )
                 return
             
-            file_bytes_io = await download_gdrive_file_to_bytesio(gdrive_service, gdrive_file_id)
+            file_bytes_io = await download_gdrive_file_to_bytesio(gdrive_shard.service, gdrive_file_id)
             if not file_bytes_io:
                 await interaction.followup.send(f"ファイル `{gdrive_actual_filename}` のGoogle Driveからのダウンロードに失敗しました。")
                 return
@@ -1272,6 +5408,424 @@ async def files_get(interaction: discord.Interaction, filepath: str):
             print(f"Google Driveファイル送信エラー (ID: {gdrive_file_id}): {e}")
             await interaction.followup.send(f"ファイル `{filepath}` の送信中にエラーが発生しました: {e}")
 
+async def compute_stored_file_dhash(filepath: str) -> int | None:
+    """ 保存済みファイル (YYYYMM/ファイル名) の知覚ハッシュを計算する。Driveの場合はダウンロードして計算 """
+    current_upload_dest = await resolve_file_tier(filepath) # tiered の場合はファイルのある層 ("local" / "gdrive")
+    try:
+        ym_dir_name, filename = filepath.split('/', 1)
+    except ValueError:
+        return None
+    if os.path.splitext(filename)[1].lower() not in IMAGE_EXTENSIONS:
+        return None
+    if current_upload_dest == "local":
+        full_path = os.path.join(get_base_upload_folder(), ym_dir_name, filename)
+        if not await local_storage.is_file(full_path): return None
+        return await compute_image_dhash_async(full_path)
+    if current_upload_dest == "gdrive" and gdrive_available():
+        gdrive_shard, gdrive_file_id = await find_gdrive_file(filepath)
+        if not gdrive_file_id: return None
+        file_bytes_io = await download_gdrive_file_to_bytesio(gdrive_shard.service, gdrive_file_id)
+        if not file_bytes_io: return None
+        return await compute_image_dhash_async(file_bytes_io)
+    return None
+
+@files_group.command(name="similar", description="指定したファイルまたは添付画像に似た保存済み画像を検索します。")
+@app_commands.describe(filepath="基準にする保存済みファイル (年月フォルダ/ファイル名)", attachment="基準にする画像 (新しく添付)",
+                       max_distance="許容するハッシュ距離 (0-32、小さいほど厳密)")
+@app_commands.autocomplete(filepath=filename_autocomplete)
+async def files_similar(interaction: discord.Interaction, filepath: str = None, attachment: discord.Attachment = None,
+                        max_distance: app_commands.Range[int, 0, 32] = None):
+    await interaction.response.defer(ephemeral=True) # 後続の送信の公開範囲は defer で決まる
+    if not filepath and not attachment:
+        await interaction.followup.send("`filepath` または `attachment` のどちらかを指定してください。", ephemeral=True)
+        return
+    if max_distance is None: max_distance = PHASH_SIMILAR_THRESHOLD
+
+    phash_index = await get_phash_index()
+    query_hash = None
+    query_label = ""
+    if attachment:
+        if os.path.splitext(attachment.filename)[1].lower() not in IMAGE_EXTENSIONS:
+            await interaction.followup.send(f"添付ファイル '{attachment.filename}' は画像ではありません。", ephemeral=True)
+            return
+        try:
+            query_hash = await compute_image_dhash_async(io.BytesIO(await attachment.read()))
+        except Exception as e:
+            print(f"/files similar: 添付ファイルの読み込みに失敗: {e}")
+        query_label = attachment.filename
+    else:
+        indexed = phash_index.get(filepath)
+        if indexed:
+            query_hash = indexed[0]
+        else:
+            query_hash = await compute_stored_file_dhash(filepath)
+            if query_hash is not None:
+                phash_index.add(filepath, query_hash, parse_bot_filename(filepath.split('/', 1)[-1])["tags_raw"])
+        query_label = filepath
+
+    if query_hash is None:
+        await interaction.followup.send(f"`{query_label}` の画像ハッシュを計算できませんでした。画像ファイルか確認してください。", ephemeral=True)
+        return
+
+    search_started = time.perf_counter()
+    matches = phash_index.search(query_hash, max_distance, exclude=filepath)
+    search_ms = (time.perf_counter() - search_started) * 1000
+
+    if not matches:
+        await interaction.followup.send(f"`{query_label}` に似た画像は見つかりませんでした。(距離 {max_distance} 以内、索引 {len(phash_index.entries)} 件)", ephemeral=True)
+        return
+
+    embed = discord.Embed(title="類似画像の検索結果", description=f"基準: `{query_label}` | 距離 {max_distance} 以内", color=discord.Color.purple())
+    MAX_SIMILAR_IN_EMBED = 10
+    for distance, match_path, tags in matches[:MAX_SIMILAR_IN_EMBED]:
+        similarity = round((64 - distance) / 64 * 100, 1)
+        tags_display = tags.replace("_", "-") if tags != "notags" else "タグなし"
+        embed.add_field(name=f"🖼️ `{match_path}`", value=f"類似度: {similarity}% (距離 {distance})\nタグ: `{tags_display}`", inline=False)
+    if len(matches) > MAX_SIMILAR_IN_EMBED:
+        embed.add_field(name="...", value=f"他 {len(matches) - MAX_SIMILAR_IN_EMBED} 件の類似画像があります。", inline=False)
+    embed.set_footer(text=f"索引 {len(phash_index.entries)} 件から {search_ms:.2f} ms で検索")
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+@files_group.command(name="search", description="タグと元ファイル名を全文検索し、関連度の高い順に表示します。")
+@app_commands.describe(query="検索語 (全角/半角・カタカナ/ひらがなの違いや多少の誤字は吸収します)")
+async def files_search(interaction: discord.Interaction, query: str):
+    if not normalize_search_text(query): # 公開で defer した後の ephemeral は効かないので、defer の前に返す
+        await interaction.response.send_message("検索語を入力してください。", ephemeral=True)
+        return
+    await interaction.response.defer()
+    search_index = await get_search_index()
+    if not search_index.is_built():
+        progress_msg = await interaction.followup.send("全文検索索引を作成しています。しばらくお待ちください...")
+        error_msg = await search_index.ensure_built()
+        if error_msg:
+            await progress_msg.edit(content=f"全文検索索引を作成できませんでした: {error_msg}")
+            return
+        await progress_msg.edit(content=f"全文検索索引を作成しました ({len(search_index.doc_ids)} 件)。")
+
+    search_started = time.perf_counter()
+    hits = search_index.search(query, limit=25)
+    search_ms = (time.perf_counter() - search_started) * 1000
+
+    if not hits:
+        await interaction.followup.send(f"`{query}` に一致するファイルは見つかりませんでした。(索引 {len(search_index.doc_ids)} 件)")
+        return
+
+    embed = discord.Embed(title="検索結果", description=f"検索語: `{query}`", color=discord.Color.blue())
+    MAX_SEARCH_RESULTS_IN_EMBED = 10
+    for score, match_path in hits[:MAX_SEARCH_RESULTS_IN_EMBED]:
+        parsed_info = parse_bot_filename(match_path.split('/', 1)[-1])
+        embed.add_field(name=f"📁 `{match_path}`",
+                        value=f"元ファイル名: `{parsed_info['original_stem']}`\nタグ: `{parsed_info['tags_display']}`\nスコア: {score:.2f}",
+                        inline=False)
+    if len(hits) > MAX_SEARCH_RESULTS_IN_EMBED:
+        embed.add_field(name="...", value=f"他 {len(hits) - MAX_SEARCH_RESULTS_IN_EMBED} 件の候補があります。`filepath` の入力欄でも検索できます。", inline=False)
+    embed.set_footer(text=f"索引 {len(search_index.doc_ids)} 件から {search_ms:.2f} ms で検索")
+    await interaction.followup.send(embed=embed)
+
+@files_group.command(name="search_reindex", description="全文検索索引を保存済みファイルから作り直します。(ロール制限あり)")
+@is_admin()
+async def files_search_reindex(interaction: discord.Interaction):
+    await interaction.response.defer(ephemeral=True)
+    search_index = await get_search_index()
+    indexed_count, error_msg = await search_index.rebuild()
+    if error_msg:
+        await interaction.followup.send(f"全文検索索引を作成できませんでした: {error_msg}", ephemeral=True)
+        return
+    await interaction.followup.send(f"全文検索索引を作り直しました ({indexed_count} 件)。", ephemeral=True)
+    print(f"全文検索索引の再構築: {indexed_count} 件 (実行者: {interaction.user})")
+
+@files_group.command(name="hash_backfill", description="既存の保存済み画像の類似検索用ハッシュを作成します。(ロール制限あり)")
+@app_commands.describe(year_month="対象の年月 (例: 202305)。省略時はすべて。")
+@app_commands.autocomplete(year_month=year_month_autocomplete)
+@is_admin()
+async def files_hash_backfill(interaction: discord.Interaction, year_month: str = None):
+    await interaction.response.defer(ephemeral=True)
+    stored_files, error_msg = await collect_stored_files(year_month)
+    if error_msg:
+        await interaction.followup.send(error_msg, ephemeral=True)
+        return
+    targets = [f"{f['year_month']}/{f['fullname']}" for f in stored_files # "YYYYMM/ファイル名"
+               if os.path.splitext(f['fullname'])[1].lower() in IMAGE_EXTENSIONS]
+
+    phash_index = await get_phash_index()
+    pending = [t for t in targets if phash_index.get(t) is None]
+    if not pending:
+        await interaction.followup.send(f"ハッシュ未作成の画像はありません。(対象 {len(targets)} 件)", ephemeral=True)
+        return
+    progress_msg = await interaction.followup.send(f"{len(pending)} 件の画像ハッシュを作成しています...", ephemeral=True)
+
+    semaphore = asyncio.Semaphore(4)
+    done_count = 0
+    failed_count = 0
+    async def backfill_one(target: str):
+        nonlocal done_count, failed_count
+        async with semaphore:
+            try: hash_value = await compute_stored_file_dhash(target)
+            except DependencyUnavailableError: hash_value = None # Drive の停止中は失敗に数え、再実行で作り直す
+        if hash_value is None: failed_count += 1
+        else: phash_index.add(target, hash_value, parse_bot_filename(target.split('/', 1)[1])["tags_raw"])
+        done_count += 1
+        if done_count % 50 == 0:
+            try: await progress_msg.edit(content=f"画像ハッシュを作成中... {done_count}/{len(pending)}")
+            except discord.HTTPException: pass
+    await asyncio.gather(*(backfill_one(t) for t in pending))
+    await progress_msg.edit(content=f"画像ハッシュの作成が完了しました。成功 {done_count - failed_count} 件 / 失敗 {failed_count} 件 (索引 {len(phash_index.entries)} 件)")
+    print(f"知覚ハッシュのバックフィル完了: {done_count - failed_count}/{len(pending)} 件 (実行者: {interaction.user})")
+
+@files_group.command(name="gallery", description="年月やタグで絞り込んだファイルのサムネイル一覧画像 (コンタクトシート) を表示します。")
+@app_commands.describe(year_month="対象の年月 (例: 202305)", tag="絞り込むタグ (スペース区切りで複数指定可)")
+@app_commands.autocomplete(year_month=year_month_autocomplete)
+async def files_gallery(interaction: discord.Interaction, year_month: str = None, tag: str = None):
+    await interaction.response.defer()
+    if not year_month and not tag:
+        await interaction.followup.send("`year_month` または `tag` のどちらかを指定してください。")
+        return
+    current_upload_dest = get_upload_destination()
+    found_files_details, error_msg = await collect_stored_files(year_month, tag_filter=tag)
+    if error_msg:
+        await interaction.followup.send(error_msg)
+        return
+    condition_parts = []
+    if year_month: condition_parts.append(f"年月: `{year_month}`")
+    if tag: condition_parts.append(f"タグ: `{tag}`")
+    condition_text = " | ".join(condition_parts)
+    if not found_files_details:
+        await interaction.followup.send(f"ファイルは見つかりませんでした。({condition_text})")
+        return
+
+    limit_bytes = interaction.guild.filesize_limit if interaction.guild else (8 * 1024 * 1024)
+    filepaths = [f"{f['year_month']}/{f['fullname']}" for f in found_files_details]
+    scope_key = f"{current_upload_dest}|{year_month or ''}|{' '.join(parse_tag_filter(tag))}"
+    signature_source = json.dumps([filepaths, GALLERY_COLUMNS, GALLERY_TILE_SIZE, GALLERY_MAX_TILES_PER_SHEET, limit_bytes], ensure_ascii=False)
+    signature = hashlib.sha256(signature_source.encode("utf-8")).hexdigest()
+
+    sheet_paths = await local_storage.run(load_cached_gallery, scope_key, signature)
+    from_cache = sheet_paths is not None
+    if not from_cache:
+        download_semaphore = asyncio.Semaphore(4)
+        thumbnail_paths = await asyncio.gather(*(get_gallery_thumbnail(f, download_semaphore) for f in found_files_details))
+        entries = list(zip(filepaths, thumbnail_paths))
+        try:
+            sheets = await asyncio.to_thread(build_contact_sheets, entries, limit_bytes)
+            sheet_paths = await local_storage.run(store_gallery_cache, scope_key, signature, sheets)
+        except Exception as e:
+            print(f"コンタクトシートの作成中にエラー ({scope_key}): {e}")
+            await interaction.followup.send(f"ギャラリー画像の作成中にエラーが発生しました: {e}")
+            return
+    if not sheet_paths:
+        await interaction.followup.send("ギャラリー画像を作成できませんでした。")
+        return
+
+    # 1メッセージあたり添付10件・合計サイズが上限以内になるように分けて送信
+    batches, current_batch, current_size = [], [], 0
+    sheet_stats = await local_storage.stat_many(sheet_paths)
+    for sheet_path, sheet_stat in zip(sheet_paths, sheet_stats):
+        sheet_size = sheet_stat.st_size if sheet_stat else 0
+        if current_batch and (len(current_batch) >= 10 or current_size + sheet_size > limit_bytes):
+            batches.append(current_batch)
+            current_batch, current_size = [], 0
+        current_batch.append(sheet_path)
+        current_size += sheet_size
+    batches.append(current_batch)
+
+    summary = (f"🖼️ ギャラリー ({condition_text}): {len(found_files_details)} 件 / シート {len(sheet_paths)} 枚"
+               f"{' (キャッシュ)' if from_cache else ''}")
+    sheet_number = 0
+    for batch_index, batch in enumerate(batches):
+        files_to_send = []
+        for sheet_path in batch:
+            sheet_number += 1
+            files_to_send.append(discord.File(sheet_path, filename=f"gallery_{year_month or 'tag'}_{sheet_number}.jpg"))
+        content = summary if batch_index == 0 else None
+        try:
+            await interaction.followup.send(content=content, files=files_to_send)
+        except discord.HTTPException as e:
+            print(f"ギャラリー画像の送信に失敗しました: {e}")
+            await interaction.followup.send(f"ギャラリー画像の送信中にエラーが発生しました: {e}")
+            return
+
+@files_group.command(name="export", description="年月やタグで絞り込んだファイルをZIPにまとめて送信します (サイズ上限ごとに分割)。")
+@app_commands.describe(year_month="対象の年月 (例: 202305)", tag="絞り込むタグ (スペース区切りで複数指定可)")
+@app_commands.autocomplete(year_month=year_month_autocomplete)
+async def files_export(interaction: discord.Interaction, year_month: str = None, tag: str = None):
+    await interaction.response.defer()
+    if not year_month and not tag:
+        await interaction.followup.send("`year_month` または `tag` のどちらかを指定してください。")
+        return
+    found_files_details, error_msg = await collect_stored_files(year_month, tag_filter=tag)
+    if error_msg:
+        await interaction.followup.send(error_msg)
+        return
+    condition_parts = []
+    if year_month: condition_parts.append(f"年月: `{year_month}`")
+    if tag: condition_parts.append(f"タグ: `{tag}`")
+    condition_text = " | ".join(condition_parts)
+    if not found_files_details:
+        await interaction.followup.send(f"ファイルは見つかりませんでした。({condition_text})")
+        return
+
+    limit_bytes = interaction.guild.filesize_limit if interaction.guild else (8 * 1024 * 1024)
+    max_part_bytes = limit_bytes - EXPORT_PART_MARGIN_BYTES
+    if max_part_bytes < 1024 * 1024:
+        await interaction.followup.send("Discordの送信サイズ上限が小さすぎるため、エクスポートできません。")
+        return
+    export_dir = os.path.join(get_base_upload_folder(), "temp", f"export_{interaction.id}")
+    await local_storage.makedirs(export_dir)
+    base_name = sanitize_filename_component("_".join(["export"] + [part for part in (year_month, tag) if part]))
+    writer = ZipPartWriter(export_dir, base_name, max_part_bytes)
+    total = len(found_files_details)
+    progress_msg = await interaction.followup.send(f"📦 {total} 件のファイルをZIPにまとめています... ({condition_text})")
+
+    processed_count, failed_count, sent_parts = 0, 0, 0
+    last_progress_edit = 0.0
+    async def update_progress(force: bool = False):
+        nonlocal last_progress_edit
+        now = time.monotonic()
+        if not force and now - last_progress_edit < 2.0: return
+        last_progress_edit = now
+        try:
+            await progress_msg.edit(content=(f"📦 ZIPを作成中... ({condition_text}) 処理 {processed_count}/{total} 件"
+                                             f" / 送信済みパート {sent_parts} / 失敗 {failed_count} 件"))
+        except discord.HTTPException: pass
+
+    async def send_part(part_path: str):
+        nonlocal sent_parts
+        try:
+            await interaction.followup.send(file=discord.File(part_path, filename=os.path.basename(part_path)))
+            sent_parts += 1
+        finally:
+            try: await local_storage.remove(part_path)
+            except OSError: pass
+        await update_progress(force=True)
+
+    # Drive からのダウンロードは並列 (上限あり)。書き込みが終わるまで枠を解放しないので一時ファイルも上限内に収まる
+    download_slots = asyncio.Semaphore(EXPORT_DOWNLOAD_CONCURRENCY)
+    download_tasks: list[asyncio.Task] = [] # スレッドでのダウンロードは取り消せないので、終わるのを待ってから一時フォルダを消す
+    async def fetch(index: int, file_info: dict) -> tuple[dict, str | None, bool]:
+        if file_info.get("tier") == "local":
+            return file_info, os.path.join(get_base_upload_folder(), file_info["year_month"], file_info["fullname"]), False
+        await download_slots.acquire()
+        temp_path = os.path.join(export_dir, f"download_{index}")
+        download_task = asyncio.create_task(download_gdrive_file_to_path(
+            gdrive_service_for_file(file_info.get("gdrive_id")), file_info.get("gdrive_id"), temp_path))
+        download_tasks.append(download_task)
+        if await asyncio.shield(download_task):
+            return file_info, temp_path, True
+        download_slots.release()
+        return file_info, None, False
+
+    fetch_tasks = [asyncio.create_task(fetch(i, f)) for i, f in enumerate(found_files_details)]
+    upload_task = None
+    try:
+        for next_fetched in asyncio.as_completed(fetch_tasks):
+            file_info, source_path, is_temp = await next_fetched
+            arcname = f"{file_info['year_month']}/{file_info['fullname']}"
+            try:
+                if source_path and await local_storage.is_file(source_path):
+                    finished_parts = await asyncio.to_thread(writer.add_file, source_path, arcname)
+                else:
+                    finished_parts = []
+                    failed_count += 1
+            except Exception as e:
+                print(f"ZIPへの書き込み中にエラー ({arcname}): {e}")
+                failed_count += 1
+                finished_parts = []
+            finally:
+                if is_temp:
+                    try: await local_storage.remove(source_path)
+                    except OSError: pass
+                    download_slots.release()
+            processed_count += 1
+            for part_path in finished_parts:
+                if upload_task: await upload_task # 送信は1件ずつ。次のパートの作成と並行して進める
+                upload_task = asyncio.create_task(send_part(part_path))
+            await update_progress()
+        last_part = await asyncio.to_thread(writer.finish_part)
+        if upload_task: await upload_task
+        if last_part: await send_part(last_part)
+    except Exception as e:
+        print(f"エクスポート処理中にエラー ({condition_text}): {e}")
+        if upload_task and not upload_task.done(): upload_task.cancel()
+        await asyncio.to_thread(writer.finish_part)
+        await progress_msg.edit(content=f"エクスポート中にエラーが発生しました: {e} (送信済みパート {sent_parts})")
+        return
+    finally:
+        for task in fetch_tasks: task.cancel() # まだ始まっていないダウンロードは始めない
+        await asyncio.gather(*fetch_tasks, *download_tasks, return_exceptions=True)
+        await local_storage.run(lambda: shutil.rmtree(export_dir, ignore_errors=True))
+
+    result_text = (f"✅ エクスポートが完了しました。({condition_text}) {processed_count - failed_count}/{total} 件を"
+                   f" {sent_parts} 個のZIPパートで送信しました。")
+    if failed_count: result_text += f" 失敗 {failed_count} 件。"
+    if writer.split_files:
+        result_text += (f"\n上限を超える {writer.split_files} 件のファイルは `.001`, `.002`... に分割されています。"
+                        "展開後に連結してください (Windows: `copy /b a.001+a.002 a`、macOS/Linux: `cat a.0* > a`)。")
+    await progress_msg.edit(content=result_text)
+    print(f"エクスポート完了: {condition_text} {processed_count - failed_count}/{total} 件, パート {sent_parts} (実行者: {interaction.user})")
+
+@files_group.command(name="retag", description="既存ファイルを現在のGeminiモデル・プロンプトで再タグ付けします。(ロール制限あり)")
+@app_commands.describe(action="開始 / 進捗表示 / 中止 / 再開", year_month="対象の年月 (例: 202305)。省略時はすべて。",
+                       tag="対象を絞り込むタグ", notags_only="タグなし (notags) のファイルだけを対象にする")
+@app_commands.choices(action=[
+    app_commands.Choice(name="開始", value="start"),
+    app_commands.Choice(name="進捗表示", value="status"),
+    app_commands.Choice(name="中止", value="cancel"),
+    app_commands.Choice(name="再開", value="resume"),
+])
+@app_commands.autocomplete(year_month=year_month_autocomplete)
+@is_admin()
+async def files_retag(interaction: discord.Interaction, action: app_commands.Choice[str], year_month: str = None,
+                      tag: str = None, notags_only: bool = False):
+    await interaction.response.defer(ephemeral=True)
+    if action.value == "status":
+        await interaction.followup.send(get_retag_manager().progress_text(), ephemeral=True)
+        return
+    if action.value == "cancel":
+        if get_retag_manager().cancel():
+            await interaction.followup.send("再タグ付けを中止しました。`再開` で続きから実行できます。", ephemeral=True)
+            print(f"再タグ付けが中止されました。(実行者: {interaction.user})")
+        else:
+            await interaction.followup.send("実行中の再タグ付けはありません。", ephemeral=True)
+        return
+    if get_retag_manager().is_running():
+        await interaction.followup.send("再タグ付けは既に実行中です。\n" + get_retag_manager().progress_text(), ephemeral=True)
+        return
+    if not gemini_model_instance:
+        await interaction.followup.send("Geminiモデルが初期化されていないため、再タグ付けできません。", ephemeral=True)
+        return
+    if action.value == "resume":
+        if get_retag_manager().resume():
+            await interaction.followup.send("再タグ付けを再開しました。\n" + get_retag_manager().progress_text(), ephemeral=True)
+            print(f"再タグ付けが再開されました。(実行者: {interaction.user})")
+        else:
+            await interaction.followup.send("再開できる再タグ付けジョブはありません。", ephemeral=True)
+        return
+
+    stored_files, error_msg = await collect_stored_files(year_month, tag_filter=tag)
+    if error_msg:
+        await interaction.followup.send(error_msg, ephemeral=True)
+        return
+    targets = []
+    for file_info in stored_files:
+        if os.path.splitext(file_info["fullname"])[1].lower() not in IMAGE_EXTENSIONS + VIDEO_EXTENSIONS: continue
+        if notags_only and parse_bot_filename(file_info["fullname"])["tags_raw"] != "notags": continue
+        targets.append({"filepath": f"{file_info['year_month']}/{file_info['fullname']}", "tier": file_info["tier"],
+                        "gdrive_id": file_info.get("gdrive_id"), "gdrive_shard": file_info.get("gdrive_shard")})
+    if not targets:
+        await interaction.followup.send("再タグ付けの対象ファイルはありません。", ephemeral=True)
+        return
+
+    progress_msg = None
+    if interaction.channel:
+        try: progress_msg = await interaction.channel.send(f"🏷️ 再タグ付けを開始します ({len(targets)} 件)... (実行者: {interaction.user.mention})")
+        except discord.HTTPException as e: print(f"再タグ付けの進捗メッセージの送信に失敗しました: {e}")
+    scope = {"year_month": year_month, "tag": tag, "notags_only": notags_only}
+    get_retag_manager().start(targets, scope, getattr(interaction.channel, "id", None), getattr(progress_msg, "id", None), str(interaction.user))
+    await interaction.followup.send(
+        f"{len(targets)} 件の再タグ付けをバックグラウンドで開始しました (同時 {RETAG_CONCURRENCY} 件、毎分 {RETAG_RATE_PER_MINUTE} 件まで)。",
+        ephemeral=True)
+    print(f"再タグ付けを開始しました: {len(targets)} 件 {scope} (実行者: {interaction.user})")
+
 # --- /gemini サブコマンド ---
 @gemini_group.command(name="list", description="利用可能なGeminiモデルの一覧を表示します。(ロール制限あり)")
 @is_admin()
@@ -1334,13 +5888,7 @@ async def gemini_set(interaction: discord.Interaction, model_name: str):
             await interaction.followup.send(f"モデル `{model_name}` は `generateContent` をサポートしていません。タグ付けには利用できません。", ephemeral=True)
             return
 
-        new_model_instance = genai.GenerativeModel(
-            retrieved_model.name, 
-            safety_settings={ HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-                             HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-                             HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-                             HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,}
-        )
+        new_model_instance = create_gemini_model(retrieved_model.name)
         current_gemini_model = retrieved_model.name.replace("models/", "") 
         gemini_model_instance = new_model_instance
         
@@ -1351,33 +5899,77 @@ async def gemini_set(interaction: discord.Interaction, model_name: str):
         await interaction.followup.send(f"モデル `{model_name}` の設定に失敗しました: {e}", ephemeral=True)
         print(f"Geminiモデル '{model_name}' の設定失敗: {e}")
 
-@gemini_group.command(name="current", description="現在設定されているGeminiモデル名を表示します。(ロール制限あり)")
+@gemini_group.command(name="set_fallback", description="応答が遅いときに同じリクエストを送る予備のGeminiモデルを設定します。(ロール制限あり)")
+@app_commands.describe(model_name="予備のGeminiモデル名。省略するとヘッジ (予備のモデルへの送信) を止めます。")
+@app_commands.autocomplete(model_name=gemini_model_autocomplete)
+@is_admin()
+async def gemini_set_fallback(interaction: discord.Interaction, model_name: str = None):
+    if model_name is None:
+        save_bot_config({"gemini_fallback_model": None})
+        await interaction.response.send_message("予備のGeminiモデルの設定を解除しました。応答が遅くてもヘッジしません。", ephemeral=True)
+        print(f"予備のGeminiモデルの設定が解除されました。 (実行者: {interaction.user})")
+        return
+    if not GEMINI_API_KEY or not genai:
+        await interaction.response.send_message("Gemini APIキーが設定されていないか、Geminiライブラリが利用できません。", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True)
+    try:
+        retrieved_model = genai.get_model(model_name if model_name.startswith("models/") else f"models/{model_name}")
+        if 'generateContent' not in retrieved_model.supported_generation_methods:
+            await interaction.followup.send(f"モデル `{model_name}` は `generateContent` をサポートしていません。タグ付けには利用できません。", ephemeral=True)
+            return
+        fallback_name = retrieved_model.name.replace("models/", "")
+        save_bot_config({"gemini_fallback_model": fallback_name})
+        await interaction.followup.send(
+            f"予備のGeminiモデルを `{fallback_name}` に設定しました。`{current_gemini_model}` が直近の応答時間の "
+            f"p{GEMINI_HEDGE_PERCENTILE} までに応答しない場合に、このモデルにも送信します。", ephemeral=True)
+        print(f"予備のGeminiモデルが '{fallback_name}' に変更されました。 (実行者: {interaction.user})")
+    except Exception as e:
+        await interaction.followup.send(f"モデル `{model_name}` の設定に失敗しました: {e}", ephemeral=True)
+        print(f"予備のGeminiモデル '{model_name}' の設定失敗: {e}")
+
+def format_gemini_hedge_stats() -> str:
+    fallback_name = gemini_hedger.fallback_name()
+    totals = gemini_hedger.totals()
+    hedged = totals["hedged"]
+    def rate(count: int, total: int) -> str:
+        return f"{count / total * 100:.1f}%" if total else "-"
+    return (f"予備のモデル: {f'`{fallback_name}`' if fallback_name else '未設定 (ヘッジしない)'}\n"
+            f"ヘッジの締め切り (直近の応答時間の p{GEMINI_HEDGE_PERCENTILE}): 単体 {gemini_hedger.deadline('single'):.1f} 秒 / "
+            f"バッチ {gemini_hedger.deadline('batch'):.1f} 秒\n"
+            f"起動後: リクエスト {totals['requests']} 件 / ヘッジ {hedged} 件 ({rate(hedged, totals['requests'])})\n"
+            f"ヘッジしたときに先に応答した割合: 主モデル {rate(totals['primary_wins'], hedged)} / 予備のモデル {rate(totals['fallback_wins'], hedged)}")
+
+@gemini_group.command(name="current", description="現在設定されているGeminiモデル名とヘッジの状況を表示します。(ロール制限あり)")
 @is_admin()
 async def gemini_current(interaction: discord.Interaction):
     if not gemini_model_instance:
         await interaction.response.send_message(f"Geminiモデルは現在設定されていません、または初期化に失敗しています。", ephemeral=True)
     else:
-        await interaction.response.send_message(f"現在設定されている自動タグ付け用Geminiモデルは `{current_gemini_model}` です。", ephemeral=True)
+        await interaction.response.send_message(
+            f"現在設定されている自動タグ付け用Geminiモデルは `{current_gemini_model}` です。\n{format_gemini_hedge_stats()}", ephemeral=True)
 
 # --- /upload_settings コマンド ---
 @upload_settings_group.command(name="set_destination", description="ファイルのアップロード先を設定します。(ロール制限あり)")
-@app_commands.describe(destination="アップロード先 ('local' または 'gdrive')")
+@app_commands.describe(destination="アップロード先 ('local'、'gdrive' または 'tiered')")
 @app_commands.choices(destination=[
     app_commands.Choice(name="ローカルストレージ", value="local"),
     app_commands.Choice(name="Google Drive", value="gdrive"),
+    app_commands.Choice(name="階層化 (ローカル + 古いファイルをGoogle Driveへ移動)", value="tiered"),
 ])
 @is_admin()
 async def set_upload_destination(interaction: discord.Interaction, destination: app_commands.Choice[str]):
     await interaction.response.defer(ephemeral=True)
     new_destination_value = destination.value
 
-    if new_destination_value not in ["local", "gdrive"]:
-        await interaction.followup.send("無効なアップロード先です。'local' または 'gdrive' を指定してください。", ephemeral=True)
+    if new_destination_value not in ["local", "gdrive", "tiered"]:
+        await interaction.followup.send("無効なアップロード先です。'local'、'gdrive' または 'tiered' を指定してください。", ephemeral=True)
         return
 
-    if new_destination_value == "gdrive":
+    if new_destination_value in ("gdrive", "tiered"):
         # GDrive関連の設定を確認
-        current_gdrive_folder_id = bot_config.get("gdrive_target_folder_id")
+        current_gdrive_folder_id = get_current_guild_context().setting("gdrive_target_folder_id")
         current_gdrive_key_path = bot_config.get("gdrive_service_account_key_path")
 
         if not current_gdrive_folder_id:
@@ -1400,12 +5992,15 @@ async def set_upload_destination(interaction: discord.Interaction, destination:
                 await interaction.followup.send("Google Driveサービスが利用できません。設定（サービスアカウントキー等）を確認してください。", ephemeral=True)
                 return
              
-    save_bot_config({"upload_destination": new_destination_value})
-    # UPLOAD_DESTINATION グローバル変数を更新 (save_bot_config内でも行われるが念のため)
-    global UPLOAD_DESTINATION
-    UPLOAD_DESTINATION = new_destination_value
-    await interaction.followup.send(f"ファイルのアップロード先を「{destination.name}」に設定しました。", ephemeral=True)
-    print(f"アップロード先が '{new_destination_value}' に変更されました。(実行者: {interaction.user})")
+    guild_ctx = get_current_guild_context()
+    save_guild_settings(guild_ctx, {"upload_destination": new_destination_value})
+    if not guild_ctx.isolated:
+        # UPLOAD_DESTINATION グローバル変数を更新 (save_bot_config内でも行われるが念のため)
+        global UPLOAD_DESTINATION
+        UPLOAD_DESTINATION = new_destination_value
+    if new_destination_value == "tiered": start_tier_mover()
+    await interaction.followup.send(f"ファイルのアップロード先を「{destination.name}」に設定しました。({guild_ctx.label})", ephemeral=True)
+    print(f"アップロード先が '{new_destination_value}' に変更されました。({guild_ctx.label}, 実行者: {interaction.user})")
 
 @upload_settings_group.command(name="set_gdrive_folder", description="Google Driveのアップロード先フォルダIDまたはURLを設定します。(ロール制限あり)")
 @app_commands.describe(folder_id_or_url="Google DriveのフォルダID、またはフォルダのURL")
@@ -1422,9 +6017,11 @@ async def set_gdrive_folder_id(interaction: discord.Interaction, folder_id_or_ur
         )
         return
         
-    save_bot_config({"gdrive_target_folder_id": extracted_folder_id})
+    guild_ctx = get_current_guild_context()
+    save_guild_settings(guild_ctx, {"gdrive_target_folder_id": extracted_folder_id})
+    await enter_guild_context(guild_ctx.guild_id)
     await interaction.followup.send(
-        f"Google Driveのアップロード先フォルダIDを `{extracted_folder_id}` に設定しました。\n"
+        f"Google Driveのアップロード先フォルダIDを `{extracted_folder_id}` に設定しました。({guild_ctx.label})\n"
         f"(入力値: `{folder_id_or_url}`)", 
         ephemeral=True
     )
@@ -1435,17 +6032,45 @@ async def set_gdrive_folder_id(interaction: discord.Interaction, folder_id_or_ur
 async def current_upload_settings(interaction: discord.Interaction):
     await interaction.response.defer(ephemeral=True)
     
-    # bot_configから最新の設定を読み込む
-    dest = bot_config.get("upload_destination", DEFAULT_CONFIG["upload_destination"])
-    folder_id = bot_config.get("gdrive_target_folder_id") # None もありうる
+    # bot_configから最新の設定を読み込む (分離されたサーバーではそのサーバーの設定)
+    guild_ctx = get_current_guild_context()
+    dest = get_upload_destination()
+    folder_id = guild_ctx.setting("gdrive_target_folder_id") # None もありうる
     create_ym = bot_config.get("gdrive_create_ym_folders", DEFAULT_CONFIG["gdrive_create_ym_folders"])
     gdrive_key_path = bot_config.get("gdrive_service_account_key_path", "未設定")
 
     embed = discord.Embed(title="現在のアップロード設定", color=discord.Color.blue())
     embed.add_field(name="アップロード先", value=f"`{dest}`", inline=False)
+    embed.add_field(name="保存先の範囲", value=(
+        f"{guild_ctx.label} / ローカル: `{guild_ctx.base_upload_folder}` / 取り込みの同時実行数 {guild_ctx.setting('guild_ingest_concurrency')}"
+        + (f"\nDrive: 各シャードの `guild_{guild_ctx.key}` フォルダ" if guild_ctx.isolated and not guild_ctx.overrides.get("gdrive_target_folder_id") else "")), inline=False)
     embed.add_field(name="Google Drive フォルダID", value=f"`{folder_id if folder_id else '未設定'}`", inline=False)
     embed.add_field(name="Google Drive 年月フォルダ作成", value=f"`{create_ym}`", inline=False)
     embed.add_field(name="Google Drive サービスキーパス", value=f"`{gdrive_key_path}`", inline=False)
+    await write_back_ingest.journal.ensure_loaded()
+    pending_jobs = write_back_ingest.journal.pending()
+    embed.add_field(name="ライトバック取り込み", value=(
+        f"`{'有効' if WRITE_BACK_INGEST or ingest_process_pool.enabled else '無効'}` (ワーカー {WRITE_BACK_WORKERS}) / 未完了ジョブ {len(pending_jobs)} 件"
+        f" (うち失敗 {sum(1 for job in pending_jobs if job.get('status') == 'failed')} 件)"
+        + (f"\nワーカープロセス: {ingest_process_pool.alive_count()}/{INGEST_WORKER_PROCESSES} 稼働中 (各 {INGEST_WORKER_CONCURRENCY} 件同時)"
+           if ingest_process_pool.enabled else "")), inline=False)
+    embed.add_field(name="取り込みの受け付け制御", value=format_ingest_limits(guild_ctx), inline=False)
+    degraded_queue = await get_degraded_queue()
+    embed.add_field(name="外部サービスの状態", value=(
+        "".join(f"Google Drive ({shard.name}): {shard.breaker.status_text()}\n" for shard in get_gdrive_shards())
+        + f"Gemini API: {gemini_breaker.status_text()}\n"
+        f"復旧待ち: Drive へのアップロード {len(degraded_queue.pending('drive'))} 件 / タグ付け {len(degraded_queue.pending('tag'))} 件"
+        f" (うち失敗して再試行待ち {degraded_queue.failed_count('drive')} 件 / {degraded_queue.failed_count('tag')} 件)"), inline=False)
+    tag_cache = await get_tag_cache()
+    embed.add_field(name="タグ付け結果のキャッシュ", value=(
+        f"{len(tag_cache)}/{TAG_CACHE_MAX_ENTRIES} 件 (起動後: ヒット {tag_cache.hits} 件 / ミス {tag_cache.misses} 件)"
+        if TAG_CACHE_MAX_ENTRIES > 0 else "無効"), inline=False)
+    if dest == "tiered":
+        usage_percent = (await local_storage.run(get_disk_usage))[0]
+        embed.add_field(name="階層化ストレージ", value=(
+            f"{TIERED_MIGRATE_AFTER_DAYS} 日より古いファイル、またはディスク使用率が {TIERED_DISK_USAGE_HIGH_PERCENT}% を超えた場合は "
+            f"{TIERED_DISK_USAGE_LOW_PERCENT}% まで古い順に Google Drive へ移動 ({TIERED_MOVER_INTERVAL_MINUTES} 分ごと)\n"
+            f"現在のディスク使用率: {usage_percent:.1f}%"), inline=False)
     
     gdrive_status_msg = "不明"
     if google_drive_libs_available:
@@ -1467,30 +6092,151 @@ async def current_upload_settings(interaction: discord.Interaction):
         gdrive_status_msg = "ライブラリ不足"
         
     embed.add_field(name="Google Drive サービス状態", value=gdrive_status_msg, inline=False)
+    shards = get_gdrive_shards()
+    if len(shards) > 1 or extra_gdrive_shards:
+        await refresh_gdrive_shard_usage()
+        shard_lines = [f"`{shard.name}`: 使用量 {round(shard.estimated_used_bytes / (1024*1024), 1)} MB / "
+                       f"起動後のアップロード {shard.uploaded_files} 件" for shard in shards]
+        embed.add_field(name=f"Google Drive シャード (配置: {GDRIVE_PLACEMENT_POLICY})", value="\n".join(shard_lines) or "利用可能なシャードがありません", inline=False)
     
     await interaction.followup.send(embed=embed, ephemeral=True)
 
+def format_ingest_limits(guild_ctx: GuildContext) -> str:
+    def limit_text(key: str, unit: str) -> str:
+        value = guild_ctx.setting(key)
+        return f"{value}{unit}" if value else "無制限"
+    max_depth, max_waiting = IngestAdmission.global_limit("ingest_max_queue_depth"), IngestAdmission.global_limit("ingest_max_waiting")
+    stats = ingest_admission.stats
+    return (f"ユーザーごと: {limit_text('ingest_user_files_per_minute', ' 件')} / {limit_text('ingest_user_mb_per_minute', ' MB')} (1分あたり)\n"
+            f"チャンネルごと: {limit_text('ingest_channel_files_per_minute', ' 件')} / {limit_text('ingest_channel_mb_per_minute', ' MB')} (1分あたり)\n"
+            f"上限超過時の待ち時間の上限: {guild_ctx.setting('ingest_quota_max_wait_seconds')} 秒\n"
+            f"受け付け中: {ingest_admission.active}/{max_depth or '無制限'} 件 / 順番待ち: {len(ingest_admission.waiting)}/{max_waiting} 件 (BOT全体)\n"
+            f"起動後: 受け付け {stats['admitted']} 件 / 遅延 {stats['delayed']} 件 / 順番待ち {stats['queued']} 件 / 拒否 {stats['rejected']} 件")
+
+@upload_settings_group.command(name="set_ingest_limits", description="取り込みの上限 (ユーザー・チャンネルごとの流量、同時受け付け数) を設定します。(ロール制限あり)")
+@app_commands.describe(
+    user_files_per_minute="1ユーザーが1分間に取り込めるファイル数 (0: 無制限)",
+    user_mb_per_minute="1ユーザーが1分間に取り込めるサイズ (MB、0: 無制限)",
+    channel_files_per_minute="1チャンネルで1分間に取り込めるファイル数 (0: 無制限)",
+    channel_mb_per_minute="1チャンネルで1分間に取り込めるサイズ (MB、0: 無制限)",
+    max_wait_seconds="上限を超えた添付を待たせる秒数の上限 (これ以上かかる場合は断る)",
+    max_queue_depth="BOT全体で同時に受け付ける添付の数 (0: 無制限)",
+    max_waiting="同時受け付け数が上限のときに順番待ちにできる添付の数")
+@is_admin()
+async def set_ingest_limits(interaction: discord.Interaction,
+                            user_files_per_minute: app_commands.Range[int, 0, 100000] = None,
+                            user_mb_per_minute: app_commands.Range[int, 0, 10000000] = None,
+                            channel_files_per_minute: app_commands.Range[int, 0, 100000] = None,
+                            channel_mb_per_minute: app_commands.Range[int, 0, 10000000] = None,
+                            max_wait_seconds: app_commands.Range[int, 0, 3600] = None,
+                            max_queue_depth: app_commands.Range[int, 0, 100000] = None,
+                            max_waiting: app_commands.Range[int, 0, 1000000] = None):
+    await interaction.response.defer(ephemeral=True)
+    guild_ctx = get_current_guild_context()
+    guild_limits = {key: value for key, value in (
+        ("ingest_user_files_per_minute", user_files_per_minute), ("ingest_user_mb_per_minute", user_mb_per_minute),
+        ("ingest_channel_files_per_minute", channel_files_per_minute), ("ingest_channel_mb_per_minute", channel_mb_per_minute),
+        ("ingest_quota_max_wait_seconds", max_wait_seconds)) if value is not None}
+    global_limits = {key: value for key, value in (
+        ("ingest_max_queue_depth", max_queue_depth), ("ingest_max_waiting", max_waiting)) if value is not None}
+    if guild_limits: save_guild_settings(guild_ctx, guild_limits)
+    if global_limits: save_bot_config(global_limits) # 同時受け付け数は BOT 全体で1つ
+    await interaction.followup.send(
+        ("取り込みの上限を更新しました。" if guild_limits or global_limits else "変更する値が指定されていません。現在の設定:")
+        + f" ({guild_ctx.label})\n{format_ingest_limits(guild_ctx)}", ephemeral=True)
+    if guild_limits or global_limits:
+        print(f"取り込みの上限が変更されました: {guild_limits | global_limits} ({guild_ctx.label}, 実行者: {interaction.user})")
+
+@upload_settings_group.command(name="traffic_recording", description="負荷試験用に投稿・コマンドの匿名化したトレースを記録します。(ロール制限あり)")
+@app_commands.describe(enabled="記録するかどうか")
+@is_admin()
+async def set_traffic_recording(interaction: discord.Interaction, enabled: bool):
+    await interaction.response.defer(ephemeral=True)
+    if enabled:
+        await traffic_recorder.start(traffic_trace_path())
+        if not traffic_recorder.enabled:
+            await interaction.followup.send(f"トレースファイル `{traffic_trace_path()}` を開けないため、記録を開始できませんでした。", ephemeral=True)
+            return
+        save_bot_config({"traffic_recording": True}) # 記録は BOT 全体で1つ (再起動後も続ける)
+        message = (f"トラフィックの記録を開始しました: `{traffic_recorder.path}`\n"
+                   "ユーザー・チャンネルは仮名に、ファイル名・検索語は長さだけに置き換えて記録します。")
+    else:
+        save_bot_config({"traffic_recording": False})
+        events = traffic_recorder.events
+        await traffic_recorder.stop()
+        message = f"トラフィックの記録を停止しました ({events} 件)。\n`python benchmark.py --scenario replay --trace <ファイル> --speed 10` で再生できます。"
+    await interaction.followup.send(message, ephemeral=True)
+    print(f"トラフィックの記録が {'有効' if enabled else '無効'} に変更されました。(実行者: {interaction.user})")
+
+@upload_settings_group.command(name="migrate_now", description="階層化ストレージの Drive への移動処理をすぐに実行します。(ロール制限あり)")
+@is_admin()
+async def migrate_now(interaction: discord.Interaction):
+    await interaction.response.defer(ephemeral=True)
+    if get_upload_destination() != "tiered":
+        await interaction.followup.send("アップロード先が `tiered` ではないため、移動処理は行いません。", ephemeral=True)
+        return
+    if not gdrive_available():
+        await interaction.followup.send("Google Driveサービスが利用できないか、ターゲットフォルダが設定されていません。", ephemeral=True)
+        return
+    stats = await run_tier_migration()
+    await interaction.followup.send(
+        f"移動処理が完了しました。対象 {stats['candidates']} 件 / 移動 {stats['moved']} 件"
+        f" ({round(stats['moved_bytes'] / (1024*1024), 2)} MB) / 失敗 {stats['failed']} 件\n"
+        f"ディスク使用率: {stats['usage_before']:.1f}% → {stats['usage_after']:.1f}%", ephemeral=True)
+    print(f"tiered 移動処理を手動実行しました。(実行者: {interaction.user})")
+
+@upload_settings_group.command(name="rebalance_shards", description="Google Drive シャード間の保存量を揃えるようにファイルを移動します。(ロール制限あり)")
+@app_commands.describe(max_files="1回で移動するファイル数の上限")
+@is_admin()
+async def rebalance_shards(interaction: discord.Interaction, max_files: app_commands.Range[int, 1, 1000] = 50):
+    await interaction.response.defer(ephemeral=True)
+    if len(get_gdrive_shards()) < 2:
+        await interaction.followup.send("利用可能な Google Drive シャードが2つ以上ないため、リバランスできません。", ephemeral=True)
+        return
+    if gdrive_rebalance_lock.locked():
+        await interaction.followup.send("リバランスは既に実行中です。", ephemeral=True)
+        return
+    stats = await rebalance_gdrive_shards(max_files)
+    usage_lines = [f"`{name}`: {round(stats['before'][name] / (1024*1024), 1)} MB → {round(stats['after'].get(name, 0) / (1024*1024), 1)} MB"
+                   for name in stats["before"]]
+    await interaction.followup.send(
+        f"リバランスが完了しました。移動 {stats['moved']} 件 ({round(stats['moved_bytes'] / (1024*1024), 2)} MB) / 失敗 {stats['failed']} 件\n"
+        + "\n".join(usage_lines), ephemeral=True)
+    print(f"Driveシャードのリバランスを実行しました。(実行者: {interaction.user})")
+
 @bot.tree.command(name="help_nasbot", description="このBOTのコマンド一覧と簡単な説明を表示します。")
 async def help_nasbot(interaction: discord.Interaction):
     embed = discord.Embed(title="ファイル管理BOT ヘルプ", description="このBOTで利用可能なコマンド一覧です。", color=discord.Color.blue())
     
     embed.add_field(name="ファイル管理 (`/files`)", value=(
-        "`  list [year_month] [keyword]` - 保存されたファイルの一覧を表示します。\n"
+        "`  list [year_month] [keyword]` - 保存されたファイルの一覧を表示します。(`keyword` は `tag:猫 type:video size>50MB date:20240101..20240331` のような検索式も可)\n"
         "`  info <filepath>` - 指定されたファイルの詳細情報を表示します。\n" 
         "`  get <filepath>` - 指定されたファイルを取得します。\n"
         "`  delete <filepath>` - 指定されたファイルを削除します。\n"
+        "`  search <query>` - タグと元ファイル名を全文検索し、関連度順に表示します。\n"
+        "`  similar [filepath] [attachment]` - 似た画像を検索します。\n"
+        "`  gallery [year_month] [tag]` - サムネイルの一覧画像 (コンタクトシート) を表示します。\n"
+        "`  export [year_month] [tag]` - ファイルをZIPにまとめて送信します (サイズ上限ごとに分割)。\n"
+        "`  retag <action> [year_month] [tag] [notags_only]` - 既存ファイルを再タグ付けします。(指定ロールのみ)\n"
+        "`  hash_backfill [year_month]` - 既存画像の類似検索用ハッシュを作成します。(指定ロールのみ)\n"
+        "`  search_reindex` - 全文検索索引を作り直します。(指定ロールのみ)\n"
         "*補足: `filepath` は `YYYYMM/ファイル名` の形式です。オートコンプリートが利用できます。*"
     ), inline=False)
     
     embed.add_field(name="アップロード設定 (`/upload_settings`) (指定ロールのみ)", value=(
-        "`  set_destination <local|gdrive>` - アップロード先を設定します。\n"
+        "`  set_destination <local|gdrive|tiered>` - アップロード先を設定します。\n"
         "`  set_gdrive_folder <folder_id_or_url>` - Google Driveの保存先フォルダID/URLを設定します。\n"
         "`  current_settings` - 現在のアップロード関連設定を表示します。\n"
+        "`  set_ingest_limits [...]` - ユーザー・チャンネルごとの取り込みの上限と同時受け付け数を設定します。\n"
+        "`  traffic_recording <enabled>` - 負荷試験用に投稿・コマンドの匿名化したトレースを記録します。\n"
+        "`  migrate_now` - 階層化 (tiered) 時の Drive への移動処理をすぐに実行します。\n"
+        "`  rebalance_shards [max_files]` - 複数の Google Drive シャード間で保存量を揃えます。\n"
     ), inline=False)
     
     embed.add_field(name="Geminiモデル設定 (`/gemini`) (指定ロールのみ)", value=(
         "`  set <model_name>` - 自動タグ付けに使用するGeminiモデルを設定します。\n"
-        "`  current` - 現在のGeminiモデル名を表示します。\n"
+        "`  set_fallback [model_name]` - 応答が遅いときに同じリクエストを送る予備のモデルを設定します。\n"
+        "`  current` - 現在のGeminiモデル名と、予備のモデルへのヘッジの状況を表示します。\n"
         "`  list` - 利用可能なGeminiモデルの一覧を表示します。\n"
     ), inline=False)
     
@@ -0,0 +1,808 @@
+"""
+Google Drive v3 エミュレータ (インメモリ)
+
+bot.py が使う Drive API のサブセットをローカルで再現し、10万ファイル規模での
+一覧・検索の挙動やクエリ数を Drive のクォータを消費せずに確認するためのもの。
+
+- googleapiclient 互換のサービスオブジェクト (DriveEmulator) として
+  bot.gdrive_service に直接差し込める
+- 小さな HTTP サーバー (REST /drive/v3/...) としても起動できる
+- q 文法: and / or / not / 括弧, 'ID' in parents, name = / != / contains,
+  mimeType = / !=, trashed = true/false, createdTime / modifiedTime の比較
+- ページネーション (pageSize, pageToken), fields による射影, orderBy,
+  new_batch_http_request() によるバッチ実行
+- シード固定のデータ生成 (generate_archive) と呼び出し回数の集計 (stats)
+
+使い方:
+    python gdrive_emulator.py serve --port 8765 --files 100000 --months 60
+    python gdrive_emulator.py stats --files 100000 --months 60
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import random
+import re
+import threading
+import urllib.parse
+from email.parser import BytesParser
+from email.policy import HTTP as HTTP_POLICY
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    from googleapiclient.errors import HttpError as _GoogleHttpError
+    import httplib2
+    google_errors_available = True
+except ImportError:
+    google_errors_available = False
+
+FOLDER_MIME = "application/vnd.google-apps.folder"
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_BATCH_SIZE = 100
+DEFAULT_LIST_FIELDS = "kind, nextPageToken, incompleteSearch, files(kind, id, name, mimeType)"
+DEFAULT_GET_FIELDS = "kind, id, name, mimeType"
+
+
+class DriveEmulatorError(Exception):
+    """ googleapiclient が無い環境で HttpError の代わりに送出する """
+    def __init__(self, status: int, message: str):
+        super().__init__(f"<HttpError {status}: {message}>")
+        self.status = status
+        self.message = message
+
+
+def _http_error(status: int, message: str) -> Exception:
+    if google_errors_available:
+        resp = httplib2.Response({"status": status})
+        body = json.dumps({"error": {"code": status, "message": message}}).encode("utf-8")
+        return _GoogleHttpError(resp, body)
+    return DriveEmulatorError(status, message)
+
+
+# --- q 文法 ---
+_TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<string>'(?:\\.|[^'\\])*')
+      | (?P<op><=|>=|!=|=|<|>)
+      | (?P<lparen>\()
+      | (?P<rparen>\))
+      | (?P<word>[A-Za-z_][A-Za-z0-9_.]*)
+      | (?P<number>-?\d+(?:\.\d+)?)
+    )""", re.VERBOSE)
+
+_QUERY_FIELDS = {"name", "mimeType", "trashed", "createdTime", "modifiedTime", "starred", "fullText"}
+
+
+def _tokenize(q: str) -> list[tuple[str, str]]:
+    tokens = []
+    pos = 0
+    q = q.rstrip()
+    while pos < len(q):
+        m = _TOKEN_RE.match(q, pos)
+        if not m or m.end() == pos:
+            raise _http_error(400, f"Invalid Value: q (unexpected character at {pos}: {q[pos:pos + 10]!r})")
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == "string":
+            value = re.sub(r"\\(.)", r"\1", value[1:-1])
+        elif kind == "word" and value.lower() in ("and", "or", "not", "in", "contains", "true", "false", "has"):
+            kind, value = value.lower(), value.lower()
+        tokens.append((kind, value))
+        pos = m.end()
+    return tokens
+
+
+class _Query:
+    """ q をパースした結果。predicate と、インデックスで絞り込める親フォルダIDを持つ """
+    def __init__(self, predicate, parent_ids: set[str] | None, fingerprint: str):
+        self.predicate = predicate
+        self.parent_ids = parent_ids
+        self.fingerprint = fingerprint
+
+
+class _QueryParser:
+    def __init__(self, q: str, strict_contains: bool):
+        self.tokens = _tokenize(q)
+        self.pos = 0
+        self.strict_contains = strict_contains
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def _take(self, kind=None):
+        tok = self._peek()
+        if tok[0] is None or (kind and tok[0] != kind):
+            raise _http_error(400, f"Invalid Value: q (expected {kind or 'token'}, got {tok[1]!r})")
+        self.pos += 1
+        return tok
+
+    def parse(self):
+        if not self.tokens:
+            return (lambda item: True), None
+        node = self._expr()
+        if self.pos != len(self.tokens):
+            raise _http_error(400, f"Invalid Value: q (trailing token {self._peek()[1]!r})")
+        return node
+
+    # 各ノードは (predicate, parent_ids) を返す。parent_ids は「この条件を満たす項目は必ずこの親のどれかに属する」集合
+    def _expr(self):
+        pred, parents = self._term()
+        preds = [pred]
+        parent_sets = [parents]
+        while self._peek()[0] == "or":
+            self._take("or")
+            p, ps = self._term()
+            preds.append(p)
+            parent_sets.append(ps)
+        if len(preds) == 1:
+            return pred, parents
+        union = None if any(ps is None for ps in parent_sets) else set().union(*parent_sets)
+        return (lambda item, preds=preds: any(p(item) for p in preds)), union
+
+    def _term(self):
+        pred, parents = self._factor()
+        preds = [pred]
+        narrowed = parents
+        while self._peek()[0] == "and":
+            self._take("and")
+            p, ps = self._factor()
+            preds.append(p)
+            if ps is not None:
+                narrowed = ps if narrowed is None else (narrowed & ps)
+        if len(preds) == 1:
+            return pred, parents
+        return (lambda item, preds=preds: all(p(item) for p in preds)), narrowed
+
+    def _factor(self):
+        kind, _ = self._peek()
+        if kind == "not":
+            self._take("not")
+            pred, _ = self._factor()
+            return (lambda item, pred=pred: not pred(item)), None
+        if kind == "lparen":
+            self._take("lparen")
+            node = self._expr()
+            self._take("rparen")
+            return node
+        return self._comparison()
+
+    def _comparison(self):
+        kind, value = self._peek()
+        if kind == "string":
+            self._take("string")
+            self._take("in")
+            _, collection = self._take("word")
+            if collection == "parents":
+                return (lambda item, v=value: v in item["parents"]), {value}
+            if collection in ("owners", "writers", "readers"):
+                return (lambda item: True), None
+            raise _http_error(400, f"Invalid Value: q (unsupported collection {collection!r})")
+
+        _, field = self._take("word")
+        if field not in _QUERY_FIELDS:
+            raise _http_error(400, f"Invalid Value: q (unsupported field {field!r})")
+        op_kind, op = self._peek()
+        if op_kind == "contains":
+            self._take("contains")
+            _, needle = self._take("string")
+            return self._contains(field, needle), None
+        if op_kind != "op":
+            raise _http_error(400, f"Invalid Value: q (expected operator after {field})")
+        self._take("op")
+        v_kind, v = self._take()
+        if v_kind in ("true", "false"):
+            v = v_kind == "true"
+        elif v_kind == "number":
+            v = float(v)
+        elif v_kind != "string":
+            raise _http_error(400, f"Invalid Value: q (bad literal {v!r})")
+        return self._compare(field, op, v), None
+
+    def _contains(self, field: str, needle: str):
+        needle_l = needle.lower()
+        if field == "fullText" or self.strict_contains:
+            key = "name" if field == "fullText" else field
+            return lambda item: needle_l in str(item.get(key, "")).lower()
+        if field == "name":
+            # 実際の Drive と同様、name contains は語 (区切り文字で分割) の前方一致
+            return lambda item: any(item["name"].lower().startswith(needle_l, s) for s in _term_starts(item["name"].lower()))
+        return lambda item: needle_l in str(item.get(field, "")).lower()
+
+    def _compare(self, field: str, op: str, value):
+        if field in ("createdTime", "modifiedTime") and isinstance(value, str):
+            value = _parse_rfc3339(value)
+            getter = lambda item: _parse_rfc3339(item[field])
+        else:
+            getter = lambda item: item.get(field)
+        ops = {"=": lambda a, b: a == b, "!=": lambda a, b: a != b, "<": lambda a, b: a < b,
+               "<=": lambda a, b: a <= b, ">": lambda a, b: a > b, ">=": lambda a, b: a >= b}
+        fn = ops[op]
+        return lambda item: fn(getter(item), value)
+
+
+def _term_starts(name_l: str) -> list[int]:
+    return [0] + [m.start() for m in re.finditer(r"[^\s_\-.,()\[\]]+", name_l) if m.start()]
+
+
+def _parse_rfc3339(value: str) -> datetime.datetime:
+    dt = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return dt if dt.tzinfo else dt.replace(tzinfo=datetime.timezone.utc)
+
+
+def _rfc3339(dt: datetime.datetime) -> str:
+    return dt.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.") + f"{dt.microsecond // 1000:03d}Z"
+
+
+# --- fields 射影 ---
+def _parse_fields(fields: str) -> dict:
+    """ 'nextPageToken, files(id, name)' -> {'nextPageToken': None, 'files': {'id': None, 'name': None}} """
+    result: dict = {}
+    stack = [result]
+    token = ""
+    for ch in fields + ",":
+        if ch in ",()":
+            name = token.strip()
+            token = ""
+            if ch == "(":
+                child: dict = {}
+                stack[-1][name] = child
+                stack.append(child)
+                continue
+            if name:
+                for part_container, part in _split_path(stack[-1], name):
+                    part_container[part] = None
+            if ch == ")":
+                if len(stack) == 1:
+                    raise _http_error(400, f"Invalid field selection {fields}")
+                stack.pop()
+        else:
+            token += ch
+    if len(stack) != 1:
+        raise _http_error(400, f"Invalid field selection {fields}")
+    return result
+
+
+def _split_path(container: dict, dotted: str):
+    parts = dotted.split("/")
+    for part in parts[:-1]:
+        container = container.setdefault(part, {})
+    yield container, parts[-1]
+
+
+def _project(obj: dict, spec: dict | None) -> dict:
+    if spec is None or "*" in spec:
+        return {k: list(v) if isinstance(v, list) else v for k, v in obj.items()}
+    out = {}
+    for key, sub in spec.items():
+        if key not in obj:
+            continue
+        value = obj[key]
+        if isinstance(sub, dict):
+            if isinstance(value, list):
+                value = [_project(v, sub) for v in value]
+            elif isinstance(value, dict):
+                value = _project(value, sub)
+        elif isinstance(value, list):
+            value = list(value)
+        out[key] = value
+    return out
+
+
+# --- リクエストオブジェクト ---
+class EmulatedRequest:
+    """ googleapiclient.http.HttpRequest 相当。execute() で実行される """
+    def __init__(self, emulator: "DriveEmulator", method_id: str, fn):
+        self._emulator = emulator
+        self.methodId = method_id
+        self._fn = fn
+
+    def execute(self, http=None, num_retries: int = 0):
+        self._emulator._account(self.methodId)
+        with self._emulator._lock:
+            return self._fn()
+
+
+class _MediaResponse(dict):
+    """ httplib2.Response 互換 (MediaIoBaseDownload が参照する status と header 辞書) """
+    def __init__(self, status: int, headers: dict):
+        super().__init__(headers)
+        self.status = status
+        self.reason = "OK" if status < 400 else "Error"
+
+
+class _MediaHttp:
+    def __init__(self, emulator: "DriveEmulator", file_id: str):
+        self._emulator = emulator
+        self._file_id = file_id
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        self._emulator._account("drive.files.get_media.chunk")
+        with self._emulator._lock:
+            item = self._emulator._items.get(self._file_id)
+            if item is None:
+                return _MediaResponse(404, {}), b""
+            content = self._emulator._content.get(self._file_id, b"")
+        total = len(content)
+        rng = (headers or {}).get("range")
+        if rng:
+            m = re.fullmatch(r"bytes=(\d+)-(\d+)", rng)
+            start, end = int(m.group(1)), min(int(m.group(2)), total - 1)
+            if start >= total:
+                return _MediaResponse(416, {"content-range": f"bytes */{total}"}), b""
+            return _MediaResponse(206, {"content-range": f"bytes {start}-{end}/{total}"}), content[start:end + 1]
+        return _MediaResponse(200, {"content-length": str(total)}), content
+
+
+class EmulatedMediaRequest(EmulatedRequest):
+    """ get_media() の戻り値。MediaIoBaseDownload に渡せるよう uri / headers / http を持つ """
+    def __init__(self, emulator: "DriveEmulator", file_id: str):
+        super().__init__(emulator, "drive.files.get_media", lambda: emulator._content.get(file_id, b""))
+        self.uri = f"emulator://drive/v3/files/{file_id}?alt=media"
+        self.headers = {}
+        self.http = _MediaHttp(emulator, file_id)
+
+
+class EmulatedBatch:
+    """ new_batch_http_request() 相当。execute() で登録順に実行しコールバックを呼ぶ """
+    def __init__(self, emulator: "DriveEmulator", callback=None):
+        self._emulator = emulator
+        self._callback = callback
+        self._requests: list[tuple[str, EmulatedRequest, object]] = []
+
+    def add(self, request: EmulatedRequest, callback=None, request_id: str | None = None):
+        if len(self._requests) >= MAX_BATCH_SIZE:
+            raise _http_error(400, f"Batch contains more than {MAX_BATCH_SIZE} requests")
+        request_id = request_id or str(len(self._requests) + 1)
+        if any(rid == request_id for rid, _, _ in self._requests):
+            raise KeyError(f"A request with this ID already exists: {request_id}")
+        self._requests.append((request_id, request, callback))
+
+    def execute(self, http=None):
+        self._emulator._account("drive.batch")
+        for request_id, request, callback in self._requests:
+            response, exception = None, None
+            self._emulator._account(request.methodId, batched=True)
+            try:
+                with self._emulator._lock:
+                    response = request._fn()
+            except Exception as e:
+                exception = e
+            for cb in (callback, self._callback):
+                if cb:
+                    cb(request_id, response, exception)
+
+
+class _FilesResource:
+    def __init__(self, emulator: "DriveEmulator"):
+        self._e = emulator
+
+    def list(self, q: str | None = None, pageSize: int | None = None, pageToken: str | None = None,
+             fields: str | None = None, orderBy: str | None = None, spaces: str | None = None, **kwargs):
+        return EmulatedRequest(self._e, "drive.files.list",
+                               lambda: self._e._list(q, pageSize, pageToken, fields, orderBy))
+
+    def get(self, fileId: str, fields: str | None = None, **kwargs):
+        return EmulatedRequest(self._e, "drive.files.get", lambda: self._e._get(fileId, fields))
+
+    def get_media(self, fileId: str, **kwargs):
+        if fileId not in self._e._items:
+            raise _http_error(404, f"File not found: {fileId}.")
+        return EmulatedMediaRequest(self._e, fileId)
+
+    def create(self, body: dict | None = None, media_body=None, fields: str | None = None, **kwargs):
+        return EmulatedRequest(self._e, "drive.files.create", lambda: self._e._create(body or {}, media_body, fields))
+
+    def update(self, fileId: str, body: dict | None = None, media_body=None, addParents: str | None = None,
+               removeParents: str | None = None, fields: str | None = None, **kwargs):
+        return EmulatedRequest(self._e, "drive.files.update",
+                               lambda: self._e._update(fileId, body or {}, media_body, addParents, removeParents, fields))
+
+    def delete(self, fileId: str, **kwargs):
+        return EmulatedRequest(self._e, "drive.files.delete", lambda: self._e._delete(fileId))
+
+
+class _AboutResource:
+    def __init__(self, emulator: "DriveEmulator"):
+        self._e = emulator
+
+    def get(self, fields: str | None = None, **kwargs):
+        def run():
+            used = sum(len(c) for c in self._e._content.values())
+            about = {"kind": "drive#about", "user": {"displayName": "drive-emulator", "emailAddress": "emulator@localhost"},
+                     "storageQuota": {"usage": str(used), "limit": str(15 * 1024 ** 3)}}
+            return _project(about, _parse_fields(fields) if fields else None)
+        return EmulatedRequest(self._e, "drive.about.get", run)
+
+
+# --- エミュレータ本体 ---
+class DriveEmulator:
+    """
+    googleapiclient の drive v3 サービスと同じ呼び出し形式を持つインメモリ Drive。
+    on_call に関数を渡すと API 呼び出しごとに on_call(method_id) が呼ばれる (遅延・エラー注入用)。
+    strict_contains=True にすると name contains を単純な部分一致として扱う。
+    """
+    def __init__(self, on_call=None, strict_contains: bool = False, seed: int = 0):
+        self._lock = threading.RLock()
+        self._items: dict[str, dict] = {}
+        self._content: dict[str, bytes] = {}
+        self._children: dict[str, dict[str, None]] = {}
+        self._seq = 0
+        self._rng = random.Random(seed)
+        self._clock = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        self.on_call = on_call
+        self.strict_contains = strict_contains
+        self.stats: dict[str, int] = {}
+        self.items_scanned = 0
+        self.root_id = self.add_folder("emulator-root", None)["id"]
+
+    # --- 集計 ---
+    def _account(self, method_id: str, batched: bool = False):
+        with self._lock:
+            key = f"{method_id} (batched)" if batched else method_id
+            self.stats[key] = self.stats.get(key, 0) + 1
+        if self.on_call and not batched:
+            self.on_call(method_id)
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats.clear()
+            self.items_scanned = 0
+
+    def snapshot_stats(self) -> dict:
+        with self._lock:
+            return {"calls": dict(self.stats), "items_scanned": self.items_scanned, "items": len(self._items)}
+
+    # --- サービスオブジェクト API ---
+    def files(self):
+        return _FilesResource(self)
+
+    def about(self):
+        return _AboutResource(self)
+
+    def new_batch_http_request(self, callback=None):
+        return EmulatedBatch(self, callback)
+
+    # --- 直接操作 (データ生成用、呼び出し回数に数えない) ---
+    def _new_id(self) -> str:
+        self._seq += 1
+        digest = hashlib.sha1(f"{self._seq}".encode()).hexdigest()
+        return f"emu{self._seq:08d}{digest[:22]}"
+
+    def _tick(self, created: datetime.datetime | None) -> datetime.datetime:
+        if created:
+            return created
+        self._clock += datetime.timedelta(seconds=1)
+        return self._clock
+
+    def _insert(self, name: str, parent_id: str | None, mime_type: str, content: bytes,
+                created: datetime.datetime | None = None) -> dict:
+        with self._lock:
+            if parent_id and parent_id not in self._items:
+                raise _http_error(404, f"File not found: {parent_id}.")
+            file_id = self._new_id()
+            ts = _rfc3339(self._tick(created))
+            item = {"kind": "drive#file", "id": file_id, "name": name, "mimeType": mime_type,
+                    "parents": [parent_id] if parent_id else [], "trashed": False,
+                    "createdTime": ts, "modifiedTime": ts,
+                    "webViewLink": f"https://drive.google.com/file/d/{file_id}/view"}
+            if mime_type != FOLDER_MIME:
+                item["size"] = str(len(content))
+                item["md5Checksum"] = hashlib.md5(content).hexdigest()
+                item["thumbnailLink"] = f"https://lh3.googleusercontent.com/emulator/{file_id}=s220"
+                self._content[file_id] = content
+            self._items[file_id] = item
+            self._children.setdefault(file_id, {})
+            if parent_id:
+                self._children.setdefault(parent_id, {})[file_id] = None
+            return item
+
+    def add_folder(self, name: str, parent_id: str | None, created: datetime.datetime | None = None) -> dict:
+        return self._insert(name, parent_id, FOLDER_MIME, b"", created)
+
+    def add_file(self, name: str, parent_id: str, content: bytes = b"", mime_type: str = "application/octet-stream",
+                 created: datetime.datetime | None = None) -> dict:
+        return self._insert(name, parent_id, mime_type, content, created)
+
+    # --- API 実装 ---
+    def _compile(self, q: str | None) -> _Query:
+        predicate, parents = _QueryParser(q or "", self.strict_contains).parse()
+        return _Query(predicate, parents, hashlib.sha1((q or "").encode("utf-8")).hexdigest()[:12])
+
+    def _candidates(self, query: _Query):
+        if query.parent_ids is None:
+            return self._items.values()
+        out = []
+        for pid in query.parent_ids:
+            out.extend(self._items[cid] for cid in self._children.get(pid, ()))
+        return out
+
+    def _list(self, q, page_size, page_token, fields, order_by) -> dict:
+        query = self._compile(q)
+        page_size = DEFAULT_PAGE_SIZE if page_size is None else int(page_size)
+        if not 1 <= page_size <= MAX_PAGE_SIZE:
+            raise _http_error(400, f"Invalid value for pageSize: {page_size}")
+        offset = 0
+        if page_token:
+            try:
+                fp, offset_s = page_token.split(":", 1)
+                offset = int(offset_s)
+            except ValueError:
+                raise _http_error(400, f"Invalid Value: pageToken")
+            if fp != query.fingerprint:
+                raise _http_error(400, "Invalid Value: pageToken (query changed between pages)")
+
+        candidates = self._candidates(query)
+        matched = []
+        scanned = 0
+        for item in candidates:
+            scanned += 1
+            if query.predicate(item):
+                matched.append(item)
+        self.items_scanned += scanned
+        if order_by:
+            for key in reversed([k.strip() for k in order_by.split(",") if k.strip()]):
+                field, _, direction = key.partition(" ")
+                if field == "folder":
+                    sort_key = lambda it: it["mimeType"] != FOLDER_MIME
+                elif field == "name_natural":
+                    sort_key = lambda it: it["name"].lower()
+                else:
+                    sort_key = lambda it, f=field: it.get(f) or ""
+                matched.sort(key=sort_key, reverse=direction.strip().lower() == "desc")
+
+        page = matched[offset:offset + page_size]
+        response = {"kind": "drive#fileList", "incompleteSearch": False, "files": page}
+        if offset + page_size < len(matched):
+            response["nextPageToken"] = f"{query.fingerprint}:{offset + page_size}"
+        return _project(response, _parse_fields(fields or DEFAULT_LIST_FIELDS))
+
+    def _require(self, file_id: str) -> dict:
+        item = self._items.get(file_id)
+        if item is None:
+            raise _http_error(404, f"File not found: {file_id}.")
+        return item
+
+    def _get(self, file_id, fields) -> dict:
+        return _project(self._require(file_id), _parse_fields(fields or DEFAULT_GET_FIELDS))
+
+    @staticmethod
+    def _media_bytes(media_body) -> tuple[bytes, str | None]:
+        if media_body is None:
+            return b"", None
+        if isinstance(media_body, (bytes, bytearray)):
+            return bytes(media_body), None
+        size = media_body.size()
+        data = media_body.getbytes(0, size) if size else b""
+        return data, media_body.mimetype()
+
+    def _create(self, body: dict, media_body, fields) -> dict:
+        content, media_mime = self._media_bytes(media_body)
+        parents = body.get("parents") or [self.root_id]
+        mime_type = body.get("mimeType") or media_mime or "application/octet-stream"
+        item = self._insert(body.get("name", "Untitled"), parents[0], mime_type, content)
+        if body.get("description"):
+            item["description"] = body["description"]
+        return _project(item, _parse_fields(fields or DEFAULT_GET_FIELDS))
+
+    def _update(self, file_id, body: dict, media_body, add_parents, remove_parents, fields) -> dict:
+        item = self._require(file_id)
+        for key in ("name", "description", "trashed", "starred"):
+            if key in body:
+                item[key] = body[key]
+        if media_body is not None:
+            content, _ = self._media_bytes(media_body)
+            self._content[file_id] = content
+            item["size"] = str(len(content))
+            item["md5Checksum"] = hashlib.md5(content).hexdigest()
+        for pid in (remove_parents or "").split(","):
+            if pid and pid in item["parents"]:
+                item["parents"].remove(pid)
+                self._children.get(pid, {}).pop(file_id, None)
+        for pid in (add_parents or "").split(","):
+            if pid and pid not in item["parents"]:
+                self._require(pid)
+                item["parents"].append(pid)
+                self._children.setdefault(pid, {})[file_id] = None
+        item["modifiedTime"] = _rfc3339(self._tick(None))
+        return _project(item, _parse_fields(fields or DEFAULT_GET_FIELDS))
+
+    def _delete(self, file_id) -> str:
+        item = self._require(file_id)
+        for child_id in list(self._children.get(file_id, ())):
+            self._delete(child_id)
+        for pid in item["parents"]:
+            self._children.get(pid, {}).pop(file_id, None)
+        self._items.pop(file_id, None)
+        self._content.pop(file_id, None)
+        self._children.pop(file_id, None)
+        return ""
+
+
+# --- シード固定のデータ生成 ---
+TAG_POOL = ["風景", "猫", "犬", "空", "海", "山", "夜景", "料理", "花", "人物", "建物", "車", "ゲーム", "イラスト",
+            "桜", "紅葉", "雪", "祭り", "電車", "スクリーンショット"]
+
+
+def month_names(months: int, start: str = "202001") -> list[str]:
+    base = int(start[:4]) * 12 + int(start[4:]) - 1
+    return [f"{(base + i) // 12}{(base + i) % 12 + 1:02d}" for i in range(months)]
+
+
+def generate_archive(emulator: DriveEmulator, files: int, months: int, seed: int = 0,
+                     parent_id: str | None = None, notags_ratio: float = 0.05, video_ratio: float = 0.1) -> dict:
+    """
+    bot.py の命名規則 (YYYYMMDD_タグ_元ファイル名.ext) に従うファイルを年月フォルダに生成する。
+    戻り値: {'root_id': ..., 'months': {'YYYYMM': folder_id}, 'files': 生成数}
+    """
+    rng = random.Random(seed)
+    root_id = parent_id or emulator.root_id
+    folders = {}
+    names = month_names(months)
+    per_month, extra = divmod(files, max(1, months))
+    total = 0
+    for index, ym in enumerate(names):
+        year, month = int(ym[:4]), int(ym[4:])
+        folder_id = emulator.add_folder(ym, root_id, created=datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc))["id"]
+        folders[ym] = folder_id
+        for n in range(per_month + (1 if index < extra else 0)):
+            day = rng.randrange(1, 29)
+            is_video = rng.random() < video_ratio
+            tags = "notags" if rng.random() < notags_ratio else "_".join(rng.sample(TAG_POOL, rng.randrange(2, 6)))
+            ext, mime = (".mp4", "video/mp4") if is_video else rng.choice([(".jpg", "image/jpeg"), (".png", "image/png")])
+            name = f"{ym}{day:02d}_{tags}_{'clip' if is_video else 'photo'}{n:05d}{ext}"
+            size = rng.randrange(5_000_000, 80_000_000) if is_video else rng.randrange(50_000, 6_000_000)
+            created = datetime.datetime(year, month, day, rng.randrange(24), rng.randrange(60), tzinfo=datetime.timezone.utc)
+            item = emulator.add_file(name, folder_id, b"", mime, created=created)
+            item["size"] = str(size) # 中身は持たずサイズだけ現実的な値にする
+            total += 1
+    return {"root_id": root_id, "months": folders, "files": total}
+
+
+# --- HTTP サーバー ---
+class _Handler(BaseHTTPRequestHandler):
+    emulator: DriveEmulator = None
+    server_version = "DriveEmulator/1.0"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _send_json(self, status: int, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, e: Exception):
+        status = getattr(getattr(e, "resp", None), "status", None) or getattr(e, "status", 500)
+        self._send_json(int(status), {"error": {"code": int(status), "message": str(e)}})
+
+    def _route(self):
+        parsed = urllib.parse.urlparse(self.path)
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(parsed.query).items()}
+        return parsed.path.rstrip("/"), params
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        path, p = self._route()
+        e = self.emulator
+        try:
+            if path == "/_emulator/stats":
+                return self._send_json(200, e.snapshot_stats())
+            if path == "/drive/v3/about":
+                return self._send_json(200, e.about().get(fields=p.get("fields")).execute())
+            if path == "/drive/v3/files":
+                page_size = int(p["pageSize"]) if "pageSize" in p else None
+                return self._send_json(200, e.files().list(q=p.get("q"), pageSize=page_size, pageToken=p.get("pageToken"),
+                                                           fields=p.get("fields"), orderBy=p.get("orderBy")).execute())
+            m = re.fullmatch(r"/drive/v3/files/([^/]+)", path)
+            if m:
+                file_id = urllib.parse.unquote(m.group(1))
+                if p.get("alt") == "media":
+                    data = e.files().get_media(fileId=file_id).execute()
+                    self.send_response(200)
+                    self.send_header("Content-Type", e._items[file_id]["mimeType"])
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    return
+                return self._send_json(200, e.files().get(fileId=file_id, fields=p.get("fields")).execute())
+            self._send_json(404, {"error": {"code": 404, "message": f"Not Found: {path}"}})
+        except Exception as ex:
+            self._send_error(ex)
+
+    def do_POST(self):
+        path, p = self._route()
+        e = self.emulator
+        try:
+            body = self._read_body()
+            if path == "/_emulator/reset":
+                e.reset_stats()
+                return self._send_json(200, {"ok": True})
+            if path == "/drive/v3/files":
+                metadata = json.loads(body or b"{}")
+                return self._send_json(200, e.files().create(body=metadata, fields=p.get("fields")).execute())
+            if path == "/upload/drive/v3/files":
+                metadata, content, mime = self._parse_upload(body, p.get("uploadType", "media"))
+                metadata.setdefault("mimeType", mime)
+                return self._send_json(200, e.files().create(body=metadata, media_body=content, fields=p.get("fields")).execute())
+            self._send_json(404, {"error": {"code": 404, "message": f"Not Found: {path}"}})
+        except Exception as ex:
+            self._send_error(ex)
+
+    def _parse_upload(self, body: bytes, upload_type: str) -> tuple[dict, bytes, str]:
+        content_type = self.headers.get("Content-Type", "application/octet-stream")
+        if upload_type != "multipart":
+            return {}, body, content_type
+        msg = BytesParser(policy=HTTP_POLICY).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        parts = list(msg.iter_parts())
+        metadata = json.loads(parts[0].get_content()) if parts else {}
+        media = parts[1].get_payload(decode=True) if len(parts) > 1 else b""
+        return metadata, media, parts[1].get_content_type() if len(parts) > 1 else "application/octet-stream"
+
+    def do_PATCH(self):
+        path, p = self._route()
+        m = re.fullmatch(r"/drive/v3/files/([^/]+)", path)
+        try:
+            if not m:
+                return self._send_json(404, {"error": {"code": 404, "message": f"Not Found: {path}"}})
+            metadata = json.loads(self._read_body() or b"{}")
+            self._send_json(200, self.emulator.files().update(
+                fileId=urllib.parse.unquote(m.group(1)), body=metadata, addParents=p.get("addParents"),
+                removeParents=p.get("removeParents"), fields=p.get("fields")).execute())
+        except Exception as ex:
+            self._send_error(ex)
+
+    def do_DELETE(self):
+        path, _ = self._route()
+        m = re.fullmatch(r"/drive/v3/files/([^/]+)", path)
+        try:
+            if not m:
+                return self._send_json(404, {"error": {"code": 404, "message": f"Not Found: {path}"}})
+            self.emulator.files().delete(fileId=urllib.parse.unquote(m.group(1))).execute()
+            self.send_response(204)
+            self.end_headers()
+        except Exception as ex:
+            self._send_error(ex)
+
+
+def make_http_server(emulator: DriveEmulator, host: str = "127.0.0.1", port: int = 8765) -> ThreadingHTTPServer:
+    handler = type("DriveEmulatorHandler", (_Handler,), {"emulator": emulator})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Google Drive v3 エミュレータ")
+    p.add_argument("command", choices=("serve", "stats"))
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--files", type=int, default=100000)
+    p.add_argument("--months", type=int, default=60)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--strict-contains", action="store_true", help="name contains を単純な部分一致にする")
+    args = p.parse_args(argv)
+
+    emulator = DriveEmulator(strict_contains=args.strict_contains, seed=args.seed)
+    info = generate_archive(emulator, args.files, args.months, seed=args.seed)
+    print(f"ルートフォルダID: {info['root_id']} (年月フォルダ {len(info['months'])} 件, ファイル {info['files']} 件)")
+
+    if args.command == "stats":
+        print(json.dumps(emulator.snapshot_stats(), ensure_ascii=False, indent=2))
+        return
+    server = make_http_server(emulator, args.host, args.port)
+    print(f"Drive エミュレータを http://{args.host}:{args.port}/drive/v3/ で起動しました。(Ctrl+C で終了)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()